@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Convert a sensors history database between storage layouts.
+
+Reads every sample from the source database and writes it to a new database
+using the target layout (see sensors_storage.py). The source database is not
+modified; stop sensormon before migrating, then point db_path (and db_layout)
+to the new database.
+
+Usage:
+    python migrate_sensors_db.py sensors.sqlite sensors_narrow.sqlite            # wide -> narrow
+    python migrate_sensors_db.py --to wide sensors_narrow.sqlite sensors.sqlite  # narrow -> wide
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+from sensors_chunks import copy_chunks
+from sensors_storage import build_storage, detect_storage_layout, dump_sensor
+
+# Samples written per transaction
+_BATCH_SZ = 10000
+
+
+def migrate(src_path, dst_path, dst_layout):
+    """ Copy all samples in src_path to a new database in dst_path, with layout dst_layout. Returns the number of
+    samples copied. """
+    with sqlite3.connect(src_path) as src_conn:
+        src_layout = detect_storage_layout(src_conn)
+    if src_layout is None:
+        raise ValueError(f"{src_path} has no sensor data")
+    src = build_storage(src_layout)
+    dst = build_storage(dst_layout)
+
+    src_conn = sqlite3.connect(src_path)
+    dst_conn = sqlite3.connect(dst_path, isolation_level=None)
+    try:
+        dst_conn.execute('PRAGMA journal_mode=WAL')
+        dst.migrate(dst_conn)
+        copied = 0
+        for sensor_name in src.known_sensors(src_conn):
+            dst_conn.execute('BEGIN')
+            dst.ensure_schema(dst_conn, sensor_name, src.sensor_metrics(src_conn, sensor_name))
+            n = 0
+            for sample_time, values in dump_sensor(src, src_conn, sensor_name):
+                if values:
+                    dst.insert(dst_conn, sensor_name, sample_time, values)
+                    n += 1
+                    if n % _BATCH_SZ == 0:
+                        dst_conn.execute('COMMIT')
+                        dst_conn.execute('BEGIN')
+            dst_conn.execute('COMMIT')
+            print(f"{sensor_name}: {n} samples")
+            copied += n
+
+        # Compressed chunks don't depend on the layout, they are copied as they are
+        dst_conn.execute('BEGIN')
+        chunks = copy_chunks(src_conn, dst_conn)
+        dst_conn.execute('COMMIT')
+        if chunks > 0:
+            print(f"{chunks} compressed chunks")
+        return copied
+    finally:
+        src_conn.close()
+        dst_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a sensors history database between storage layouts")
+    parser.add_argument('src', help="Existing sensors database")
+    parser.add_argument('dst', help="New database to create")
+    parser.add_argument('--to', choices=['wide', 'narrow'], default='narrow', help="Layout of the new database")
+    args = parser.parse_args()
+
+    if os.path.exists(args.dst):
+        print(f"{args.dst} already exists, refusing to overwrite it", file=sys.stderr)
+        return 1
+    copied = migrate(args.src, args.dst, args.to)
+    print(f"Copied {copied} samples to {args.dst} ({args.to} layout)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
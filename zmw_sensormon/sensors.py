@@ -1,183 +1,270 @@
 """ Keeps a historical database of sensor readings """
 
 from apscheduler.triggers.cron import CronTrigger
+from datetime import datetime, timedelta, timezone
+from flask import Response, abort, request
+import itertools
+import queue
 import sqlite3
 import logging
-import re
+import threading
+import time
+
+from sensors_aggregate import align_buckets, bucket_series, validate_aggregations, validate_bucket_secs
+from sensors_archive import SensorArchive
+from sensors_backfill import DerivedMetricsBackfill
+from sensors_cache import SensorsCache
+from sensors_chunks import SensorChunks
+from sensors_downsample import downsample_rows, resolution_for_max_points
+from sensors_filter import WriteFilter
+from sensors_formats import FORMAT_MIMETYPES, encode_rows, gzip_stream, to_csv
+from sensors_live import LiveReadings
+from sensors_rolling import DEFAULT_EWMA_TAU_SECS, DEFAULT_WINDOWS_SECS, RollingStats
+from sensors_rollups import EXTREMES, ROLLUP_AGGREGATIONS, ROLLUP_TIERS, SensorRollups, time_range_secs
+from sensors_storage import build_storage, detect_storage_layout, since_modifier, validate_sql_identifier
 log = logging.getLogger(__name__)
 
-# SQL injection protection: Valid identifier pattern (alphanumeric + underscore, can't start with digit)
-_SQL_IDENTIFIER_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
-_MAX_IDENTIFIER_LENGTH = 128
-
-# SQLite reserved keywords that should not be used as identifiers
-_SQLITE_KEYWORDS = {
-    'abort', 'action', 'add', 'after', 'all', 'alter', 'analyze', 'and', 'as', 'asc',
-    'attach', 'autoincrement', 'before', 'begin', 'between', 'by', 'cascade', 'case',
-    'cast', 'check', 'collate', 'column', 'commit', 'conflict', 'constraint', 'create',
-    'cross', 'current_date', 'current_time', 'current_timestamp', 'database', 'default',
-    'deferrable', 'deferred', 'delete', 'desc', 'detach', 'distinct', 'drop', 'each',
-    'else', 'end', 'escape', 'except', 'exclusive', 'exists', 'explain', 'fail', 'for',
-    'foreign', 'from', 'full', 'glob', 'group', 'having', 'if', 'ignore', 'immediate',
-    'in', 'index', 'indexed', 'initially', 'inner', 'insert', 'instead', 'intersect',
-    'into', 'is', 'isnull', 'join', 'key', 'left', 'like', 'limit', 'match', 'natural',
-    'no', 'not', 'notnull', 'null', 'of', 'offset', 'on', 'or', 'order', 'outer', 'plan',
-    'pragma', 'primary', 'query', 'raise', 'recursive', 'references', 'regexp', 'reindex',
-    'release', 'rename', 'replace', 'restrict', 'right', 'rollback', 'row', 'savepoint',
-    'select', 'set', 'table', 'temp', 'temporary', 'then', 'to', 'transaction', 'trigger',
-    'union', 'unique', 'update', 'using', 'vacuum', 'values', 'view', 'virtual', 'when',
-    'where', 'with', 'without'
-}
-
-def _validate_sql_identifier(identifier, identifier_type="identifier"):
-    """
-    Validates that an identifier (table/column name) is safe to use in SQL queries.
-
-    This prevents SQL injection by ensuring identifiers only contain safe characters.
-    Since SQLite doesn't support parameterized table/column names, we must validate them.
-
-    Args:
-        identifier: The identifier to validate (table name, column name, etc.)
-        identifier_type: Description of what this identifier represents (for error messages)
-
-    Raises:
-        ValueError: If the identifier is invalid or potentially unsafe
-    """
-    if not identifier or not isinstance(identifier, str):
-        raise ValueError(f"Invalid {identifier_type}: must be a non-empty string")
-
-    if len(identifier) > _MAX_IDENTIFIER_LENGTH:
-        raise ValueError(
-            f"Invalid {identifier_type} '{identifier}': exceeds maximum length of {_MAX_IDENTIFIER_LENGTH}")
-
-    if not _SQL_IDENTIFIER_PATTERN.match(identifier):
-        raise ValueError(
-            f"Invalid {identifier_type} '{identifier}': must contain only alphanumeric characters "
-            f"and underscores, and cannot start with a digit")
-
-    if identifier.lower() in _SQLITE_KEYWORDS:
-        raise ValueError(
-            f"Invalid {identifier_type} '{identifier}': cannot use SQLite reserved keyword")
-
-    return identifier
-
-def _validate_time_unit(unit):
-    """Validates time units used in SQLite datetime() function to prevent injection."""
-    valid_units = {'years', 'months', 'days', 'hours', 'minutes', 'seconds'}
-    if unit not in valid_units:
-        raise ValueError(f"Invalid time unit '{unit}': must be one of {valid_units}")
-    return unit
-
-
-def _maybe_create_table(conn, sensor_name, metrics):
-    # Validate all identifiers to prevent SQL injection
-    sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-    validated_metrics = [_validate_sql_identifier(m, "metric name") for m in metrics]
-
-    metric_cols = ' REAL, '.join(validated_metrics)
-    conn.execute(
-        f'CREATE TABLE IF NOT EXISTS {sensor_name} ('
-        '   sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, '
-        f'  {metric_cols} REAL'
-        ')')
 
-    # Add any missing columns to existing tables
-    _add_missing_columns(conn, sensor_name, validated_metrics)
+def _to_csv_downsampled(header, rows, max_points):
+    if header is None:
+        return ''
+    if max_points is not None:
+        rows = downsample_rows(header, rows, max_points)
+    return to_csv(header, rows)
 
 
-def _add_missing_columns(conn, sensor_name, metrics):
-    """Add any columns that exist in metrics but not in the table."""
-    res = conn.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{sensor_name}')")
-    existing_columns = {row[0] for row in res.fetchall()}
+def _now_sample_time():
+    """ Current time, in the same format sqlite uses for CURRENT_TIMESTAMP """
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
 
-    for metric in metrics:
-        if metric not in existing_columns:
-            log.info("Adding missing column '%s' to table '%s'", metric, sensor_name)
-            conn.execute(f'ALTER TABLE {sensor_name} ADD COLUMN {metric} REAL')
 
+class _SensorsDbWriter:
+    """ Owns the only writable connection to the sensors database. Readings are queued by the caller (usually an MQTT
+    callback) and written from a dedicated thread, in batches: a batch is committed when it has batch_max_rows rows,
+    or batch_max_delay_ms after its first row arrived, whatever happens first. The storage layout caches known
+    schemas, so schema checks only hit the db when a sensor reports a metric we haven't seen before.
 
-def _discard_old_samples_by_retention_count(conn, sensor_name, retention_rows):
-    if retention_rows is None or retention_rows <= 0:
-        return
+    Other db maintenance (schema changes, retention) should also go through this writer, via run_sync or
+    run_async, so there is a single writer and readers never block ingestion.
 
-    # Validate sensor name to prevent SQL injection
-    sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-    retention_rows = int(retention_rows)
-
-    conn.execute(
-        f'DELETE FROM {sensor_name} '
-        f'WHERE '
-        f'  rowid NOT IN ('
-        f'    SELECT ROWID FROM {sensor_name} '
-        f'    ORDER BY sample_time DESC '
-        f'    LIMIT {retention_rows} '
-        f'  )'
-    )
-
-
-def _discard_old_samples_by_retention_days(conn, sensor_name, retention_days):
-    if retention_days is None:
-        return
-
-    # Validate sensor name to prevent SQL injection
-    sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-    retention_days = int(retention_days)
-
-    conn.execute(
-        f"DELETE FROM {sensor_name} "
-        f"WHERE sample_time < datetime('now', '-{retention_days} days')"
-    )
-
-
-def _get_known_sensors(conn):
-    res = conn.execute(
-        "SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()
-    # unpack, so we return as a vector instead of a vec of tuples
-    return [x for (x,) in res]
-
-
-def _discard_old_samples_by_retention_days_all_tables(conn, retention_days):
-    for sensor_name in _get_known_sensors(conn):
-        _discard_old_samples_by_retention_days(conn, sensor_name, retention_days)
-
-
-def _discard_old_samples_by_retention_count_all_tables(conn, retention_days):
-    for sensor_name in _get_known_sensors(conn):
-        _discard_old_samples_by_retention_count(conn, sensor_name, retention_days)
-
-
-def _get_sensor_metrics(conn, sensor_name):
-    # Validate sensor name to prevent SQL injection
-    sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-
-    res = conn.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{sensor_name}')")
-    # unpack, so we return as a vector instead of a vec of tuples
-    # also remove the special metric "sample_time"
-    return [metric for (metric,) in res.fetchall() if metric != 'sample_time']
-
-
-def _get_known_metrics(conn):
-    sensors = _get_known_sensors(conn)
-    known_metrics = set()
-    for s in sensors:
-        for m in _get_sensor_metrics(conn, s):
-            known_metrics.add(m)
-    return known_metrics
-
-
-def _sensors_with_metric(conn, metric):
-    all_sensors = []
-    for sensor_name in _get_known_sensors(conn):
-        if metric in _get_sensor_metrics(conn, sensor_name):
-            all_sensors.append(sensor_name)
-    return all_sensors
+    Batch hooks, fn(conn, readings), are called with all readings of a batch, as a list of
+    (sensor_name, sample_time, values_dict), before the batch is committed. Readings are usually stored and passed to
+    the hooks, but either can be skipped: eg a write filter may store only some readings, while the hooks still need
+    to see all of them. """
 
+    def __init__(self, dbpath, storage, batch_max_rows=200, batch_max_delay_ms=500):
+        self._dbpath = dbpath
+        self._storage = storage
+        self._batch_hooks = []
+        self._batch_max_rows = batch_max_rows
+        self._batch_max_delay_secs = batch_max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._stop_requested = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "rows_written": 0,
+            "write_errors": 0,
+            "commits": 0,
+            "batch_rows_last": 0,
+            "batch_rows_max": 0,
+            "commit_latency_last_ms": None,
+            "commit_latency_max_ms": 0.0,
+            "commit_latency_total_ms": 0.0,
+        }
+
+        self._conn = sqlite3.connect(self._dbpath, isolation_level=None, check_same_thread=False)
+        # WAL lets readers run concurrently with the writer; synchronous=NORMAL only fsyncs on checkpoints, which is
+        # safe in WAL mode (a power loss may drop the last commits, but won't corrupt the db)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._storage.migrate(self._conn)
+
+        self._thread = threading.Thread(target=self._run, name="SensorsDbWriter", daemon=True)
+        self._thread.start()
+
+    def save_reading(self, sensor_name, sample_time, values_dict, batch_hooks=True):
+        """ Queue a reading to be written, and passed to the batch hooks if batch_hooks is set. Identifiers must be
+        validated by the caller. """
+        self._queue.put(('reading' if batch_hooks else 'store', sensor_name, sample_time, values_dict))
+
+    def observe_reading(self, sensor_name, sample_time, values_dict):
+        """ Queue a reading to be passed to the batch hooks, without storing it """
+        self._queue.put(('observe', sensor_name, sample_time, values_dict))
+
+    def add_batch_hook(self, fn):
+        """ Call fn(conn, readings) for each batch, in the writer thread. Should be called before any readings are
+        saved. """
+        self._batch_hooks.append(fn)
+
+    def run_async(self, fn):
+        """ Run fn(conn) in the writer thread, as part of the next batch """
+        self._queue.put(('call', fn, None, None))
+
+    def run_sync(self, fn):
+        """ Run fn(conn) in the writer thread and wait until its batch is committed. Returns fn's result, or
+        re-raises its exception. """
+        done = threading.Event()
+        result = {}
+        self._queue.put(('call', fn, done, result))
+        done.wait()
+        if 'exception' in result:
+            raise result['exception']
+        return result.get('value')
+
+    def flush(self):
+        """ Block until all readings queued so far are committed """
+        self.run_sync(lambda _conn: None)
+
+    def stop(self):
+        """ Write any pending readings and close the db """
+        self.flush()
+        self._stop_requested = True
+        self._queue.put(None)
+        self._thread.join()
+        self._conn.close()
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["commit_latency_avg_ms"] = \
+                stats["commit_latency_total_ms"] / stats["commits"] if stats["commits"] else None
+        return stats
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self._batch_max_delay_secs
+        while len(batch) < self._batch_max_rows and not self._has_waiter(batch[-1]):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._stop_requested = True
+                break
+            batch.append(item)
+        return batch
+
+    @staticmethod
+    def _has_waiter(item):
+        # If someone is waiting for this item, the commit shouldn't be delayed
+        return item[0] == 'call' and item[2] is not None
+
+    def _run(self):
+        while not self._stop_requested:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception as ex:  # pylint: disable=broad-except
+                # Keep the writer alive: if this thread dies, nothing is saved anymore and run_sync never returns
+                log.error("Sensors db writer failed to write a batch of %d items", len(batch), exc_info=True)
+                self._abort_batch(batch, ex)
+            finally:
+                for kind, _fn, done, _result in batch:
+                    if kind == 'call' and done is not None:
+                        done.set()
+
+    def _abort_batch(self, batch, ex):
+        """ Roll back a batch that failed unexpectedly, and report the failure to anyone waiting for it """
+        try:
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            log.error("Failed to roll back sensors db batch", exc_info=True)
+        self._storage.invalidate_cache()
+        self._fail_waiters(batch, ex)
+        with self._stats_lock:
+            self._stats["write_errors"] += sum(1 for item in batch if item[0] in ('reading', 'store'))
+
+    @staticmethod
+    def _fail_waiters(batch, ex):
+        # A task whose batch wasn't committed failed, even if the task itself returned a value
+        for kind, _fn, _done, result in batch:
+            if kind == 'call' and result is not None:
+                result.pop('value', None)
+                result.setdefault('exception', ex)
+
+    def _run_task(self, fn, result):
+        # Each task is atomic: if it fails partway, none of its changes are committed with the batch
+        self._conn.execute('SAVEPOINT writer_task')
+        try:
+            value = fn(self._conn)
+            if result is not None:
+                result['value'] = value
+        except Exception as ex:  # pylint: disable=broad-except
+            self._conn.execute('ROLLBACK TO writer_task')
+            # Schema changes may have been rolled back, so the cache can't be trusted anymore
+            self._storage.invalidate_cache()
+            if result is not None:
+                result['exception'] = ex
+            else:
+                log.error("Sensors db writer task failed", exc_info=True)
+        self._conn.execute('RELEASE writer_task')
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        rows = 0
+        errors = 0
+        hooked = []
+        self._conn.execute('BEGIN')
+        for kind, arg1, arg2, arg3 in batch:
+            if kind in ('reading', 'store'):
+                try:
+                    self._storage.insert(self._conn, arg1, arg2, arg3)
+                    if kind == 'reading':
+                        hooked.append((arg1, arg2, arg3))
+                    rows += 1
+                except Exception:  # pylint: disable=broad-except
+                    errors += 1
+                    log.error("Failed to save reading for sensor %s", arg1, exc_info=True)
+            elif kind == 'observe':
+                hooked.append((arg1, arg2, arg3))
+            else:
+                self._run_task(arg1, arg3)
+
+        for hook in self._batch_hooks:
+            if not hooked:
+                break
+            # A failing hook shouldn't lose the readings, only its own changes
+            self._conn.execute('SAVEPOINT batch_hook')
+            try:
+                hook(self._conn, hooked)
+            except Exception:  # pylint: disable=broad-except
+                log.error("Sensors db writer batch hook failed", exc_info=True)
+                self._conn.execute('ROLLBACK TO batch_hook')
+            self._conn.execute('RELEASE batch_hook')
 
-def _csv(header, data):
-    csv = ','.join(header) + '\n'
-    for row in data:
-        csv += ','.join(str(x) for x in row) + '\n'
-    return csv
+        try:
+            self._conn.execute('COMMIT')
+        except sqlite3.Error as ex:
+            log.error("Failed to commit %d sensor readings", rows, exc_info=True)
+            errors += rows
+            rows = 0
+            # Schema changes may have been lost, so the cache can't be trusted anymore
+            self._storage.invalidate_cache()
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+            self._fail_waiters(batch, ex)
+
+        latency_ms = (time.monotonic() - start) * 1000
+        with self._stats_lock:
+            self._stats["rows_written"] += rows
+            self._stats["write_errors"] += errors
+            self._stats["commits"] += 1
+            self._stats["batch_rows_last"] = rows
+            self._stats["batch_rows_max"] = max(self._stats["batch_rows_max"], rows)
+            self._stats["commit_latency_last_ms"] = latency_ms
+            self._stats["commit_latency_max_ms"] = max(self._stats["commit_latency_max_ms"], latency_ms)
+            self._stats["commit_latency_total_ms"] += latency_ms
 
 
 class SensorsHistory:
@@ -185,16 +272,117 @@ class SensorsHistory:
     layer - it receives sensor data and stores it, but does not manage callbacks
     or sensor objects directly. """
 
-    def __init__(self, dbpath, scheduler, retention_rows=None, retention_days=None):
+    def __init__(self, dbpath, scheduler, retention_rows=None, retention_days=None, db_layout='wide',
+                 batch_max_rows=200, batch_max_delay_ms=500,
+                 retention_interval_secs=600, retention_max_rows_per_run=5000, retention_chunk_rows=500,
+                 rollup_retention_days=None, auto_resolution_points=1000, write_filter=None,
+                 chunk_after_days=None, chunk_window_hours=24, chunk_max_windows_per_run=24,
+                 backfill_window_hours=6, backfill_pause_secs=1.0,
+                 archive_dir=None, archive_max_months_per_run=3,
+                 rolling_windows_secs=DEFAULT_WINDOWS_SECS, rolling_ewma_tau_secs=DEFAULT_EWMA_TAU_SECS):
         self._retention_rows = retention_rows
         self._retention_days = retention_days
+        self._retention_max_rows_per_run = retention_max_rows_per_run
+        self._retention_chunk_rows = retention_chunk_rows
+        self._retention_stats = {
+            "runs": 0,
+            "rows_deleted_last_run": 0,
+            "rows_deleted_total": 0,
+            "pending": False,
+        }
+        self._chunk_max_windows_per_run = chunk_max_windows_per_run
+        self._compaction_stats = {
+            "runs": 0,
+            "rows_moved_last_run": 0,
+            "rows_moved_total": 0,
+        }
+        self._backfill_window_hours = backfill_window_hours
+        self._backfill_pause_secs = backfill_pause_secs
+        self._archive_max_months_per_run = archive_max_months_per_run
+        self._backfill_stats = {
+            "runs": 0,
+            "windows_total": 0,
+            "values_written_total": 0,
+            "pending": 0,
+            "current": None,
+            "progress": None,
+        }
+        self._stopped = threading.Event()
         self._dbpath = dbpath
-
-        # try to open the db once, to verify it's usable
-        with sqlite3.connect(self._dbpath):
-            pass
+        self._auto_resolution_points = auto_resolution_points
+
+        with sqlite3.connect(dbpath) as conn:
+            existing_layout = detect_storage_layout(conn)
+        if existing_layout is not None and existing_layout != db_layout:
+            raise ValueError(f"Sensors db {dbpath} uses the '{existing_layout}' layout, but '{db_layout}' is "
+                             "configured. Use migrate_sensors_db.py to convert it.")
+        self._storage = build_storage(db_layout)
+
+        # All writes go through a single writer thread, with a long-lived connection. This will also fail early if
+        # the db is not usable.
+        self._writer = _SensorsDbWriter(dbpath, self._storage,
+                                        batch_max_rows=batch_max_rows, batch_max_delay_ms=batch_max_delay_ms)
+
+        # Rollups are updated with each batch of readings. If they are new, readings already in the db will be added
+        # to them in the background.
+        self._rollups = SensorRollups(rollup_retention_days)
+        self._writer.add_batch_hook(self._rollups.add_readings)
+        self._writer.run_sync(self._migrate_rollups)
+
+        # Cold readings may be kept in compressed chunks. Chunks are always queried, even if compaction is disabled,
+        # so history compacted before isn't lost.
+        self._chunks = SensorChunks(chunk_after_days, chunk_window_hours)
+        self._writer.run_sync(self._chunks.migrate)
+
+        # Closed months can be moved out of the db into archive files. Archives are queried with the rest of the
+        # history.
+        self._archive = SensorArchive(archive_dir) if archive_dir is not None else None
+
+        # Derived metrics can be recomputed over existing history, see schedule_derived_metrics_backfill
+        self._backfill = DerivedMetricsBackfill(backfill_window_hours)
+        self._seed_derived_versions = self._writer.run_sync(self._backfill.migrate)
+
+        # Readings that don't add information (see sensors_filter.py) are dropped before they reach the writer
+        self._write_filter = WriteFilter(write_filter)
+
+        # Push clients get readings as they are saved, see subscribe_live
+        self._live = LiveReadings()
+
+        # Metadata and current values are served from memory
+        self._cache = SensorsCache()
+        # Rolling stats of recent readings, seeded from the db so they don't start empty
+        self._rolling = RollingStats(rolling_windows_secs, rolling_ewma_tau_secs)
+        with sqlite3.connect(dbpath) as conn:
+            self._cache.load(conn, self._storage)
+            self._seed_rolling_stats(conn)
 
         self._scheduler = scheduler
+        self._scheduler.add_job(self.backfill_rollups, id='sensor_history_rollup_backfill')
+
+        # Retention runs in the background, with a bound on how many rows each run deletes, so neither ingestion
+        # nor queries have to wait for a large delete
+        self._scheduler.add_job(
+            self.apply_retention,
+            trigger='interval',
+            seconds=retention_interval_secs,
+            id='sensor_history_retention'
+        )
+
+        if chunk_after_days is not None:
+            self._scheduler.add_job(
+                self.compact_cold_samples,
+                trigger='interval',
+                seconds=retention_interval_secs,
+                id='sensor_history_compaction'
+            )
+
+        if self._archive is not None:
+            self._scheduler.add_job(
+                self.archive_closed_months,
+                trigger='interval',
+                seconds=retention_interval_secs,
+                id='sensor_history_archive'
+            )
 
         # Clear old sensors once a day, some time at a random hour during the night
         self._scheduler.add_job(
@@ -211,26 +399,122 @@ class SensorsHistory:
         server.add_url_rule('/sensors/metrics/<sensor_name>', None, self.get_metrics_for_sensor)
         server.add_url_rule('/sensors/measuring/<metric>', None, self.get_known_sensors_measuring)
         server.add_url_rule('/sensors/get_metric_in_sensor_csv/<sensor_name>/<metric>',
-                            None, self.get_metric_in_sensor_csv)
+                            None, self._www_get_metric_in_sensor_csv)
         server.add_url_rule('/sensors/get_metric_in_sensor_csv/<sensor_name>/<metric>/history/<unit>/<time>',
-                            None, self.get_metric_in_sensor_csv_time_limit)
+                            None, self._www_get_metric_in_sensor_csv_time_limit)
         server.add_url_rule('/sensors/get_all_metrics_in_sensor_csv/<sensor_name>',
-                            None, self.get_all_metrics_in_sensor_csv)
+                            None, self._www_get_all_metrics_in_sensor_csv)
         server.add_url_rule('/sensors/get_single_metric_in_all_sensors_csv/<metric>',
-                            None, self.get_single_metric_in_all_sensors_csv)
+                            None, self._www_get_single_metric_in_all_sensors_csv)
         server.add_url_rule('/sensors/get_single_metric_in_all_sensors_csv/<metric>/<unit>/<time>',
-                            None, self.get_single_metric_in_all_sensors_csv)
+                            None, self._www_get_single_metric_in_all_sensors_csv)
+        server.add_url_rule('/sensors/aggregate/<metric>', None, self._www_aggregate)
+        server.add_url_rule('/sensors/rolling/<sensor_name>', None, self._www_rolling_stats)
+        server.add_url_rule('/sensors/rolling/<sensor_name>/<metric>', None, self._www_rolling_stats)
         server.add_url_rule('/sensors/gc_dead_sensors', None, self.gc_dead_sensors)
+        server.add_url_rule('/sensors/writer_stats', None, self.get_writer_stats)
         ## Only enable this for testing, not a good idea to leave this open
         # server.add_url_rule('/sensors/force_retention_days/<retention_n>', None, self._force_retention_days)
         # server.add_url_rule('/sensors/force_retention_rows/<retention_n>', None, self._force_retention_rows)
 
+    @staticmethod
+    def _www_max_points():
+        """ Optional ?max_points=<n> arg, to downsample results for charts """
+        max_points = request.args.get('max_points')
+        if max_points is None:
+            return None
+        if not max_points.isdigit() or int(max_points) == 0:
+            abort(400, f"Invalid max_points '{max_points}', must be a positive number")
+        return int(max_points)
+
+    @staticmethod
+    def _www_rollup_args():
+        """ Optional query args to select a rollup tier: ?resolution=<secs>&agg=<avg|min|max|count> """
+        resolution = request.args.get('resolution')
+        if resolution is not None and not resolution.isdigit():
+            abort(400, f"Invalid resolution '{resolution}', must be a number of seconds")
+        agg = request.args.get('agg', 'avg')
+        if agg not in ROLLUP_AGGREGATIONS:
+            abort(400, f"Invalid aggregation '{agg}', must be one of {list(ROLLUP_AGGREGATIONS)}")
+        return {
+            'resolution': int(resolution) if resolution is not None else None,
+            'agg': agg,
+            'max_points': SensorsHistory._www_max_points(),
+        }
+
+    @staticmethod
+    def _www_stream(header, rows):
+        """ Streams query results, in the format requested with ?format=<csv|ndjson|bin> (default csv). The response
+        is gzipped if the client accepts it. With ?max_points=<n>, results are downsampled to n rows (see
+        sensors_downsample.py), and can't be streamed. """
+        if header is None:
+            return ''
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMAT_MIMETYPES:
+            abort(400, f"Invalid format '{fmt}', must be one of {list(FORMAT_MIMETYPES)}")
+        max_points = SensorsHistory._www_max_points()
+        if max_points is not None:
+            rows = downsample_rows(header, rows, max_points)
+        body = encode_rows(header, rows, fmt)
+        headers = {}
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = gzip_stream(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        return Response(body, mimetype=FORMAT_MIMETYPES[fmt], headers=headers)
+
+    def _www_get_metric_in_sensor_csv(self, sensor_name, metric):
+        return self._www_get_metric_in_sensor_csv_time_limit(sensor_name, metric, 'days', self._retention_days)
+
+    def _www_get_metric_in_sensor_csv_time_limit(self, sensor_name, metric, unit, time):
+        try:
+            header_rows = self._query_metric_in_sensor(sensor_name, metric, unit, time, **self._www_rollup_args())
+        except ValueError as e:
+            abort(400, str(e))
+        return self._www_stream(*header_rows)
+
+    def _www_get_all_metrics_in_sensor_csv(self, sensor_name):
+        try:
+            header_rows = self._query_all_metrics_in_sensor(sensor_name)
+        except ValueError as e:
+            abort(400, str(e))
+        return self._www_stream(*header_rows)
+
+    def _www_get_single_metric_in_all_sensors_csv(self, metric, unit='days', time=2):
+        try:
+            header_rows = self._query_single_metric_in_all_sensors(metric, unit, time, **self._www_rollup_args())
+        except ValueError as e:
+            abort(400, str(e))
+        return self._www_stream(*header_rows)
+
+    def _www_aggregate(self, metric):
+        """ ?sensors=<s1,s2...>&bucket_secs=<secs>&agg=<agg1,agg2...>&unit=<unit>&time=<n>, all optional. Sensors
+        default to all sensors measuring metric. """
+        sensors = request.args.get('sensors')
+        try:
+            header_rows = self._query_aggregate(
+                metric,
+                sensors.split(',') if sensors else None,
+                request.args.get('bucket_secs', 3600),
+                request.args.get('agg', 'avg').split(','),
+                request.args.get('unit', 'days'),
+                request.args.get('time', 2))
+        except ValueError as e:
+            abort(400, str(e))
+        return self._www_stream(*header_rows)
+
+    def _www_rolling_stats(self, sensor_name, metric=None):
+        stats = self.get_rolling_stats(sensor_name, metric)
+        if stats is None:
+            abort(404, f"No recent readings for {sensor_name}" + (f".{metric}" if metric is not None else ""))
+        return stats
+
     def register_sensor(self, sensor_name, metrics):
         """ Register a sensor schema in the database. Creates the table if needed,
         or adds any missing columns to an existing table. Does not manage callbacks. """
         # Validate sensor name early to catch invalid names at registration
         try:
-            _validate_sql_identifier(sensor_name, "sensor name")
+            validate_sql_identifier(sensor_name, "sensor name")
         except ValueError as e:
             log.error("Cannot register sensor with invalid name: %s", e)
             raise
@@ -238,186 +522,520 @@ class SensorsHistory:
         # Validate all metric names early
         for metric in metrics:
             try:
-                _validate_sql_identifier(metric, "metric name")
+                validate_sql_identifier(metric, "metric name")
             except ValueError as e:
                 log.error("Cannot register sensor %s with invalid metric name: %s", sensor_name, e)
                 raise
 
-        with sqlite3.connect(self._dbpath) as conn:
-            _maybe_create_table(conn, sensor_name, metrics)
-            conn.commit()
-
+        if set(metrics).issubset(self._cache.metrics_for_sensor(sensor_name)):
+            # Already known, no need to wait for the db
+            return
+        self._writer.run_sync(lambda conn: self._storage.ensure_schema(conn, sensor_name, metrics))
+        self._cache.add_schema(sensor_name, metrics)
         log.info('Registered sensor %s to sensor_history', sensor_name)
 
     def save_reading(self, sensor_name, values_dict):
-        """ Save a sensor reading to the database.
+        """ Save a sensor reading to the database. The reading is timestamped now, but written to the db in the
+        background (see _SensorsDbWriter).
 
         Args:
             sensor_name: Name of the sensor
             values_dict: Dictionary of {metric_name: value}
         """
-        metrics = list(values_dict.keys())
-        readings = list(values_dict.values())
-
         # Validate all identifiers to prevent SQL injection
-        sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-        validated_metrics = [_validate_sql_identifier(m, "metric name") for m in metrics]
-
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        for metric in values_dict.keys():
+            validate_sql_identifier(metric, "metric name")
+        sample_time = _now_sample_time()
+        values_dict = dict(values_dict)
+        # The cache always has the latest values, even if they aren't written
+        self._cache.update(sensor_name, sample_time, values_dict)
+        self._live.publish(sensor_name, sample_time, values_dict)
+        self._rolling.update(sensor_name, time.time(), values_dict)
+        if not self._write_filter.is_enabled():
+            self._writer.save_reading(sensor_name, sample_time, values_dict)
+            return
+        # Rollups see every reading, so their averages and counts aren't skewed by the readings that aren't stored
+        self._writer.observe_reading(sensor_name, sample_time, values_dict)
+        for write_time, values in self._write_filter.filter(sensor_name, sample_time, time.time(), values_dict):
+            self._writer.save_reading(sensor_name, write_time, values, batch_hooks=False)
+
+    def subscribe_live(self, sensors=None, metrics=None):
+        """ Returns a LiveSubscription that will receive every reading saved from now on, for the listed sensors and
+        metrics (or all of them, if None). Call unsubscribe_live once done. """
+        return self._live.subscribe(sensors, metrics)
+
+    def unsubscribe_live(self, sub):
+        self._live.unsubscribe(sub)
+
+    def flush(self):
+        """ Block until all readings saved so far are written to the db """
+        self._writer.flush()
+
+    def stop(self):
+        """ Write pending readings (including values held back by the write filter) and close the db """
+        self._stopped.set()
+        for sensor_name, sample_time, values in self._write_filter.drain():
+            self._writer.save_reading(sensor_name, sample_time, values, batch_hooks=False)
+        self._writer.stop()
+
+    def get_writer_stats(self):
+        """ Returns stats for the db writer: queue depth, rows written, commit latency... """
+        stats = self._writer.get_stats()
+        stats["retention"] = dict(self._retention_stats)
+        stats["write_filter"] = self._write_filter.get_stats()
         with sqlite3.connect(self._dbpath) as conn:
-            _maybe_create_table(conn, sensor_name, validated_metrics)
-
-            cols_q = ', '.join(validated_metrics)
-            vals_placeholders = ', '.join('?' * len(validated_metrics))
-            query = f'INSERT INTO {sensor_name}'\
-                    f' ({cols_q}) VALUES ({vals_placeholders})'
-            conn.execute(query, readings)
-
-            _discard_old_samples_by_retention_count(
-                conn, sensor_name, self._retention_rows)
-            _discard_old_samples_by_retention_days(
-                conn, sensor_name, self._retention_days)
-            conn.commit()
+            stats["chunks"] = {**self._compaction_stats, **self._chunks.get_stats(conn)}
+        if self._archive is not None:
+            stats["archive"] = self._archive.get_stats()
+        stats["derived_backfill"] = dict(self._backfill_stats)
+        stats["live"] = self._live.get_stats()
+        return stats
 
     def get_known_sensors(self):
         """ Returns a list of all sensor names kept in this database """
-        with sqlite3.connect(self._dbpath) as conn:
-            return _get_known_sensors(conn)
+        return self._cache.known_sensors()
 
     def get_known_metrics(self):
         """ Returns a list of all metrics being measured """
-        with sqlite3.connect(self._dbpath) as conn:
-            return list(_get_known_metrics(conn))
+        return self._cache.known_metrics()
 
     def get_known_sensors_measuring(self, metric):
         """ Returns a list of all sensor that can measure $metric"""
-        with sqlite3.connect(self._dbpath) as conn:
-            sensors = _get_known_sensors(conn)
-            can_measure = []
-            for sensor in sensors:
-                if metric in _get_sensor_metrics(conn, sensor):
-                    can_measure.append(sensor)
-            return can_measure
+        return self._cache.sensors_measuring(metric)
 
     def get_metrics_for_sensor(self, sensor_name):
         """ Returns a list of all metrics available for a specific sensor """
-        with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
-                return []
-            return _get_sensor_metrics(conn, sensor_name)
-
-    def get_metric_in_sensor_csv(self, sensor_name, metric):
-        """ Retrieves all measurements of $metric for $sensor """
-        return self.get_metric_in_sensor_csv_time_limit(sensor_name, metric, 'days', self._retention_days)
+        return self._cache.metrics_for_sensor(sensor_name)
+
+    def get_last_values(self, sensor_name):
+        """ Returns {metric: value} with the last value saved for each metric of a sensor, or None if the sensor is
+        unknown. Served from memory. """
+        return self._cache.last_values(sensor_name)
+
+    def get_last_values_for_metric(self, metric):
+        """ Returns {sensor_name: value} with the last value of $metric saved by each sensor. Served from memory. """
+        return self._cache.last_values_for_metric(metric)
+
+    def get_rolling_stats(self, sensor_name, metric=None):
+        """ Returns {metric: stats} with the rolling stats (see sensors_rolling.py) of a sensor, or only of metric if
+        set. None if the sensor (or metric) has no recent numeric readings. Served from memory. """
+        return self._rolling.get(sensor_name, time.time(), metric)
+
+    def _seed_rolling_stats(self, conn):
+        since = f'-{self._rolling.windows_secs[-1]} seconds'
+        for sensor_name in self._storage.known_sensors(conn):
+            for metric in self._storage.sensor_metrics(conn, sensor_name):
+                for sample_time, value in self._storage.metric_in_sensor(conn, sensor_name, metric, since):
+                    epoch = datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp()
+                    self._rolling.update(sensor_name, epoch, {metric: value})
+
+    def _pick_rollup_tier(self, unit, time, resolution, agg, max_points=None):
+        """ Rollup tier to serve a query for the last $time $units, or None to use raw readings. If no resolution
+        (in seconds) is requested, one is picked so that about auto_resolution_points are returned, or enough
+        buckets for downsampling to max_points (see sensors_downsample.py). """
+        if agg not in ROLLUP_AGGREGATIONS:
+            raise ValueError(f"Invalid aggregation '{agg}': must be one of {ROLLUP_AGGREGATIONS}")
+        range_secs = time_range_secs(unit, time)
+        if resolution is None and max_points is not None:
+            resolution = resolution_for_max_points(range_secs, max_points)
+        elif resolution is None and range_secs is not None:
+            resolution = range_secs / self._auto_resolution_points
+        # Archives are never discarded, so with an archive raw readings cover any range
+        raw_retention_days = self._retention_days if self._archive is None else None
+        return self._rollups.pick_tier(range_secs, resolution, raw_retention_days)
+
+    def _query(self, query_fn):
+        """ Runs query_fn(conn), which returns (header, rows), on a new connection. rows is returned as a generator
+        that closes the connection once it's exhausted, so results can be streamed. If header is None there are no
+        results, and (None, None) is returned. """
+        conn = sqlite3.connect(self._dbpath)
+        try:
+            header, rows = query_fn(conn)
+        except Exception:
+            conn.close()
+            raise
+        if header is None:
+            conn.close()
+            return None, None
 
-    def get_metric_in_sensor_csv_time_limit(self, sensor_name, metric, unit, time):
-        """ Retrieves measurements of $metric for $sensor,
-        for samples taken after N units of time (eg 2 days history) """
+        def _rows():
+            try:
+                yield from rows
+            finally:
+                conn.close()
+        return header, _rows()
+
+    @staticmethod
+    def _rollup_agg(agg, max_points):
+        """ Downsampling from rollups reads the min and max of each bucket, unless another aggregation than the
+        default average was requested """
+        return EXTREMES if max_points is not None and agg == 'avg' else agg
+
+    def _query_metric_in_sensor(self, sensor_name, metric, unit, time, resolution=None, agg='avg', max_points=None):
         # Validate all identifiers to prevent SQL injection
-        sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
-        metric = _validate_sql_identifier(metric, "metric name")
-        unit = _validate_time_unit(unit)
-        time = int(time)
-
-        with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        metric = validate_sql_identifier(metric, "metric name")
+        since = since_modifier(unit, time)
+        tier = self._pick_rollup_tier(unit, time, resolution, agg, max_points)
+        agg = self._rollup_agg(agg, max_points)
+
+        def _q(conn):
+            if sensor_name not in self._storage.known_sensors(conn):
                 log.error('Received request for unknown sensor %s', sensor_name)
-                return ''
+                return None, None
 
-            if metric not in _get_sensor_metrics(conn, sensor_name):
+            if metric not in self._storage.sensor_metrics(conn, sensor_name):
                 log.error('Received request for unknown metric %s in sensor %s', metric, sensor_name)
-                return ''
+                return None, None
+
+            if tier is not None:
+                res = self._rollups.metric_in_sensor(conn, tier, sensor_name, metric, since, agg)
+            else:
+                res = self._raw_metric_in_sensor(conn, sensor_name, metric, since)
+            return ['sample_time', metric], res
+        return self._query(_q)
+
+    def _raw_metric_in_sensor(self, conn, sensor_name, metric, since):
+        """ Readings of one metric, from the archive, chunks and hot table. Each tier only has readings older than
+        those in the next one. """
+        res = itertools.chain(self._chunks.metric_in_sensor(conn, sensor_name, metric, since),
+                              self._storage.metric_in_sensor(conn, sensor_name, metric, since))
+        if self._archive is not None:
+            res = itertools.chain(self._archive.metric_in_sensor(conn, sensor_name, metric, since), res)
+        return res
+
+    def _query_all_metrics_in_sensor(self, sensor_name):
+        # Validate sensor name to prevent SQL injection
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
 
-            query = f"SELECT sample_time, {metric} " +\
-                    f"FROM {sensor_name} " +\
-                    f"WHERE sample_time > datetime('now', '-{time} {unit}')" +\
-                    "ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
-            return _csv(['sample_time', metric], res)
+        def _q(conn):
+            if sensor_name not in self._storage.known_sensors(conn):
+                log.error('Received request for unknown sensor %s', sensor_name)
+                return None, None
 
-    def get_all_metrics_in_sensor_csv(self, sensor_name):
-        """ Equivalent to select * for a single sensor: retrieves all historical
-        data for a single sensor, as far as the retention period allows """
-        # Validate sensor name to prevent SQL injection
-        sensor_name = _validate_sql_identifier(sensor_name, "sensor name")
+            metrics, res = self._storage.all_metrics_in_sensor(conn, sensor_name)
+            res = itertools.chain(self._chunks.all_metrics_in_sensor(conn, sensor_name, metrics), res)
+            if self._archive is not None:
+                res = itertools.chain(self._archive.all_metrics_in_sensor(sensor_name, metrics), res)
+            return ['sample_time'] + metrics, res
+        return self._query(_q)
 
+    def _query_single_metric_in_all_sensors(self, metric, unit='days', time=2, resolution=None, agg='avg',
+                                            max_points=None):
+        # Validate all parameters to prevent SQL injection
+        metric = validate_sql_identifier(metric, "metric name")
+        since = since_modifier(unit, time)
+        tier = self._pick_rollup_tier(unit, time, resolution, agg, max_points)
+        agg = self._rollup_agg(agg, max_points)
+
+        def _q(conn):
+            if tier is not None:
+                all_sensors = self._storage.sensors_with_metric(conn, metric)
+                res = self._rollups.single_metric_in_all_sensors(conn, tier, all_sensors, metric, since, agg)
+            else:
+                all_sensors, res = self._storage.single_metric_in_all_sensors(conn, metric, since)
+                res = itertools.chain(self._chunks.single_metric_in_all_sensors(conn, all_sensors, metric, since),
+                                      res)
+                if self._archive is not None:
+                    res = itertools.chain(
+                        self._archive.single_metric_in_all_sensors(conn, all_sensors, metric, since), res)
+            if len(all_sensors) == 0:
+                return None, None
+            return ['sample_time'] + all_sensors, res
+        return self._query(_q)
+
+    def _aggregate(self, conn, metric, sensors, since, bucket_secs, aggs):
+        """ Returns {sensor: {bucket_epoch: [value of each agg]}} for raw readings (hot, chunked and archived) of
+        metric, or None if none of the sensors measure it """
+        known = self._storage.sensors_with_metric(conn, metric)
+        if sensors is None:
+            sensors = known
+        for sensor_name in sensors:
+            if sensor_name not in known:
+                log.error('Received aggregation request for sensor %s, which does not measure %s',
+                          sensor_name, metric)
+        sensors = [s for s in sensors if s in known]
+        if len(sensors) == 0:
+            return None
+        return {sensor_name: bucket_series(self._raw_metric_in_sensor(conn, sensor_name, metric, since),
+                                           bucket_secs, aggs)
+                for sensor_name in sensors}
+
+    def _validate_aggregate_args(self, metric, sensors, bucket_secs, aggs, unit, time):
+        metric = validate_sql_identifier(metric, "metric name")
+        if sensors is not None:
+            sensors = [validate_sql_identifier(s, "sensor name") for s in sensors]
+        since = since_modifier(unit, time)
+        bucket_secs = validate_bucket_secs(bucket_secs, time_range_secs(unit, time))
+        return metric, sensors, since, bucket_secs, validate_aggregations(aggs)
+
+    def _query_aggregate(self, metric, sensors, bucket_secs, aggs, unit, time):
+        metric, sensors, since, bucket_secs, aggs = \
+                self._validate_aggregate_args(metric, sensors, bucket_secs, aggs, unit, time)
+
+        def _q(conn):
+            series = self._aggregate(conn, metric, sensors, since, bucket_secs, aggs)
+            if series is None:
+                return None, None
+            header, rows = align_buckets(series, aggs)
+            return header, iter(rows)
+        return self._query(_q)
+
+    def get_aggregate(self, metric, sensors=None, bucket_secs=3600, aggs=('avg',), unit='days', time=2):
+        """ Bucketed aggregates of $metric over the last $time $units, for a list of sensors (default: all sensors
+        measuring it). Returns {'sample_time': [bucket starts], 'sensors': {sensor: {agg: [values]}}}, where all
+        lists are aligned to the same buckets, or None if no sensor measures $metric. See sensors_aggregate.py for
+        the supported aggregations. """
+        metric, sensors, since, bucket_secs, aggs = \
+                self._validate_aggregate_args(metric, sensors, bucket_secs, aggs, unit, time)
         with sqlite3.connect(self._dbpath) as conn:
-            if sensor_name not in _get_known_sensors(conn):
-                log.error('Received request for unknown sensor %s', sensor_name)
-                return ''
+            series = self._aggregate(conn, metric, sensors, since, bucket_secs, aggs)
+        if series is None:
+            return None
+        header, rows = align_buckets(series, aggs)
+        columns = list(zip(*rows)) if rows else [()] * len(header)
+        result = {'sample_time': list(columns[0]), 'sensors': {}}
+        col = 1
+        for sensor_name in series:
+            result['sensors'][sensor_name] = {}
+            for agg in aggs:
+                result['sensors'][sensor_name][agg] = list(columns[col])
+                col += 1
+        return result
+
+    def get_metric_in_sensor_csv(self, sensor_name, metric, resolution=None, agg='avg', max_points=None):
+        """ Retrieves all measurements of $metric for $sensor """
+        return self.get_metric_in_sensor_csv_time_limit(sensor_name, metric, 'days', self._retention_days,
+                                                        resolution, agg, max_points)
 
-            # metrics returned from _get_sensor_metrics are already validated
-            metrics = _get_sensor_metrics(conn, sensor_name)
-            cols = ','.join(metrics)
-            query = f"SELECT sample_time, {cols} FROM {sensor_name} ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
-            return _csv(['sample_time'] + metrics, res)
+    def get_metric_in_sensor_csv_time_limit(self, sensor_name, metric, unit, time, resolution=None, agg='avg',
+                                            max_points=None):
+        """ Retrieves measurements of $metric for $sensor,
+        for samples taken after N units of time (eg 2 days history). For long ranges (or if a coarse
+        resolution is requested) values come from a rollup tier, aggregated with $agg. If $max_points is set, the
+        result is downsampled to at most that many rows. """
+        header, rows = self._query_metric_in_sensor(sensor_name, metric, unit, time, resolution, agg, max_points)
+        return _to_csv_downsampled(header, rows, max_points)
 
-    def get_single_metric_in_all_sensors_csv(self, metric, unit='days', time=2):
+    def get_all_metrics_in_sensor_csv(self, sensor_name, max_points=None):
+        """ Equivalent to select * for a single sensor: retrieves all historical
+        data for a single sensor, as far as the retention period allows """
+        header, rows = self._query_all_metrics_in_sensor(sensor_name)
+        return _to_csv_downsampled(header, rows, max_points)
+
+    def get_single_metric_in_all_sensors_csv(self, metric, unit='days', time=2, resolution=None, agg='avg',
+                                             max_points=None):
         """ Gets the same metric, as measured by different sensors. Will check
         on all known sensors (sensors that don't know this metric will be skipped """
-        # Validate all parameters to prevent SQL injection
-        metric = _validate_sql_identifier(metric, "metric name")
-        unit = _validate_time_unit(unit)
-        time = int(time)
-
+        header, rows = self._query_single_metric_in_all_sensors(metric, unit, time, resolution, agg, max_points)
+        return _to_csv_downsampled(header, rows, max_points)
+
+    def apply_retention(self):
+        """ Discard samples outside of the retention policy, deleting at most retention_max_rows_per_run rows. If
+        there is more work left, the next run will continue where this one stopped. """
+        deleted = self._discard_old_samples(self._retention_rows, self._raw_retention_days(),
+                                            self._retention_max_rows_per_run)
+        deleted += self._discard_old_rollups(self._retention_max_rows_per_run - deleted)
+        deleted += self._delete_in_chunks(
+            lambda conn, chunk: self._chunks.discard_old_chunks(conn, self._raw_retention_days(), chunk),
+            self._retention_max_rows_per_run - deleted)
+        self._retention_stats["runs"] += 1
+        self._retention_stats["rows_deleted_last_run"] = deleted
+        self._retention_stats["rows_deleted_total"] += deleted
+        self._retention_stats["pending"] = deleted >= self._retention_max_rows_per_run
+        if deleted > 0:
+            log.info('Sensor history: retention discarded %d samples', deleted)
+
+    def _raw_retention_days(self):
+        """ Retention for readings in the db. With an archive, readings are kept at least until their month is closed
+        and archived: they are only discarded if they are from before the previous month (eg because they can't be
+        archived). """
+        if self._archive is None or self._retention_days is None:
+            return self._retention_days
+        now = datetime.now(timezone.utc)
+        prev_month_start = (now.replace(day=1) - timedelta(days=1)).replace(day=1, hour=0, minute=0, second=0,
+                                                                            microsecond=0)
+        return max(self._retention_days, (now - prev_month_start).days + 1)
+
+    def _delete_in_chunks(self, delete_fn, max_rows):
+        """ Call delete_fn(conn, chunk_rows) until it deletes less than a full chunk, or max_rows are deleted. Each
+        chunk is its own commit, so readings queued in the meantime are written between chunks. Returns the number
+        of deleted rows. """
+        deleted = 0
+        while max_rows is None or deleted < max_rows:
+            chunk = self._retention_chunk_rows if max_rows is None \
+                    else min(self._retention_chunk_rows, max_rows - deleted)
+            n = self._writer.run_sync(lambda conn, chunk=chunk: delete_fn(conn, chunk))
+            deleted += n
+            if n < chunk:
+                break
+        return deleted
+
+    def _discard_old_samples(self, retention_rows, retention_days, max_rows=None):
+        """ Delete old samples from all sensors. Returns the number of deleted rows. """
+        deleted = 0
+        # Use the sensors in the db: a sensor may be in the cache before its first reading is written
         with sqlite3.connect(self._dbpath) as conn:
-            # all_sensors come from _sensors_with_metric which validates them
-            all_sensors = _sensors_with_metric(conn, metric)
-            if len(all_sensors) == 0:
-                return ''
-
-            # Select a single column per sensor (=table), and enough nulls for all
-            # other columns. The query should look like
-            # SELECT * FROM (
-            #   SELECT metric AS sensor1, NULL as sensor2,   NULL as sensor3...
-            #   UNION
-            #   SELECT NULL AS sensor1,   metric as sensor2, NULL as sensor3...
-            #   UNION
-            #   SELECT NULL AS sensor1,   NULL as sensor2,   metric as sensor3...
-            #   UNION
-            #   ...
-            # )
-            sensor_qs = []
-            for sensor in all_sensors:
-                cols_mask = []
-                for other_sensor in all_sensors:
-                    if other_sensor == sensor:
-                        cols_mask.append(f"{metric} AS {sensor}")
-                    else:
-                        cols_mask.append(f"'' AS {other_sensor}")
-                cols = ", ".join(cols_mask)
-                sensor_qs.append(f"SELECT sample_time, {cols} "
-                                 f"FROM {sensor} "
-                                 f"WHERE {metric} IS NOT NULL"
-                                 f"  AND sample_time > datetime('now', '-{time} {unit}')")
-
-            query = "SELECT * FROM (" +\
-                    (" UNION ".join(sensor_qs)) +\
-                    ") ORDER BY sample_time"
-            res = conn.execute(query).fetchall()
-            return _csv(['sample_time'] + all_sensors, res)
+            known_sensors = self._storage.known_sensors(conn)
+        for sensor_name in known_sensors:
+            deleted += self._delete_in_chunks(
+                lambda conn, chunk, sensor_name=sensor_name: self._storage.discard_old_samples(
+                    conn, sensor_name, retention_rows, retention_days, chunk),
+                max_rows - deleted if max_rows is not None else None)
+        return deleted
+
+    def _discard_old_rollups(self, max_rows=None):
+        """ Delete rollup buckets older than the retention of their tier. Returns the number of deleted rows. """
+        deleted = 0
+        metrics = self.get_known_metrics()
+        for tier, _ in ROLLUP_TIERS:
+            if max_rows is not None and deleted >= max_rows:
+                break
+            deleted += self._delete_in_chunks(
+                lambda conn, chunk, tier=tier: self._rollups.discard_old_buckets(conn, tier, metrics, chunk),
+                max_rows - deleted if max_rows is not None else None)
+        return deleted
+
+    def compact_cold_samples(self):
+        """ Move readings older than chunk_after_days from the hot table into compressed chunks. Each window is
+        compacted in its own commit, and each run compacts at most chunk_max_windows_per_run windows per sensor. """
+        moved = 0
+        with sqlite3.connect(self._dbpath) as conn:
+            known_sensors = self._storage.known_sensors(conn)
+            # Rollup and derived metric backfills read the hot table, so they need to finish before a sensor can be
+            # compacted
+            pending_backfill = {sensor_name for sensor_name, _ in self._rollups.pending_backfill(conn)}
+            pending_backfill.update(sensor_name for sensor_name, *_ in self._backfill.pending(conn))
+        for sensor_name in known_sensors:
+            if sensor_name in pending_backfill:
+                continue
+            for _ in range(self._chunk_max_windows_per_run):
+                n = self._writer.run_sync(lambda conn, sensor_name=sensor_name:
+                                          self._chunks.compact_sensor(conn, self._storage, sensor_name, 1))
+                moved += n
+                if n == 0:
+                    break
+        self._compaction_stats["runs"] += 1
+        self._compaction_stats["rows_moved_last_run"] = moved
+        self._compaction_stats["rows_moved_total"] += moved
+        if moved > 0:
+            log.info('Sensor history: moved %d cold samples to compressed chunks', moved)
+
+    def archive_closed_months(self):
+        """ Move months before the current one from the db into archive files. Each month of each sensor is archived
+        in its own commit, and each run archives at most archive_max_months_per_run months per sensor. """
+        current_month = _now_sample_time()[:7]
+        archived = 0
+        with sqlite3.connect(self._dbpath) as conn:
+            known_sensors = self._storage.known_sensors(conn)
+            # Backfills read the hot table, so they need to finish before a sensor can be archived
+            pending_backfill = {sensor_name for sensor_name, _ in self._rollups.pending_backfill(conn)}
+            pending_backfill.update(sensor_name for sensor_name, *_ in self._backfill.pending(conn))
+        for sensor_name in known_sensors:
+            if sensor_name in pending_backfill:
+                continue
+            for _ in range(self._archive_max_months_per_run):
+                n = self._writer.run_sync(lambda conn, sensor_name=sensor_name: self._archive.archive_oldest_month(
+                    conn, self._storage, self._chunks, sensor_name, current_month))
+                archived += n
+                if n == 0:
+                    break
+        if archived > 0:
+            log.info('Sensor history: archived %d readings of closed months', archived)
+
+    def _migrate_rollups(self, conn):
+        if self._rollups.migrate(conn):
+            # Rollups are new: readings already in the db need to be added, readings from now on will be added as
+            # they are stored
+            self._rollups.schedule_backfill(conn, self._storage.known_sensors(conn), _now_sample_time())
+
+    def backfill_rollups(self):
+        """ Add readings stored before rollups existed to the rollups. Runs once per sensor, in the background, one
+        window of backfill_window_hours per commit (with a pause of backfill_pause_secs between them) so ingestion
+        isn't held up. Stops early if the history is stopped; the next run continues from the last window. """
+        with sqlite3.connect(self._dbpath) as conn:
+            pending = self._rollups.pending_backfill(conn)
+        for sensor_name, until in pending:
+            added = 0
+            while until is not None:
+                n, until = self._writer.run_sync(lambda conn, sensor_name=sensor_name, until=until:
+                                                 self._rollups.backfill_sensor_window(
+                                                     conn, self._storage, sensor_name, until,
+                                                     self._backfill_window_hours))
+                added += n
+                if until is not None and self._stopped.wait(self._backfill_pause_secs):
+                    log.info('Sensor history: rollup backfill of %s interrupted, will resume on next run',
+                             sensor_name)
+                    return
+            log.info('Sensor history: added %d old readings of %s to rollups', added, sensor_name)
+
+    def schedule_derived_metrics_backfill(self, derived):
+        """ Recompute derived metrics over the existing history, in the background, for every sensor that has their
+        source metrics and doesn't have the current version of the derived metric. derived is a dict like
+        VIRTUAL_METRICS. Readings saved from now on are expected to include the derived metrics already. On the first
+        run over a db that predates backfills, derived metrics already in the db are assumed to be current. """
+        seed_existing = self._seed_derived_versions
+        scheduled = self._writer.run_sync(
+            lambda conn: self._backfill.schedule(conn, self._storage, derived, _now_sample_time(), seed_existing))
+        self._seed_derived_versions = False
+        for sensor_name, metric in scheduled:
+            log.info('Sensor history: scheduled backfill of %s for %s', metric, sensor_name)
+        self._scheduler.add_job(lambda: self.backfill_derived_metrics(derived), id='sensor_history_derived_backfill')
+
+    def backfill_derived_metrics(self, derived):
+        """ Run all pending derived metric backfills. Each window of history is its own commit, with a pause of
+        backfill_pause_secs between windows so live readings are not held up. Stops early if the history is stopped;
+        the next run will continue from the last window written. """
+        with sqlite3.connect(self._dbpath) as conn:
+            pending = self._backfill.pending(conn)
+        self._backfill_stats["runs"] += 1
+        self._backfill_stats["pending"] = len(pending)
+        for sensor_name, metric, done_until, until in pending:
+            if metric not in derived:
+                continue
+            self._cache.add_schema(sensor_name, [metric])
+            carry = {}
+            written = 0
+            try:
+                while done_until < until:
+                    n, done_until = self._writer.run_sync(
+                        lambda conn, sensor_name=sensor_name, metric=metric, done_until=done_until, carry=carry:
+                        self._backfill.backfill_window(conn, self._storage, self._rollups, sensor_name, metric,
+                                                       derived[metric], done_until, carry))
+                    written += n
+                    self._backfill_stats["windows_total"] += 1
+                    self._backfill_stats["values_written_total"] += n
+                    with sqlite3.connect(self._dbpath) as conn:
+                        progress = self._backfill.progress(conn, sensor_name, metric)
+                    self._backfill_stats["current"] = f'{sensor_name}.{metric}'
+                    self._backfill_stats["progress"] = progress
+                    log.debug('Sensor history: backfill of %s for %s at %.0f%%', metric, sensor_name, 100 * progress)
+                    if self._stopped.wait(self._backfill_pause_secs):
+                        log.info('Sensor history: backfill of %s for %s interrupted, will resume on next run',
+                                 metric, sensor_name)
+                        return
+            except Exception:  # pylint: disable=broad-except
+                log.error('Sensor history: backfill of %s for %s failed', metric, sensor_name, exc_info=True)
+                continue
+            self._backfill_stats["pending"] -= 1
+            log.info('Sensor history: backfilled %d values of %s for %s', written, metric, sensor_name)
 
     def gc_dead_sensors(self):
         """Run garbage collection to discard old sensor data based on retention policy."""
         log.info('Sensor history: run GC to discard old sensors')
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_days_all_tables(conn, self._retention_days)
-            _discard_old_samples_by_retention_count_all_tables(conn, self._retention_rows)
-            conn.commit()
+        self._discard_old_samples(self._retention_rows, self._raw_retention_days())
+        self._discard_old_rollups()
         return "OK"
 
     def _force_retention_days(self, retention_n):
         retention_n = int(retention_n)
         log.info('Discarding old measurements by forcing DAYS retention to %d', retention_n)
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_days_all_tables(conn, retention_n)
-            conn.commit()
+        self._discard_old_samples(None, retention_n)
         return "OK"
 
     def _force_retention_rows(self, retention_n):
         retention_n = int(retention_n)
         log.info('Discarding old measurements by forcing ROWS retention to %d', retention_n)
-        with sqlite3.connect(self._dbpath) as conn:
-            _discard_old_samples_by_retention_count_all_tables(conn, retention_n)
-            conn.commit()
+        self._discard_old_samples(retention_n, None)
         return "OK"
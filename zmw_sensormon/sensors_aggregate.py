@@ -0,0 +1,134 @@
+""" Server-side time bucketing of sensor history.
+
+Readings of one metric, for one or more sensors, are grouped into fixed-size
+time buckets and reduced to one value per bucket and aggregation. Buckets are
+aligned to multiples of bucket_secs since the epoch, so all sensors share the
+same time axis: a row per bucket with at least one reading, and a column per
+sensor and aggregation.
+
+Supported aggregations:
+
+- avg, min, max, count
+- first, last: value of the first/last reading in the bucket
+- rate: change per second between the first and last reading of the bucket
+  (None if the bucket has a single reading)
+- pNN: NN-th percentile, eg p50 (median) or p95, interpolated linearly
+"""
+
+from datetime import datetime, timezone
+
+AGGREGATIONS = ('avg', 'min', 'max', 'count', 'first', 'last', 'rate')
+
+# Bound how many buckets a single query can return
+MAX_BUCKETS = 10000
+
+
+def _to_epoch(sample_time):
+    return int(datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _to_sample_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _percentile(sorted_values, pct):
+    pos = (len(sorted_values) - 1) * pct / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _parse_percentile(agg):
+    if len(agg) < 2 or agg[0] != 'p':
+        return None
+    try:
+        pct = float(agg[1:])
+    except ValueError:
+        return None
+    return pct if 0 <= pct <= 100 else None
+
+
+def validate_aggregations(aggs):
+    """ Returns aggs as a list, or raises ValueError if any of them isn't supported """
+    aggs = list(aggs)
+    if not aggs:
+        raise ValueError("At least one aggregation is needed")
+    for agg in aggs:
+        if agg not in AGGREGATIONS and _parse_percentile(agg) is None:
+            raise ValueError(f"Invalid aggregation '{agg}': must be one of {list(AGGREGATIONS)} or pNN (eg p95)")
+    return aggs
+
+
+def validate_bucket_secs(bucket_secs, range_secs):
+    """ Returns bucket_secs as an int, or raises ValueError if it's invalid or too small for range_secs """
+    bucket_secs = int(bucket_secs)
+    if bucket_secs <= 0:
+        raise ValueError(f"Invalid bucket size {bucket_secs}, must be a positive number of seconds")
+    if range_secs is not None and range_secs / bucket_secs > MAX_BUCKETS:
+        raise ValueError(f"Bucket size {bucket_secs} is too small, a query can't return more than {MAX_BUCKETS} "
+                         "buckets")
+    return bucket_secs
+
+
+def _reduce(times, values, aggs):
+    """ Computes aggs over the readings of one bucket """
+    sorted_values = None
+    out = []
+    for agg in aggs:
+        if agg == 'avg':
+            out.append(sum(values) / len(values))
+        elif agg == 'min':
+            out.append(min(values))
+        elif agg == 'max':
+            out.append(max(values))
+        elif agg == 'count':
+            out.append(len(values))
+        elif agg == 'first':
+            out.append(values[0])
+        elif agg == 'last':
+            out.append(values[-1])
+        elif agg == 'rate':
+            dt = times[-1] - times[0]
+            out.append((values[-1] - values[0]) / dt if dt > 0 else None)
+        else:
+            if sorted_values is None:
+                sorted_values = sorted(values)
+            out.append(_percentile(sorted_values, _parse_percentile(agg)))
+    return out
+
+
+def bucket_series(samples, bucket_secs, aggs):
+    """ Reduce an iterator of (sample_time, value), sorted by time, to {bucket_epoch: [value of each agg]}.
+    Non-numeric values are ignored. """
+    buckets = {}
+    current = None
+    times = []
+    values = []
+    for sample_time, value in samples:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        epoch = _to_epoch(sample_time)
+        bucket = epoch - epoch % bucket_secs
+        if bucket != current:
+            if values:
+                buckets[current] = _reduce(times, values, aggs)
+            current, times, values = bucket, [], []
+        times.append(epoch)
+        values.append(value)
+    if values:
+        buckets[current] = _reduce(times, values, aggs)
+    return buckets
+
+
+def align_buckets(series, aggs):
+    """ Merge {sensor: {bucket_epoch: [aggs]}} into (header, rows) on a common time axis. Each row is
+    (bucket_start, sensor1_agg1, sensor1_agg2..., sensor2_agg1...); sensors without readings in a bucket have None. """
+    header = ['sample_time'] + [f'{sensor}_{agg}' for sensor in series for agg in aggs]
+    empty = [None] * len(aggs)
+    rows = []
+    for bucket in sorted(set().union(*series.values())):
+        row = [_to_sample_time(bucket)]
+        for buckets in series.values():
+            row.extend(buckets.get(bucket, empty))
+        rows.append(tuple(row))
+    return header, rows
@@ -0,0 +1,258 @@
+""" Monthly columnar archive of sensor history.
+
+Closed months of history are moved out of the db into one file per sensor and
+month, `<archive_dir>/<sensor>/<YYYY-MM>.zmwa`, so the db only has recent
+readings. Archived readings are still returned by history queries: the months
+a query spans are read from their files, before the readings in the db.
+
+Archive files are columnar, with one column per metric, and are read through
+mmap: a reader parses the directory at the start of the file, then decodes
+only the byte ranges of the metrics it needs. Each column has its own
+timestamps, encoded like compressed chunks (see sensors_chunks.py):
+delta-of-delta timestamps and XOR'd float64 values, each deflated with zlib.
+
+File layout, all numbers little-endian:
+
+- Header: `ZMWA` magic, `uint8` version (1), a padding byte, `uint16` column
+  count.
+- Directory, one entry per column: `uint16` name length and the UTF-8 name,
+  then `uint32` reading count, `uint64` offset and `uint32` length of the
+  timestamps blob, `uint64` offset and `uint32` length of the values blob.
+  Offsets are from the start of the file.
+- Blobs, in any order.
+
+Only numeric values can be archived. Sensors with non-numeric values stay in
+the db, and a warning is logged.
+"""
+
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime, timezone
+
+from sensors_chunks import decode_timestamps, decode_values, encode_timestamps, encode_values
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSION = '.zmwa'
+_MAGIC = b'ZMWA'
+_VERSION = 1
+_HEADER = struct.Struct('<4sBxH')
+_NAME_LEN = struct.Struct('<H')
+_COLUMN = struct.Struct('<IQIQI')
+
+
+def _to_epoch(sample_time):
+    return int(datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _to_sample_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def month_of(sample_time):
+    """ Month of a sample_time, as YYYY-MM """
+    return sample_time[:7]
+
+
+def month_bounds(month):
+    """ [start, end) of a YYYY-MM month, as sample times """
+    year, mon = int(month[:4]), int(month[5:7])
+    next_year, next_mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f'{year:04}-{mon:02}-01 00:00:00', f'{next_year:04}-{next_mon:02}-01 00:00:00'
+
+
+def write_archive(path, series):
+    """ Write {metric: [(epoch, value)]}, each sorted by time, to an archive file. The file is replaced atomically. """
+    columns = []
+    for metric, samples in series.items():
+        columns.append((metric.encode(), len(samples),
+                        encode_timestamps([ts for ts, _ in samples]),
+                        encode_values([float(value) for _, value in samples])))
+
+    offset = _HEADER.size + sum(_NAME_LEN.size + len(name) + _COLUMN.size for name, *_ in columns)
+    header = [_HEADER.pack(_MAGIC, _VERSION, len(columns))]
+    blobs = []
+    for name, n, ts, vals in columns:
+        header.append(_NAME_LEN.pack(len(name)) + name +
+                      _COLUMN.pack(n, offset, len(ts), offset + len(ts), len(vals)))
+        blobs += [ts, vals]
+        offset += len(ts) + len(vals)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(b''.join(header + blobs))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+class ArchiveReader:
+    """ Reads columns of an archive file through mmap. Use as a context manager, or call close(). """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, n_columns = _HEADER.unpack_from(self._mm, 0)
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f"{path} is not a sensor archive (or has an unsupported version)")
+            self._columns = {}
+            pos = _HEADER.size
+            for _ in range(n_columns):
+                (name_len,) = _NAME_LEN.unpack_from(self._mm, pos)
+                pos += _NAME_LEN.size
+                name = self._mm[pos:pos + name_len].decode()
+                pos += name_len
+                self._columns[name] = _COLUMN.unpack_from(self._mm, pos)
+                pos += _COLUMN.size
+        except Exception:
+            self._mm.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def metrics(self):
+        return list(self._columns)
+
+    def read(self, metric):
+        """ Returns [(epoch, value)] for a metric, or [] if it isn't in the archive """
+        if metric not in self._columns:
+            return []
+        n, ts_off, ts_len, vals_off, vals_len = self._columns[metric]
+        # Slicing an mmap only reads the pages of this column
+        return list(zip(decode_timestamps(self._mm[ts_off:ts_off + ts_len], n),
+                        decode_values(self._mm[vals_off:vals_off + vals_len], n)))
+
+
+class SensorArchive:
+    """ Manages the archive files of all sensors, and reads them for history queries """
+
+    def __init__(self, archive_dir):
+        self._dir = archive_dir
+        self._skipped_sensors = set()
+        self._stats = {
+            "months_archived_total": 0,
+            "readings_archived_total": 0,
+        }
+
+    def path(self, sensor_name, month):
+        return os.path.join(self._dir, sensor_name, f'{month}{ARCHIVE_EXTENSION}')
+
+    def months(self, sensor_name):
+        """ Archived months of a sensor, sorted, as YYYY-MM """
+        try:
+            files = os.listdir(os.path.join(self._dir, sensor_name))
+        except FileNotFoundError:
+            return []
+        return sorted(f[:-len(ARCHIVE_EXTENSION)] for f in files if f.endswith(ARCHIVE_EXTENSION))
+
+    def archive_oldest_month(self, conn, storage, chunks, sensor_name, current_month):
+        """ Move the oldest month of a sensor's history in the db (hot and chunked readings) into its archive file,
+        if that month is before current_month. Readings already archived for that month are kept. Returns the
+        number of readings archived, 0 if there was nothing to archive. """
+        if sensor_name in self._skipped_sensors:
+            return 0
+        oldest = [t for t in (storage.oldest_sample_time(conn, sensor_name),
+                              chunks.oldest_sample_time(conn, sensor_name)) if t is not None]
+        if not oldest or month_of(min(oldest)) >= current_month:
+            return 0
+        month = month_of(min(oldest))
+        start, end = month_bounds(month)
+
+        hot = storage.samples_between(conn, sensor_name, start, end)
+        for metric, samples in hot.items():
+            if not all(_is_number(value) for _, value in samples):
+                log.warning('Sensor %s has non-numeric values for %s, its history will not be archived',
+                            sensor_name, metric)
+                self._skipped_sensors.add(sensor_name)
+                return 0
+
+        path = self.path(sensor_name, month)
+        series = {}
+        if os.path.exists(path):
+            # Readings that arrived late, or a previous run that wrote the file but failed to commit
+            with ArchiveReader(path) as archived:
+                series = {metric: dict(archived.read(metric)) for metric in archived.metrics()}
+        for metric, samples in itertools.chain(chunks.take_between(conn, sensor_name, start, end).items(),
+                                               hot.items()):
+            series.setdefault(metric, {}).update((_to_epoch(ts), value) for ts, value in samples)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_archive(path, {metric: sorted(samples.items()) for metric, samples in series.items()})
+        storage.delete_between(conn, sensor_name, start, end)
+        n = sum(len(samples) for samples in series.values())
+        self._stats["months_archived_total"] += 1
+        self._stats["readings_archived_total"] += n
+        return n
+
+    def _read(self, sensor_name, metric, since_time):
+        """ Yields (sample_time, value) for the archived readings of one metric, after since_time """
+        for month in self.months(sensor_name):
+            if since_time is not None and month_bounds(month)[1] <= since_time:
+                continue
+            with ArchiveReader(self.path(sensor_name, month)) as archived:
+                samples = archived.read(metric)
+            for epoch, value in samples:
+                sample_time = _to_sample_time(epoch)
+                if since_time is None or sample_time > since_time:
+                    yield sample_time, value
+
+    def _tagged(self, sensor_name, metric, since_time, col):
+        for sample_time, value in self._read(sensor_name, metric, since_time):
+            yield sample_time, col, value
+
+    @staticmethod
+    def _since_time(conn, since):
+        if since is None:
+            return None
+        return conn.execute("SELECT datetime('now', ?)", (since,)).fetchone()[0]
+
+    def metric_in_sensor(self, conn, sensor_name, metric, since):
+        """ Returns an iterator of (sample_time, value) for one metric of one sensor, after the datetime('now', since)
+        modifier """
+        return self._read(sensor_name, metric, self._since_time(conn, since))
+
+    def all_metrics_in_sensor(self, sensor_name, metrics):
+        """ Returns an iterator of (sample_time, metric1, metric2...) for all archived readings of a sensor. Metrics
+        not read at a sample_time are None. """
+        per_metric = [self._tagged(sensor_name, m, None, col) for col, m in enumerate(metrics)]
+        for sample_time, group in itertools.groupby(heapq.merge(*per_metric), key=lambda x: x[0]):
+            row = [None] * len(metrics)
+            for _, col, value in group:
+                row[col] = value
+            yield tuple([sample_time] + row)
+
+    def single_metric_in_all_sensors(self, conn, all_sensors, metric, since):
+        """ Returns an iterator of (sample_time, value_in_sensor1, value_in_sensor2...) for archived readings of
+        metric. Each row has a single sensor set, the value for all other sensors is ''. """
+        since_time = self._since_time(conn, since)
+        per_sensor = [self._tagged(s, metric, since_time, col) for col, s in enumerate(all_sensors)]
+        for sample_time, col, value in heapq.merge(*per_sensor):
+            row = [''] * len(all_sensors)
+            row[col] = value
+            yield tuple([sample_time] + row)
+
+    def get_stats(self):
+        files = 0
+        size = 0
+        if os.path.isdir(self._dir):
+            for sensor_name in os.listdir(self._dir):
+                for month in self.months(sensor_name):
+                    files += 1
+                    size += os.path.getsize(self.path(sensor_name, month))
+        return {**self._stats, "files": files, "bytes": size}
@@ -0,0 +1,144 @@
+""" Backfill of derived (virtual) metrics over sensor history.
+
+Virtual metrics (see virtual_metrics.py) are computed as readings arrive, so
+history stored before a virtual metric existed, or before its formula was
+fixed, has no (or stale) values. The backfill recomputes them from the source
+metrics already in the db.
+
+History is processed in windows of a few hours. For each window, the source
+metrics are read as columns aligned by sample_time, the derived metric is
+computed over the whole columns at once, and the results are written back (and
+the rollups of the window rebuilt) in a single transaction. Progress is kept in
+the db after each window, so an interrupted backfill continues where it stopped
+the next time it runs.
+
+Each derived metric has a version: when it changes, the backfill of that metric
+starts again from the oldest reading. Databases created before versions were
+tracked already have derived metrics computed at ingest: the first time
+backfills are scheduled, sensors that already have a derived metric are
+recorded as having its current version, instead of recomputing their whole
+history.
+
+Only readings in the hot table are backfilled: readings already moved to
+compressed chunks keep the values they had.
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _floor_hour(sample_time):
+    return f'{sample_time[:13]}:00:00'
+
+
+def _add_hours(sample_time, hours):
+    return (datetime.fromisoformat(sample_time) + timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _secs_between(start, end):
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+
+def compute_window(series, requires, compute_column, carry):
+    """ Compute a derived metric for all readings in series, {metric: [(sample_time, value)]}. The required
+    metrics are aligned by sample_time; a metric without a reading at some sample_time uses its last known value,
+    kept in carry across windows. Returns [(sample_time, value)] for all sample times where the derived metric
+    could be computed. """
+    by_time = {metric: dict(series.get(metric, [])) for metric in requires}
+    times = sorted(set().union(*by_time.values()))
+    columns = {metric: [] for metric in requires}
+    for sample_time in times:
+        for metric in requires:
+            value = by_time[metric].get(sample_time)
+            if value is not None:
+                carry[metric] = value
+            columns[metric].append(carry.get(metric))
+    values = compute_column(columns)
+    return [(sample_time, value) for sample_time, value in zip(times, values) if value is not None]
+
+
+class DerivedMetricsBackfill:
+    """ Tracks and runs the backfill of derived metrics, one (sensor, metric) at a time. Sensors and metrics are
+    stored by name, so the backfill works the same way with any storage layout. """
+
+    def __init__(self, window_hours=6):
+        if window_hours < 1 or int(window_hours) != window_hours:
+            raise ValueError(f"Invalid backfill window {window_hours}, must be a whole number of hours")
+        self._window_hours = int(window_hours)
+
+    def migrate(self, conn):
+        """ Create the progress table. Returns True if it didn't exist before (ie no versions are known yet) """
+        created = conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table' AND name = 'zmw_derived_backfill'"
+                               ).fetchone() is None
+        # Progress of each backfill: readings in [started, done_until) are done, the backfill ends at until. Rows
+        # are kept once done, to know which version of a metric is already in the history.
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_derived_backfill ('
+                     '  sensor TEXT NOT NULL, metric TEXT NOT NULL, version INTEGER NOT NULL,'
+                     '  started DATETIME NOT NULL, done_until DATETIME NOT NULL, until DATETIME NOT NULL,'
+                     '  PRIMARY KEY (sensor, metric))')
+        return created
+
+    def schedule(self, conn, storage, derived, until, seed_existing=False):
+        """ Schedule a backfill, up to until, for every derived metric that can be computed for a sensor in the db
+        and isn't up to date. derived is {metric: {'requires': [...], 'compute_column': fn, 'version': n}}, like
+        VIRTUAL_METRICS. With seed_existing, sensors that already have a derived metric but no known version of it
+        are recorded as having the current version, without a backfill. Returns the list of (sensor, metric)
+        scheduled. """
+        done = {(sensor, metric): version for sensor, metric, version in
+                conn.execute('SELECT sensor, metric, version FROM zmw_derived_backfill')}
+        scheduled = []
+        for sensor_name in storage.known_sensors(conn):
+            sensor_metrics = set(storage.sensor_metrics(conn, sensor_name))
+            for metric, cfg in derived.items():
+                if 'compute_column' not in cfg or not set(cfg['requires']).issubset(sensor_metrics):
+                    continue
+                if done.get((sensor_name, metric)) == cfg.get('version', 1):
+                    continue
+                if seed_existing and (sensor_name, metric) not in done and metric in sensor_metrics:
+                    conn.execute('INSERT INTO zmw_derived_backfill '
+                                 '  (sensor, metric, version, started, done_until, until) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (sensor_name, metric, cfg.get('version', 1), until, until, until))
+                    continue
+                oldest = storage.oldest_sample_time(conn, sensor_name)
+                if oldest is None:
+                    continue
+                started = _floor_hour(oldest)
+                conn.execute('INSERT OR REPLACE INTO zmw_derived_backfill '
+                             '  (sensor, metric, version, started, done_until, until) VALUES (?, ?, ?, ?, ?, ?)',
+                             (sensor_name, metric, cfg.get('version', 1), started, started, until))
+                scheduled.append((sensor_name, metric))
+        return scheduled
+
+    def pending(self, conn):
+        """ Returns [(sensor, metric, done_until, until)] for all unfinished backfills """
+        return conn.execute('SELECT sensor, metric, done_until, until FROM zmw_derived_backfill '
+                            'WHERE done_until < until ORDER BY sensor, metric').fetchall()
+
+    def progress(self, conn, sensor_name, metric):
+        """ Fraction (0 to 1) of the history of a sensor already backfilled for metric """
+        started, done_until, until = conn.execute(
+            'SELECT started, done_until, until FROM zmw_derived_backfill WHERE sensor = ? AND metric = ?',
+            (sensor_name, metric)).fetchone()
+        total = _secs_between(started, until)
+        return 1.0 if total <= 0 else min(_secs_between(started, done_until) / total, 1.0)
+
+    def backfill_window(self, conn, storage, rollups, sensor_name, metric, cfg, done_until, carry):
+        """ Compute and store metric for the next window of a sensor's history, starting at done_until, and record
+        the progress. Returns (values written, new done_until). """
+        end = _add_hours(done_until, self._window_hours)
+        series = storage.samples_between(conn, sensor_name, done_until, end)
+        computed = compute_window(series, cfg['requires'], cfg['compute_column'], carry)
+        storage.set_values(conn, sensor_name, metric, computed)
+
+        # If the rollups of this sensor are still pending a backfill, they will pick up the new values from the raw
+        # history. Otherwise the buckets of this window need to be rebuilt: old values can't be removed from a bucket.
+        if sensor_name not in {s for s, _ in rollups.pending_backfill(conn)}:
+            merged = dict(series.get(metric, []))
+            merged.update(computed)
+            rollups.rebuild_metric(conn, sensor_name, metric, done_until, end, sorted(merged.items()))
+
+        conn.execute('UPDATE zmw_derived_backfill SET done_until = ? WHERE sensor = ? AND metric = ?',
+                     (end, sensor_name, metric))
+        return len(computed), end
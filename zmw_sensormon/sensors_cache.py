@@ -0,0 +1,85 @@
+""" In-memory cache of sensor metadata and last values.
+
+Current-value and metadata queries (which sensors exist, what they measure,
+what they last reported) are the most frequent queries for sensormon. This
+cache serves them from memory: it's loaded from the db on startup, and kept
+up to date by SensorsHistory as sensors are registered and readings are saved,
+so it never needs to go back to disk.
+"""
+
+import threading
+
+
+class SensorsCache:
+    """ Known sensors, their metrics, and the last value reported for each metric. Thread safe. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Dicts keep insertion order, so sensors and metrics are listed in the order they were first seen
+        self._sensor_metrics = {}  # {sensor_name: {metric: None}}
+        self._metric_sensors = {}  # {metric: {sensor_name: None}}
+        self._last_values = {}  # {sensor_name: {metric: value}}
+        self._last_sample_times = {}  # {sensor_name: sample_time}
+
+    def load(self, conn, storage):
+        """ Populate the cache from the db """
+        for sensor_name in storage.known_sensors(conn):
+            self.add_schema(sensor_name, storage.sensor_metrics(conn, sensor_name))
+            latest = storage.latest_values(conn, sensor_name)
+            if not latest:
+                continue
+            with self._lock:
+                self._last_values[sensor_name] = {m: value for m, (_, value) in latest.items()}
+                self._last_sample_times[sensor_name] = max(ts for ts, _ in latest.values())
+
+    def add_schema(self, sensor_name, metrics):
+        """ Record that sensor_name measures metrics. Returns True if this is new information. """
+        with self._lock:
+            known = self._sensor_metrics.setdefault(sensor_name, {})
+            new_metrics = [m for m in metrics if m not in known]
+            for metric in new_metrics:
+                known[metric] = None
+                self._metric_sensors.setdefault(metric, {})[sensor_name] = None
+            return len(new_metrics) > 0
+
+    def update(self, sensor_name, sample_time, values_dict):
+        """ Record a new reading. Null values don't replace the last known value of a metric. """
+        self.add_schema(sensor_name, values_dict.keys())
+        with self._lock:
+            last = self._last_values.setdefault(sensor_name, {})
+            last.update({m: v for m, v in values_dict.items() if v is not None})
+            self._last_sample_times[sensor_name] = sample_time
+
+    def known_sensors(self):
+        with self._lock:
+            return list(self._sensor_metrics)
+
+    def known_metrics(self):
+        with self._lock:
+            return list(self._metric_sensors)
+
+    def metrics_for_sensor(self, sensor_name):
+        with self._lock:
+            return list(self._sensor_metrics.get(sensor_name, {}))
+
+    def sensors_measuring(self, metric):
+        with self._lock:
+            return list(self._metric_sensors.get(metric, {}))
+
+    def last_values(self, sensor_name):
+        """ Returns {metric: value} with the last known values of a sensor, or None for unknown sensors """
+        with self._lock:
+            if sensor_name not in self._sensor_metrics:
+                return None
+            return dict(self._last_values.get(sensor_name, {}))
+
+    def last_sample_time(self, sensor_name):
+        with self._lock:
+            return self._last_sample_times.get(sensor_name)
+
+    def last_values_for_metric(self, metric):
+        """ Returns {sensor_name: value} with the last known value of metric, for all sensors that reported it """
+        with self._lock:
+            return {sensor_name: self._last_values[sensor_name][metric]
+                    for sensor_name in self._metric_sensors.get(metric, {})
+                    if metric in self._last_values.get(sensor_name, {})}
@@ -0,0 +1,329 @@
+""" Compressed chunk storage for cold sensor history.
+
+Readings older than a few days are rarely queried at full resolution, but
+keeping them as one SQLite row per reading costs a text timestamp plus a REAL
+per metric. Cold readings are moved into chunks instead: one row per sensor,
+metric and closed time window, with the readings of the window packed into
+two blobs:
+
+- Timestamps (epoch seconds) as delta-of-delta: the first timestamp, the first
+  delta, then the change of each delta. Sensors that report on a fixed period
+  produce runs of zeros.
+- Values as the XOR of each float64 with the previous one. Repeated values
+  encode as a single zero byte, values that change slightly share their high
+  bytes (sign, exponent, top of the mantissa) with the previous value, so only
+  the bytes that differ are stored.
+
+Both encodings are byte aligned, and deflated with zlib. The most recent
+readings stay in the hot table of the storage layout (see sensors_storage.py);
+the window they're in is only compacted once it's older than hot_days.
+
+Only numeric values can be chunked. If a window has a non-numeric value (eg a
+string), that sensor is left uncompacted and a warning is logged.
+"""
+
+import array
+import heapq
+import itertools
+import logging
+import zlib
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+_CHUNKS_TABLE = 'zmw_chunks'
+
+
+def _to_epoch(sample_time):
+    return int(datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _to_sample_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+
+def encode_timestamps(timestamps):
+    """ Delta-of-delta encode a sorted list of epoch seconds """
+    out = bytearray()
+    prev = 0
+    prev_delta = 0
+    for i, ts in enumerate(timestamps):
+        if i == 0:
+            _put_varint(out, ts)
+        else:
+            delta = ts - prev
+            _put_varint(out, _zigzag(delta - prev_delta))
+            prev_delta = delta
+        prev = ts
+    return zlib.compress(bytes(out))
+
+
+def decode_timestamps(blob, n):
+    buf = zlib.decompress(blob)
+    timestamps = []
+    pos = 0
+    prev = 0
+    delta = 0
+    for i in range(n):
+        v, pos = _get_varint(buf, pos)
+        if i == 0:
+            prev = v
+        else:
+            delta += _unzigzag(v)
+            prev += delta
+        timestamps.append(prev)
+    return timestamps
+
+
+def encode_values(values):
+    """ XOR encode a list of floats. Each value is stored as a header byte with the number of leading zero bytes
+    (high nibble) and significant bytes (low nibble) of its XOR with the previous value, followed by the significant
+    bytes. A header of 0 means the value didn't change. """
+    bits = array.array('Q')
+    bits.frombytes(array.array('d', values).tobytes())
+    out = bytearray()
+    prev = 0
+    for b in bits:
+        xor = b ^ prev
+        prev = b
+        if xor == 0:
+            out.append(0)
+            continue
+        lead = (64 - xor.bit_length()) // 8
+        trail = ((xor & -xor).bit_length() - 1) // 8
+        sig = 8 - lead - trail
+        out.append((lead << 4) | sig)
+        out += (xor >> (8 * trail)).to_bytes(sig, 'big')
+    return zlib.compress(bytes(out))
+
+
+def decode_values(blob, n):
+    buf = zlib.decompress(blob)
+    bits = array.array('Q')
+    pos = 0
+    prev = 0
+    for _ in range(n):
+        hdr = buf[pos]
+        pos += 1
+        if hdr != 0:
+            lead, sig = hdr >> 4, hdr & 0x0f
+            trail = 8 - lead - sig
+            prev ^= int.from_bytes(buf[pos:pos + sig], 'big') << (8 * trail)
+            pos += sig
+        bits.append(prev)
+    return array.array('d', bits.tobytes()).tolist()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def copy_chunks(src_conn, dst_conn):
+    """ Copy all chunks from one db to another (chunks don't depend on the storage layout). Returns the number of
+    chunks copied. """
+    if src_conn.execute("SELECT 1 FROM sqlite_schema WHERE type = 'table' AND name = ?",
+                        (_CHUNKS_TABLE,)).fetchone() is None:
+        return 0
+    SensorChunks.migrate(dst_conn)
+    rows = src_conn.execute(f'SELECT sensor, metric, start, end, n, ts, vals FROM {_CHUNKS_TABLE}').fetchall()
+    dst_conn.executemany(f'INSERT OR REPLACE INTO {_CHUNKS_TABLE} (sensor, metric, start, end, n, ts, vals) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+class SensorChunks:
+    """ Cold tier for sensor history: closed windows of readings, compressed into one row per sensor and metric """
+
+    def __init__(self, hot_days, window_hours=24):
+        self._hot_days = hot_days
+        self._window_secs = int(window_hours * 60 * 60)
+        self._skipped_sensors = set()
+
+    @staticmethod
+    def migrate(conn):
+        """ Create the chunks table, if needed """
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {_CHUNKS_TABLE} ('
+                     '  sensor TEXT NOT NULL, metric TEXT NOT NULL,'
+                     '  start DATETIME NOT NULL, end DATETIME NOT NULL, n INTEGER NOT NULL,'
+                     '  ts BLOB NOT NULL, vals BLOB NOT NULL,'
+                     '  PRIMARY KEY (sensor, metric, start)'
+                     ') WITHOUT ROWID')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {_CHUNKS_TABLE}_metric_idx ON {_CHUNKS_TABLE} (metric, start)')
+
+    def _cutoff(self, conn):
+        """ Readings before this (epoch secs) are cold: the end of the last closed window older than hot_days """
+        now = conn.execute(f"SELECT datetime('now', '-{int(self._hot_days)} days')").fetchone()[0]
+        now = _to_epoch(now)
+        return now - now % self._window_secs
+
+    def compact_sensor(self, conn, storage, sensor_name, max_windows):
+        """ Move up to max_windows cold windows of a sensor from the hot table into chunks. Returns the number of hot
+        rows moved; if windows were left, the next call will continue where this one stopped. """
+        if sensor_name in self._skipped_sensors:
+            return 0
+        cutoff = self._cutoff(conn)
+        moved = 0
+        for _ in range(max_windows):
+            oldest = storage.oldest_sample_time(conn, sensor_name)
+            if oldest is None or _to_epoch(oldest) >= cutoff:
+                break
+            start = _to_epoch(oldest)
+            start -= start % self._window_secs
+            end = start + self._window_secs
+            start_time, end_time = _to_sample_time(start), _to_sample_time(end)
+
+            series = storage.samples_between(conn, sensor_name, start_time, end_time)
+            for metric, samples in series.items():
+                if not all(_is_number(value) for _, value in samples):
+                    log.warning('Sensor %s has non-numeric values for %s, its history will not be compacted',
+                                sensor_name, metric)
+                    self._skipped_sensors.add(sensor_name)
+                    return moved
+
+            for metric, samples in series.items():
+                self._add_chunk(conn, sensor_name, metric, start_time, end_time, samples)
+            moved += storage.delete_between(conn, sensor_name, start_time, end_time)
+        return moved
+
+    def _add_chunk(self, conn, sensor_name, metric, start_time, end_time, samples):
+        samples = [(_to_epoch(ts), float(value)) for ts, value in samples]
+        existing = conn.execute(f'SELECT n, ts, vals FROM {_CHUNKS_TABLE} '
+                                'WHERE sensor = ? AND metric = ? AND start = ?',
+                                (sensor_name, metric, start_time)).fetchone()
+        if existing is not None:
+            # Late readings for a window that was already compacted
+            n, ts, vals = existing
+            merged = dict(zip(decode_timestamps(ts, n), decode_values(vals, n)))
+            merged.update(samples)
+            samples = sorted(merged.items())
+        timestamps = [ts for ts, _ in samples]
+        values = [value for _, value in samples]
+        conn.execute(f'INSERT OR REPLACE INTO {_CHUNKS_TABLE} (sensor, metric, start, end, n, ts, vals) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (sensor_name, metric, start_time, end_time, len(samples),
+                      encode_timestamps(timestamps), encode_values(values)))
+
+    def oldest_sample_time(self, conn, sensor_name):
+        """ Time of the oldest chunked reading of a sensor, or None if it has no chunks """
+        rows = conn.execute(f'SELECT n, ts FROM {_CHUNKS_TABLE} WHERE sensor = ? AND start = '
+                            f'  (SELECT MIN(start) FROM {_CHUNKS_TABLE} WHERE sensor = ?)',
+                            (sensor_name, sensor_name)).fetchall()
+        if not rows:
+            return None
+        return _to_sample_time(min(decode_timestamps(ts, n)[0] for n, ts in rows))
+
+    def take_between(self, conn, sensor_name, start_time, end_time):
+        """ Remove the chunked readings of a sensor in [start_time, end_time) and return them, as
+        {metric: [(sample_time, value)]}. Chunks that are only partly in the range keep the readings outside of it. """
+        start, end = _to_epoch(start_time), _to_epoch(end_time)
+        rows = conn.execute(f'SELECT metric, start, end, n, ts, vals FROM {_CHUNKS_TABLE} '
+                            'WHERE sensor = ? AND start < ? AND end > ? ORDER BY metric, start',
+                            (sensor_name, end_time, start_time)).fetchall()
+        series = {}
+        for metric, chunk_start, chunk_end, n, ts, vals in rows:
+            inside, outside = [], []
+            for epoch, value in zip(decode_timestamps(ts, n), decode_values(vals, n)):
+                (inside if start <= epoch < end else outside).append((_to_sample_time(epoch), value))
+            series.setdefault(metric, []).extend(inside)
+            conn.execute(f'DELETE FROM {_CHUNKS_TABLE} WHERE sensor = ? AND metric = ? AND start = ?',
+                         (sensor_name, metric, chunk_start))
+            if outside:
+                self._add_chunk(conn, sensor_name, metric, chunk_start, chunk_end, outside)
+        return series
+
+    def discard_old_chunks(self, conn, retention_days, max_rows):
+        """ Delete up to max_rows chunks that ended before the retention cutoff. Returns the number deleted. """
+        if retention_days is None:
+            return 0
+        res = conn.execute(
+            f'DELETE FROM {_CHUNKS_TABLE} WHERE (sensor, metric, start) IN ('
+            f'  SELECT sensor, metric, start FROM {_CHUNKS_TABLE} '
+            f"  WHERE end < datetime('now', '-{int(retention_days)} days') LIMIT {int(max_rows)}"
+            ')')
+        return res.rowcount
+
+    @staticmethod
+    def _since_time(conn, since):
+        if since is None:
+            return None
+        return conn.execute("SELECT datetime('now', ?)", (since,)).fetchone()[0]
+
+    @staticmethod
+    def _decode(chunks, since_time):
+        """ Yields (sample_time, value) for all readings in chunks, sorted by start, after since_time """
+        for n, ts, vals in chunks:
+            for epoch, value in zip(decode_timestamps(ts, n), decode_values(vals, n)):
+                sample_time = _to_sample_time(epoch)
+                if since_time is None or sample_time > since_time:
+                    yield sample_time, value
+
+    def _tagged(self, conn, sensor_name, metric, since_time, col):
+        """ Like _decode, for a single series, with each reading tagged with col: (sample_time, col, value) """
+        for sample_time, value in self._decode(self._fetch(conn, sensor_name, metric, since_time), since_time):
+            yield sample_time, col, value
+
+    def _fetch(self, conn, sensor_name, metric, since_time):
+        # Fetch now, the blobs are decoded lazily as the result is consumed
+        time_limit = 'AND end > :since ' if since_time is not None else ''
+        return conn.execute(f'SELECT n, ts, vals FROM {_CHUNKS_TABLE} '
+                            f'WHERE sensor = :sensor AND metric = :metric {time_limit}'
+                            'ORDER BY start',
+                            {'sensor': sensor_name, 'metric': metric, 'since': since_time}).fetchall()
+
+    def metric_in_sensor(self, conn, sensor_name, metric, since):
+        """ Returns an iterator of (sample_time, value) for one metric of one sensor, after the datetime('now', since)
+        modifier """
+        since_time = self._since_time(conn, since)
+        return self._decode(self._fetch(conn, sensor_name, metric, since_time), since_time)
+
+    def all_metrics_in_sensor(self, conn, sensor_name, metrics):
+        """ Returns an iterator of (sample_time, metric1, metric2...) for all chunked readings of a sensor. Metrics
+        not read at a sample_time are None. """
+        per_metric = [self._tagged(conn, sensor_name, m, None, col) for col, m in enumerate(metrics)]
+        for sample_time, group in itertools.groupby(heapq.merge(*per_metric), key=lambda x: x[0]):
+            row = [None] * len(metrics)
+            for _, col, value in group:
+                row[col] = value
+            yield tuple([sample_time] + row)
+
+    def single_metric_in_all_sensors(self, conn, all_sensors, metric, since):
+        """ Returns an iterator of (sample_time, value_in_sensor1, value_in_sensor2...) for chunked readings of
+        metric. Each row has a single sensor set, the value for all other sensors is ''. """
+        since_time = self._since_time(conn, since)
+        per_sensor = [self._tagged(conn, s, metric, since_time, col) for col, s in enumerate(all_sensors)]
+        for sample_time, col, value in heapq.merge(*per_sensor):
+            row = [''] * len(all_sensors)
+            row[col] = value
+            yield tuple([sample_time] + row)
+
+    def get_stats(self, conn):
+        row = conn.execute(f'SELECT COUNT(*), COALESCE(SUM(n), 0), '
+                           f'COALESCE(SUM(length(ts) + length(vals)), 0) FROM {_CHUNKS_TABLE}').fetchone()
+        return {"chunks": row[0], "readings": row[1], "bytes": row[2]}
@@ -0,0 +1,98 @@
+""" Shape-preserving downsampling of query results for charts.
+
+Averaging readings into buckets smooths away short spikes (a window opening, a
+heater kicking in), which are often what a chart is for. Largest-Triangle-
+Three-Buckets (LTTB) instead picks actual readings: the series is split into
+as many buckets as points are wanted, and from each bucket the reading that
+forms the largest triangle with the reading picked from the previous bucket
+and the average of the next one. Peaks and dips are kept, flat stretches are
+thinned out.
+
+Query results may have several value columns (several metrics of a sensor, or
+one metric of several sensors). Each column is downsampled on its own, with an
+equal share of max_points, and a row is kept if any of its columns was picked,
+so the result never has more than max_points rows.
+
+Long ranges are downsampled from a rollup tier instead of raw readings: the
+coarsest tier with buckets no longer than range / (OVERSAMPLING * max_points),
+so LTTB still has several buckets to pick from for each point. The min and max
+of each bucket are used, so extremes aren't averaged away before LTTB sees
+them.
+"""
+
+from datetime import datetime, timezone
+
+# Less than this can't keep the first and last points plus a point per bucket
+MIN_POINTS = 3
+# Rollup buckets to read per downsampled point
+OVERSAMPLING = 4
+
+
+def resolution_for_max_points(range_secs, max_points):
+    """ Resolution, in seconds, of the data to downsample to max_points over range_secs, or None if unbounded """
+    if range_secs is None:
+        return None
+    return range_secs / (OVERSAMPLING * max_points)
+
+
+def _to_epoch(sample_time):
+    return datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp()
+
+
+def lttb_indices(xs, ys, max_points):
+    """ Returns the indices of at most max_points points of the series (xs, ys) to keep, in order """
+    n = len(xs)
+    if max_points >= n:
+        return list(range(n))
+    if max_points < MIN_POINTS:
+        return [0, n - 1][:max_points]
+
+    keep = [0]
+    # The first and last points are always kept, the rest are split into max_points - 2 buckets
+    bucket_size = (n - 2) / (max_points - 2)
+    prev = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        # Average of the next bucket (or the last point, for the last bucket)
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        px, py = xs[prev], ys[prev]
+        best_area = -1
+        best = start
+        for i in range(start, end):
+            area = abs((px - avg_x) * (ys[i] - py) - (px - xs[i]) * (avg_y - py))
+            if area > best_area:
+                best_area = area
+                best = i
+        keep.append(best)
+        prev = best
+    keep.append(n - 1)
+    return keep
+
+
+def downsample_rows(header, rows, max_points):
+    """ Returns at most max_points of rows, (sample_time, value1, value2...), picked with LTTB on each value column.
+    Non-numeric values (and the '' or None of rows where a column has no value) are ignored. """
+    rows = list(rows)
+    if len(rows) <= max_points:
+        return rows
+    n_cols = len(header) - 1
+    per_col = max(max_points // max(n_cols, 1), 1)
+    xs = [_to_epoch(row[0]) for row in rows]
+
+    keep = set()
+    for col in range(1, n_cols + 1):
+        idx = [i for i, row in enumerate(rows)
+               if isinstance(row[col], (int, float)) and not isinstance(row[col], bool)]
+        picked = lttb_indices([xs[i] for i in idx], [rows[i][col] for i in idx], per_col)
+        keep.update(idx[i] for i in picked)
+    keep = sorted(keep)
+    if len(keep) > max_points:
+        # More columns than points: each column kept at least one row, thin them out evenly
+        keep = [keep[i * len(keep) // max_points] for i in range(max_points)]
+    return [rows[i] for i in keep]
@@ -0,0 +1,145 @@
+""" Write filtering for sensor readings.
+
+Many devices report the same values over and over (a temperature that hasn't
+changed, the same battery level, a link quality that moves by one point).
+Storing each of these readings makes the db, retention and queries more
+expensive without adding any information to a chart.
+
+WriteFilter drops values that are within a deadband of the last value written
+for the same sensor and metric. To keep charts the same:
+
+- The last value dropped before a change (the end of a flat line) is written
+  when the change arrives, at its original time. Otherwise the chart would
+  draw a slope from the start of the flat line to the change.
+- A value is always written if the last write for that metric is older than
+  its heartbeat, so flat lines are still recorded periodically and gaps in the
+  data mean the sensor stopped reporting.
+
+Rules are configured per metric:
+
+    {
+        "*": {"heartbeat_secs": 900},
+        "temperature": {"deadband": 0.1},
+        "linkquality": {"deadband_pct": 20, "heartbeat_secs": 3600}
+    }
+
+"*" applies to metrics without a rule of their own. Metrics without any rule
+are never filtered. A rule without a deadband only filters repeated values.
+"""
+
+import threading
+from dataclasses import dataclass
+
+DEFAULT_HEARTBEAT_SECS = 900
+
+_RULE_OPTIONS = ('deadband', 'deadband_pct', 'heartbeat_secs')
+
+
+@dataclass(frozen=True)
+class FilterRule:
+    deadband: float = 0
+    deadband_pct: float = 0
+    heartbeat_secs: float = DEFAULT_HEARTBEAT_SECS
+
+    def is_within_deadband(self, last, value):
+        # Non-numeric values (including bools, which would compare as ints) only filter repeats
+        numeric = (int, float)
+        if isinstance(value, bool) or isinstance(last, bool) or \
+                not isinstance(value, numeric) or not isinstance(last, numeric):
+            return value == last
+        band = max(self.deadband, abs(last) * self.deadband_pct / 100)
+        return abs(value - last) <= band
+
+
+def parse_filter_rules(cfg):
+    """ Build {metric: FilterRule} from config. Raises ValueError for invalid options. """
+    rules = {}
+    for metric, opts in (cfg or {}).items():
+        unknown = set(opts) - set(_RULE_OPTIONS)
+        if unknown:
+            raise ValueError(f"Invalid write filter options for '{metric}': {sorted(unknown)}. "
+                             f"Valid options are {list(_RULE_OPTIONS)}")
+        if any(opts[k] < 0 for k in opts):
+            raise ValueError(f"Invalid write filter for '{metric}': options can't be negative")
+        rules[metric] = FilterRule(**opts)
+    return rules
+
+
+class WriteFilter:
+    """ Decides which values of each reading need to be written to the db. Thread safe. """
+
+    def __init__(self, cfg=None):
+        self._rules = parse_filter_rules(cfg)
+        self._default_rule = self._rules.get('*')
+        self._lock = threading.Lock()
+        # {(sensor_name, metric): [last_written_value, last_written_secs, pending]}, where pending is the last
+        # (sample_time, value) dropped since the last write, or None
+        self._state = {}
+        self._stats = {
+            "values_seen": 0,
+            "values_suppressed": 0,
+            "readings_suppressed": 0,
+            "held_back_written": 0,
+            "suppressed_per_metric": {},
+        }
+
+    def is_enabled(self):
+        return len(self._rules) > 0
+
+    def _rule_for(self, metric):
+        return self._rules.get(metric, self._default_rule)
+
+    def filter(self, sensor_name, sample_time, now_secs, values_dict):
+        """ Returns a list of (sample_time, values_dict) to write for this reading: nothing if the whole reading is
+        suppressed, or the values that need writing, possibly preceded by held-back values at an earlier time. """
+        to_write = {}
+        held_back = {}
+        with self._lock:
+            for metric, value in values_dict.items():
+                self._stats["values_seen"] += 1
+                rule = self._rule_for(metric)
+                if rule is None or value is None:
+                    to_write[metric] = value
+                    continue
+
+                state = self._state.get((sensor_name, metric))
+                unchanged = state is not None and rule.is_within_deadband(state[0], value)
+                if unchanged and now_secs - state[1] < rule.heartbeat_secs:
+                    state[2] = (sample_time, value)
+                    self._stats["values_suppressed"] += 1
+                    per_metric = self._stats["suppressed_per_metric"]
+                    per_metric[metric] = per_metric.get(metric, 0) + 1
+                    continue
+
+                # A heartbeat continues the flat line, a change needs to close it
+                if not unchanged and state is not None and state[2] is not None and state[2][0] != sample_time:
+                    held_back.setdefault(state[2][0], {})[metric] = state[2][1]
+                self._state[(sensor_name, metric)] = [value, now_secs, None]
+                to_write[metric] = value
+
+            if len(to_write) == 0:
+                self._stats["readings_suppressed"] += 1
+            self._stats["held_back_written"] += sum(len(vals) for vals in held_back.values())
+
+        writes = sorted(held_back.items())
+        if len(to_write) > 0:
+            writes.append((sample_time, to_write))
+        return writes
+
+    def drain(self):
+        """ Returns a list of (sensor_name, sample_time, values_dict) with all values held back so far, and forgets
+        them. Used on shutdown, so the end of flat lines isn't lost. """
+        pending = {}
+        with self._lock:
+            for (sensor_name, metric), state in self._state.items():
+                if state[2] is not None:
+                    sample_time, value = state[2]
+                    pending.setdefault((sensor_name, sample_time), {})[metric] = value
+                    state[2] = None
+        return [(sensor_name, sample_time, values) for (sensor_name, sample_time), values in sorted(pending.items())]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["suppressed_per_metric"] = dict(self._stats["suppressed_per_metric"])
+        return stats
@@ -0,0 +1,119 @@
+""" Encoders for sensor history query results.
+
+Results are encoded incrementally, a chunk of rows at a time, so a response
+can be streamed straight from the db cursor without building it in memory.
+
+Supported formats:
+
+- csv: the original format, a header line and one line per row.
+- ndjson: one JSON object per row, keyed by column name.
+- bin: columnar little-endian binary, for clients that decode into typed arrays.
+  See README.md for the layout.
+"""
+
+import array
+import json
+import struct
+import sys
+import zlib
+from datetime import datetime, timezone
+
+FORMAT_MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'bin': 'application/octet-stream',
+}
+
+BIN_MAGIC = b'ZMWS'
+BIN_VERSION = 1
+
+# Rows per encoded chunk
+_CHUNK_ROWS = 1024
+
+
+def _chunks(rows, chunk_rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _encode_csv(header, rows, chunk_rows):
+    yield (','.join(header) + '\n').encode()
+    for chunk in _chunks(rows, chunk_rows):
+        yield ''.join(','.join(str(x) for x in row) + '\n' for row in chunk).encode()
+
+
+def _encode_ndjson(header, rows, chunk_rows):
+    for chunk in _chunks(rows, chunk_rows):
+        yield ''.join(json.dumps(dict(zip(header, row))) + '\n' for row in chunk).encode()
+
+
+def _sample_time_to_epoch(sample_time):
+    return datetime.fromisoformat(sample_time).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _to_float(value):
+    if value is None or value == '':
+        return float('nan')
+    return float(value)
+
+
+def _pad8(buf):
+    return buf + b'\0' * (-len(buf) % 8)
+
+
+def _le_doubles(values):
+    col = array.array('d', values)
+    if sys.byteorder != 'little':
+        col.byteswap()
+    return col.tobytes()
+
+
+def _encode_bin(header, rows, chunk_rows):
+    hdr = BIN_MAGIC + struct.pack('<BxH', BIN_VERSION, len(header))
+    for name in header:
+        name = name.encode()
+        hdr += struct.pack('<H', len(name)) + name
+    yield _pad8(hdr)
+
+    for chunk in _chunks(rows, chunk_rows):
+        block = [struct.pack('<I4x', len(chunk)),
+                 _le_doubles(_sample_time_to_epoch(row[0]) for row in chunk)]
+        for col in range(1, len(header)):
+            block.append(_le_doubles(_to_float(row[col]) for row in chunk))
+        yield b''.join(block)
+    yield struct.pack('<I4x', 0)
+
+
+_ENCODERS = {
+    'csv': _encode_csv,
+    'ndjson': _encode_ndjson,
+    'bin': _encode_bin,
+}
+
+
+def encode_rows(header, rows, fmt, chunk_rows=_CHUNK_ROWS):
+    """ Returns an iterator of bytes with rows (of which the first column is a sample_time) encoded as fmt """
+    if fmt not in _ENCODERS:
+        raise ValueError(f"Invalid format '{fmt}': must be one of {list(_ENCODERS)}")
+    return _ENCODERS[fmt](header, rows, chunk_rows)
+
+
+def gzip_stream(chunks, level=6):
+    """ Gzip-compresses an iterator of bytes, as an iterator of bytes """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def to_csv(header, rows):
+    """ Whole result as a CSV string """
+    return b''.join(encode_rows(header, rows, 'csv')).decode()
@@ -0,0 +1,88 @@
+""" Live fan-out of sensor readings to push clients.
+
+Charts fetch a range of history once, then subscribe to new readings instead of
+re-fetching the whole range. Each subscriber gets its own bounded queue, with
+the readings of the sensors and metrics it asked for: publishing never blocks
+on a slow client. If a client can't keep up, its oldest queued readings are
+dropped.
+"""
+
+import queue
+import threading
+
+
+class LiveSubscription:
+    """ Readings queued for one client. Filters are lists of names, or None to get everything. """
+
+    def __init__(self, sensors, metrics, max_queued):
+        self.sensors = set(sensors) if sensors else None
+        self.metrics = set(metrics) if metrics else None
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+
+    def offer(self, sensor_name, sample_time, values_dict):
+        """ Queue a reading, if it matches the filters. If the queue is full, the oldest reading is dropped. """
+        if self.sensors is not None and sensor_name not in self.sensors:
+            return
+        if self.metrics is not None:
+            values_dict = {m: v for m, v in values_dict.items() if m in self.metrics}
+        values_dict = {m: v for m, v in values_dict.items() if v is not None}
+        if not values_dict:
+            return
+        msg = {'sensor': sensor_name, 'sample_time': sample_time, 'values': values_dict}
+        while True:
+            try:
+                self._queue.put_nowait(msg)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """ Next reading as {'sensor', 'sample_time', 'values'}, or None if there was none before timeout """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveReadings:
+    """ Fans out readings to all current subscribers. Thread safe. """
+
+    def __init__(self, max_queued=1000):
+        self._max_queued = max_queued
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._stats = {
+            "readings_published": 0,
+            "readings_dropped": 0,
+        }
+
+    def subscribe(self, sensors=None, metrics=None):
+        sub = LiveSubscription(sensors, metrics, self._max_queued)
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+            self._stats["readings_dropped"] += sub.dropped
+
+    def publish(self, sensor_name, sample_time, values_dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._stats["readings_published"] += 1
+        for sub in subscribers:
+            sub.offer(sensor_name, sample_time, values_dict)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "subscribers": len(self._subscribers),
+                "readings_dropped": self._stats["readings_dropped"] + sum(s.dropped for s in self._subscribers),
+            }
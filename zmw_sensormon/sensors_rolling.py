@@ -0,0 +1,233 @@
+""" Incremental rolling statistics over recent sensor readings.
+
+For each sensor and numeric metric, sensormon keeps statistics that are
+updated in O(1) (amortized) per reading, so consumers can ask for trends
+without scanning history:
+
+- ewma: exponentially weighted moving average. Readings are weighted by time,
+  not by count: a reading decays to 1/e of its weight after ewma_tau_secs, so
+  sensors that report irregularly are averaged correctly.
+- last_change: time of the last reading with a different value than the one
+  before it.
+- For each window (eg the last 15 minutes): count, min, max, mean and slope
+  (least squares fit, change per second). mean and slope use running sums of
+  t, v, t*v and t*t, which are updated as readings enter and leave the window.
+
+Windows don't keep individual readings: each window is split in up to
+BUCKETS_PER_WINDOW time buckets, and each bucket keeps the count, sums, min
+and max of its readings. Readings leave a window a bucket at a time, so the
+start of a window has a resolution of 1/BUCKETS_PER_WINDOW of its length, but
+memory per metric is constant, however often a sensor reports. The sums of a
+bucket are exact, so mean and slope are exact for the readings in the window.
+min and max use monotonic deques with at most one entry per bucket.
+
+Statistics are kept in memory only. On startup they are seeded from the
+readings of the longest window still in the db.
+"""
+
+from collections import deque
+import math
+import threading
+from datetime import datetime, timezone
+
+DEFAULT_WINDOWS_SECS = (15 * 60, 60 * 60, 24 * 60 * 60)
+DEFAULT_EWMA_TAU_SECS = 10 * 60
+BUCKETS_PER_WINDOW = 120
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _to_sample_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def window_name(secs):
+    """ Human name of a window, eg 900 -> 15m """
+    if secs % 3600 == 0:
+        return f'{secs // 3600}h'
+    if secs % 60 == 0:
+        return f'{secs // 60}m'
+    return f'{secs}s'
+
+
+class _Bucket:
+    """ Count, min, max and sums of the readings in [start, start + bucket_secs), with t relative to start """
+
+    __slots__ = ('start', 'n', 'st', 'sv', 'stv', 'stt')
+
+    def __init__(self, start):
+        self.start = start
+        self.n = 0
+        self.st = self.sv = self.stv = self.stt = 0.0
+
+    def add(self, dt, value):
+        self.n += 1
+        self.st += dt
+        self.sv += value
+        self.stv += dt * value
+        self.stt += dt * dt
+
+
+class _Window:
+    """ Stats over the readings of the last secs seconds """
+
+    def __init__(self, secs):
+        self.secs = secs
+        self.bucket_secs = -(-secs // BUCKETS_PER_WINDOW)
+        self._buckets = deque()  # _Bucket, oldest first
+        self._mins = deque()  # (bucket start, value), values increasing, at most one per bucket
+        self._maxs = deque()  # (bucket start, value), values decreasing, at most one per bucket
+        # Running sums of all buckets, with t relative to _origin to keep them small and precise
+        self._origin = None
+        self._n = 0
+        self._st = self._sv = self._stv = self._stt = 0.0
+
+    @staticmethod
+    def _push_extreme(extremes, start, value, replaces):
+        # Skip values that can't be the extreme of their bucket, so there's at most one entry per bucket
+        if extremes and extremes[-1][0] == start and not replaces(extremes[-1][1], value):
+            return
+        while extremes and replaces(extremes[-1][1], value):
+            extremes.pop()
+        extremes.append((start, value))
+
+    def add(self, t, value):
+        if self._origin is None:
+            self._origin = t
+        start = t - t % self.bucket_secs
+        if not self._buckets or self._buckets[-1].start != start:
+            self._buckets.append(_Bucket(start))
+        self._buckets[-1].add(t - start, value)
+        self._push_extreme(self._mins, start, value, lambda last, v: last >= v)
+        self._push_extreme(self._maxs, start, value, lambda last, v: last <= v)
+        dt = t - self._origin
+        self._n += 1
+        self._st += dt
+        self._sv += value
+        self._stv += dt * value
+        self._stt += dt * dt
+
+    def evict(self, now):
+        cutoff = now - self.secs
+        while self._buckets and self._buckets[0].start <= cutoff:
+            bucket = self._buckets.popleft()
+            # Bucket sums are relative to its start: shift them to the window origin
+            d = bucket.start - self._origin
+            self._n -= bucket.n
+            self._st -= bucket.st + bucket.n * d
+            self._sv -= bucket.sv
+            self._stv -= bucket.stv + d * bucket.sv
+            self._stt -= bucket.stt + 2 * d * bucket.st + bucket.n * d * d
+        while self._mins and self._mins[0][0] <= cutoff:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0] <= cutoff:
+            self._maxs.popleft()
+        if not self._buckets:
+            self._origin = None
+            self._n = 0
+            self._st = self._sv = self._stv = self._stt = 0.0
+        elif self._buckets[0].start - self._origin > self.secs:
+            self._rebase(self._buckets[0].start)
+
+    def _rebase(self, origin):
+        # Shift all sums to a new origin: t' = t - d
+        d = origin - self._origin
+        n = self._n
+        self._stt += -2 * d * self._st + n * d * d
+        self._stv -= d * self._sv
+        self._st -= n * d
+        self._origin = origin
+
+    def get(self):
+        n = self._n
+        if n == 0:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None, 'slope_per_sec': None}
+        denom = n * self._stt - self._st * self._st
+        # Readings too close together (or a single one) have no slope
+        slope = (n * self._stv - self._st * self._sv) / denom if denom > 1e-9 * n * n else None
+        return {
+            'count': n,
+            'min': self._mins[0][1],
+            'max': self._maxs[0][1],
+            'mean': self._sv / n,
+            'slope_per_sec': slope,
+        }
+
+
+class _MetricStats:
+    def __init__(self, windows_secs, ewma_tau_secs):
+        self._tau = ewma_tau_secs
+        self._windows = [_Window(secs) for secs in windows_secs]
+        self.last_t = None
+        self._last_value = None
+        self._last_change = None
+        self._ewma = None
+
+    def add(self, t, value):
+        if self._ewma is None:
+            self._ewma = value
+        else:
+            alpha = 1 - math.exp(-(t - self.last_t) / self._tau)
+            self._ewma += alpha * (value - self._ewma)
+        if self._last_value is not None and value != self._last_value:
+            self._last_change = t
+        self.last_t = t
+        self._last_value = value
+        for window in self._windows:
+            window.add(t, value)
+            window.evict(t)
+
+    def get(self, now):
+        windows = {}
+        for window in self._windows:
+            window.evict(now)
+            windows[window_name(window.secs)] = window.get()
+        return {
+            'value': self._last_value,
+            'last_update': _to_sample_time(self.last_t),
+            'last_change': _to_sample_time(self._last_change) if self._last_change is not None else None,
+            'ewma': self._ewma,
+            'windows': windows,
+        }
+
+
+class RollingStats:
+    """ Rolling statistics for all sensors and metrics. Thread safe. """
+
+    def __init__(self, windows_secs=DEFAULT_WINDOWS_SECS, ewma_tau_secs=DEFAULT_EWMA_TAU_SECS):
+        windows_secs = sorted(int(s) for s in windows_secs)
+        if not windows_secs or windows_secs[0] <= 0:
+            raise ValueError(f"Invalid rolling stats windows {windows_secs}, must be a list of positive seconds")
+        if ewma_tau_secs <= 0:
+            raise ValueError(f"Invalid EWMA time constant {ewma_tau_secs}, must be a positive number of seconds")
+        self.windows_secs = windows_secs
+        self._ewma_tau_secs = ewma_tau_secs
+        self._lock = threading.Lock()
+        self._stats = {}  # {sensor_name: {metric: _MetricStats}}
+
+    def update(self, sensor_name, t, values_dict):
+        """ Add a reading, taken at epoch t. Non-numeric values, and readings older than the last one of a metric,
+        are ignored. """
+        with self._lock:
+            sensor_stats = self._stats.setdefault(sensor_name, {})
+            for metric, value in values_dict.items():
+                if not _is_number(value):
+                    continue
+                stats = sensor_stats.get(metric)
+                if stats is None:
+                    stats = sensor_stats[metric] = _MetricStats(self.windows_secs, self._ewma_tau_secs)
+                elif t < stats.last_t:
+                    continue
+                stats.add(t, value)
+
+    def get(self, sensor_name, now, metric=None):
+        """ Returns {metric: stats} for a sensor (or only for metric, if set), as of epoch now. None if there are
+        no stats for the sensor (or the metric). """
+        with self._lock:
+            sensor_stats = self._stats.get(sensor_name)
+            if sensor_stats is None or (metric is not None and metric not in sensor_stats):
+                return None
+            metrics = [metric] if metric is not None else list(sensor_stats)
+            return {m: sensor_stats[m].get(now) for m in metrics}
@@ -0,0 +1,232 @@
+""" Downsampled rollups of sensor readings, for long-range queries.
+
+Each rollup tier keeps one row per (sensor, metric, time bucket), with the
+min, max, sum and count of all readings in that bucket. Tiers are updated
+incrementally by the db writer, as part of the same transaction that stores
+the raw readings: each batch of readings is pre-aggregated in memory, then
+merged into the tier tables with a single upsert per bucket.
+
+Rollups are kept for longer than raw readings, so long-range charts stay cheap
+even with a short raw retention period.
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+log = logging.getLogger(__name__)
+
+# (name, bucket size in seconds). Bucket sizes must divide an hour. Ordered from finest to coarsest.
+ROLLUP_TIERS = [('1m', 60), ('15m', 15 * 60), ('1h', 60 * 60)]
+DEFAULT_ROLLUP_RETENTION_DAYS = {'1m': 14, '15m': 180, '1h': 3650}
+ROLLUP_AGGREGATIONS = ('avg', 'min', 'max', 'count')
+# Not selectable by users: two rows per bucket, with its min and its max, so downsampling keeps peaks and dips
+EXTREMES = 'extremes'
+
+_TIME_UNIT_SECS = {
+    'seconds': 1,
+    'minutes': 60,
+    'hours': 60 * 60,
+    'days': 24 * 60 * 60,
+    'months': 30 * 24 * 60 * 60,
+    'years': 365 * 24 * 60 * 60,
+}
+
+
+def time_range_secs(unit, time):
+    """ Length of a query range like (days, 2) in seconds, or None for an unbounded range """
+    if time is None:
+        return None
+    return int(time) * _TIME_UNIT_SECS[unit]
+
+
+def bucket_start(sample_time, bucket_secs):
+    """ Start of the bucket for a sample_time in the 'YYYY-MM-DD HH:MM:SS' format """
+    secs_in_hour = int(sample_time[14:16]) * 60 + int(sample_time[17:19])
+    secs_in_hour -= secs_in_hour % bucket_secs
+    return f'{sample_time[:14]}{secs_in_hour // 60:02}:{secs_in_hour % 60:02}'
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+class SensorRollups:
+    """ Maintains and queries rollup tiers. Sensors and metrics are stored by name, so rollups work the same way
+    with any storage layout. """
+
+    def __init__(self, retention_days=None):
+        self._retention_days = dict(DEFAULT_ROLLUP_RETENTION_DAYS)
+        self._retention_days.update(retention_days or {})
+        unknown = set(self._retention_days) - {name for name, _ in ROLLUP_TIERS}
+        if unknown:
+            raise ValueError(f"Unknown rollup tiers {unknown}, valid tiers are {[t for t, _ in ROLLUP_TIERS]}")
+
+    def migrate(self, conn):
+        """ Create rollup tables. Returns True if they didn't exist before (ie they need to be backfilled) """
+        created = conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table' AND name = 'zmw_rollup_state'"
+                               ).fetchone() is None
+        for tier, _ in ROLLUP_TIERS:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS zmw_rollup_{tier} ('
+                         '  sensor TEXT NOT NULL, metric TEXT NOT NULL, bucket DATETIME NOT NULL,'
+                         '  vmin REAL, vmax REAL, vsum REAL, n INTEGER NOT NULL,'
+                         '  PRIMARY KEY (sensor, metric, bucket)'
+                         ') WITHOUT ROWID')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS zmw_rollup_{tier}_metric_idx '
+                         f'  ON zmw_rollup_{tier} (metric, bucket, sensor)')
+        # Sensors whose raw history still needs to be added to the rollups, and up to which time
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_rollup_state ('
+                     '  sensor TEXT PRIMARY KEY, backfill_until DATETIME NOT NULL)')
+        return created
+
+    def add_readings(self, conn, readings):
+        """ Merge a batch of readings, as [(sensor_name, sample_time, {metric: value})], into all tiers """
+        for tier, bucket_secs in ROLLUP_TIERS:
+            buckets = {}
+            for sensor_name, sample_time, values in readings:
+                bucket = bucket_start(sample_time, bucket_secs)
+                for metric, value in values.items():
+                    if not _is_number(value):
+                        continue
+                    key = (sensor_name, metric, bucket)
+                    agg = buckets.get(key)
+                    if agg is None:
+                        buckets[key] = [value, value, value, 1]
+                    else:
+                        agg[0] = min(agg[0], value)
+                        agg[1] = max(agg[1], value)
+                        agg[2] += value
+                        agg[3] += 1
+            if not buckets:
+                continue
+            conn.executemany(
+                f'INSERT INTO zmw_rollup_{tier} (sensor, metric, bucket, vmin, vmax, vsum, n) '
+                '  VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (sensor, metric, bucket) DO UPDATE SET '
+                '  vmin = min(vmin, excluded.vmin), vmax = max(vmax, excluded.vmax), '
+                '  vsum = vsum + excluded.vsum, n = n + excluded.n',
+                [(*key, *agg) for key, agg in buckets.items()])
+
+    def schedule_backfill(self, conn, sensors, until):
+        """ Mark the raw history of sensors, up to (excluding) until, as pending to be added to the rollups """
+        conn.executemany('INSERT OR IGNORE INTO zmw_rollup_state (sensor, backfill_until) VALUES (?, ?)',
+                         [(s, until) for s in sensors])
+
+    def pending_backfill(self, conn):
+        return conn.execute('SELECT sensor, backfill_until FROM zmw_rollup_state').fetchall()
+
+    def backfill_sensor_window(self, conn, storage, sensor_name, until, window_hours):
+        """ Add one window of the raw history of a sensor, before until, to the rollups. Readings at or after until
+        were already added. The backfill walks back from until to the oldest reading, one window per call, so each
+        call is a short transaction; gaps in the history are skipped. The pending backfill_until is moved back to the
+        start of the window, or the sensor is marked as done if there are no older readings. Returns
+        (readings added, next until), with next until None when the sensor is done. """
+        newest = storage.newest_sample_time_before(conn, sensor_name, until)
+        if newest is None:
+            conn.execute('DELETE FROM zmw_rollup_state WHERE sensor = ?', (sensor_name,))
+            return 0, None
+        start = (datetime.fromisoformat(newest) - timedelta(hours=window_hours)).strftime('%Y-%m-%d %H:%M:%S')
+        readings = [(sensor_name, sample_time, {metric: value})
+                    for metric, samples in storage.samples_between(conn, sensor_name, start, until).items()
+                    for sample_time, value in samples]
+        self.add_readings(conn, readings)
+        conn.execute('UPDATE zmw_rollup_state SET backfill_until = ? WHERE sensor = ?', (start, sensor_name))
+        return len(readings), start
+
+    def rebuild_metric(self, conn, sensor_name, metric, start, end, samples):
+        """ Replace all buckets of one metric of a sensor in [start, end) with buckets built from samples, as
+        [(sample_time, value)]. start and end must be on an hour boundary, so no bucket is only partly replaced. """
+        for tier, _ in ROLLUP_TIERS:
+            conn.execute(f'DELETE FROM zmw_rollup_{tier} '
+                         'WHERE sensor = ? AND metric = ? AND bucket >= ? AND bucket < ?',
+                         (sensor_name, metric, start, end))
+        self.add_readings(conn, [(sensor_name, sample_time, {metric: value}) for sample_time, value in samples])
+
+    def retention_days(self, tier):
+        return self._retention_days[tier]
+
+    def pick_tier(self, range_secs, resolution_secs, raw_retention_days):
+        """ Picks the coarsest tier with buckets no larger than resolution_secs that still covers range_secs, or
+        None if raw readings should be used instead. If raw readings don't cover the range, the finest tier that
+        does is used even if it's coarser than the requested resolution. """
+        def covers(retention_days):
+            if range_secs is None:
+                return retention_days is None
+            return retention_days is None or retention_days * 24 * 60 * 60 >= range_secs
+
+        candidates = [(tier, secs) for tier, secs in ROLLUP_TIERS if covers(self._retention_days[tier])]
+        if resolution_secs is not None:
+            fine_enough = [tier for tier, secs in candidates if secs <= resolution_secs]
+            if fine_enough:
+                return fine_enough[-1]
+        if covers(raw_retention_days) or not candidates:
+            return None
+        return candidates[0][0]
+
+    def metric_in_sensor(self, conn, tier, sensor_name, metric, since, agg='avg'):
+        """ Returns an iterator of (bucket, aggregated_value) for one metric of one sensor """
+        time_limit = "AND bucket > datetime('now', :since) " if since is not None else ""
+        res = conn.execute(
+            f'SELECT bucket, {self._agg_expr(agg)} FROM zmw_rollup_{tier} '
+            'WHERE sensor = :sensor AND metric = :metric '
+            f'{time_limit}'
+            'ORDER BY bucket', {'sensor': sensor_name, 'metric': metric, 'since': since})
+        return self._split_extremes(res) if agg == EXTREMES else res
+
+    def single_metric_in_all_sensors(self, conn, tier, all_sensors, metric, since, agg='avg'):
+        """ Same format as the raw storage query: a row per (bucket, sensor), with '' for all other sensors """
+        col_of = {s: i for i, s in enumerate(all_sensors)}
+        time_limit = "AND bucket > datetime('now', :since) " if since is not None else ""
+        res = conn.execute(
+            f'SELECT bucket, sensor, {self._agg_expr(agg)} FROM zmw_rollup_{tier} '
+            'WHERE metric = :metric '
+            f'{time_limit}'
+            'ORDER BY bucket', {'metric': metric, 'since': since})
+        if agg == EXTREMES:
+            res = self._split_extremes(res)
+        for bucket, sensor, value in res:
+            if sensor not in col_of:
+                continue
+            row = [''] * len(all_sensors)
+            row[col_of[sensor]] = value
+            yield tuple([bucket] + row)
+
+    def discard_old_buckets(self, conn, tier, metrics, max_rows):
+        """ Delete up to max_rows buckets of a tier that are older than its retention period, for a list of metrics.
+        Returns the number of deleted rows. """
+        retention_days = self._retention_days[tier]
+        if retention_days is None:
+            return 0
+        cutoff = conn.execute(f"SELECT datetime('now', '-{int(retention_days)} days')").fetchone()[0]
+        deleted = 0
+        for metric in metrics:
+            if deleted >= max_rows:
+                break
+            res = conn.execute(
+                f'DELETE FROM zmw_rollup_{tier} WHERE (sensor, metric, bucket) IN ('
+                f'  SELECT sensor, metric, bucket FROM zmw_rollup_{tier} '
+                '  WHERE metric = ? AND bucket < ? ORDER BY bucket LIMIT ?'
+                ')', (metric, cutoff, int(max_rows - deleted)))
+            deleted += res.rowcount
+        return deleted
+
+    @staticmethod
+    def _split_extremes(rows):
+        """ Rows of (bucket, ..., vmin, vmax) to a row for vmin and another one for vmax, if they differ """
+        for *key, vmin, vmax in rows:
+            yield (*key, vmin)
+            if vmax != vmin:
+                yield (*key, vmax)
+
+    @staticmethod
+    def _agg_expr(agg):
+        if agg == EXTREMES:
+            return 'vmin, vmax'
+        if agg == 'avg':
+            return 'vsum / n'
+        if agg == 'min':
+            return 'vmin'
+        if agg == 'max':
+            return 'vmax'
+        if agg == 'count':
+            return 'n'
+        raise ValueError(f"Invalid aggregation '{agg}': must be one of {ROLLUP_AGGREGATIONS}")
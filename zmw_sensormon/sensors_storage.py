@@ -0,0 +1,595 @@
+""" Storage layouts for the sensors history database.
+
+Two layouts are supported, with the same interface:
+
+- wide (the default, and the original layout): one table per sensor, with a
+  sample_time column and one REAL column per metric. New metrics are added
+  with ALTER TABLE.
+- narrow: a single table of (sensor_id, metric_id, ts, value) readings, plus
+  dictionary tables for sensor and metric names. New metrics need no schema
+  changes, and per-metric or cross-sensor queries are a single index range scan.
+
+All methods receive the sqlite connection to use; queries return lazy row
+iterators, so results can be streamed. Methods that write are only
+called from the db writer thread; the schema caches are owned by that thread.
+Tables used internally (ie not sensor tables) are prefixed with zmw_.
+"""
+
+import logging
+import re
+log = logging.getLogger(__name__)
+
+# SQL injection protection: Valid identifier pattern (alphanumeric + underscore, can't start with digit)
+_SQL_IDENTIFIER_PATTERN = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+_MAX_IDENTIFIER_LENGTH = 128
+
+# SQLite reserved keywords that should not be used as identifiers
+_SQLITE_KEYWORDS = {
+    'abort', 'action', 'add', 'after', 'all', 'alter', 'analyze', 'and', 'as', 'asc',
+    'attach', 'autoincrement', 'before', 'begin', 'between', 'by', 'cascade', 'case',
+    'cast', 'check', 'collate', 'column', 'commit', 'conflict', 'constraint', 'create',
+    'cross', 'current_date', 'current_time', 'current_timestamp', 'database', 'default',
+    'deferrable', 'deferred', 'delete', 'desc', 'detach', 'distinct', 'drop', 'each',
+    'else', 'end', 'escape', 'except', 'exclusive', 'exists', 'explain', 'fail', 'for',
+    'foreign', 'from', 'full', 'glob', 'group', 'having', 'if', 'ignore', 'immediate',
+    'in', 'index', 'indexed', 'initially', 'inner', 'insert', 'instead', 'intersect',
+    'into', 'is', 'isnull', 'join', 'key', 'left', 'like', 'limit', 'match', 'natural',
+    'no', 'not', 'notnull', 'null', 'of', 'offset', 'on', 'or', 'order', 'outer', 'plan',
+    'pragma', 'primary', 'query', 'raise', 'recursive', 'references', 'regexp', 'reindex',
+    'release', 'rename', 'replace', 'restrict', 'right', 'rollback', 'row', 'savepoint',
+    'select', 'set', 'table', 'temp', 'temporary', 'then', 'to', 'transaction', 'trigger',
+    'union', 'unique', 'update', 'using', 'vacuum', 'values', 'view', 'virtual', 'when',
+    'where', 'with', 'without'
+}
+
+def validate_sql_identifier(identifier, identifier_type="identifier"):
+    """
+    Validates that an identifier (table/column name) is safe to use in SQL queries.
+
+    This prevents SQL injection by ensuring identifiers only contain safe characters.
+    Since SQLite doesn't support parameterized table/column names, we must validate them.
+
+    Args:
+        identifier: The identifier to validate (table name, column name, etc.)
+        identifier_type: Description of what this identifier represents (for error messages)
+
+    Raises:
+        ValueError: If the identifier is invalid or potentially unsafe
+    """
+    if not identifier or not isinstance(identifier, str):
+        raise ValueError(f"Invalid {identifier_type}: must be a non-empty string")
+
+    if len(identifier) > _MAX_IDENTIFIER_LENGTH:
+        raise ValueError(
+            f"Invalid {identifier_type} '{identifier}': exceeds maximum length of {_MAX_IDENTIFIER_LENGTH}")
+
+    if not _SQL_IDENTIFIER_PATTERN.match(identifier):
+        raise ValueError(
+            f"Invalid {identifier_type} '{identifier}': must contain only alphanumeric characters "
+            f"and underscores, and cannot start with a digit")
+
+    if identifier.lower() in _SQLITE_KEYWORDS:
+        raise ValueError(
+            f"Invalid {identifier_type} '{identifier}': cannot use SQLite reserved keyword")
+
+    return identifier
+
+def validate_time_unit(unit):
+    """Validates time units used in SQLite datetime() function to prevent injection."""
+    valid_units = {'years', 'months', 'days', 'hours', 'minutes', 'seconds'}
+    if unit not in valid_units:
+        raise ValueError(f"Invalid time unit '{unit}': must be one of {valid_units}")
+    return unit
+
+
+# Tables matching this are internal, and never sensor tables
+INTERNAL_TABLE_PREFIX = 'zmw_'
+_NARROW_READINGS_TABLE = 'zmw_readings'
+
+
+def _known_tables(conn):
+    res = conn.execute("SELECT name FROM sqlite_schema WHERE type = 'table'").fetchall()
+    return [x for (x,) in res]
+
+
+def detect_storage_layout(conn):
+    """ Returns the layout of an existing database ('wide' or 'narrow'), or None if it has no tables yet """
+    tables = _known_tables(conn)
+    if _NARROW_READINGS_TABLE in tables:
+        return 'narrow'
+    if any(not t.startswith(INTERNAL_TABLE_PREFIX) for t in tables):
+        return 'wide'
+    return None
+
+
+def build_storage(layout):
+    """ Returns the storage implementation for a layout name """
+    if layout == 'wide':
+        return WideStorage()
+    if layout == 'narrow':
+        return NarrowStorage()
+    raise ValueError(f"Unknown sensors db layout '{layout}': must be 'wide' or 'narrow'")
+
+
+def dump_sensor(storage, conn, sensor_name):
+    """ Yields (sample_time, {metric: value}) for all samples of a sensor, oldest first """
+    metrics, rows = storage.all_metrics_in_sensor(conn, sensor_name)
+    for row in rows:
+        yield row[0], {m: v for m, v in zip(metrics, row[1:]) if v is not None}
+
+
+def since_modifier(unit, time):
+    """ Builds a modifier for sqlite's datetime('now', ?), or None if there should be no time limit """
+    if time is None:
+        return None
+    return f'-{int(time)} {validate_time_unit(unit)}'
+
+
+class WideStorage:
+    """ One table per sensor, one column per metric """
+
+    layout = 'wide'
+
+    def __init__(self):
+        self._schema_cache = {}  # {sensor_name: set(columns)}
+
+    def migrate(self, conn):
+        """ Databases created before sample_time was indexed need their index created once """
+        indexed = {tbl for (tbl,) in conn.execute(
+            "SELECT tbl_name FROM sqlite_schema WHERE type = 'index' AND name = tbl_name || '_sample_time_idx'")}
+        for sensor_name in self.known_sensors(conn):
+            if sensor_name not in indexed:
+                log.info("Creating sample_time index for sensor table '%s'", sensor_name)
+                self._maybe_create_time_index(conn, validate_sql_identifier(sensor_name, "sensor name"))
+
+    def invalidate_cache(self):
+        self._schema_cache.clear()
+
+    def ensure_schema(self, conn, sensor_name, metrics):
+        """ Create table or add missing columns, unless the schema cache says they already exist """
+        known = self._schema_cache.get(sensor_name)
+        if known is not None and known.issuperset(metrics):
+            return
+        self._maybe_create_table(conn, sensor_name, metrics)
+        self._schema_cache[sensor_name] = {'sample_time', *self.sensor_metrics(conn, sensor_name)}
+
+    def insert(self, conn, sensor_name, sample_time, values_dict):
+        metrics = list(values_dict.keys())
+        self.ensure_schema(conn, sensor_name, metrics)
+        cols_q = ', '.join(['sample_time'] + metrics)
+        vals_placeholders = ', '.join('?' * (len(metrics) + 1))
+        conn.execute(f'INSERT INTO {sensor_name} ({cols_q}) VALUES ({vals_placeholders})',
+                     [sample_time] + list(values_dict.values()))
+
+    def set_values(self, conn, sensor_name, metric, samples):
+        """ Set metric to value in the existing samples of a sensor, for each (sample_time, value) in samples """
+        self.ensure_schema(conn, sensor_name, [metric])
+        conn.executemany(f'UPDATE {sensor_name} SET {metric} = ? WHERE sample_time = ?',
+                         [(value, sample_time) for sample_time, value in samples])
+
+    def known_sensors(self, conn):
+        return [t for t in _known_tables(conn) if not t.startswith(INTERNAL_TABLE_PREFIX)]
+
+    def sensor_metrics(self, conn, sensor_name):
+        # Validate sensor name to prevent SQL injection
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+
+        res = conn.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{sensor_name}')")
+        # unpack, so we return as a vector instead of a vec of tuples
+        # also remove the special metric "sample_time"
+        return [metric for (metric,) in res.fetchall() if metric != 'sample_time']
+
+    def known_metrics(self, conn):
+        known_metrics = set()
+        for s in self.known_sensors(conn):
+            for m in self.sensor_metrics(conn, s):
+                known_metrics.add(m)
+        return known_metrics
+
+    def sensors_with_metric(self, conn, metric):
+        all_sensors = []
+        for sensor_name in self.known_sensors(conn):
+            if metric in self.sensor_metrics(conn, sensor_name):
+                all_sensors.append(sensor_name)
+        return all_sensors
+
+    def discard_old_samples(self, conn, sensor_name, retention_rows, retention_days, max_rows):
+        """ Delete up to max_rows samples older than the retention cutoff, oldest first. Returns the number of
+        deleted rows; if it's max_rows, there may be more samples left to discard. """
+        # Validate sensor name to prevent SQL injection
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        cutoff = self._retention_cutoff(conn, sensor_name, retention_rows, retention_days)
+        if cutoff is None:
+            return 0
+        res = conn.execute(
+            f'DELETE FROM {sensor_name} '
+            f'WHERE rowid IN ('
+            f'  SELECT rowid FROM {sensor_name} '
+            f'  WHERE sample_time < ? '
+            f'  ORDER BY sample_time '
+            f'  LIMIT {int(max_rows)}'
+            f')', (cutoff,))
+        return res.rowcount
+
+    def latest_values(self, conn, sensor_name):
+        """ Returns {metric: (sample_time, value)} with the last non-null value of each metric of a sensor """
+        latest = {}
+        for metric in self.sensor_metrics(conn, sensor_name):
+            row = conn.execute(f'SELECT sample_time, {metric} FROM {sensor_name} '
+                               f'WHERE {metric} IS NOT NULL ORDER BY sample_time DESC LIMIT 1').fetchone()
+            if row is not None:
+                latest[metric] = row
+        return latest
+
+    def oldest_sample_time(self, conn, sensor_name):
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        row = conn.execute(f'SELECT MIN(sample_time) FROM {sensor_name}').fetchone()
+        return row[0]
+
+    def newest_sample_time_before(self, conn, sensor_name, before):
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        row = conn.execute(f'SELECT MAX(sample_time) FROM {sensor_name} WHERE sample_time < ?',
+                           (before,)).fetchone()
+        return row[0]
+
+    def samples_between(self, conn, sensor_name, start, end):
+        """ Returns {metric: [(sample_time, value)]} with the non-null values of a sensor in [start, end) """
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        metrics = self.sensor_metrics(conn, sensor_name)
+        if not metrics:
+            return {}
+        series = {m: [] for m in metrics}
+        res = conn.execute(f'SELECT sample_time, {", ".join(metrics)} FROM {sensor_name} '
+                           'WHERE sample_time >= ? AND sample_time < ? ORDER BY sample_time', (start, end))
+        for row in res:
+            for metric, value in zip(metrics, row[1:]):
+                if value is not None:
+                    series[metric].append((row[0], value))
+        return {m: samples for m, samples in series.items() if samples}
+
+    def delete_between(self, conn, sensor_name, start, end):
+        """ Delete all samples of a sensor in [start, end). Returns the number of deleted rows. """
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        return conn.execute(f'DELETE FROM {sensor_name} WHERE sample_time >= ? AND sample_time < ?',
+                            (start, end)).rowcount
+
+    def metric_in_sensor(self, conn, sensor_name, metric, since):
+        """ Returns an iterator of (sample_time, value) for one metric of one sensor, after the datetime('now', since)
+        modifier """
+        # Rows where this metric is null were saved for other metrics (eg because of write filtering)
+        where = f"WHERE {metric} IS NOT NULL "
+        if since is not None:
+            where += "AND sample_time > datetime('now', ?) "
+        query = f"SELECT sample_time, {metric} " +\
+                f"FROM {sensor_name} " +\
+                where +\
+                "ORDER BY sample_time"
+        return conn.execute(query, (since,) if since is not None else ())
+
+    def all_metrics_in_sensor(self, conn, sensor_name):
+        """ Returns (metrics, iterator of (sample_time, metric1, metric2...)) for all samples of a sensor """
+        # metrics returned from sensor_metrics are already validated
+        metrics = self.sensor_metrics(conn, sensor_name)
+        cols = ','.join(metrics)
+        query = f"SELECT sample_time, {cols} FROM {sensor_name} ORDER BY sample_time"
+        return metrics, conn.execute(query)
+
+    def single_metric_in_all_sensors(self, conn, metric, since):
+        """ Returns (sensors, iterator of (sample_time, value_in_sensor1, value_in_sensor2...)). Each row has a
+        single sensor set, the value for all other sensors is ''. """
+        # all_sensors come from sensors_with_metric, which validates them
+        all_sensors = self.sensors_with_metric(conn, metric)
+        if len(all_sensors) == 0:
+            return [], []
+
+        # Select a single column per sensor (=table), and enough nulls for all
+        # other columns. The query should look like
+        # SELECT * FROM (
+        #   SELECT metric AS sensor1, NULL as sensor2,   NULL as sensor3...
+        #   UNION
+        #   SELECT NULL AS sensor1,   metric as sensor2, NULL as sensor3...
+        #   UNION
+        #   SELECT NULL AS sensor1,   NULL as sensor2,   metric as sensor3...
+        #   UNION
+        #   ...
+        # )
+        sensor_qs = []
+        for sensor in all_sensors:
+            cols_mask = []
+            for other_sensor in all_sensors:
+                if other_sensor == sensor:
+                    cols_mask.append(f"{metric} AS {sensor}")
+                else:
+                    cols_mask.append(f"'' AS {other_sensor}")
+            cols = ", ".join(cols_mask)
+            time_limit = "  AND sample_time > datetime('now', :since)" if since is not None else ""
+            sensor_qs.append(f"SELECT sample_time, {cols} "
+                             f"FROM {sensor} "
+                             f"WHERE {metric} IS NOT NULL"
+                             f"{time_limit}")
+
+        query = "SELECT * FROM (" +\
+                (" UNION ".join(sensor_qs)) +\
+                ") ORDER BY sample_time"
+        return all_sensors, conn.execute(query, {'since': since})
+
+    def _maybe_create_table(self, conn, sensor_name, metrics):
+        # Validate all identifiers to prevent SQL injection
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        validated_metrics = [validate_sql_identifier(m, "metric name") for m in metrics]
+
+        metric_cols = ' REAL, '.join(validated_metrics)
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {sensor_name} ('
+            '   sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, '
+            f'  {metric_cols} REAL'
+            ')')
+
+        # Add any missing columns to existing tables
+        self._add_missing_columns(conn, sensor_name, validated_metrics)
+        self._maybe_create_time_index(conn, sensor_name)
+
+    @staticmethod
+    def _maybe_create_time_index(conn, sensor_name):
+        # All queries (and retention) filter or sort by sample_time
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {sensor_name}_sample_time_idx ON {sensor_name} (sample_time)')
+
+    @staticmethod
+    def _add_missing_columns(conn, sensor_name, metrics):
+        """Add any columns that exist in metrics but not in the table."""
+        res = conn.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{sensor_name}')")
+        existing_columns = {row[0] for row in res.fetchall()}
+
+        for metric in metrics:
+            if metric not in existing_columns:
+                log.info("Adding missing column '%s' to table '%s'", metric, sensor_name)
+                conn.execute(f'ALTER TABLE {sensor_name} ADD COLUMN {metric} REAL')
+
+    @staticmethod
+    def _retention_cutoff(conn, sensor_name, retention_rows, retention_days):
+        """ Returns the sample_time before which samples should be discarded, or None if all samples should be
+        kept. Both lookups use the sample_time index, so this doesn't scan the table. """
+        cutoffs = []
+        if retention_rows is not None and retention_rows > 0:
+            row = conn.execute(f'SELECT sample_time FROM {sensor_name} '
+                               f'ORDER BY sample_time DESC LIMIT 1 OFFSET {int(retention_rows) - 1}').fetchone()
+            if row is not None:
+                cutoffs.append(row[0])
+        if retention_days is not None:
+            cutoffs.append(conn.execute(f"SELECT datetime('now', '-{int(retention_days)} days')").fetchone()[0])
+        return max(cutoffs) if cutoffs else None
+
+
+class NarrowStorage:
+    """ A single long-format readings table, keyed by (sensor_id, metric_id, ts). The table is clustered on its
+    primary key, so all readings of a sensor's metric are contiguous; a covering index on (metric_id, ts) serves
+    cross-sensor queries. Timestamps have a resolution of one second: if a sensor reports the same metric twice in
+    the same second, only the last value is kept. Null values aren't stored. """
+
+    layout = 'narrow'
+
+    def __init__(self):
+        self._sensor_ids = {}  # {sensor_name: id}
+        self._metric_ids = {}  # {metric_name: id}
+        self._sensor_metrics = {}  # {sensor_name: set(metric_names)}
+
+    def migrate(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_sensors ('
+                     '  id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_metrics ('
+                     '  id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        # Keeps track of which metrics a sensor has, even before (or after) it has readings
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_sensor_metrics ('
+                     '  sensor_id INTEGER NOT NULL, metric_id INTEGER NOT NULL,'
+                     '  PRIMARY KEY (sensor_id, metric_id)'
+                     ') WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS zmw_readings ('
+                     '  sensor_id INTEGER NOT NULL, metric_id INTEGER NOT NULL,'
+                     '  ts DATETIME NOT NULL, value REAL,'
+                     '  PRIMARY KEY (sensor_id, metric_id, ts)'
+                     ') WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS zmw_readings_metric_ts_idx '
+                     '  ON zmw_readings (metric_id, ts, sensor_id, value)')
+
+    def invalidate_cache(self):
+        self._sensor_ids.clear()
+        self._metric_ids.clear()
+        self._sensor_metrics.clear()
+
+    def ensure_schema(self, conn, sensor_name, metrics):
+        """ Register sensor and metric names, unless the cache says they are already known """
+        known = self._sensor_metrics.get(sensor_name)
+        if known is not None and known.issuperset(metrics):
+            return
+        sensor_name = validate_sql_identifier(sensor_name, "sensor name")
+        sensor_id = self._get_id(conn, 'zmw_sensors', self._sensor_ids, sensor_name)
+        for metric in metrics:
+            metric_id = self._get_id(conn, 'zmw_metrics', self._metric_ids,
+                                     validate_sql_identifier(metric, "metric name"))
+            conn.execute('INSERT OR IGNORE INTO zmw_sensor_metrics (sensor_id, metric_id) VALUES (?, ?)',
+                         (sensor_id, metric_id))
+        self._sensor_metrics.setdefault(sensor_name, set()).update(metrics)
+
+    def insert(self, conn, sensor_name, sample_time, values_dict):
+        self.ensure_schema(conn, sensor_name, values_dict.keys())
+        sensor_id = self._sensor_ids[sensor_name]
+        conn.executemany('INSERT OR REPLACE INTO zmw_readings (sensor_id, metric_id, ts, value) VALUES (?, ?, ?, ?)',
+                         [(sensor_id, self._metric_ids[m], sample_time, v)
+                          for m, v in values_dict.items() if v is not None])
+
+    def set_values(self, conn, sensor_name, metric, samples):
+        """ Set metric to value in the existing samples of a sensor, for each (sample_time, value) in samples """
+        self.ensure_schema(conn, sensor_name, [metric])
+        sensor_id, metric_id = self._sensor_ids[sensor_name], self._metric_ids[metric]
+        conn.executemany('INSERT OR REPLACE INTO zmw_readings (sensor_id, metric_id, ts, value) VALUES (?, ?, ?, ?)',
+                         [(sensor_id, metric_id, sample_time, value)
+                          for sample_time, value in samples if value is not None])
+
+    def known_sensors(self, conn):
+        return [x for (x,) in conn.execute('SELECT name FROM zmw_sensors ORDER BY id')]
+
+    def sensor_metrics(self, conn, sensor_name):
+        res = conn.execute('SELECT m.name FROM zmw_sensor_metrics sm '
+                           '  JOIN zmw_sensors s ON s.id = sm.sensor_id '
+                           '  JOIN zmw_metrics m ON m.id = sm.metric_id '
+                           'WHERE s.name = ? ORDER BY m.id', (sensor_name,))
+        return [x for (x,) in res]
+
+    def known_metrics(self, conn):
+        res = conn.execute('SELECT name FROM zmw_metrics '
+                           'WHERE id IN (SELECT metric_id FROM zmw_sensor_metrics)')
+        return {x for (x,) in res}
+
+    def sensors_with_metric(self, conn, metric):
+        res = conn.execute('SELECT s.name FROM zmw_sensor_metrics sm '
+                           '  JOIN zmw_sensors s ON s.id = sm.sensor_id '
+                           '  JOIN zmw_metrics m ON m.id = sm.metric_id '
+                           'WHERE m.name = ? ORDER BY s.id', (metric,))
+        return [x for (x,) in res]
+
+    def discard_old_samples(self, conn, sensor_name, retention_rows, retention_days, max_rows):
+        """ Delete up to max_rows samples older than the retention cutoff, oldest first. Retention by row count
+        applies to each metric of the sensor. Returns the number of deleted rows. """
+        row = conn.execute('SELECT id FROM zmw_sensors WHERE name = ?', (sensor_name,)).fetchone()
+        if row is None:
+            return 0
+        sensor_id = row[0]
+        metric_ids = [x for (x,) in conn.execute(
+            'SELECT metric_id FROM zmw_sensor_metrics WHERE sensor_id = ?', (sensor_id,))]
+        days_cutoff = None
+        if retention_days is not None:
+            days_cutoff = conn.execute(f"SELECT datetime('now', '-{int(retention_days)} days')").fetchone()[0]
+
+        deleted = 0
+        for metric_id in metric_ids:
+            if deleted >= max_rows:
+                break
+            cutoffs = [days_cutoff] if days_cutoff is not None else []
+            if retention_rows is not None and retention_rows > 0:
+                row = conn.execute('SELECT ts FROM zmw_readings WHERE sensor_id = ? AND metric_id = ? '
+                                   f'ORDER BY ts DESC LIMIT 1 OFFSET {int(retention_rows) - 1}',
+                                   (sensor_id, metric_id)).fetchone()
+                if row is not None:
+                    cutoffs.append(row[0])
+            if not cutoffs:
+                continue
+            res = conn.execute(
+                'DELETE FROM zmw_readings WHERE sensor_id = :s AND metric_id = :m AND ts IN ('
+                '  SELECT ts FROM zmw_readings WHERE sensor_id = :s AND metric_id = :m AND ts < :cutoff '
+                '  ORDER BY ts LIMIT :n'
+                ')', {'s': sensor_id, 'm': metric_id, 'cutoff': max(cutoffs), 'n': int(max_rows - deleted)})
+            deleted += res.rowcount
+        return deleted
+
+    def latest_values(self, conn, sensor_name):
+        """ Returns {metric: (sample_time, value)} with the last value of each metric of a sensor """
+        metric_ids = conn.execute(
+            'SELECT sm.sensor_id, sm.metric_id, m.name FROM zmw_sensor_metrics sm '
+            '  JOIN zmw_metrics m ON m.id = sm.metric_id '
+            'WHERE sm.sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?)', (sensor_name,)).fetchall()
+        latest = {}
+        for sensor_id, metric_id, metric in metric_ids:
+            row = conn.execute('SELECT ts, value FROM zmw_readings WHERE sensor_id = ? AND metric_id = ? '
+                               'ORDER BY ts DESC LIMIT 1', (sensor_id, metric_id)).fetchone()
+            if row is not None:
+                latest[metric] = row
+        return latest
+
+    def oldest_sample_time(self, conn, sensor_name):
+        # One primary key lookup per metric, instead of scanning all readings of the sensor
+        res = conn.execute('SELECT (SELECT MIN(ts) FROM zmw_readings r '
+                           '        WHERE r.sensor_id = sm.sensor_id AND r.metric_id = sm.metric_id) '
+                           'FROM zmw_sensor_metrics sm '
+                           'WHERE sm.sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?)', (sensor_name,))
+        oldest = [ts for (ts,) in res if ts is not None]
+        return min(oldest) if oldest else None
+
+    def newest_sample_time_before(self, conn, sensor_name, before):
+        res = conn.execute('SELECT (SELECT MAX(ts) FROM zmw_readings r '
+                           '        WHERE r.sensor_id = sm.sensor_id AND r.metric_id = sm.metric_id AND r.ts < ?) '
+                           'FROM zmw_sensor_metrics sm '
+                           'WHERE sm.sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?)', (before, sensor_name))
+        newest = [ts for (ts,) in res if ts is not None]
+        return max(newest) if newest else None
+
+    def samples_between(self, conn, sensor_name, start, end):
+        """ Returns {metric: [(sample_time, value)]} with the values of a sensor in [start, end) """
+        series = {}
+        res = conn.execute('SELECT m.name, r.ts, r.value FROM zmw_readings r '
+                           '  JOIN zmw_metrics m ON m.id = r.metric_id '
+                           'WHERE r.sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?) '
+                           '  AND r.ts >= ? AND r.ts < ? '
+                           'ORDER BY r.metric_id, r.ts', (sensor_name, start, end))
+        for metric, ts, value in res:
+            series.setdefault(metric, []).append((ts, value))
+        return series
+
+    def delete_between(self, conn, sensor_name, start, end):
+        """ Delete all samples of a sensor in [start, end). Returns the number of deleted rows. """
+        return conn.execute('DELETE FROM zmw_readings '
+                            'WHERE sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?) '
+                            '  AND ts >= ? AND ts < ?', (sensor_name, start, end)).rowcount
+
+    def metric_in_sensor(self, conn, sensor_name, metric, since):
+        """ Returns an iterator of (sample_time, value) for one metric of one sensor, after the datetime('now', since)
+        modifier """
+        time_limit = "AND r.ts > datetime('now', :since) " if since is not None else ""
+        return conn.execute(
+            'SELECT r.ts, r.value FROM zmw_readings r '
+            'WHERE r.sensor_id = (SELECT id FROM zmw_sensors WHERE name = :sensor) '
+            '  AND r.metric_id = (SELECT id FROM zmw_metrics WHERE name = :metric) '
+            f'{time_limit}'
+            'ORDER BY r.ts', {'sensor': sensor_name, 'metric': metric, 'since': since})
+
+    def all_metrics_in_sensor(self, conn, sensor_name):
+        """ Returns (metrics, iterator of (sample_time, metric1, metric2...)) for all samples of a sensor """
+        metrics = self.sensor_metrics(conn, sensor_name)
+        col_of = {m: i for i, m in enumerate(metrics)}
+        res = conn.execute(
+            'SELECT r.ts, m.name, r.value FROM zmw_readings r '
+            '  JOIN zmw_metrics m ON m.id = r.metric_id '
+            'WHERE r.sensor_id = (SELECT id FROM zmw_sensors WHERE name = ?) '
+            'ORDER BY r.ts', (sensor_name,))
+
+        def _pivot():
+            current_ts = None
+            current = None
+            for ts, metric, value in res:
+                if ts != current_ts:
+                    if current is not None:
+                        yield tuple([current_ts] + current)
+                    current_ts = ts
+                    current = [None] * len(metrics)
+                current[col_of[metric]] = value
+            if current is not None:
+                yield tuple([current_ts] + current)
+        return metrics, _pivot()
+
+    def single_metric_in_all_sensors(self, conn, metric, since):
+        """ Returns (sensors, iterator of (sample_time, value_in_sensor1, value_in_sensor2...)). Each row has a
+        single sensor set, the value for all other sensors is ''. """
+        all_sensors = self.sensors_with_metric(conn, metric)
+        if len(all_sensors) == 0:
+            return [], []
+        col_of = {s: i for i, s in enumerate(all_sensors)}
+        time_limit = "AND r.ts > datetime('now', :since) " if since is not None else ""
+        res = conn.execute(
+            'SELECT r.ts, s.name, r.value FROM zmw_readings r '
+            '  JOIN zmw_sensors s ON s.id = r.sensor_id '
+            'WHERE r.metric_id = (SELECT id FROM zmw_metrics WHERE name = :metric) '
+            f'{time_limit}'
+            'ORDER BY r.ts', {'metric': metric, 'since': since})
+
+        def _spread():
+            for ts, sensor, value in res:
+                row = [''] * len(all_sensors)
+                row[col_of[sensor]] = value
+                yield tuple([ts] + row)
+        return all_sensors, _spread()
+
+    @staticmethod
+    def _get_id(conn, table, cache, name):
+        if name not in cache:
+            conn.execute(f'INSERT OR IGNORE INTO {table} (name) VALUES (?)', (name,))
+            cache[name] = conn.execute(f'SELECT id FROM {table} WHERE name = ?', (name,)).fetchone()[0]
+        return cache[name]
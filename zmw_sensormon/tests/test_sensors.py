@@ -0,0 +1,203 @@
+"""Unit tests for sensors.py"""
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory
+
+
+@pytest.fixture
+def history(tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), retention_days=7,
+                          batch_max_delay_ms=10)
+    yield hist
+    hist.stop()
+
+
+def _rows(history, query):
+    with sqlite3.connect(history._dbpath) as conn:
+        return conn.execute(query).fetchall()
+
+
+class TestSensorsHistoryWriter:
+    """Test the batched db writer behind SensorsHistory"""
+
+    def test_register_creates_table(self, history):
+        history.register_sensor('Sensor1', ['temperature', 'humidity'])
+        assert history.get_known_sensors() == ['Sensor1']
+        assert set(history.get_metrics_for_sensor('Sensor1')) == {'temperature', 'humidity'}
+
+    def test_register_rejects_bad_names(self, history):
+        with pytest.raises(ValueError):
+            history.register_sensor('Bad name', ['temperature'])
+        with pytest.raises(ValueError):
+            history.register_sensor('Sensor1', ['select'])
+
+    def test_save_reading_is_written_after_flush(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        for i in range(10):
+            history.save_reading('Sensor1', {'temperature': 20 + i})
+        history.flush()
+        assert len(_rows(history, "SELECT * FROM Sensor1")) == 10
+        stats = history.get_writer_stats()
+        assert stats['rows_written'] == 10
+        assert stats['queue_depth'] == 0
+        assert stats['commits'] >= 1
+        assert stats['commit_latency_last_ms'] is not None
+
+    def test_save_reading_adds_new_columns(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.save_reading('Sensor1', {'temperature': 20, 'battery': 90})
+        history.flush()
+        assert set(history.get_metrics_for_sensor('Sensor1')) == {'temperature', 'battery'}
+        assert _rows(history, "SELECT temperature, battery FROM Sensor1") == [(20, 90)]
+
+    def test_save_reading_validates_identifiers(self, history):
+        with pytest.raises(ValueError):
+            history.save_reading('Robert; DROP TABLE x', {'temperature': 1})
+
+    def test_db_uses_wal(self, history):
+        assert _rows(history, "PRAGMA journal_mode") == [('wal',)]
+
+    def test_csv_endpoints(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.register_sensor('Sensor2', ['temperature', 'humidity'])
+        history.save_reading('Sensor1', {'temperature': 20})
+        history.save_reading('Sensor2', {'temperature': 21, 'humidity': 50})
+        history.flush()
+        csv = history.get_metric_in_sensor_csv('Sensor1', 'temperature').splitlines()
+        assert csv[0] == 'sample_time,temperature'
+        assert csv[1].endswith(',20.0')
+        csv = history.get_single_metric_in_all_sensors_csv('temperature').splitlines()
+        assert csv[0] == 'sample_time,Sensor1,Sensor2'
+        assert len(csv) == 3
+        assert sorted(history.get_known_sensors_measuring('humidity')) == ['Sensor2']
+
+    def test_stop_writes_pending_readings(self, tmp_path):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), batch_max_delay_ms=10000)
+        hist.register_sensor('Sensor1', ['temperature'])
+        hist.save_reading('Sensor1', {'temperature': 20})
+        hist.stop()
+        with sqlite3.connect(str(tmp_path / "s.sqlite")) as conn:
+            assert conn.execute("SELECT temperature FROM Sensor1").fetchall() == [(20,)]
+
+    def test_failed_task_changes_are_rolled_back(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.save_reading('Sensor1', {'temperature': 20})
+
+        def partial_task(conn):
+            conn.execute("INSERT INTO Sensor1 (sample_time, temperature) VALUES ('2020-01-01 00:00:00', 99)")
+            raise RuntimeError("failed halfway")
+
+        with pytest.raises(RuntimeError):
+            history._writer.run_sync(partial_task)
+        history.flush()
+        # The reading in the same batch is still saved, the task's partial write isn't
+        assert _rows(history, "SELECT temperature FROM Sensor1") == [(20,)]
+
+    def test_writer_survives_unexpected_errors(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history._writer.add_batch_hook(Mock(side_effect=RuntimeError("bad hook")))
+        history.save_reading('Sensor1', {'temperature': 20})
+        history.flush()
+        assert _rows(history, "SELECT temperature FROM Sensor1") == [(20,)]
+
+        # Non-db errors saving a reading only lose that reading
+        insert = history._writer._storage.insert
+        history._writer._storage.insert = Mock(side_effect=KeyError("boom"))
+        history.save_reading('Sensor1', {'temperature': 21})
+        history.flush()
+        history._writer._storage.insert = insert
+        assert history.get_writer_stats()['write_errors'] == 1
+
+        # If a whole batch fails, waiters are released with the error and the writer keeps going
+        write_batch = history._writer._write_batch
+        history._writer._write_batch = Mock(side_effect=RuntimeError("batch failed"))
+        with pytest.raises(RuntimeError):
+            history._writer.run_sync(lambda _conn: 1)
+        history._writer._write_batch = write_batch
+        assert history._writer.run_sync(lambda _conn: 42) == 42
+        history.save_reading('Sensor1', {'temperature': 22})
+        history.flush()
+        assert _rows(history, "SELECT temperature FROM Sensor1") == [(20,), (22,)]
+
+def _insert_samples(dbpath, sensor_name, sample_times):
+    with sqlite3.connect(dbpath) as conn:
+        conn.executemany(f"INSERT INTO {sensor_name} (sample_time, temperature) VALUES (?, 20)",
+                         [(t,) for t in sample_times])
+
+
+class TestSensorsHistoryRetention:
+    """Test time indexes and background retention"""
+
+    def test_tables_get_time_index(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        idx = _rows(history, "SELECT name FROM sqlite_schema WHERE type = 'index' AND tbl_name = 'Sensor1'")
+        assert idx == [('Sensor1_sample_time_idx',)]
+        plan = _rows(history, "EXPLAIN QUERY PLAN SELECT * FROM Sensor1 WHERE sample_time > '2020-01-01'")
+        assert 'Sensor1_sample_time_idx' in str(plan)
+
+    def test_index_migrated_for_existing_db(self, tmp_path):
+        dbpath = str(tmp_path / "old.sqlite")
+        with sqlite3.connect(dbpath) as conn:
+            conn.execute("CREATE TABLE Sensor1 (sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, temperature REAL)")
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock())
+        hist.stop()
+        with sqlite3.connect(dbpath) as conn:
+            idx = conn.execute("SELECT name FROM sqlite_schema WHERE type = 'index' AND tbl_name = 'Sensor1'"
+                               ).fetchall()
+        assert idx == [('Sensor1_sample_time_idx',)]
+        assert hist.get_known_sensors() == ['Sensor1']
+
+    def test_retention_job_is_scheduled(self, tmp_path):
+        sched = Mock()
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=sched, retention_interval_secs=60)
+        hist.stop()
+        jobs = {c.kwargs['id']: c.kwargs for c in sched.add_job.call_args_list}
+        assert jobs['sensor_history_retention']['seconds'] == 60
+
+    def test_retention_by_days(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        _insert_samples(history._dbpath, 'Sensor1', ['2000-01-01 00:00:00', '2000-01-02 00:00:00'])
+        history.save_reading('Sensor1', {'temperature': 20})
+        history.flush()
+        history.apply_retention()
+        assert len(_rows(history, "SELECT * FROM Sensor1")) == 1
+        assert history.get_writer_stats()['retention']['rows_deleted_last_run'] == 2
+
+    def test_retention_by_rows_keeps_newest(self, tmp_path):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), retention_rows=3)
+        hist.register_sensor('Sensor1', ['temperature'])
+        _insert_samples(hist._dbpath, 'Sensor1', [f'2000-01-0{d} 00:00:00' for d in range(1, 10)])
+        hist.apply_retention()
+        hist.stop()
+        with sqlite3.connect(str(tmp_path / "s.sqlite")) as conn:
+            left = conn.execute("SELECT sample_time FROM Sensor1 ORDER BY sample_time").fetchall()
+        assert [t for (t,) in left] == ['2000-01-07 00:00:00', '2000-01-08 00:00:00', '2000-01-09 00:00:00']
+
+    def test_retention_work_is_bounded_per_run(self, tmp_path):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), retention_days=1,
+                              retention_max_rows_per_run=5, retention_chunk_rows=2)
+        hist.register_sensor('Sensor1', ['temperature'])
+        _insert_samples(hist._dbpath, 'Sensor1', [f'2000-01-{d:02} 00:00:00' for d in range(1, 13)])
+        hist.apply_retention()
+        stats = hist.get_writer_stats()['retention']
+        assert stats['rows_deleted_last_run'] == 5
+        assert stats['pending']
+        hist.apply_retention()
+        hist.apply_retention()
+        stats = hist.get_writer_stats()['retention']
+        assert stats['rows_deleted_total'] == 12
+        assert not stats['pending']
+        hist.stop()
+
+    def test_gc_deletes_everything_out_of_retention(self, tmp_path):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), retention_days=1,
+                              retention_max_rows_per_run=5, retention_chunk_rows=2)
+        hist.register_sensor('Sensor1', ['temperature'])
+        _insert_samples(hist._dbpath, 'Sensor1', [f'2000-01-{d:02} 00:00:00' for d in range(1, 13)])
+        hist.gc_dead_sensors()
+        hist.stop()
+        with sqlite3.connect(str(tmp_path / "s.sqlite")) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM Sensor1").fetchone() == (0,)
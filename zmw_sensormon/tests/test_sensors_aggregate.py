@@ -0,0 +1,104 @@
+"""Unit tests for sensors_aggregate.py"""
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+import pytest
+from flask import Flask
+
+from sensors import SensorsHistory
+from sensors_aggregate import align_buckets, bucket_series, validate_aggregations, validate_bucket_secs
+
+
+def _t(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# A bucket boundary for hourly buckets, a couple of hours ago
+_BASE = int(datetime.now(timezone.utc).timestamp()) // 3600 * 3600 - 2 * 3600
+
+
+class TestBucketing:
+    """Test bucketing and aggregations"""
+
+    SAMPLES = [(_t(_BASE + 10 * i), v) for i, v in enumerate([4, 1, 3, 2, 5])] + \
+              [(_t(_BASE + 3600), 7), (_t(_BASE + 3600 + 100), 'off')]
+
+    def test_aggregations(self):
+        buckets = bucket_series(self.SAMPLES, 3600, ['avg', 'min', 'max', 'count', 'first', 'last', 'rate', 'p50'])
+        assert buckets[_BASE] == [3, 1, 5, 5, 4, 5, 1 / 40, 3]
+        # Non-numeric values are skipped, a single reading has no rate
+        assert buckets[_BASE + 3600] == [7, 7, 7, 1, 7, 7, None, 7]
+
+    def test_percentiles_interpolate(self):
+        buckets = bucket_series(self.SAMPLES[:5], 3600, ['p0', 'p25', 'p100', 'p90'])
+        assert buckets[_BASE] == [1, 2, 5, pytest.approx(4.6)]
+
+    def test_small_buckets(self):
+        buckets = bucket_series(self.SAMPLES[:5], 20, ['count'])
+        assert buckets == {_BASE: [2], _BASE + 20: [2], _BASE + 40: [1]}
+
+    def test_align(self):
+        series = {'Sensor1': {_BASE: [1, 2]}, 'Sensor2': {_BASE + 60: [3, 4]}}
+        header, rows = align_buckets(series, ['avg', 'max'])
+        assert header == ['sample_time', 'Sensor1_avg', 'Sensor1_max', 'Sensor2_avg', 'Sensor2_max']
+        assert rows == [(_t(_BASE), 1, 2, None, None), (_t(_BASE + 60), None, None, 3, 4)]
+
+    def test_validation(self):
+        assert validate_aggregations(['avg', 'p95', 'p99.9']) == ['avg', 'p95', 'p99.9']
+        for bad in (['median'], ['p101'], ['px'], []):
+            with pytest.raises(ValueError):
+                validate_aggregations(bad)
+        with pytest.raises(ValueError):
+            validate_bucket_secs(0, None)
+        with pytest.raises(ValueError):
+            validate_bucket_secs(1, 365 * 24 * 60 * 60)
+
+
+@pytest.fixture
+def history(tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), retention_days=7,
+                          batch_max_delay_ms=10)
+    hist.register_sensor('Sensor1', ['temperature'])
+    hist.register_sensor('Sensor2', ['temperature', 'humidity'])
+    readings = [('Sensor1', 0, 10), ('Sensor1', 60, 20), ('Sensor2', 30, 15), ('Sensor1', 3600, 30)]
+    for sensor_name, offset, value in readings:
+        hist._writer.run_sync(lambda conn, s=sensor_name, o=offset, v=value:
+                              hist._storage.insert(conn, s, _t(_BASE + o), {'temperature': v}))
+    yield hist
+    hist.stop()
+
+
+class TestSensorsHistoryAggregate:
+    """Test aggregation queries over sensor history"""
+
+    def test_all_sensors_on_common_axis(self, history):
+        res = history.get_aggregate('temperature', aggs=['avg', 'max'])
+        assert res == {
+            'sample_time': [_t(_BASE), _t(_BASE + 3600)],
+            'sensors': {
+                'Sensor1': {'avg': [15, 30], 'max': [20, 30]},
+                'Sensor2': {'avg': [15, None], 'max': [15, None]},
+            },
+        }
+
+    def test_selected_sensors(self, history):
+        res = history.get_aggregate('temperature', sensors=['Sensor2', 'Unknown'], bucket_secs=60, aggs=['count'])
+        assert res == {'sample_time': [_t(_BASE)], 'sensors': {'Sensor2': {'count': [1]}}}
+
+    def test_unknown_metric(self, history):
+        assert history.get_aggregate('pressure') is None
+
+    def test_time_range(self, history):
+        res = history.get_aggregate('temperature', unit='minutes', time=1)
+        assert res['sample_time'] == []
+
+    def test_http(self, history):
+        app = Flask(__name__)
+        history.register_to_webserver(app)
+        client = app.test_client()
+        res = client.get('/sensors/aggregate/temperature?sensors=Sensor1&agg=min,last&bucket_secs=3600')
+        assert res.status_code == 200
+        assert res.get_data(as_text=True).splitlines() == [
+            'sample_time,Sensor1_min,Sensor1_last', f'{_t(_BASE)},10.0,20.0', f'{_t(_BASE + 3600)},30.0,30.0']
+        assert client.get('/sensors/aggregate/temperature?agg=median').status_code == 400
+        assert client.get('/sensors/aggregate/temperature?bucket_secs=abc').status_code == 400
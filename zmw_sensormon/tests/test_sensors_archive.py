@@ -0,0 +1,123 @@
+"""Unit tests for sensors_archive.py"""
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory
+from sensors_archive import ArchiveReader, month_bounds, write_archive
+
+
+def _days_ago(days, secs=0):
+    t = datetime.now(timezone.utc) - timedelta(days=days) + timedelta(seconds=secs)
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class TestArchiveFile:
+    """Test the archive file format"""
+
+    def test_roundtrip(self, tmp_path):
+        path = str(tmp_path / 'a.zmwa')
+        series = {'temperature': [(1700000000 + 60 * i, 20 + i / 10) for i in range(100)],
+                  'humidity': [(1700000030, 55.0)]}
+        write_archive(path, series)
+        with ArchiveReader(path) as archived:
+            assert archived.metrics() == ['temperature', 'humidity']
+            assert archived.read('humidity') == series['humidity']
+            assert archived.read('temperature') == series['temperature']
+            assert archived.read('pressure') == []
+
+    def test_not_an_archive(self, tmp_path):
+        path = tmp_path / 'a.zmwa'
+        path.write_bytes(b'something else')
+        with pytest.raises(ValueError):
+            ArchiveReader(str(path))
+
+    def test_month_bounds(self):
+        assert month_bounds('2024-02') == ('2024-02-01 00:00:00', '2024-03-01 00:00:00')
+        assert month_bounds('2024-12') == ('2024-12-01 00:00:00', '2025-01-01 00:00:00')
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def history(request, tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), db_layout=request.param,
+                          retention_days=90, batch_max_delay_ms=10, chunk_after_days=2,
+                          archive_dir=str(tmp_path / "archive"))
+    hist.register_sensor('Sensor1', ['temperature', 'humidity'])
+    hist.register_sensor('Sensor2', ['temperature'])
+    # 70 and 40 days ago are always in closed months
+    for day in (70, 40, 0):
+        for i in range(10):
+            _insert_at(hist, 'Sensor1', _days_ago(day, -60 * i), {'temperature': 20 + i / 10, 'humidity': 50})
+            _insert_at(hist, 'Sensor2', _days_ago(day, -60 * i - 30), {'temperature': 15 - i})
+    yield hist
+    hist.stop()
+
+
+def _insert_at(history, sensor_name, sample_time, values):
+    history._writer.run_sync(lambda conn: history._storage.insert(conn, sensor_name, sample_time, values))
+
+
+def _query_all(history):
+    return (history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 100, resolution=0),
+            history.get_all_metrics_in_sensor_csv('Sensor1'),
+            history.get_single_metric_in_all_sensors_csv('temperature', 'days', 100, resolution=0),
+            history.get_aggregate('temperature', bucket_secs=24 * 60 * 60, aggs=['count'], time=100))
+
+
+def _oldest_in_db(history, sensor_name):
+    with sqlite3.connect(history._dbpath) as conn:
+        return [t for t in (history._storage.oldest_sample_time(conn, sensor_name),
+                            history._chunks.oldest_sample_time(conn, sensor_name)) if t is not None]
+
+
+class TestSensorsHistoryArchive:
+    """Test archiving closed months, and queries across the archive and the db"""
+
+    def test_archive_keeps_query_results(self, history):
+        history.compact_cold_samples()
+        before = _query_all(history)
+        history.archive_closed_months()
+        month_start = _days_ago(0)[:7] + '-01 00:00:00'
+        for sensor_name in ('Sensor1', 'Sensor2'):
+            assert min(_oldest_in_db(history, sensor_name)) >= month_start
+            assert len(history._archive.months(sensor_name)) == 2
+        assert _query_all(history) == before
+        stats = history.get_writer_stats()['archive']
+        assert stats['files'] == 4
+        assert stats['readings_archived_total'] == 60
+
+    def test_queries_only_read_spanned_months(self, history):
+        history.archive_closed_months()
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor2', 'temperature', 'days', 50, resolution=0)
+        assert len(csv.splitlines()) == 21
+
+    def test_late_readings_merge_into_archive(self, history):
+        history.archive_closed_months()
+        _insert_at(history, 'Sensor2', _days_ago(40, 15), {'temperature': 99})
+        history.archive_closed_months()
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor2', 'temperature', 'days', 100, resolution=0)
+        assert f'{_days_ago(40, 15)},99.0' in csv.splitlines()
+        assert len(csv.splitlines()) == 32
+
+    def test_retention_keeps_readings_until_archived(self, history):
+        month_start = datetime.fromisoformat(_days_ago(0)[:7] + '-01')
+        last_month = (month_start - timedelta(hours=12)).strftime('%Y-%m-%d %H:%M:%S')
+        history.register_sensor('Sensor3', ['temperature'])
+        _insert_at(history, 'Sensor3', last_month, {'temperature': 1})
+        history._retention_days = 7
+        history.apply_retention()
+        # Readings from the previous month are still in the db, waiting to be archived
+        assert _oldest_in_db(history, 'Sensor3') == [last_month]
+        history.archive_closed_months()
+        history.apply_retention()
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor3', 'temperature', 'days', 100, resolution=0)
+        assert csv.splitlines()[1:] == [f'{last_month},1.0']
+
+    def test_non_numeric_sensors_are_not_archived(self, history):
+        history.register_sensor('Sensor3', ['state'])
+        _insert_at(history, 'Sensor3', _days_ago(40), {'state': 'on'})
+        history.archive_closed_months()
+        assert history._archive.months('Sensor3') == []
+        assert _oldest_in_db(history, 'Sensor3') == [_days_ago(40)]
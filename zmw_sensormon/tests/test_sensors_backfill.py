@@ -0,0 +1,139 @@
+"""Unit tests for sensors_backfill.py"""
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory
+from sensors_backfill import compute_window
+from virtual_metrics import VIRTUAL_METRICS
+
+
+def _t(hours_ago, secs=0):
+    t = datetime.now(timezone.utc) - timedelta(hours=hours_ago) + timedelta(seconds=secs)
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _sum_column(columns):
+    return [None if a is None or b is None else a + b for a, b in zip(columns['a'], columns['b'])]
+
+
+class TestComputeWindow:
+    """Test computing a derived metric over aligned columns"""
+
+    def test_aligns_and_carries_values(self):
+        series = {'a': [('t1', 1), ('t3', 3)], 'b': [('t2', 10), ('t3', 30)]}
+        carry = {}
+        # At t1 there's no value of b yet
+        assert compute_window(series, ['a', 'b'], _sum_column, carry) == [('t2', 11), ('t3', 33)]
+        assert carry == {'a': 3, 'b': 30}
+        # Carried values are used in the next window
+        assert compute_window({'a': [('t4', 4)]}, ['a', 'b'], _sum_column, carry) == [('t4', 34)]
+
+    def test_empty_window(self):
+        assert not compute_window({}, ['a', 'b'], _sum_column, {})
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def history(request, tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), db_layout=request.param,
+                          retention_days=7, batch_max_delay_ms=10, backfill_window_hours=6, backfill_pause_secs=0)
+    hist.register_sensor('Sensor1', ['temperature', 'humidity'])
+    hist.register_sensor('Sensor2', ['temperature'])
+    # A reading every 10 minutes for the last day, stored before feels_like_temp existed
+    for i in range(6 * 24):
+        hist._writer.run_sync(lambda conn, i=i: hist._storage.insert(
+            conn, 'Sensor1', _t(24, 600 * i), {'temperature': 15 + i % 20, 'humidity': 50}))
+        hist._writer.run_sync(lambda conn, i=i: hist._storage.insert(
+            conn, 'Sensor2', _t(24, 600 * i), {'temperature': 15}))
+    yield hist
+    hist.stop()
+
+
+def _feels_like(history, resolution=0, agg='avg'):
+    csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'feels_like_temp', 'days', 2,
+                                                     resolution=resolution, agg=agg)
+    return [line.split(',') for line in csv.splitlines()[1:]]
+
+
+class TestSensorsHistoryBackfill:
+    """Test backfilling virtual metrics over sensor history"""
+
+    def test_backfill(self, history):
+        history.schedule_derived_metrics_backfill(VIRTUAL_METRICS)
+        assert history._scheduler.add_job.call_args.kwargs['id'] == 'sensor_history_derived_backfill'
+        history.backfill_derived_metrics(VIRTUAL_METRICS)
+
+        compute = VIRTUAL_METRICS['feels_like_temp']['compute']
+        rows = _feels_like(history)
+        assert len(rows) == 6 * 24
+        for i, (_, value) in enumerate(rows):
+            assert float(value) == pytest.approx(compute({'temperature': 15 + i % 20, 'humidity': 50}))
+
+        # Rollups include the new values
+        counts = _feels_like(history, resolution=3600, agg='count')
+        assert sum(int(n) for _, n in counts) == 6 * 24
+
+        assert 'feels_like_temp' in history.get_metrics_for_sensor('Sensor1')
+        assert 'feels_like_temp' not in history.get_metrics_for_sensor('Sensor2')
+        stats = history.get_writer_stats()['derived_backfill']
+        assert stats['values_written_total'] == 6 * 24
+        assert stats['progress'] == 1.0
+
+    def test_resumes_after_stop(self, history):
+        history.schedule_derived_metrics_backfill(VIRTUAL_METRICS)
+        # Stopped: only one window is written before the backfill returns
+        history._stopped.set()
+        history.backfill_derived_metrics(VIRTUAL_METRICS)
+        assert 0 < len(_feels_like(history)) < 6 * 24
+        with sqlite3.connect(history._dbpath) as conn:
+            assert len(history._backfill.pending(conn)) == 1
+
+        history._stopped.clear()
+        history.backfill_derived_metrics(VIRTUAL_METRICS)
+        assert len(_feels_like(history)) == 6 * 24
+        assert history.get_writer_stats()['derived_backfill']['values_written_total'] == 6 * 24
+
+    def test_version_bump_recomputes(self, history):
+        history.schedule_derived_metrics_backfill(VIRTUAL_METRICS)
+        history.backfill_derived_metrics(VIRTUAL_METRICS)
+        with sqlite3.connect(history._dbpath) as conn:
+            assert not history._backfill.schedule(conn, history._storage, VIRTUAL_METRICS, _t(0))
+
+        fixed = {'feels_like_temp': {**VIRTUAL_METRICS['feels_like_temp'], 'version': 2,
+                                     'compute_column': lambda cols: [42] * len(cols['temperature'])}}
+        history.schedule_derived_metrics_backfill(fixed)
+        history.backfill_derived_metrics(fixed)
+        assert {value for _, value in _feels_like(history)} == {'42.0'}
+        # Rollup buckets were rebuilt, not added to
+        assert {value for _, value in _feels_like(history, resolution=3600, agg='max')} == {'42.0'}
+        assert sum(int(n) for _, n in _feels_like(history, resolution=3600, agg='count')) == 6 * 24
+
+    def test_existing_derived_metrics_are_not_recomputed(self, tmp_path):
+        # A db from before backfills existed, where feels_like_temp was already computed at ingest
+        dbpath = str(tmp_path / "old.sqlite")
+        with sqlite3.connect(dbpath) as conn:
+            conn.execute("CREATE TABLE Sensor1 (sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, temperature REAL, "
+                         "humidity REAL, feels_like_temp REAL)")
+            conn.execute("CREATE TABLE Sensor2 (sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, temperature REAL, "
+                         "humidity REAL)")
+            for i in range(3):
+                conn.execute("INSERT INTO Sensor1 VALUES (?, 20, 50, 19)", (_t(3 - i),))
+                conn.execute("INSERT INTO Sensor2 VALUES (?, 20, 50)", (_t(3 - i),))
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), backfill_pause_secs=0)
+        hist.schedule_derived_metrics_backfill(VIRTUAL_METRICS)
+        with sqlite3.connect(dbpath) as conn:
+            # Only the sensor without the metric needs a backfill
+            assert [p[:2] for p in hist._backfill.pending(conn)] == [('Sensor2', 'feels_like_temp')]
+        hist.backfill_derived_metrics(VIRTUAL_METRICS)
+        assert hist.get_writer_stats()['derived_backfill']['values_written_total'] == 3
+        hist.stop()
+
+        # After a restart, a version bump still recomputes everything
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), backfill_pause_secs=0)
+        fixed = {'feels_like_temp': {**VIRTUAL_METRICS['feels_like_temp'], 'version': 2}}
+        hist.schedule_derived_metrics_backfill(fixed)
+        with sqlite3.connect(dbpath) as conn:
+            assert len(hist._backfill.pending(conn)) == 2
+        hist.stop()
@@ -0,0 +1,84 @@
+"""Unit tests for sensors_cache.py"""
+import sqlite3
+from unittest.mock import Mock, patch
+
+import pytest
+
+from sensors import SensorsHistory
+from sensors_cache import SensorsCache
+
+
+def _open_history(dbpath, layout):
+    return SensorsHistory(dbpath=dbpath, scheduler=Mock(), db_layout=layout, batch_max_delay_ms=10)
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def layout(request):
+    return request.param
+
+
+class TestSensorsCache:
+    """Test the in-memory metadata and last-value cache"""
+
+    def test_update_tracks_last_values(self):
+        cache = SensorsCache()
+        cache.update('Sensor1', '2024-01-01 00:00:00', {'temperature': 20, 'humidity': 50})
+        cache.update('Sensor1', '2024-01-01 00:01:00', {'temperature': 21, 'humidity': None})
+        assert cache.last_values('Sensor1') == {'temperature': 21, 'humidity': 50}
+        assert cache.last_sample_time('Sensor1') == '2024-01-01 00:01:00'
+
+    def test_metadata(self):
+        cache = SensorsCache()
+        assert cache.add_schema('Sensor1', ['temperature'])
+        assert not cache.add_schema('Sensor1', ['temperature'])
+        cache.update('Sensor2', '2024-01-01 00:00:00', {'temperature': 20, 'battery': 90})
+        assert cache.known_sensors() == ['Sensor1', 'Sensor2']
+        assert cache.known_metrics() == ['temperature', 'battery']
+        assert cache.sensors_measuring('temperature') == ['Sensor1', 'Sensor2']
+        assert cache.metrics_for_sensor('Sensor2') == ['temperature', 'battery']
+        assert cache.metrics_for_sensor('Unknown') == []
+
+    def test_last_values_for_metric(self):
+        cache = SensorsCache()
+        cache.add_schema('Sensor1', ['temperature'])
+        cache.update('Sensor2', '2024-01-01 00:00:00', {'temperature': 20})
+        cache.update('Sensor3', '2024-01-01 00:00:00', {'temperature': 22})
+        # Sensor1 never reported a value, so it's not listed
+        assert cache.last_values_for_metric('temperature') == {'Sensor2': 20, 'Sensor3': 22}
+        assert cache.last_values('Sensor1') == {}
+        assert cache.last_values('Unknown') is None
+
+
+class TestSensorsHistoryCache:
+    """Test that SensorsHistory serves metadata and current values from memory"""
+
+    def test_loaded_from_db_on_startup(self, tmp_path, layout):
+        dbpath = str(tmp_path / "sensors.sqlite")
+        hist = _open_history(dbpath, layout)
+        hist.register_sensor('Sensor1', ['temperature', 'humidity'])
+        hist.save_reading('Sensor1', {'temperature': 20, 'humidity': 50})
+        hist.save_reading('Sensor1', {'temperature': 21, 'humidity': None})
+        hist.register_sensor('Sensor2', ['temperature'])
+        hist.stop()
+
+        hist = _open_history(dbpath, layout)
+        assert hist.get_known_sensors() == ['Sensor1', 'Sensor2']
+        assert hist.get_last_values('Sensor1') == {'temperature': 21, 'humidity': 50}
+        assert hist.get_last_values('Sensor2') == {}
+        assert hist.get_last_values_for_metric('temperature') == {'Sensor1': 21}
+        hist.stop()
+
+    def test_current_values_dont_touch_db(self, tmp_path, layout):
+        hist = _open_history(str(tmp_path / "sensors.sqlite"), layout)
+        hist.register_sensor('Sensor1', ['temperature'])
+        with patch('sensors.sqlite3.connect', side_effect=AssertionError("db access")):
+            hist.save_reading('Sensor1', {'temperature': 20, 'battery': 90})
+            assert hist.get_last_values('Sensor1') == {'temperature': 20, 'battery': 90}
+            assert hist.get_last_values_for_metric('battery') == {'Sensor1': 90}
+            assert hist.get_known_sensors_measuring('battery') == ['Sensor1']
+            assert hist.get_metrics_for_sensor('Sensor1') == ['temperature', 'battery']
+            # Already known, so registering again doesn't need to wait for the writer either
+            hist.register_sensor('Sensor1', ['temperature'])
+        hist.stop()
+        with sqlite3.connect(str(tmp_path / "sensors.sqlite")) as conn:
+            assert hist._storage.latest_values(conn, 'Sensor1')['battery'][1] == 90
@@ -0,0 +1,131 @@
+"""Unit tests for sensors_chunks.py"""
+import math
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pytest
+
+from migrate_sensors_db import migrate
+from sensors import SensorsHistory
+from sensors_chunks import decode_timestamps, decode_values, encode_timestamps, encode_values
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def history(request, tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), db_layout=request.param,
+                          retention_days=30, batch_max_delay_ms=10, chunk_after_days=2, chunk_window_hours=24)
+    yield hist
+    hist.stop()
+
+
+# Readings are placed relative to one reference time, so that expected timestamps don't drift if the clock ticks
+# between inserting and checking them
+_NOW = datetime.now(timezone.utc)
+
+
+def _days_ago(days, secs=0):
+    t = _NOW - timedelta(days=days) + timedelta(seconds=secs)
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _insert_at(history, sensor_name, sample_time, values):
+    history._writer.run_sync(lambda conn: history._storage.insert(conn, sensor_name, sample_time, values))
+
+
+def _hot_count(history, sensor_name):
+    with sqlite3.connect(history._dbpath) as conn:
+        return sum(len(s) for s in history._storage.samples_between(
+            conn, sensor_name, '0000-00-00', '9999-99-99').values())
+
+
+class TestChunkEncoding:
+    """Test delta-of-delta timestamps and XOR values"""
+
+    @pytest.mark.parametrize('timestamps', [
+        [1700000000],
+        [1700000000 + 10 * i for i in range(1000)],
+        [1700000000, 1700000001, 1700000100, 1700000099 + 3600, 1700090000],
+    ])
+    def test_timestamps_roundtrip(self, timestamps):
+        assert decode_timestamps(encode_timestamps(timestamps), len(timestamps)) == timestamps
+
+    @pytest.mark.parametrize('values', [
+        [20.5],
+        [20.5] * 100,
+        [20.1, 20.2, -3.0, 0.0, 1e300, -1e-300, 1234567.891, math.inf],
+    ])
+    def test_values_roundtrip(self, values):
+        assert decode_values(encode_values(values), len(values)) == values
+
+    def test_regular_readings_compress(self):
+        n = 8640
+        timestamps = [1700000000 + 10 * i for i in range(n)]
+        values = [20 + round(math.sin(i / 500), 1) for i in range(n)]
+        assert len(encode_timestamps(timestamps)) + len(encode_values(values)) < n
+
+
+class TestSensorsHistoryChunks:
+    """Test compaction of cold readings, and queries across hot and cold readings"""
+
+    def _fill(self, history):
+        history.register_sensor('Sensor1', ['temperature', 'humidity'])
+        history.register_sensor('Sensor2', ['temperature'])
+        for day in (10, 5, 1):
+            for i in range(10):
+                _insert_at(history, 'Sensor1', _days_ago(day, 60 * i), {'temperature': 20 + i / 10, 'humidity': 50})
+                _insert_at(history, 'Sensor2', _days_ago(day, 60 * i + 30), {'temperature': 15 - i})
+
+    def _query_all(self, history):
+        return (history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 7, resolution=0),
+                history.get_all_metrics_in_sensor_csv('Sensor1'),
+                history.get_single_metric_in_all_sensors_csv('temperature', 'days', 30, resolution=0))
+
+    def test_compaction_keeps_query_results(self, history):
+        self._fill(history)
+        before = self._query_all(history)
+        history.compact_cold_samples()
+        # Only readings from the last 2 days are left in the hot table
+        assert _hot_count(history, 'Sensor1') == 20
+        assert _hot_count(history, 'Sensor2') == 10
+        assert self._query_all(history) == before
+        stats = history.get_writer_stats()['chunks']
+        # Narrow layout stores one row per value
+        assert stats['rows_moved_total'] == (40 if history._storage.layout == 'wide' else 60)
+        assert stats['readings'] == 60
+
+    def test_late_readings_merge_into_chunks(self, history):
+        self._fill(history)
+        history.compact_cold_samples()
+        _insert_at(history, 'Sensor2', _days_ago(10, 15), {'temperature': 99})
+        history.compact_cold_samples()
+        assert _hot_count(history, 'Sensor2') == 10
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor2', 'temperature', 'days', 30, resolution=0)
+        assert csv.splitlines()[1:3] == [f'{_days_ago(10, 15)},99.0', f'{_days_ago(10, 30)},15.0']
+
+    def test_non_numeric_sensors_are_not_compacted(self, history):
+        history.register_sensor('Sensor1', ['state'])
+        _insert_at(history, 'Sensor1', _days_ago(10), {'state': 'on'})
+        history.compact_cold_samples()
+        assert _hot_count(history, 'Sensor1') == 1
+
+    def test_retention_discards_old_chunks(self, history):
+        self._fill(history)
+        history.compact_cold_samples()
+        history._retention_days = 7
+        history.apply_retention()
+        assert history.get_writer_stats()['chunks']['readings'] == 30
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 7, resolution=0)
+        assert len(csv.splitlines()) == 21
+
+    def test_migration_copies_chunks(self, history, tmp_path):
+        self._fill(history)
+        history.compact_cold_samples()
+        before = self._query_all(history)
+        history.flush()
+        other = 'narrow' if history._storage.layout == 'wide' else 'wide'
+        dst = str(tmp_path / "migrated.sqlite")
+        migrate(history._dbpath, dst, other)
+        migrated = SensorsHistory(dbpath=dst, scheduler=Mock(), db_layout=other, retention_days=30)
+        assert self._query_all(migrated) == before
+        migrated.stop()
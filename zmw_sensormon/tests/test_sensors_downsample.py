@@ -0,0 +1,118 @@
+"""Unit tests for sensors_downsample.py"""
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
+
+import pytest
+from flask import Flask
+
+from sensors import SensorsHistory
+from sensors_downsample import downsample_rows, lttb_indices
+from sensors_rollups import bucket_start
+
+
+def _t(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+_BASE = int(datetime.now(timezone.utc).timestamp()) - 3600
+
+
+class TestLttb:
+    """Test the LTTB downsampler"""
+
+    def test_short_series_are_kept(self):
+        assert lttb_indices([1, 2, 3], [1, 2, 3], 10) == [0, 1, 2]
+        assert lttb_indices([], [], 10) == []
+
+    def test_keeps_first_last_and_spikes(self):
+        xs = list(range(1000))
+        ys = [20.0] * 1000
+        ys[345] = 35.0
+        ys[712] = 5.0
+        keep = lttb_indices(xs, ys, 20)
+        assert len(keep) == 20
+        assert keep[0] == 0 and keep[-1] == 999
+        assert 345 in keep and 712 in keep
+        assert keep == sorted(keep)
+
+    def test_tiny_budgets(self):
+        assert lttb_indices(list(range(10)), list(range(10)), 2) == [0, 9]
+        assert lttb_indices(list(range(10)), list(range(10)), 1) == [0]
+
+
+class TestDownsampleRows:
+    """Test downsampling of query results"""
+
+    def test_single_column(self):
+        rows = [(_t(_BASE + i), 20 + (10 if i == 500 else 0)) for i in range(1000)]
+        out = downsample_rows(['sample_time', 'temperature'], iter(rows), 50)
+        assert len(out) <= 50
+        assert (_t(_BASE + 500), 30) in out
+
+    def test_sparse_columns_share_the_budget(self):
+        # Rows of single_metric_in_all_sensors: one sensor per row
+        rows = []
+        for i in range(1000):
+            rows.append((_t(_BASE + 2 * i), 20 + i % 7, ''))
+            rows.append((_t(_BASE + 2 * i + 1), '', 10 + i % 5))
+        out = downsample_rows(['sample_time', 'Sensor1', 'Sensor2'], rows, 100)
+        assert len(out) <= 100
+        assert len([r for r in out if r[1] != '']) == 50
+        assert len([r for r in out if r[2] != '']) == 50
+
+    def test_more_columns_than_points(self):
+        rows = [(_t(_BASE + i), *([''] * i), 20 + i, *([''] * (9 - i))) for i in range(10)]
+        header = ['sample_time'] + [f'Sensor{i}' for i in range(10)]
+        out = downsample_rows(header, rows, 4)
+        assert len(out) == 4
+        assert out == sorted(out)
+
+    def test_small_results_are_unchanged(self):
+        rows = [(_t(_BASE), 1, None), (_t(_BASE + 1), None, 2)]
+        assert downsample_rows(['sample_time', 'a', 'b'], rows, 10) == rows
+
+
+@pytest.fixture
+def history(tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), retention_days=2,
+                          batch_max_delay_ms=10)
+    hist.register_sensor('Sensor1', ['temperature'])
+    readings = [('Sensor1', _t(_BASE + i), {'temperature': 40 if i == 123 else 20}) for i in range(600)]
+    hist._writer.run_sync(lambda conn: [hist._storage.insert(conn, *reading) for reading in readings])
+    hist._writer.run_sync(lambda conn: hist._rollups.add_readings(conn, readings))
+    yield hist
+    hist.stop()
+
+
+class TestSensorsHistoryMaxPoints:
+    """Test max_points in history queries"""
+
+    def test_short_range_uses_raw_readings(self, history):
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'hours', 1, max_points=30)
+        lines = csv.splitlines()
+        assert lines[0] == 'sample_time,temperature'
+        assert 1 < len(lines) - 1 <= 30
+        assert f'{_t(_BASE + 123)},40.0' in lines
+
+    def test_long_range_uses_rollup_extremes(self, history):
+        with patch.object(history, '_raw_metric_in_sensor', side_effect=AssertionError("Raw readings read")):
+            csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 1, max_points=30)
+        lines = csv.splitlines()
+        assert 1 < len(lines) - 1 <= 30
+        # 1 day / (4 * 30 points) is 12 minutes: read from the 1m tier, whose max keeps the spike
+        assert f'{bucket_start(_t(_BASE + 123), 60)},40.0' in lines
+        # Other aggregations are honoured
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 1, agg='min',
+                                                          max_points=30)
+        assert all(line.endswith(',20.0') for line in csv.splitlines()[1:])
+
+    def test_http(self, history):
+        app = Flask(__name__)
+        history.register_to_webserver(app)
+        client = app.test_client()
+        res = client.get('/sensors/get_metric_in_sensor_csv/Sensor1/temperature?max_points=30')
+        assert len(res.get_data(as_text=True).splitlines()) - 1 <= 30
+        res = client.get('/sensors/get_single_metric_in_all_sensors_csv/temperature/days/1?max_points=10&format=ndjson')
+        assert len(res.get_data(as_text=True).splitlines()) <= 10
+        assert client.get('/sensors/get_metric_in_sensor_csv/Sensor1/temperature?max_points=0').status_code == 400
+        assert client.get('/sensors/get_metric_in_sensor_csv/Sensor1/temperature?max_points=x').status_code == 400
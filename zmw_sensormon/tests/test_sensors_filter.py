@@ -0,0 +1,134 @@
+"""Unit tests for sensors_filter.py"""
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory
+from sensors_filter import WriteFilter
+
+
+def _t(secs):
+    return f'2024-01-01 00:{secs // 60:02}:{secs % 60:02}'
+
+
+def _feed(wf, readings, sensor_name='Sensor1'):
+    """ Feed [(secs, values)] through the filter, returns everything that would be written """
+    written = []
+    for secs, values in readings:
+        written.extend(wf.filter(sensor_name, _t(secs), secs, values))
+    return written
+
+
+class TestWriteFilter:
+    """Test deadbands, heartbeats and held-back values"""
+
+    def test_no_rules_writes_everything(self):
+        wf = WriteFilter()
+        assert not wf.is_enabled()
+        assert _feed(wf, [(0, {'temperature': 20}), (1, {'temperature': 20})]) == \
+            [(_t(0), {'temperature': 20}), (_t(1), {'temperature': 20})]
+
+    def test_change_only(self):
+        wf = WriteFilter({'battery': {}})
+        written = _feed(wf, [(0, {'battery': 90}), (1, {'battery': 90}), (2, {'battery': 90}), (3, {'battery': 89})])
+        # The end of the flat line is written when the value changes, so the chart stays the same
+        assert written == [(_t(0), {'battery': 90}), (_t(2), {'battery': 90}), (_t(3), {'battery': 89})]
+        stats = wf.get_stats()
+        assert stats['values_seen'] == 4
+        assert stats['values_suppressed'] == 2
+        assert stats['readings_suppressed'] == 2
+        assert stats['held_back_written'] == 1
+        assert stats['suppressed_per_metric'] == {'battery': 2}
+
+    def test_absolute_deadband(self):
+        wf = WriteFilter({'temperature': {'deadband': 0.5}})
+        written = _feed(wf, [(0, {'temperature': 20}), (1, {'temperature': 20.4}), (2, {'temperature': 19.6}),
+                             (3, {'temperature': 21})])
+        assert [vals['temperature'] for _, vals in written] == [20, 19.6, 21]
+
+    def test_relative_deadband(self):
+        wf = WriteFilter({'linkquality': {'deadband_pct': 10}})
+        written = _feed(wf, [(0, {'linkquality': 100}), (1, {'linkquality': 109}), (2, {'linkquality': 120})])
+        assert [vals['linkquality'] for _, vals in written] == [100, 109, 120]
+        assert wf.get_stats()['values_suppressed'] == 1
+
+    def test_heartbeat(self):
+        wf = WriteFilter({'temperature': {'heartbeat_secs': 60}})
+        written = _feed(wf, [(secs, {'temperature': 20}) for secs in range(0, 150, 10)])
+        assert [t for t, _ in written] == [_t(0), _t(60), _t(120)]
+
+    def test_only_filters_configured_metrics(self):
+        wf = WriteFilter({'battery': {}})
+        written = _feed(wf, [(0, {'battery': 90, 'temperature': 20}), (1, {'battery': 90, 'temperature': 20})])
+        assert written == [(_t(0), {'battery': 90, 'temperature': 20}), (_t(1), {'temperature': 20})]
+
+    def test_default_rule(self):
+        wf = WriteFilter({'*': {}, 'temperature': {'deadband': 1}})
+        written = _feed(wf, [(0, {'battery': 90, 'temperature': 20}), (1, {'battery': 90, 'temperature': 20.5})])
+        assert written == [(_t(0), {'battery': 90, 'temperature': 20})]
+
+    def test_non_numeric_values_filter_repeats(self):
+        wf = WriteFilter({'*': {'deadband': 5}})
+        written = _feed(wf, [(0, {'contact': True, 'state': 'on'}), (1, {'contact': True, 'state': 'on'}),
+                             (2, {'contact': False, 'state': 'on'})])
+        assert written == [(_t(0), {'contact': True, 'state': 'on'}), (_t(1), {'contact': True}),
+                           (_t(2), {'contact': False})]
+
+    def test_sensors_are_independent(self):
+        wf = WriteFilter({'temperature': {}})
+        assert _feed(wf, [(0, {'temperature': 20})], 'Sensor1') != []
+        assert _feed(wf, [(0, {'temperature': 20})], 'Sensor2') != []
+
+    def test_drain_returns_held_back_values(self):
+        wf = WriteFilter({'temperature': {}})
+        _feed(wf, [(0, {'temperature': 20}), (1, {'temperature': 20})])
+        assert wf.drain() == [('Sensor1', _t(1), {'temperature': 20})]
+        assert wf.drain() == []
+
+    def test_invalid_config(self):
+        with pytest.raises(ValueError):
+            WriteFilter({'temperature': {'deadbnd': 1}})
+        with pytest.raises(ValueError):
+            WriteFilter({'temperature': {'deadband': -1}})
+
+
+class TestSensorsHistoryWriteFilter:
+    """Test write filtering in SensorsHistory"""
+
+    @pytest.mark.parametrize('layout', ['wide', 'narrow'])
+    def test_flat_readings_are_not_written(self, tmp_path, layout):
+        dbpath = str(tmp_path / "sensors.sqlite")
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), db_layout=layout, batch_max_delay_ms=10,
+                              write_filter={'battery': {}})
+        for _ in range(5):
+            hist.save_reading('Sensor1', {'temperature': 20, 'battery': 90})
+        # Current values don't depend on what's written
+        assert hist.get_last_values('Sensor1') == {'temperature': 20, 'battery': 90}
+        assert hist.get_writer_stats()['write_filter']['values_suppressed'] == 4
+        hist.stop()
+
+        with sqlite3.connect(dbpath) as conn:
+            battery = list(hist._storage.metric_in_sensor(conn, 'Sensor1', 'battery', None))
+            temperature = list(hist._storage.metric_in_sensor(conn, 'Sensor1', 'temperature', None))
+        # Readings within one second overwrite each other in the narrow layout
+        assert len(temperature) == (5 if layout == 'wide' else 1)
+        # The first value, and the held-back value written on stop (unless it landed on the same second)
+        assert 1 <= len(battery) <= 2
+        assert all(value == 90 for _, value in battery)
+
+    def test_rollups_see_every_reading(self, tmp_path):
+        dbpath = str(tmp_path / "sensors.sqlite")
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), batch_max_delay_ms=10,
+                              write_filter={'battery': {'deadband': 5}})
+        for battery in (90, 90, 90, 91, 90, 60):
+            hist.save_reading('Sensor1', {'battery': battery})
+        hist.stop()
+
+        with sqlite3.connect(dbpath) as conn:
+            stored = list(hist._storage.metric_in_sensor(conn, 'Sensor1', 'battery', None))
+            n, vsum = conn.execute("SELECT SUM(n), SUM(vsum) FROM zmw_rollup_1h WHERE metric = 'battery'").fetchone()
+        assert len(stored) < 6
+        # Held-back values written later aren't counted twice
+        assert n == 6
+        assert vsum == 90 + 90 + 90 + 91 + 90 + 60
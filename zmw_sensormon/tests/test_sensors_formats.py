@@ -0,0 +1,148 @@
+"""Unit tests for sensors_formats.py, and the streaming http endpoints"""
+import gzip
+import json
+import math
+import struct
+from unittest.mock import Mock
+
+import pytest
+from flask import Flask
+
+from sensors import SensorsHistory
+from sensors_formats import encode_rows, gzip_stream, to_csv
+
+
+def _decode_bin(data):
+    """ Reference decoder for the bin format """
+    assert data[:4] == b'ZMWS'
+    version, ncols = struct.unpack_from('<BxH', data, 4)
+    assert version == 1
+    pos = 8
+    header = []
+    for _ in range(ncols):
+        (sz,) = struct.unpack_from('<H', data, pos)
+        header.append(data[pos + 2:pos + 2 + sz].decode())
+        pos += 2 + sz
+    pos += -pos % 8
+    cols = [[] for _ in range(ncols)]
+    while True:
+        (nrows,) = struct.unpack_from('<I', data, pos)
+        pos += 8
+        if nrows == 0:
+            break
+        for col in cols:
+            col.extend(struct.unpack_from(f'<{nrows}d', data, pos))
+            pos += 8 * nrows
+    assert pos == len(data)
+    return header, cols
+
+
+ROWS = [('2024-03-01 10:00:00', 20.5, ''), ('2024-03-01 10:00:01', None, 3)]
+
+
+class TestFormats:
+    """Test encoders"""
+
+    def test_csv(self):
+        assert to_csv(['sample_time', 'a', 'b'], ROWS) == \
+                'sample_time,a,b\n2024-03-01 10:00:00,20.5,\n2024-03-01 10:00:01,None,3\n'
+        assert to_csv(['sample_time', 'a'], []) == 'sample_time,a\n'
+
+    def test_ndjson(self):
+        data = b''.join(encode_rows(['sample_time', 'a', 'b'], ROWS, 'ndjson')).decode()
+        lines = [json.loads(l) for l in data.splitlines()]
+        assert lines == [{'sample_time': '2024-03-01 10:00:00', 'a': 20.5, 'b': ''},
+                         {'sample_time': '2024-03-01 10:00:01', 'a': None, 'b': 3}]
+
+    def test_bin(self):
+        data = b''.join(encode_rows(['sample_time', 'a', 'b'], iter(ROWS * 3), 'bin', chunk_rows=4))
+        header, cols = _decode_bin(data)
+        assert header == ['sample_time', 'a', 'b']
+        assert cols[0][:2] == [1709287200.0, 1709287201.0]
+        assert len(cols[0]) == 6
+        assert cols[1][0] == 20.5 and math.isnan(cols[1][1])
+        assert math.isnan(cols[2][0]) and cols[2][1] == 3.0
+
+    def test_bin_columns_are_aligned(self):
+        data = b''.join(encode_rows(['sample_time', 'x'], ROWS, 'bin'))
+        # Header (8 + 2+11 + 2+1 = 24 bytes) is padded to 8 bytes, so each column can be a Float64Array view
+        assert len(data) == 24 + 8 + 2 * 2 * 8 + 8
+
+    def test_invalid_format(self):
+        with pytest.raises(ValueError):
+            encode_rows(['sample_time'], [], 'xml')
+
+    def test_gzip(self):
+        chunks = encode_rows(['sample_time', 'a', 'b'], ROWS, 'csv')
+        assert gzip.decompress(b''.join(gzip_stream(chunks))).decode() == to_csv(['sample_time', 'a', 'b'], ROWS)
+
+
+@pytest.fixture
+def client(tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), retention_days=2,
+                          batch_max_delay_ms=10)
+    app = Flask(__name__)
+    hist.register_to_webserver(app)
+    hist.register_sensor('Sensor1', ['temperature'])
+    for t in range(5):
+        hist.save_reading('Sensor1', {'temperature': 20 + t})
+    hist.flush()
+    yield app.test_client()
+    hist.stop()
+
+
+class TestStreamingEndpoints:
+    """Test history endpoints over http"""
+
+    URL = '/sensors/get_metric_in_sensor_csv/Sensor1/temperature?resolution=0'
+
+    def test_csv_is_default(self, client):
+        res = client.get(self.URL)
+        assert res.mimetype == 'text/csv'
+        assert res.is_streamed
+        lines = res.data.decode().splitlines()
+        assert lines[0] == 'sample_time,temperature'
+        assert len(lines) == 6
+
+    def test_gzip(self, client):
+        res = client.get(self.URL, headers={'Accept-Encoding': 'gzip, deflate'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(res.data).decode() == client.get(self.URL).data.decode()
+
+    def test_ndjson(self, client):
+        res = client.get(self.URL + '&format=ndjson')
+        assert res.mimetype == 'application/x-ndjson'
+        assert [json.loads(l)['temperature'] for l in res.data.decode().splitlines()] == [20, 21, 22, 23, 24]
+
+    def test_bin(self, client):
+        res = client.get('/sensors/get_all_metrics_in_sensor_csv/Sensor1?format=bin')
+        header, cols = _decode_bin(res.data)
+        assert header == ['sample_time', 'temperature']
+        assert cols[1] == [20, 21, 22, 23, 24]
+
+    def test_bad_format(self, client):
+        assert client.get(self.URL + '&format=xml').status_code == 400
+
+    def test_bad_rollup_args(self, client):
+        base = '/sensors/get_metric_in_sensor_csv/Sensor1/temperature'
+        assert client.get(base + '?resolution=abc').status_code == 400
+        assert client.get(base + '?resolution=-5').status_code == 400
+        assert client.get(base + '?agg=median').status_code == 400
+        assert client.get('/sensors/get_single_metric_in_all_sensors_csv/temperature?agg=median').status_code == 400
+        assert client.get(base + '/history/decades/2').status_code == 400
+        assert client.get(base + '/history/days/x').status_code == 400
+        assert client.get(base + '?resolution=60&agg=max').status_code == 200
+
+    def test_bad_sensor_name(self, client):
+        assert client.get('/sensors/get_all_metrics_in_sensor_csv/Sensor-1').status_code == 400
+        assert client.get('/sensors/get_metric_in_sensor_csv/Sensor-1/temperature').status_code == 400
+
+    def test_unknown_sensor(self, client):
+        res = client.get('/sensors/get_metric_in_sensor_csv/Sensor2/temperature')
+        assert res.status_code == 200
+        assert res.data == b''
+
+    def test_single_metric_in_all_sensors(self, client):
+        res = client.get('/sensors/get_single_metric_in_all_sensors_csv/temperature/days/1?format=ndjson')
+        rows = [json.loads(l) for l in res.data.decode().splitlines()]
+        assert rows and all('Sensor1' in r for r in rows)
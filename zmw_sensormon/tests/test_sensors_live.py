@@ -0,0 +1,66 @@
+"""Unit tests for sensors_live.py"""
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory
+from sensors_live import LiveReadings
+
+
+class TestLiveReadings:
+    """Test fan-out of readings to subscribers"""
+
+    def test_filters(self):
+        live = LiveReadings()
+        everything = live.subscribe()
+        temps = live.subscribe(sensors=['Sensor1'], metrics=['temperature'])
+        live.publish('Sensor1', 't1', {'temperature': 20, 'humidity': 50})
+        live.publish('Sensor2', 't2', {'temperature': 15})
+        live.publish('Sensor1', 't3', {'humidity': 55})
+
+        assert temps.get(timeout=0) == {'sensor': 'Sensor1', 'sample_time': 't1', 'values': {'temperature': 20}}
+        assert temps.get(timeout=0) is None
+        assert [everything.get(timeout=0)['sample_time'] for _ in range(3)] == ['t1', 't2', 't3']
+
+    def test_null_values_are_not_sent(self):
+        live = LiveReadings()
+        sub = live.subscribe()
+        live.publish('Sensor1', 't1', {'temperature': None})
+        assert sub.get(timeout=0) is None
+
+    def test_slow_subscriber_drops_oldest(self):
+        live = LiveReadings(max_queued=2)
+        sub = live.subscribe()
+        for i in range(5):
+            live.publish('Sensor1', f't{i}', {'temperature': i})
+        assert [sub.get(timeout=0)['sample_time'] for _ in range(2)] == ['t3', 't4']
+        assert live.get_stats() == {'readings_published': 5, 'readings_dropped': 3, 'subscribers': 1}
+        live.unsubscribe(sub)
+        live.publish('Sensor1', 't5', {'temperature': 5})
+        assert sub.get(timeout=0) is None
+        assert live.get_stats()['subscribers'] == 0
+        assert live.get_stats()['readings_dropped'] == 3
+
+
+@pytest.fixture
+def history(tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), retention_days=2,
+                          batch_max_delay_ms=10, write_filter={'temperature': {'deadband': 1}})
+    hist.register_sensor('Sensor1', ['temperature'])
+    yield hist
+    hist.stop()
+
+
+class TestSensorsHistoryLive:
+    """Test that saved readings are pushed to subscribers"""
+
+    def test_saved_readings_are_pushed(self, history):
+        sub = history.subscribe_live(sensors=['Sensor1'])
+        history.save_reading('Sensor1', {'temperature': 20})
+        # Readings skipped by the write filter are still pushed
+        history.save_reading('Sensor1', {'temperature': 20.1})
+        assert sub.get(timeout=1)['values'] == {'temperature': 20}
+        assert sub.get(timeout=1)['values'] == {'temperature': 20.1}
+        assert history.get_writer_stats()['live']['subscribers'] == 1
+        history.unsubscribe_live(sub)
+        assert history.get_writer_stats()['live']['subscribers'] == 0
@@ -0,0 +1,142 @@
+"""Unit tests for sensors_rolling.py"""
+import math
+import random
+import time
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+import pytest
+from flask import Flask
+
+from sensors import SensorsHistory
+from sensors_rolling import BUCKETS_PER_WINDOW, RollingStats, window_name
+
+_T0 = 1700000000
+
+
+class TestRollingStats:
+    """Test incremental rolling stats"""
+
+    def test_windows(self):
+        stats = RollingStats(windows_secs=[60, 3600], ewma_tau_secs=60)
+        for i, value in enumerate([5, 3, 8, 1, 7]):
+            stats.update('Sensor1', _T0 + 30 * i, {'temperature': value})
+        res = stats.get('Sensor1', _T0 + 120)['temperature']
+        # The last minute only has the readings at +90 and +120
+        assert res['windows']['1m'] == {'count': 2, 'min': 1, 'max': 7, 'mean': 4,
+                                        'slope_per_sec': pytest.approx(6 / 30)}
+        assert res['windows']['1h'] == {'count': 5, 'min': 1, 'max': 8, 'mean': 4.8,
+                                        'slope_per_sec': pytest.approx(1 / 150)}
+        assert res['value'] == 7
+        # Windows are relative to the query time
+        assert stats.get('Sensor1', _T0 + 1000)['temperature']['windows']['1m']['count'] == 0
+
+    def test_slope_stays_precise(self):
+        stats = RollingStats(windows_secs=[600])
+        # A week of readings every 10s, rising 1 per hour
+        for i in range(7 * 24 * 360):
+            stats.update('Sensor1', _T0 + 10 * i, {'temperature': 20 + 10 * i / 3600})
+        res = stats.get('Sensor1', _T0 + 10 * i)['temperature']['windows']['10m']
+        assert res['count'] == 60
+        assert res['slope_per_sec'] == pytest.approx(1 / 3600, rel=1e-6)
+
+    def test_memory_is_bounded(self):
+        stats = RollingStats(windows_secs=[900, 86400])
+        rnd = random.Random(42)
+        readings = []
+        # Two days of readings every 2 seconds (or so), with random values
+        t = _T0
+        for _ in range(2 * 24 * 1800):
+            t += rnd.choice((1, 2, 3))
+            readings.append((t, rnd.uniform(0, 100)))
+            stats.update('Sensor1', t, {'power': readings[-1][1]})
+        res = stats.get('Sensor1', t)['power']['windows']
+
+        metric_stats = stats._stats['Sensor1']['power']
+        for window in metric_stats._windows:
+            assert len(window._buckets) <= BUCKETS_PER_WINDOW + 1
+            assert len(window._mins) <= BUCKETS_PER_WINDOW + 1
+            assert len(window._maxs) <= BUCKETS_PER_WINDOW + 1
+            # Stats are exact for the readings in the window, whose start has the resolution of a bucket
+            name = window_name(window.secs)
+            in_window = [(rt, v) for rt, v in readings if rt - rt % window.bucket_secs > t - window.secs]
+            # The window starts at most a bucket (plus the gap between readings) after now - secs
+            assert window.secs - window.bucket_secs - 3 <= t - in_window[0][0] <= window.secs
+            values = [v for _, v in in_window]
+            assert res[name]['count'] == len(in_window)
+            assert res[name]['min'] == min(values)
+            assert res[name]['max'] == max(values)
+            assert res[name]['mean'] == pytest.approx(sum(values) / len(values))
+            n = len(in_window)
+            mt = sum(rt for rt, _ in in_window) / n
+            mv = sum(values) / n
+            slope = sum((rt - mt) * (v - mv) for rt, v in in_window) / sum((rt - mt) ** 2 for rt, _ in in_window)
+            assert res[name]['slope_per_sec'] == pytest.approx(slope, rel=1e-6, abs=1e-9)
+
+    def test_ewma_is_weighted_by_time(self):
+        stats = RollingStats(windows_secs=[60], ewma_tau_secs=60)
+        stats.update('Sensor1', _T0, {'temperature': 10})
+        stats.update('Sensor1', _T0 + 60, {'temperature': 20})
+        assert stats.get('Sensor1', _T0 + 60)['temperature']['ewma'] == pytest.approx(20 - 10 / math.e)
+
+    def test_last_change(self):
+        stats = RollingStats()
+        stats.update('Sensor1', _T0, {'contact': 1})
+        stats.update('Sensor1', _T0 + 10, {'contact': 1})
+        assert stats.get('Sensor1', _T0 + 10)['contact']['last_change'] is None
+        stats.update('Sensor1', _T0 + 20, {'contact': 0})
+        stats.update('Sensor1', _T0 + 30, {'contact': 0})
+        res = stats.get('Sensor1', _T0 + 30)['contact']
+        assert res['last_change'] == datetime.fromtimestamp(_T0 + 20, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def test_ignored_readings(self):
+        stats = RollingStats()
+        stats.update('Sensor1', _T0, {'state': 'on', 'temperature': 20})
+        stats.update('Sensor1', _T0 - 10, {'temperature': 99})
+        assert list(stats.get('Sensor1', _T0)) == ['temperature']
+        assert stats.get('Sensor1', _T0)['temperature']['windows']['15m']['max'] == 20
+        assert stats.get('Sensor1', _T0, 'humidity') is None
+        assert stats.get('Sensor2', _T0) is None
+
+    def test_validation(self):
+        with pytest.raises(ValueError):
+            RollingStats(windows_secs=[])
+        with pytest.raises(ValueError):
+            RollingStats(ewma_tau_secs=0)
+        assert [window_name(s) for s in (30, 900, 7200)] == ['30s', '15m', '2h']
+
+
+def _t(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class TestSensorsHistoryRolling:
+    """Test rolling stats in SensorsHistory"""
+
+    def test_seeded_from_db_and_updated(self, tmp_path):
+        dbpath = str(tmp_path / "sensors.sqlite")
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), retention_days=2, batch_max_delay_ms=10)
+        hist.register_sensor('Sensor1', ['temperature'])
+        now = int(time.time())
+        for i, value in enumerate([10, 12, 14]):
+            hist._writer.run_sync(lambda conn, i=i, value=value: hist._storage.insert(
+                conn, 'Sensor1', _t(now - 300 + 60 * i), {'temperature': value}))
+        hist.stop()
+
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), retention_days=2, batch_max_delay_ms=10)
+        res = hist.get_rolling_stats('Sensor1', 'temperature')['temperature']
+        assert res['windows']['15m']['count'] == 3
+        assert res['windows']['15m']['slope_per_sec'] == pytest.approx(2 / 60)
+
+        hist.save_reading('Sensor1', {'temperature': 4})
+        res = hist.get_rolling_stats('Sensor1')['temperature']
+        assert res['value'] == 4
+        assert res['windows']['15m']['min'] == 4
+
+        app = Flask(__name__)
+        hist.register_to_webserver(app)
+        client = app.test_client()
+        assert client.get('/sensors/rolling/Sensor1').get_json()['temperature']['value'] == 4
+        assert client.get('/sensors/rolling/Sensor1/temperature').status_code == 200
+        assert client.get('/sensors/rolling/Sensor1/humidity').status_code == 404
+        hist.stop()
@@ -0,0 +1,189 @@
+"""Unit tests for sensors_rollups.py"""
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from sensors import SensorsHistory, _now_sample_time
+from sensors_rollups import SensorRollups, bucket_start
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def history(request, tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), db_layout=request.param,
+                          retention_days=2, batch_max_delay_ms=10)
+    yield hist
+    hist.stop()
+
+
+def _rollup_rows(history, tier):
+    with sqlite3.connect(history._dbpath) as conn:
+        return conn.execute(f"SELECT sensor, metric, bucket, vmin, vmax, vsum, n FROM zmw_rollup_{tier} "
+                            "ORDER BY sensor, metric, bucket").fetchall()
+
+
+class TestBuckets:
+    """Test bucket boundaries and tier selection"""
+
+    def test_bucket_start(self):
+        assert bucket_start('2024-03-01 10:37:59', 60) == '2024-03-01 10:37:00'
+        assert bucket_start('2024-03-01 10:37:59', 15 * 60) == '2024-03-01 10:30:00'
+        assert bucket_start('2024-03-01 10:37:59', 60 * 60) == '2024-03-01 10:00:00'
+        assert bucket_start('2024-03-01 10:00:00', 15 * 60) == '2024-03-01 10:00:00'
+
+    def test_pick_tier(self):
+        rollups = SensorRollups()
+        day = 24 * 60 * 60
+        # Fine resolution, raw readings cover the range
+        assert rollups.pick_tier(day, 10, 2) is None
+        # Coarsest tier that still satisfies the resolution
+        assert rollups.pick_tier(day, 100, 2) == '1m'
+        assert rollups.pick_tier(day, 1000, 2) == '15m'
+        assert rollups.pick_tier(day, 10000, 2) == '1h'
+        # 1m buckets are only kept for 14 days
+        assert rollups.pick_tier(30 * day, 100, 40) is None
+        assert rollups.pick_tier(30 * day, 1000, 40) == '15m'
+        # Raw readings don't go back far enough: finest tier that does, even if coarser than requested
+        assert rollups.pick_tier(30 * day, 10, 2) == '15m'
+        # Nothing covers the range
+        assert rollups.pick_tier(100 * 365 * day, 10000, 2) is None
+        # Unbounded range
+        assert rollups.pick_tier(None, None, None) is None
+
+    def test_unknown_tier_in_retention_fails(self):
+        with pytest.raises(ValueError):
+            SensorRollups({'5m': 3})
+
+
+class TestSensorRollups:
+    """Test rollups maintained by SensorsHistory"""
+
+    def test_readings_update_all_tiers(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        readings = [('Sensor1', '2024-03-01 10:00:10', {'temperature': 20, 'name': 'not a number'}),
+                    ('Sensor1', '2024-03-01 10:00:50', {'temperature': 22}),
+                    ('Sensor1', '2024-03-01 10:01:00', {'temperature': 30, 'humidity': None})]
+        for reading in readings[:2]:
+            history._writer.run_sync(lambda conn, r=reading: history._rollups.add_readings(conn, [r]))
+        history._writer.run_sync(lambda conn: history._rollups.add_readings(conn, readings[2:]))
+        assert _rollup_rows(history, '1m') == [
+            ('Sensor1', 'temperature', '2024-03-01 10:00:00', 20, 22, 42, 2),
+            ('Sensor1', 'temperature', '2024-03-01 10:01:00', 30, 30, 30, 1),
+        ]
+        assert _rollup_rows(history, '1h') == [('Sensor1', 'temperature', '2024-03-01 10:00:00', 20, 30, 72, 3)]
+
+    def test_saved_readings_are_rolled_up(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.save_reading('Sensor1', {'temperature': 20})
+        history.save_reading('Sensor1', {'temperature': 24})
+        history.flush()
+        rows = _rollup_rows(history, '15m')
+        assert len(rows) in (1, 2)  # 2 if the readings straddle a bucket boundary
+        assert sum(r[6] for r in rows) == 2
+
+    def test_long_range_queries_use_rollups(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.register_sensor('Sensor2', ['temperature'])
+        now = _now_sample_time()
+        history._writer.run_sync(lambda conn: history._rollups.add_readings(conn, [
+            ('Sensor1', now, {'temperature': 10}),
+            ('Sensor1', now, {'temperature': 20}),
+            ('Sensor2', now, {'temperature': 30}),
+        ]))
+        # 30 days at the default of 1000 points is a resolution of ~43 minutes: the 15m tier
+        bucket = bucket_start(now, 15 * 60)
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 30).splitlines()
+        assert csv == ['sample_time,temperature', f'{bucket},15.0']
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 30, agg='max')
+        assert csv.splitlines()[1] == f'{bucket},20.0'
+        csv = history.get_single_metric_in_all_sensors_csv('temperature', 'days', 30, agg='count').splitlines()
+        assert csv == ['sample_time,Sensor1,Sensor2', f'{bucket},2,', f'{bucket},,1']
+        # Nothing was stored as a raw reading
+        assert history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 1, resolution=0) \
+                == 'sample_time,temperature\n'
+
+    def test_invalid_aggregation_fails(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        with pytest.raises(ValueError):
+            history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 30, agg='median')
+
+    def test_old_buckets_are_discarded(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history._writer.run_sync(lambda conn: history._rollups.add_readings(conn, [
+            ('Sensor1', '2000-01-01 00:00:00', {'temperature': 10}),
+            ('Sensor1', _now_sample_time(), {'temperature': 20}),
+        ]))
+        history.apply_retention()
+        for tier in ('1m', '15m', '1h'):
+            assert len(_rollup_rows(history, tier)) == 1
+        assert history.get_writer_stats()['retention']['rows_deleted_last_run'] == 3
+
+
+class TestRollupBackfill:
+    """Test rollups for databases that had readings before rollups existed"""
+
+    def test_existing_readings_are_backfilled(self, tmp_path):
+        dbpath = str(tmp_path / "old.sqlite")
+        with sqlite3.connect(dbpath) as conn:
+            conn.execute("CREATE TABLE Sensor1 (sample_time DATETIME DEFAULT CURRENT_TIMESTAMP, temperature REAL)")
+            conn.execute("INSERT INTO Sensor1 VALUES ('2024-03-01 10:00:00', 20), ('2024-03-01 10:00:30', 22)")
+        sched = Mock()
+        hist = SensorsHistory(dbpath=dbpath, scheduler=sched, batch_max_delay_ms=10, backfill_pause_secs=0)
+        jobs = {c.kwargs['id']: c.args[0] for c in sched.add_job.call_args_list}
+        hist.save_reading('Sensor1', {'temperature': 30})
+        hist.flush()
+        jobs['sensor_history_rollup_backfill']()
+        rows = _rollup_rows(hist, '1m')
+        assert rows[0] == ('Sensor1', 'temperature', '2024-03-01 10:00:00', 20, 22, 42, 2)
+        # The new reading was counted once
+        assert sum(r[6] for r in rows) == 3
+        # Backfill only happens once
+        jobs['sensor_history_rollup_backfill']()
+        assert sum(r[6] for r in _rollup_rows(hist, '1m')) == 3
+        hist.stop()
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), backfill_pause_secs=0)
+        hist.backfill_rollups()
+        assert sum(r[6] for r in _rollup_rows(hist, '1m')) == 3
+        hist.stop()
+
+    @pytest.mark.parametrize('db_layout', ['wide', 'narrow'])
+    def test_backfill_is_done_in_bounded_windows(self, tmp_path, db_layout):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), db_layout=db_layout,
+                              backfill_window_hours=1, backfill_pause_secs=0)
+        hist.register_sensor('Sensor1', ['temperature'])
+        # Two days of readings, a year before the rollups were created
+        readings = [('Sensor1', f'2024-03-{day:02} {hour:02}:30:00', {'temperature': 20})
+                    for day in (1, 2) for hour in range(24)]
+        for reading in readings:
+            hist._writer.run_sync(lambda conn, r=reading: hist._storage.insert(conn, *r))
+        hist._writer.run_sync(lambda conn: hist._rollups.schedule_backfill(conn, ['Sensor1'], '2025-03-01 00:00:00'))
+
+        calls = []
+        run_sync = hist._writer.run_sync
+        hist._writer.run_sync = lambda fn: calls.append(run_sync(fn)) or calls[-1]
+        hist.backfill_rollups()
+        # Each window has at most the readings of an hour (plus one at its start), the gap isn't walked through
+        assert len(calls) == 25
+        assert max(n for n, _ in calls) == 2
+        assert sum(r[6] for r in _rollup_rows(hist, '1h')) == 48
+        with sqlite3.connect(hist._dbpath) as conn:
+            assert hist._rollups.pending_backfill(conn) == []
+        hist.stop()
+
+    def test_interrupted_backfill_resumes(self, tmp_path):
+        hist = SensorsHistory(dbpath=str(tmp_path / "s.sqlite"), scheduler=Mock(), backfill_window_hours=1,
+                              backfill_pause_secs=0)
+        hist.register_sensor('Sensor1', ['temperature'])
+        for hour in range(4):
+            hist._writer.run_sync(lambda conn, hour=hour: hist._storage.insert(
+                conn, 'Sensor1', f'2024-03-01 {hour:02}:30:00', {'temperature': 20}))
+        hist._writer.run_sync(lambda conn: hist._rollups.schedule_backfill(conn, ['Sensor1'], '2024-03-02 00:00:00'))
+        hist._stopped.set()
+        hist.backfill_rollups()
+        assert sum(r[6] for r in _rollup_rows(hist, '1h')) == 2
+        with sqlite3.connect(hist._dbpath) as conn:
+            assert hist._rollups.pending_backfill(conn) == [('Sensor1', '2024-03-01 02:30:00')]
+        hist._stopped.clear()
+        hist.backfill_rollups()
+        assert sum(r[6] for r in _rollup_rows(hist, '1h')) == 4
+        hist.stop()
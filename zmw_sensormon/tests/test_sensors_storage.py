@@ -0,0 +1,148 @@
+"""Unit tests for sensors_storage.py and migrate_sensors_db.py"""
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from migrate_sensors_db import migrate
+from sensors import SensorsHistory
+from sensors_storage import detect_storage_layout
+
+
+@pytest.fixture(params=['wide', 'narrow'])
+def history(request, tmp_path):
+    hist = SensorsHistory(dbpath=str(tmp_path / "sensors.sqlite"), scheduler=Mock(), db_layout=request.param,
+                          batch_max_delay_ms=10)
+    yield hist
+    hist.stop()
+
+
+def _insert_at(history, sensor_name, sample_time, values):
+    history._writer.run_sync(lambda conn: history._storage.insert(conn, sensor_name, sample_time, values))
+
+
+class TestStorageLayouts:
+    """Both layouts should behave the same way, as seen from SensorsHistory"""
+
+    def test_schema_queries(self, history):
+        history.register_sensor('Sensor1', ['temperature', 'humidity'])
+        history.register_sensor('Sensor2', ['temperature'])
+        history.save_reading('Sensor2', {'temperature': 20, 'battery': 90})
+        history.flush()
+        assert history.get_known_sensors() == ['Sensor1', 'Sensor2']
+        assert sorted(history.get_known_metrics()) == ['battery', 'humidity', 'temperature']
+        assert history.get_metrics_for_sensor('Sensor1') == ['temperature', 'humidity']
+        assert history.get_metrics_for_sensor('Sensor2') == ['temperature', 'battery']
+        assert history.get_metrics_for_sensor('Unknown') == []
+        assert history.get_known_sensors_measuring('temperature') == ['Sensor1', 'Sensor2']
+        assert history.get_known_sensors_measuring('battery') == ['Sensor2']
+
+    def test_metric_in_sensor(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        _insert_at(history, 'Sensor1', '2000-01-01 00:00:00', {'temperature': 10})
+        history.save_reading('Sensor1', {'temperature': 20})
+        history.flush()
+        csv = history.get_metric_in_sensor_csv_time_limit('Sensor1', 'temperature', 'days', 1, resolution=0).splitlines()
+        assert csv[0] == 'sample_time,temperature'
+        assert len(csv) == 2
+        assert csv[1].endswith(',20.0')
+        assert history.get_metric_in_sensor_csv('Sensor1', 'temperature').splitlines()[1] == '2000-01-01 00:00:00,10.0'
+        assert history.get_metric_in_sensor_csv('Sensor1', 'unknown') == ''
+
+    def test_all_metrics_in_sensor(self, history):
+        history.register_sensor('Sensor1', ['temperature', 'humidity'])
+        _insert_at(history, 'Sensor1', '2000-01-01 00:00:00', {'temperature': 10, 'humidity': 50})
+        _insert_at(history, 'Sensor1', '2000-01-01 00:00:01', {'humidity': 51})
+        assert history.get_all_metrics_in_sensor_csv('Sensor1').splitlines() == [
+            'sample_time,temperature,humidity',
+            '2000-01-01 00:00:00,10.0,50.0',
+            '2000-01-01 00:00:01,None,51.0',
+        ]
+
+    def test_single_metric_in_all_sensors(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        history.register_sensor('Sensor2', ['temperature', 'humidity'])
+        _insert_at(history, 'Sensor1', '2000-01-01 00:00:00', {'temperature': 10})
+        _insert_at(history, 'Sensor2', '2000-01-01 00:00:01', {'temperature': 11, 'humidity': 50})
+        _insert_at(history, 'Sensor2', '2000-01-01 00:00:02', {'humidity': 51})
+        csv = history.get_single_metric_in_all_sensors_csv('temperature', 'years', 100, resolution=0)
+        assert csv.splitlines() == [
+            'sample_time,Sensor1,Sensor2',
+            '2000-01-01 00:00:00,10.0,',
+            '2000-01-01 00:00:01,,11.0',
+        ]
+        assert history.get_single_metric_in_all_sensors_csv('temperature', resolution=0) == 'sample_time,Sensor1,Sensor2\n'
+        assert history.get_single_metric_in_all_sensors_csv('unknown') == ''
+
+    def test_retention(self, history):
+        history._retention_rows = 2
+        history.register_sensor('Sensor1', ['temperature', 'humidity'])
+        for sec in range(5):
+            _insert_at(history, 'Sensor1', f'2000-01-01 00:00:0{sec}', {'temperature': sec, 'humidity': sec})
+        history.apply_retention()
+        csv = history.get_all_metrics_in_sensor_csv('Sensor1').splitlines()
+        assert csv[1:] == ['2000-01-01 00:00:03,3.0,3.0', '2000-01-01 00:00:04,4.0,4.0']
+
+    def test_layout_mismatch_fails(self, history):
+        history.register_sensor('Sensor1', ['temperature'])
+        other = 'narrow' if history._storage.layout == 'wide' else 'wide'
+        with pytest.raises(ValueError):
+            SensorsHistory(dbpath=history._dbpath, scheduler=Mock(), db_layout=other)
+
+
+class TestNarrowLayout:
+    """Test details specific to the narrow layout"""
+
+    def test_queries_use_index_range_scans(self, tmp_path):
+        dbpath = str(tmp_path / "s.sqlite")
+        SensorsHistory(dbpath=dbpath, scheduler=Mock(), db_layout='narrow').stop()
+        with sqlite3.connect(dbpath) as conn:
+            plan = str(conn.execute("EXPLAIN QUERY PLAN SELECT ts, sensor_id, value FROM zmw_readings "
+                                    "WHERE metric_id = 1 AND ts > '2000-01-01' ORDER BY ts").fetchall())
+            assert 'COVERING INDEX zmw_readings_metric_ts_idx' in plan
+            assert 'TEMP B-TREE' not in plan
+            plan = str(conn.execute("EXPLAIN QUERY PLAN SELECT ts, value FROM zmw_readings "
+                                    "WHERE sensor_id = 1 AND metric_id = 1 AND ts > '2000-01-01' "
+                                    "ORDER BY ts").fetchall())
+            assert 'PRIMARY KEY' in plan
+            assert 'TEMP B-TREE' not in plan
+
+    def test_null_values_are_not_stored(self, tmp_path):
+        dbpath = str(tmp_path / "s.sqlite")
+        hist = SensorsHistory(dbpath=dbpath, scheduler=Mock(), db_layout='narrow')
+        hist.save_reading('Sensor1', {'temperature': 20, 'humidity': None})
+        hist.stop()
+        with sqlite3.connect(dbpath) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM zmw_readings").fetchone() == (1,)
+
+
+class TestMigration:
+    """Test converting databases between layouts"""
+
+    def test_wide_to_narrow_and_back(self, tmp_path):
+        wide = SensorsHistory(dbpath=str(tmp_path / "wide.sqlite"), scheduler=Mock())
+        wide.register_sensor('Sensor1', ['temperature', 'humidity'])
+        wide.register_sensor('Sensor2', ['temperature'])
+        _insert_at(wide, 'Sensor1', '2000-01-01 00:00:00', {'temperature': 10, 'humidity': 50})
+        _insert_at(wide, 'Sensor1', '2000-01-01 00:00:01', {'humidity': 51})
+        _insert_at(wide, 'Sensor2', '2000-01-01 00:00:00', {'temperature': 11})
+        expected = wide.get_all_metrics_in_sensor_csv('Sensor1')
+        wide.stop()
+
+        assert migrate(str(tmp_path / "wide.sqlite"), str(tmp_path / "narrow.sqlite"), 'narrow') == 3
+        with sqlite3.connect(str(tmp_path / "narrow.sqlite")) as conn:
+            assert detect_storage_layout(conn) == 'narrow'
+        narrow = SensorsHistory(dbpath=str(tmp_path / "narrow.sqlite"), scheduler=Mock(), db_layout='narrow')
+        assert narrow.get_known_sensors() == ['Sensor1', 'Sensor2']
+        assert narrow.get_all_metrics_in_sensor_csv('Sensor1') == expected
+        narrow.stop()
+
+        assert migrate(str(tmp_path / "narrow.sqlite"), str(tmp_path / "wide2.sqlite"), 'wide') == 3
+        wide = SensorsHistory(dbpath=str(tmp_path / "wide2.sqlite"), scheduler=Mock())
+        assert wide.get_all_metrics_in_sensor_csv('Sensor1') == expected
+        wide.stop()
+
+    def test_empty_db_fails(self, tmp_path):
+        sqlite3.connect(str(tmp_path / "empty.sqlite")).close()
+        with pytest.raises(ValueError):
+            migrate(str(tmp_path / "empty.sqlite"), str(tmp_path / "new.sqlite"), 'narrow')
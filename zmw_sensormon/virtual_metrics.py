@@ -48,9 +48,16 @@ def _compute_feels_like(values):
     - Cold and humid (T < 20°C, RH > 45%): Use humid-cold adjustment
     - Otherwise: Return actual temperature
     """
-    temp = values['temperature']
-    humidity = values['humidity']
+    return _feels_like(values['temperature'], values['humidity'])
 
+
+def _compute_feels_like_column(columns):
+    """Column version of _compute_feels_like: one value per row, None where an input is missing."""
+    return [None if temp is None or humidity is None else _feels_like(temp, humidity)
+            for temp, humidity in zip(columns['temperature'], columns['humidity'])]
+
+
+def _feels_like(temp, humidity):
     if temp >= 27 and humidity >= 40:
         result = _compute_heat_index(temp, humidity)
     elif temp < 20 and humidity > 45:
@@ -61,11 +68,15 @@ def _compute_feels_like(values):
 
 
 # Virtual metrics configuration
-# Each entry defines: required source metrics and compute function
+# Each entry defines: required source metrics, compute function (for a single reading), column compute function
+# (for a whole column of readings, used to backfill history) and version. Bump the version when the formula changes,
+# so that existing history is recomputed.
 VIRTUAL_METRICS = {
     'feels_like_temp': {
         'requires': ['temperature', 'humidity'],
         'compute': _compute_feels_like,
+        'compute_column': _compute_feels_like_column,
+        'version': 1,
     },
 }
 
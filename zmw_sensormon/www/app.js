@@ -65,13 +65,65 @@ function renderSensorValues(sensorData, metrics) {
 }
 
 
-function simple_dygraph_plot(html_elm_id, url) {
+// Parse a CSV from the history endpoints into dygraph's native format: rows of [Date, value or null...]
+function parseHistoryCsv(t_csv) {
+  return t_csv.split('\n').slice(1).filter(line => line).map((line) => {
+    const [sampleTime, ...values] = line.split(',');
+    return [new Date(sampleTime.replace(' ', 'T')), ...values.map(v => (v === '' ? null : parseFloat(v)))];
+  });
+}
+
+// Append readings pushed by the server to a plot, instead of re-fetching its whole range. live is
+// {sensors, metric}: sensors is the list of sensors in the plot, or null if the plot has a column per sensor.
+function follow_live_readings(html_elm_id, plot, t_csv, live) {
+  const plotDiv = document.getElementById(html_elm_id);
+  if (!plotDiv) {
+    return;
+  }
+  if (plotDiv.liveWs) {
+    plotDiv.liveWs.close();
+  }
+
+  const labels = t_csv.split('\n', 1)[0].split(',');
+  const columns = labels.slice(1);
+  const data = parseHistoryCsv(t_csv);
+  // Readings older than the range first fetched scroll out of the plot, so it doesn't grow while the page is open
+  const windowMs = data.length > 1 ? data[data.length - 1][0] - data[0][0] : null;
+  const params = new URLSearchParams({ metrics: live.metric });
+  if (live.sensors) {
+    params.set('sensors', live.sensors.join(','));
+  }
+
+  mJsonGet('/sensors/get_ws_url', (resp) => {
+    const ws = new WebSocket(`${resp.url}?${params}`);
+    plotDiv.liveWs = ws;
+    ws.onmessage = (e) => {
+      if (!plotDiv.isConnected) {
+        ws.close();
+        return;
+      }
+      const reading = JSON.parse(e.data);
+      const value = reading.values[live.metric];
+      const sampleTime = new Date(reading.sample_time.replace(' ', 'T'));
+      // A plot has either a column per sensor, or a single column for the metric
+      const row = columns.map(col => (col === reading.sensor || (live.sensors && col === live.metric)) ? value : null);
+      data.push([sampleTime, ...row]);
+      while (windowMs !== null && data.length > 1 && sampleTime - data[0][0] > windowMs) {
+        data.shift();
+      }
+      plot.updateOptions({ file: data, labels });
+    };
+  });
+}
+
+function simple_dygraph_plot(html_elm_id, url, live = null) {
+  const width = Math.round(window.innerWidth * .9);
   let dygraph_opts = {
                       fillGraph: false,
                       connectSeparatedPoints: true,
                       highlightCircleSize: 2,
                       strokeWidth: 1,
-                      width: window.innerWidth * .9,
+                      width: width,
                       // smooth graph, helps fill in periods where sensors aren't concurrent
                       rollPeriod: 5,
                       legend: 'always',
@@ -82,15 +134,20 @@ function simple_dygraph_plot(html_elm_id, url) {
                       },
                   };
 
-  mTextGet(url, (t_csv) => {
+  // No point in fetching more than a couple of points per pixel: the server downsamples, keeping peaks and dips
+  const sep = url.includes('?') ? '&' : '?';
+  mTextGet(`${url}${sep}max_points=${2 * width}`, (t_csv) => {
     const label_elm = document.getElementById(html_elm_id + '_label');
     if (label_elm) {
       dygraph_opts['labelsDiv'] = label_elm;
     }
-    new Dygraph(
+    const plot = new Dygraph(
         document.getElementById(html_elm_id),
         t_csv,
         dygraph_opts);
+    if (live) {
+      follow_live_readings(html_elm_id, plot, t_csv, live);
+    }
   });
 }
 
@@ -248,7 +305,7 @@ class SensorsHistoryPane extends React.Component {
         if (plotDiv) {
           plotDiv.innerHTML = '';
         }
-        simple_dygraph_plot(plotId, url);
+        simple_dygraph_plot(plotId, url, { sensors: [sensorName], metric });
       }, 50);
 
       local_plots.push(
@@ -275,7 +332,7 @@ class SensorsHistoryPane extends React.Component {
         if (plotDiv) {
           plotDiv.innerHTML = '';
         }
-        simple_dygraph_plot(plotId, url);
+        simple_dygraph_plot(plotId, url, { sensors: null, metric });
       }, 0);
 
       local_plots.push(
@@ -307,7 +364,7 @@ class SensorsHistoryPane extends React.Component {
         if (plotDiv) {
           plotDiv.innerHTML = '';
         }
-        simple_dygraph_plot(plotId, url);
+        simple_dygraph_plot(plotId, url, { sensors: [sensor], metric });
       }, 50); // Give it a bit of time to let the element load, otherwise Dygraph can't find it
 
       local_plots.push(
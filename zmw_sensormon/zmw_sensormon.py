@@ -6,15 +6,24 @@ from zzmw_lib.service_runner import service_runner
 from zzmw_lib.z2m.z2mproxy import Z2MProxy
 from zzmw_lib.z2m.www import Z2Mwebservice
 
+from flask import request
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
+
 from sensors import SensorsHistory
-from virtual_metrics import get_virtual_metrics, compute_virtual_metrics
+from sensors_rolling import DEFAULT_EWMA_TAU_SECS, DEFAULT_WINDOWS_SECS
+from virtual_metrics import VIRTUAL_METRICS, get_virtual_metrics, compute_virtual_metrics
 from outside_weather import OutsideWeatherSensor
 
+import json
 import os
 import pathlib
 
 log = build_logger("ZmwSensormon")
 
+# How often a live push connection without new readings checks if its client went away
+LIVE_IDLE_CHECK_SECS = 5
+
 # 'linkquality' can be monitored too, but that means we're monitoring a lot more than sensors
 INTERESTING_ACTIONS = [
     'ac_frequency', 'battery', 'contact', 'current_a', 'current_b', 'device_temperature',
@@ -78,6 +87,12 @@ class ShellyPlugMonitor:
         if "get_mqtt_description" in topic:
             # Ignore MQTT self-description from Shelly service
             return
+        if topic == 'stats':
+            # Batched stats of all plugs polled in a cycle
+            for sensor_name, stats in payload.items():
+                self._on_stats(sensor_name, stats)
+            return
+
         parts = topic.split('/')
         if len(parts) != 2:
             log.warning("Unexpected shelly topic format '%s': %s", topic, payload)
@@ -87,7 +102,9 @@ class ShellyPlugMonitor:
         if action != 'stats':
             log.warning("Unhandled action '%s': %s", topic, payload)
             return
+        self._on_stats(sensor_name, payload)
 
+    def _on_stats(self, sensor_name, payload):
         if sensor_name not in self._known_shellies:
             try:
                 self._sensors.register_sensor(sensor_name, ShellyAdapter.METRICS)
@@ -161,8 +178,24 @@ class ZmwSensormon(ZmwMqttService):
         www_path = os.path.join(pathlib.Path(__file__).parent.resolve(), 'www')
         self._public_url_base = www.register_www_dir(www_path)
 
-        self._sensors = SensorsHistory(dbpath=cfg['db_path'], scheduler=sched, retention_days=cfg['retention_days'])
+        self._sensors = SensorsHistory(dbpath=cfg['db_path'], scheduler=sched, retention_days=cfg['retention_days'],
+                                       db_layout=cfg.get('db_layout', 'wide'),
+                                       batch_max_rows=cfg.get('db_batch_max_rows', 200),
+                                       batch_max_delay_ms=cfg.get('db_batch_max_delay_ms', 500),
+                                       retention_interval_secs=cfg.get('retention_interval_secs', 600),
+                                       retention_max_rows_per_run=cfg.get('retention_max_rows_per_run', 5000),
+                                       rollup_retention_days=cfg.get('rollup_retention_days'),
+                                       write_filter=cfg.get('write_filter'),
+                                       chunk_after_days=cfg.get('chunk_after_days'),
+                                       chunk_window_hours=cfg.get('chunk_window_hours', 24),
+                                       backfill_window_hours=cfg.get('backfill_window_hours', 6),
+                                       backfill_pause_secs=cfg.get('backfill_pause_secs', 1.0),
+                                       archive_dir=cfg.get('archive_dir'),
+                                       rolling_windows_secs=cfg.get('rolling_windows_secs', DEFAULT_WINDOWS_SECS),
+                                       rolling_ewma_tau_secs=cfg.get('rolling_ewma_tau_secs', DEFAULT_EWMA_TAU_SECS))
         self._sensors.register_to_webserver(www)
+        # History saved before a virtual metric was added (or changed) gets its values computed in the background
+        self._sensors.schedule_derived_metrics_backfill(VIRTUAL_METRICS)
 
         self._z2m = Z2MProxy(cfg, self, sched,
                              cb_on_z2m_network_discovery=self._on_z2m_network_discovery,
@@ -182,6 +215,34 @@ class ZmwSensormon(ZmwMqttService):
 
         www.serve_url('/sensors/get/<name>', self._get_sensor_values)
         www.serve_url('/sensors/get_all/<metric>', self._get_all_sensor_values)
+        www.serve_url('/sensors/get_ws_url',
+                      lambda: {'url': www.public_url_base.replace('http', 'ws', 1) + '/ws/sensor_updates'})
+
+        self._sock = Sock(www)
+        self._sock.route('/ws/sensor_updates')(self._ws_sensor_updates)
+
+    def _ws_sensor_updates(self, ws):
+        """Push readings to a client as they are saved. Accepts ?sensors=a,b and ?metrics=x,y to filter them."""
+        sensors = request.args.get('sensors')
+        metrics = request.args.get('metrics')
+        sub = self._sensors.subscribe_live(sensors.split(',') if sensors else None,
+                                           metrics.split(',') if metrics else None)
+        try:
+            while True:
+                reading = sub.get(timeout=LIVE_IDLE_CHECK_SECS)
+                if reading is not None:
+                    ws.send(json.dumps(reading))
+                else:
+                    # Raises if the client closed the connection
+                    ws.receive(timeout=0)
+        except ConnectionClosed:
+            pass
+        finally:
+            self._sensors.unsubscribe_live(sub)
+
+    def stop(self):
+        self._sensors.stop()
+        super().stop()
 
     def _build_llm_grammar_values(self):
         vals = {}
@@ -234,6 +295,22 @@ class ZmwSensormon(ZmwMqttService):
                     "description": "List sensors measuring this metric. Response on get_sensors_measuring_reply",
                     "params": {"metric": "Metric name"}
                 },
+                "get_aggregated_history": {
+                    "description": "Bucketed history of a metric, aggregated server-side. Response on get_aggregated_history_reply",
+                    "params": {
+                        "metric": "Metric name",
+                        "sensors": "(optional) List of sensor names, default all sensors measuring metric",
+                        "bucket_secs": "(optional) Bucket size in seconds, default 3600",
+                        "aggs": "(optional) List of avg, min, max, count, first, last, rate or pNN (eg p95), default ['avg']",
+                        "unit": "(optional) Unit for time: seconds, minutes, hours, days, months or years, default days",
+                        "time": "(optional) How many units of history to aggregate, default 2",
+                    }
+                },
+                "get_rolling_stats": {
+                    "description": "Trends of a sensor's recent readings: EWMA, min/max/mean/slope over recent windows, "\
+                                   "last change. Response on get_rolling_stats_reply",
+                    "params": {"name": "Sensor name", "metric": "(optional) Metric name, default all metrics"}
+                },
                 "get_mqtt_description": {
                     "description": "Service description",
                     "params": {}
@@ -260,6 +337,20 @@ class ZmwSensormon(ZmwMqttService):
                     "description": "List of sensor name strings",
                     "payload": ["<sensor_name>"]
                 },
+                "get_aggregated_history_reply": {
+                    "description": "Bucket start times, and one list of values per sensor and aggregation, aligned to the buckets",
+                    "payload": {"metric": "<metric>", "bucket_secs": "<secs>", "sample_time": ["<bucket_start>"],
+                                "sensors": {"<sensor_name>": {"<agg>": ["<value or null>"]}}}
+                },
+                "get_rolling_stats_reply": {
+                    "description": "Rolling stats per metric; empty if the sensor has no recent numeric readings. "\
+                                   "Windows are named by length (eg 15m, 1h), slope is change per second",
+                    "payload": {"name": "<sensor_name>", "stats": {"<metric>": {
+                        "value": "<last value>", "last_update": "<sample_time>", "last_change": "<sample_time>",
+                        "ewma": "<value>", "windows": {"<window>": {
+                            "count": "<n>", "min": "<value>", "max": "<value>", "mean": "<value>",
+                            "slope_per_sec": "<value>"}}}}}
+                },
                 "get_mqtt_description_reply": {
                     "description": "Service description",
                     "payload": {}
@@ -272,7 +363,8 @@ class ZmwSensormon(ZmwMqttService):
                 }
                 for sensor_name in self._sensors.get_known_sensors()
             ],
-            "llm_skip_commands": ["get_known_sensors", "get_known_metrics", "get_sensors_measuring"],
+            "llm_skip_commands": ["get_known_sensors", "get_known_metrics", "get_sensors_measuring",
+                                  "get_aggregated_history", "get_rolling_stats"],
             "llm_context_extra": self._build_llm_context_extra(),
             "llm_grammar_values": self._build_llm_grammar_values(),
         }
@@ -304,12 +396,38 @@ class ZmwSensormon(ZmwMqttService):
                     return
                 self.publish_own_svc_message("get_sensors_measuring_reply",
                     self._sensors.get_known_sensors_measuring(payload['metric']))
+            case "get_aggregated_history":
+                if 'metric' not in payload:
+                    log.error("get_aggregated_history: missing 'metric' in payload: '%s'", payload)
+                    return
+                self._publish_aggregated_history(payload)
+            case "get_rolling_stats":
+                if 'name' not in payload:
+                    log.error("get_rolling_stats: missing 'name' in payload: '%s'", payload)
+                    return
+                self.publish_own_svc_message("get_rolling_stats_reply", {
+                    'name': payload['name'],
+                    'stats': self._sensors.get_rolling_stats(payload['name'], payload.get('metric')) or {}})
             case "get_mqtt_description":
                 self.publish_own_svc_message("get_mqtt_description_reply",
                     self.get_mqtt_description())
             case _:
                 log.warning("Ignoring unknown message '%s'", subtopic)
 
+    def _publish_aggregated_history(self, payload):
+        bucket_secs = payload.get('bucket_secs', 3600)
+        try:
+            res = self._sensors.get_aggregate(payload['metric'], payload.get('sensors'), bucket_secs,
+                                              payload.get('aggs', ['avg']), payload.get('unit', 'days'),
+                                              payload.get('time', 2))
+        except ValueError as e:
+            log.error("get_aggregated_history: invalid request '%s': %s", payload, e)
+            return
+        if res is None:
+            res = {'sample_time': [], 'sensors': {}}
+        self.publish_own_svc_message("get_aggregated_history_reply",
+            {'metric': payload['metric'], 'bucket_secs': bucket_secs, **res})
+
     def _get_sensor_values(self, name):
         """Unified endpoint to get current sensor values from any backend."""
         # Check Shelly devices first (they're not in z2m)
@@ -324,7 +442,10 @@ class ZmwSensormon(ZmwMqttService):
             vals.update(vals['extras'])
             return vals
         except KeyError:
-            return {}
+            pass
+
+        # Not a live device (eg it hasn't been seen since startup): use the last values saved to history
+        return self._sensors.get_last_values(name) or {}
 
     def _get_all_sensor_values(self, metric):
         """Get current values for all sensors measuring a specific metric."""
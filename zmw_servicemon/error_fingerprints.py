@@ -0,0 +1,184 @@
+"""Error fingerprinting and aggregation for error notifications.
+
+Errors that only differ in variable tokens (numbers, timestamps, IPs...) are
+the same error: each message is normalized into a fingerprint by masking those
+tokens, and errors are aggregated per (service, fingerprint) with a count,
+first/last seen times and a few sample messages.
+
+Notifications are per fingerprint, with exponential backoff: the first time an
+error is seen it's notified, a repeat is notified after backoff_base_secs, then
+after twice as long, and so on up to backoff_max_secs. Repeats in between are
+counted and reported with the next notification. A fingerprint that isn't seen
+for backoff_reset_secs starts over.
+
+Notifications are collected until take_alert() is called, which merges them in
+a single alert. If more than storm_threshold fingerprints are pending (eg a
+service is crash-looping, or the network went down and every service is
+complaining), the alert is a summary of the storm instead of one line per
+error.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# Order matters: specific patterns first, so eg the numbers in a timestamp aren't masked as numbers
+_VARIABLE_TOKENS = [
+    (re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'), '<TIME>'),
+    (re.compile(r'\d{4}-\d{2}-\d{2}'), '<DATE>'),
+    (re.compile(r'\b\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?'), '<TIME>'),
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b', re.IGNORECASE), '<UUID>'),
+    (re.compile(r'\b(?:[0-9a-f]{2}[:-]){5}[0-9a-f]{2}\b', re.IGNORECASE), '<MAC>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<IP>'),
+    (re.compile(r'\b(?:[0-9a-f]{1,4}:{1,2}){2,7}[0-9a-f]{1,4}\b', re.IGNORECASE), '<IP>'),
+    (re.compile(r'\b0x[0-9a-f]+\b', re.IGNORECASE), '<HEX>'),
+    (re.compile(r'\b(?=[0-9a-f]*\d)[0-9a-f]{8,}\b', re.IGNORECASE), '<HEX>'),
+    # Numbers, unless they are part of a name (eg sensor1)
+    (re.compile(r'(?<![A-Za-z_])[-+]?\d+(?:\.\d+)?'), '<N>'),
+]
+
+
+def fingerprint(message):
+    """ Normalize an error message by masking its variable tokens """
+    for pattern, mask in _VARIABLE_TOKENS:
+        message = pattern.sub(mask, message)
+    return message.strip()
+
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch).isoformat() if epoch is not None else None
+
+
+class _ErrorFingerprint:
+    def __init__(self, service, priority_name, fp, now, max_samples):
+        self.service = service
+        self.priority_name = priority_name
+        self.fingerprint = fp
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.samples = deque(maxlen=max_samples)
+        # Occurrences not included in an alert yet
+        self.unreported = 0
+        self.backoff_secs = None
+        self.next_notify_at = now
+
+    def to_dict(self):
+        return {
+            'service': self.service,
+            'priority_name': self.priority_name,
+            'fingerprint': self.fingerprint,
+            'count': self.count,
+            'first_seen': _iso(self.first_seen),
+            'last_seen': _iso(self.last_seen),
+            'samples': list(self.samples),
+            'muted_until': _iso(self.next_notify_at) if self.next_notify_at > time.time() else None,
+        }
+
+
+class ErrorAggregator:
+    """ Aggregates errors by fingerprint and decides which ones to notify. Thread safe. """
+
+    def __init__(self, backoff_base_secs=5 * 60, backoff_max_secs=7 * 24 * 60 * 60,
+                 backoff_reset_secs=7 * 24 * 60 * 60, storm_threshold=5, max_samples=3, max_fingerprints=1000):
+        if backoff_base_secs <= 0 or backoff_max_secs < backoff_base_secs:
+            raise ValueError(f"Invalid error backoff {backoff_base_secs}-{backoff_max_secs} secs")
+        self._backoff_base_secs = backoff_base_secs
+        self._backoff_max_secs = backoff_max_secs
+        self._backoff_reset_secs = backoff_reset_secs
+        self._storm_threshold = storm_threshold
+        self._max_samples = max_samples
+        self._max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        # {(service, fingerprint): _ErrorFingerprint}, least recently seen first
+        self._fingerprints = OrderedDict()
+        self._pending = OrderedDict()
+        self._stats = {
+            'errors_total': 0,
+            'notified_total': 0,
+            'suppressed_total': 0,
+            'storms_total': 0,
+        }
+
+    def record(self, service, priority_name, message, now=None):
+        """ Record an error. Returns True if it should be notified, in which case it will be part of the next
+        take_alert(). """
+        now = time.time() if now is None else now
+        key = (service, fingerprint(message))
+        with self._lock:
+            self._stats['errors_total'] += 1
+            err = self._fingerprints.get(key)
+            if err is None:
+                err = self._fingerprints[key] = _ErrorFingerprint(service, priority_name, key[1], now,
+                                                                  self._max_samples)
+                if len(self._fingerprints) > self._max_fingerprints:
+                    old_key, _ = self._fingerprints.popitem(last=False)
+                    self._pending.pop(old_key, None)
+            else:
+                self._fingerprints.move_to_end(key)
+                if now - err.last_seen >= self._backoff_reset_secs:
+                    # Not seen in a long time: treat it as new
+                    err.backoff_secs = None
+                    err.next_notify_at = now
+
+            err.count += 1
+            err.unreported += 1
+            err.last_seen = now
+            err.priority_name = priority_name
+            if message not in err.samples:
+                err.samples.append(message)
+
+            if now < err.next_notify_at:
+                self._stats['suppressed_total'] += 1
+                return False
+
+            err.backoff_secs = self._backoff_base_secs if err.backoff_secs is None else \
+                min(2 * err.backoff_secs, self._backoff_max_secs)
+            err.next_notify_at = now + err.backoff_secs
+            self._pending[key] = err
+            self._stats['notified_total'] += 1
+            return True
+
+    @staticmethod
+    def _describe(err):
+        msg = f"{err.service} {err.priority_name}: {err.samples[-1]}"
+        if err.unreported > 1:
+            msg += f" (x{err.unreported} since last alert)"
+        return msg
+
+    def take_alert(self):
+        """ Returns the text of an alert for all errors to notify since the last call, or None if there are none """
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            if not pending:
+                return None
+
+            if len(pending) <= self._storm_threshold:
+                msg = '\n'.join(self._describe(err) for err in pending)
+            else:
+                self._stats['storms_total'] += 1
+                per_service = {}
+                for err in pending:
+                    per_service[err.service] = per_service.get(err.service, 0) + err.unreported
+                total = sum(per_service.values())
+                services = ', '.join(f"{svc}={count}" for svc, count in
+                                     sorted(per_service.items(), key=lambda x: x[1], reverse=True))
+                top = sorted(pending, key=lambda err: err.unreported, reverse=True)[:3]
+                msg = '\n'.join([f"Error storm: {total} errors, {len(pending)} different ones. "
+                                 f"Errors per service: {services}. Most frequent:"] +
+                                [self._describe(err) for err in top])
+
+            for err in pending:
+                err.unreported = 0
+            return msg
+
+    def get_fingerprints(self):
+        """ All known error fingerprints, most recently seen first """
+        with self._lock:
+            return [err.to_dict() for err in reversed(self._fingerprints.values())]
+
+    def get_stats(self):
+        with self._lock:
+            return {**self._stats, 'fingerprints': len(self._fingerprints)}
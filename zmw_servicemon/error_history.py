@@ -0,0 +1,231 @@
+"""Persistent, searchable history of the errors and warnings captured from the journal.
+
+Errors are stored in a local sqlite db, indexed by time, service and
+fingerprint (see error_fingerprints.py), with an FTS5 full-text index over the
+messages. This makes questions like "when did this start failing" a single
+indexed query, instead of running journalctl over days of logs:
+
+- search(): errors matching a full-text query and/or filters (service,
+  severity, time range, fingerprint), newest first.
+- fingerprints(): the same filters, grouped by fingerprint, with count and
+  first/last seen times.
+- trends(): counts per fingerprint and time bucket, for charts.
+
+Retention is limited both by age and by number of rows.
+"""
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from flask import abort, request
+
+from zzmw_lib.logs import build_logger
+
+from error_fingerprints import fingerprint
+
+log = build_logger("ErrorHistory")
+
+# Journal priorities, most severe first
+PRIORITIES = {'EMERG': 0, 'ALERT': 1, 'CRIT': 2, 'ERR': 3, 'WARNING': 4}
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS errors (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        service TEXT NOT NULL,
+        priority INTEGER,
+        priority_name TEXT,
+        fingerprint TEXT NOT NULL,
+        message TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS errors_time ON errors(time)',
+    'CREATE INDEX IF NOT EXISTS errors_service_time ON errors(service, time)',
+    'CREATE INDEX IF NOT EXISTS errors_fingerprint_time ON errors(fingerprint, time)',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS errors_fts USING fts5(message, content='errors', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS errors_fts_insert AFTER INSERT ON errors BEGIN
+        INSERT INTO errors_fts(rowid, message) VALUES (new.id, new.message);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS errors_fts_delete AFTER DELETE ON errors BEGIN
+        INSERT INTO errors_fts(errors_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END''',
+]
+
+
+def _to_epoch(timestamp):
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+def _to_iso(epoch):
+    return datetime.fromtimestamp(epoch).isoformat()
+
+
+def _fts_query(query):
+    """ Match all words of query, as literals: user input shouldn't be parsed as FTS syntax """
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class ErrorHistory:
+    """ Stores errors in a sqlite db. Thread safe. """
+
+    def __init__(self, dbpath, retention_days=90, max_rows=100000):
+        self._retention_days = retention_days
+        self._max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(dbpath, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for stmt in _SCHEMA:
+            self._conn.execute(stmt)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, error_event):
+        """ Store an error event, as captured by JournalMonitor """
+        message = error_event.get('message') or ''
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO errors (time, service, priority, priority_name, fingerprint, message) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (_to_epoch(error_event.get('timestamp')), error_event.get('service', 'unknown'),
+                 error_event.get('priority'), error_event.get('priority_name'), fingerprint(message), message))
+
+    @staticmethod
+    def _where(query=None, service=None, severity=None, since=None, until=None, fp=None):
+        """ Build the WHERE clause for a set of filters. severity is a priority name, and selects errors of that
+        severity or worse. since and until are epochs. """
+        conds = []
+        args = []
+        if query:
+            conds.append('id IN (SELECT rowid FROM errors_fts WHERE errors_fts MATCH ?)')
+            args.append(_fts_query(query))
+        if service is not None:
+            conds.append('service = ?')
+            args.append(service)
+        if severity is not None:
+            if severity not in PRIORITIES:
+                raise ValueError(f"Invalid severity '{severity}', must be one of {list(PRIORITIES)}")
+            conds.append('priority <= ?')
+            args.append(PRIORITIES[severity])
+        if since is not None:
+            conds.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            conds.append('time < ?')
+            args.append(until)
+        if fp is not None:
+            conds.append('fingerprint = ?')
+            args.append(fp)
+        return (' WHERE ' + ' AND '.join(conds)) if conds else '', args
+
+    def search(self, limit=100, **filters):
+        """ Errors matching filters (see _where), newest first. Same format as JournalMonitor events, plus their
+        fingerprint. """
+        where, args = self._where(**filters)
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT time, service, priority, priority_name, fingerprint, message FROM errors{where} '
+                'ORDER BY time DESC LIMIT ?', args + [limit]).fetchall()
+        return [{
+            'service': service,
+            'priority': priority,
+            'priority_name': priority_name,
+            'message': message,
+            'timestamp': _to_iso(t),
+            'fingerprint': fp,
+        } for t, service, priority, priority_name, fp, message in rows]
+
+    def fingerprints(self, limit=50, **filters):
+        """ Errors matching filters, grouped by service and fingerprint, most recently seen first """
+        where, args = self._where(**filters)
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT service, fingerprint, COUNT(*), MIN(time), MAX(time), MIN(priority) FROM errors{where} '
+                'GROUP BY service, fingerprint ORDER BY MAX(time) DESC LIMIT ?', args + [limit]).fetchall()
+        return [{
+            'service': service,
+            'fingerprint': fp,
+            'count': count,
+            'first_seen': _to_iso(first),
+            'last_seen': _to_iso(last),
+            'max_priority': priority,
+        } for service, fp, count, first, last, priority in rows]
+
+    def trends(self, bucket_secs=60 * 60, **filters):
+        """ Count of errors matching filters, per service, fingerprint and time bucket, oldest bucket first """
+        if bucket_secs <= 0:
+            raise ValueError(f"Invalid bucket size {bucket_secs}, must be a positive number of seconds")
+        where, args = self._where(**filters)
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT CAST(time / ? AS INTEGER) * ? AS bucket, service, fingerprint, COUNT(*) FROM errors{where} '
+                'GROUP BY bucket, service, fingerprint ORDER BY bucket', [bucket_secs, bucket_secs] + args).fetchall()
+        return [{'time': _to_iso(bucket), 'service': service, 'fingerprint': fp, 'count': count}
+                for bucket, service, fp, count in rows]
+
+    def apply_retention(self, now=None):
+        """ Delete errors older than retention_days, and the oldest ones over max_rows. Returns rows deleted. """
+        now = time.time() if now is None else now
+        with self._lock:
+            deleted = self._conn.execute('DELETE FROM errors WHERE time < ?',
+                                         (now - self._retention_days * 24 * 60 * 60,)).rowcount
+            deleted += self._conn.execute(
+                'DELETE FROM errors WHERE id <= (SELECT id FROM errors ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                (self._max_rows,)).rowcount
+        if deleted:
+            log.info("Error history retention deleted %d errors", deleted)
+        return deleted
+
+    def get_stats(self):
+        with self._lock:
+            count, oldest = self._conn.execute('SELECT COUNT(*), MIN(time) FROM errors').fetchone()
+        return {'errors': count, 'oldest': _to_iso(oldest) if oldest is not None else None}
+
+    @staticmethod
+    def _www_filters():
+        """ Filters from query args: ?q=<text>&service=<name>&severity=<ERR|...>&since=<iso>&until=<iso>&fingerprint=<fp>
+        """
+        filters = {
+            'query': request.args.get('q'),
+            'service': request.args.get('service'),
+            'severity': request.args.get('severity'),
+            'fp': request.args.get('fingerprint'),
+        }
+        for arg in ('since', 'until'):
+            val = request.args.get(arg)
+            if val is not None:
+                try:
+                    filters[arg] = datetime.fromisoformat(val).timestamp()
+                except ValueError:
+                    abort(400, f"Invalid {arg} '{val}', must be an ISO date or datetime")
+        return filters
+
+    @staticmethod
+    def _www_int_arg(name, default):
+        val = request.args.get(name, str(default))
+        if not val.isdigit() or int(val) == 0:
+            abort(400, f"Invalid {name} '{val}', must be a positive number")
+        return int(val)
+
+    def http_search(self):
+        try:
+            return self.search(limit=self._www_int_arg('limit', 100), **self._www_filters())
+        except ValueError as e:
+            return abort(400, str(e))
+
+    def http_fingerprints(self):
+        try:
+            return self.fingerprints(limit=self._www_int_arg('limit', 50), **self._www_filters())
+        except ValueError as e:
+            return abort(400, str(e))
+
+    def http_trends(self):
+        try:
+            return self.trends(bucket_secs=self._www_int_arg('bucket_secs', 60 * 60), **self._www_filters())
+        except ValueError as e:
+            return abort(400, str(e))
@@ -1,17 +1,29 @@
-"""Systemd journal monitoring for service errors."""
-import os
-import signal
+"""Systemd journal monitoring for service errors.
+
+A single journal reader runs for the lifetime of the service. It reads warnings and errors of all units, and
+filters them in-process against the set of monitored units, so new units can be monitored without restarting the
+reader (and without a window where entries could be missed).
+
+The cursor of the last processed entry, and the set of monitored units, are persisted in the runtime state cache.
+After a restart, the reader resumes right after that entry: entries logged while the service was down are processed
+once, and entries already processed aren't processed again.
+"""
+import sqlite3
 import subprocess
 import threading
+import time
 from datetime import datetime
 
 from dateutil import parser
 from systemd import journal
 
 from zzmw_lib.logs import build_logger
+from zzmw_lib.runtime_state_cache import runtime_state_cache_flush, runtime_state_cache_get, runtime_state_cache_set
 
 log = build_logger("JournalMonitor")
 
+STATE_NAMESPACE = "journal_monitor"
+
 def _systemd_svc_exists(service_name):
     result = subprocess.run(['systemctl', 'list-unit-files', f'{service_name}.service'],
                             capture_output=True, text=True, check=False)
@@ -21,7 +33,7 @@ class JournalMonitor:
     """Monitors systemd journal for warnings and errors from specified services"""
 
     def __init__(self, max_errors, on_error_logged, own_service_name,
-                 rate_limit_window_mins=5):
+                 rate_limit_window_mins=5, history=None):
         """
         Initialize the journal monitor.
 
@@ -31,14 +43,24 @@ class JournalMonitor:
             own_service_name: Name of this service to exclude from monitoring (prevents error loops).
             rate_limit_window_mins: If oldest error in FIFO is younger than this, enter rate limiting for
                                     rate_limit_window_mins.
+            history: Optional ErrorHistory, to persist captured errors. Recent errors are loaded from it on start,
+                     except those logged before the list was last cleared.
         """
+        self._history = history
+        self._history_write_errors = 0
+        # Oldest first, like new errors are appended
         self._recent_errors = []
+        if history is not None:
+            cleared_at = runtime_state_cache_get("recent_errors_cleared_at", STATE_NAMESPACE)
+            self._recent_errors = list(reversed(history.search(limit=max_errors, since=cleared_at)))
         self._recent_errors_lock = threading.RLock()  # Protects _recent_errors from concurrent access
         self._max_errors = max_errors
         self._journal_thread = None
         self._journal_stop_event = threading.Event()
-        self._monitored_services = set()  # Services currently being monitored by journal thread
-        self._journal_restart_timer = None  # Timer for delayed restart
+        # Units (as "name.service") being monitored. Replaced, never mutated, so the journal thread can read it
+        # without locks. Units monitored before a restart are kept, so their entries logged while this service was
+        # down (or before they are discovered again) aren't skipped.
+        self._monitored_units = frozenset(runtime_state_cache_get("units", STATE_NAMESPACE) or [])
         self._on_error_log_callback = on_error_logged
         self._own_service_name = own_service_name
 
@@ -63,9 +85,10 @@ class JournalMonitor:
             return self._recent_errors.copy()
 
     def clear_recent_errors(self):
-        """ Clear list of errors """
+        """ Clear list of errors. Errors logged before now won't be loaded from the history after a restart. """
         with self._recent_errors_lock:
             self._recent_errors = []
+            runtime_state_cache_set("recent_errors_cleared_at", time.time(), STATE_NAMESPACE)
             self._recent_errors.append({
                 'service': self._own_service_name,
                 'priority': 5,
@@ -77,8 +100,8 @@ class JournalMonitor:
 
     def monitor_unit(self, service_name):
         """
-        Schedule adding a service to monitoring. If the service is already being monitored,
-        this is a no-op. Otherwise, schedules a journal monitor restart after a delay.
+        Add a service to monitoring. If the service is already being monitored, this is a no-op. The journal
+        reader is started with the first monitored service, and picks up new services without restarting.
         """
         # if service_name == self._own_service_name:
         #     # Skip monitoring our own service to prevent error loops
@@ -87,44 +110,19 @@ class JournalMonitor:
         if service_name is None:
             raise ValueError("Requested to monitor service with no systemd name (not a systemd service?)")
 
-        if service_name in self._monitored_services:
-            # Already monitoring
-            return
-
-        if not _systemd_svc_exists(service_name):
-            log.error("Asked to monitor unit %s, but service doesn't exist. "
-                      "Will add it to monitor list, but it probably won't work.", service_name)
-
-        self._monitored_services.add(service_name)
+        unit = f"{service_name}.service"
+        if unit not in self._monitored_units:
+            if not _systemd_svc_exists(service_name):
+                log.error("Asked to monitor unit %s, but service doesn't exist. "
+                          "Will add it to monitor list, but it probably won't work.", service_name)
+            self._monitored_units = self._monitored_units | {unit}
+            runtime_state_cache_set("units", sorted(self._monitored_units), STATE_NAMESPACE)
+            log.info("Monitoring journal for %s", service_name)
 
-        # Cancel any existing pending restart
-        if self._journal_restart_timer is not None:
-            self._journal_restart_timer.cancel()
-            log.debug("Cancelled pending journal monitor restart, rescheduling...")
-
-        restart_delay_secs = 3
-        self._journal_restart_timer = threading.Timer(restart_delay_secs, self._restart_monitor)
-        self._journal_restart_timer.daemon = True
-        self._journal_restart_timer.start()
-        log.info("Service %s up, journal monitor will restart in %d seconds...", service_name, restart_delay_secs)
-
-    def _restart_monitor(self):
-        # Stop existing thread if running
-        if self._journal_thread and self._journal_thread.is_alive():
-            log.info("Journal monitor is restarting...")
-            self._journal_stop_event.set()
-            self._journal_thread.join(timeout=5) # Timeout must be higher than wait time in journal loop
-            if self._journal_thread.is_alive():
-                log.critical("Journal monitor thread did not stop within timeout. Killing process to restart service.")
-                os.kill(os.getpid(), signal.SIGTERM)
-                return
-
-        # Update the set of monitored services
-        self._journal_stop_event.clear()
-        self._journal_thread = threading.Thread(target=self._monitor_journal_loop, daemon=True)
-        self._journal_thread.start()
-        log.info("Started journal monitoring for %d services: %s",
-                    len(self._monitored_services), ', '.join(self._monitored_services))
+        if self._journal_thread is None:
+            self._journal_thread = threading.Thread(target=self._monitor_journal_loop, name="journal_monitor",
+                                                    daemon=True)
+            self._journal_thread.start()
 
     def stop(self):
         """
@@ -132,10 +130,6 @@ class JournalMonitor:
         """
         log.info("Stopping journal monitor...")
 
-        if self._journal_restart_timer is not None:
-            self._journal_restart_timer.cancel()
-            self._journal_restart_timer = None
-
         if self._rate_limit_resume_timer is not None:
             self._rate_limit_resume_timer.cancel()
             self._rate_limit_resume_timer = None
@@ -146,17 +140,15 @@ class JournalMonitor:
             if self._journal_thread.is_alive():
                 log.warning("Journal monitor thread did not stop gracefully")
 
+        # Persist the cursor of the last processed entry now, so no entry is processed twice after a restart
+        runtime_state_cache_flush()
+
 
     def _monitor_journal_loop(self):
         """Main loop that monitors the systemd journal for errors"""
         try:
-            if len(self._monitored_services) == 0:
-                log.info("No service to monitor yet, journal monitor exiting")
-                return
-
             try:
                 j = journal.Reader()
-                j.this_boot()
                 j.log_level(journal.LOG_WARNING)  # WARNING and above (WARNING, ERR, CRIT, ALERT, EMERG)
             except (OSError, RuntimeError):
                 log.error(
@@ -165,20 +157,20 @@ class JournalMonitor:
                 )
                 return
 
-            # Add filters for each service
-            for service_name in self._monitored_services:
-                j.add_match(_SYSTEMD_UNIT=f"{service_name}.service")
-                log.info("Monitoring journal for %s ", service_name)
-
-            j.seek_tail()
-            j.get_previous()  # Skip to end, only monitor new entries
+            self._seek_last_processed(j)
 
             log.info("Now monitoring Journal")
             # Use wait() with timeout to allow checking stop event
             while not self._journal_stop_event.is_set():
                 if j.wait(4):  # Wait up to 4 seconds for new entries
+                    cursor = None
                     for entry in j:
-                        self._handle_log(entry)
+                        cursor = entry.get('__CURSOR', cursor)
+                        if entry.get('_SYSTEMD_UNIT') in self._monitored_units:
+                            self._handle_log(entry)
+                    if cursor is not None:
+                        # Persisting is debounced by the cache, so this is cheap even for bursts of entries
+                        runtime_state_cache_set("cursor", cursor, STATE_NAMESPACE)
 
             log.info("Journal monitor stopped")
         except BaseException: # pylint: disable=broad-exception-caught
@@ -186,6 +178,23 @@ class JournalMonitor:
             # the thread (or the service) here, as it may lead to a crash loop
             log.critical("Journal monitoring thread crashed, won't restart", exc_info=True)
 
+    @staticmethod
+    def _seek_last_processed(j):
+        """ Position the reader right after the last entry processed before a restart, or at the end of the journal
+        if there is none (or it's gone, eg rotated away) """
+        cursor = runtime_state_cache_get("cursor", STATE_NAMESPACE)
+        if cursor is not None:
+            try:
+                j.seek_cursor(cursor)
+                if j.get_next() and j.test_cursor(cursor):
+                    log.info("Resuming journal monitoring after the last processed entry")
+                    return
+                log.warning("Last processed journal entry not found, only new entries will be monitored")
+            except (OSError, ValueError):
+                log.warning("Invalid journal cursor, only new entries will be monitored", exc_info=True)
+        j.seek_tail()
+        j.get_previous()  # Skip to end, only monitor new entries
+
     def _handle_log(self, entry):
         """Process a warning or error log entry from the journal"""
         if self._rate_limiting_active:
@@ -209,6 +218,15 @@ class JournalMonitor:
             'timestamp': timestamp,
         }
 
+        if self._history is not None:
+            try:
+                self._history.add(error_event)
+            except sqlite3.Error:
+                # Only log the first failure: logging it is a journal error too, which would fail to be stored again
+                self._history_write_errors += 1
+                if self._history_write_errors == 1:
+                    log.error("Failed to persist error to history, will keep failing silently", exc_info=True)
+
         # Store in memory (keep last N errors) - thread-safe
         with self._recent_errors_lock:
             self._recent_errors.append(error_event)
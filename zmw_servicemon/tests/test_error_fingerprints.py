@@ -0,0 +1,102 @@
+"""Unit tests for error_fingerprints.py"""
+import pytest
+
+from error_fingerprints import ErrorAggregator, fingerprint
+
+
+class TestFingerprint:
+    """Test variable tokens are masked"""
+
+    @pytest.mark.parametrize("message,expected", [
+        ("Timeout after 12.5ms connecting to 10.0.0.3:8080",
+         "Timeout after <N>ms connecting to <IP>"),
+        ("Reading at 2024-05-01T10:20:30.123+02:00 failed", "Reading at <TIME> failed"),
+        ("Backup of 2024-05-01 done at 10:20:30", "Backup of <DATE> done at <TIME>"),
+        ("Device aa:bb:cc:dd:ee:ff left", "Device <MAC> left"),
+        ("Job 123e4567-e89b-12d3-a456-426614174000 failed", "Job <UUID> failed"),
+        ("Object at 0x7f3a2c1b9d00, hash deadbeef42", "Object at <HEX>, hash <HEX>"),
+        ("Unreachable fe80::1c2a:3bff:fe4d:5e6f", "Unreachable <IP>"),
+        ("sensor1 reported -3 errors", "sensor1 reported <N> errors"),
+    ])
+    def test_masks(self, message, expected):
+        assert fingerprint(message) == expected
+
+    def test_same_error_same_fingerprint(self):
+        assert fingerprint("Retry 3 of 5 for 192.168.1.7") == fingerprint("Retry 4 of 5 for 192.168.1.9")
+
+
+class TestErrorAggregator:
+    """Test per-fingerprint backoff and storm summaries"""
+
+    def test_backoff_doubles(self):
+        agg = ErrorAggregator(backoff_base_secs=10, backoff_max_secs=40)
+        notified = [t for t in range(0, 200, 5) if agg.record('svc', 'ERR', f"Failed after {t} tries", now=t)]
+        # Notified at 0, then after 10, 20, 40 and 40 secs
+        assert notified == [0, 10, 30, 70, 110, 150, 190]
+
+    def test_alert_counts_repeats(self):
+        agg = ErrorAggregator(backoff_base_secs=10)
+        agg.record('svc', 'ERR', "Failed after 1 tries", now=0)
+        assert agg.take_alert() == "svc ERR: Failed after 1 tries"
+        for t in range(1, 11):
+            agg.record('svc', 'ERR', f"Failed after {t + 1} tries", now=t)
+        assert agg.take_alert() == "svc ERR: Failed after 11 tries (x10 since last alert)"
+        assert agg.take_alert() is None
+
+    def test_fingerprints_are_per_service(self):
+        agg = ErrorAggregator()
+        assert agg.record('svc1', 'ERR', "Oops 1", now=0)
+        assert agg.record('svc2', 'ERR', "Oops 2", now=0)
+        assert not agg.record('svc1', 'ERR', "Oops 3", now=1)
+        # Repeats before the alert is sent are part of it
+        assert agg.take_alert() == "svc1 ERR: Oops 3 (x2 since last alert)\nsvc2 ERR: Oops 2"
+
+    def test_backoff_resets_when_quiet(self):
+        agg = ErrorAggregator(backoff_base_secs=10, backoff_max_secs=1000, backoff_reset_secs=100)
+        for t in (0, 10, 30):
+            assert agg.record('svc', 'ERR', "Oops", now=t)
+        assert not agg.record('svc', 'ERR', "Oops", now=40)
+        assert agg.record('svc', 'ERR', "Oops", now=140)
+        assert agg.record('svc', 'ERR', "Oops", now=150)
+
+    def test_storm_is_summarized(self):
+        agg = ErrorAggregator(storm_threshold=2)
+        for i in range(5):
+            agg.record('svc1', 'ERR', f"Can't reach 10.0.0.{i}", now=i)
+        agg.record('svc2', 'CRIT', "Disk full", now=5)
+        agg.record('svc2', 'ERR', "Queue overflow", now=6)
+        agg.record('svc3', 'WARNING', "Slow reply", now=7)
+        # Only the first of svc1's errors was notified, but its repeats are counted
+        assert agg.take_alert().splitlines() == [
+            "Error storm: 8 errors, 4 different ones. Errors per service: svc1=5, svc2=2, svc3=1. Most frequent:",
+            "svc1 ERR: Can't reach 10.0.0.4 (x5 since last alert)",
+            "svc2 CRIT: Disk full",
+            "svc2 ERR: Queue overflow",
+        ]
+        assert agg.get_stats()['storms_total'] == 1
+
+    def test_fingerprint_index(self):
+        agg = ErrorAggregator(max_samples=2, max_fingerprints=2)
+        for i in range(3):
+            agg.record('svc', 'ERR', f"Timeout {i}", now=1000 + i)
+        agg.record('svc', 'ERR', "Disk full", now=1010)
+        agg.record('svc', 'ERR', "Queue overflow", now=1020)
+        fps = agg.get_fingerprints()
+        assert [fp['fingerprint'] for fp in fps] == ["Queue overflow", "Disk full"]
+        agg.record('svc', 'ERR', "Timeout 9", now=1030)
+        fp = agg.get_fingerprints()[0]
+        assert (fp['fingerprint'], fp['count'], fp['samples']) == ("Timeout <N>", 1, ["Timeout 9"])
+
+    def test_samples(self):
+        agg = ErrorAggregator(max_samples=2)
+        for i in (1, 2, 2, 3):
+            agg.record('svc', 'ERR', f"Timeout {i}", now=i)
+        fp = agg.get_fingerprints()[0]
+        assert fp['count'] == 4
+        assert fp['samples'] == ["Timeout 2", "Timeout 3"]
+
+    def test_validation(self):
+        with pytest.raises(ValueError):
+            ErrorAggregator(backoff_base_secs=0)
+        with pytest.raises(ValueError):
+            ErrorAggregator(backoff_base_secs=10, backoff_max_secs=5)
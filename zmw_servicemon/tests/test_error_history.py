@@ -0,0 +1,88 @@
+"""Unit tests for error_history.py"""
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+from error_history import ErrorHistory
+
+_T0 = datetime(2024, 5, 1, 12, 0, 0).timestamp()
+
+
+def _err(service, message, secs, priority_name='ERR'):
+    priority = {'CRIT': 2, 'ERR': 3, 'WARNING': 4}[priority_name]
+    return {'service': service, 'priority': priority, 'priority_name': priority_name, 'message': message,
+            'timestamp': datetime.fromtimestamp(_T0 + secs).isoformat()}
+
+
+@pytest.fixture
+def history(tmp_path):
+    hist = ErrorHistory(str(tmp_path / 'errors.sqlite'), retention_days=30, max_rows=1000)
+    hist.add(_err('zmw_lights', "Timeout talking to 10.0.0.5", 0))
+    hist.add(_err('zmw_lights', "Timeout talking to 10.0.0.7", 3600))
+    hist.add(_err('zmw_heating', "Sensor offline", 1800, 'WARNING'))
+    hist.add(_err('zmw_heating', "Relay stuck, can't turn off", 7200, 'CRIT'))
+    yield hist
+    hist.close()
+
+
+class TestErrorHistory:
+    """Test searching, grouping and retention of stored errors"""
+
+    def test_search(self, history):
+        assert [e['message'] for e in history.search()] == [
+            "Relay stuck, can't turn off", "Timeout talking to 10.0.0.7", "Sensor offline",
+            "Timeout talking to 10.0.0.5"]
+        assert len(history.search(query="timeout")) == 2
+        assert [e['message'] for e in history.search(query="can't turn")] == ["Relay stuck, can't turn off"]
+        # FTS syntax is taken literally
+        assert history.search(query='talking OR "offline') == []
+        assert [e['service'] for e in history.search(severity='ERR')] == ['zmw_heating', 'zmw_lights', 'zmw_lights']
+        assert len(history.search(service='zmw_heating', since=_T0 + 3600)) == 1
+        assert len(history.search(until=_T0 + 1800)) == 1
+        assert len(history.search(limit=1)) == 1
+        with pytest.raises(ValueError):
+            history.search(severity='BAD')
+
+    def test_when_did_it_start(self, history):
+        groups = history.fingerprints(query="timeout")
+        assert groups == [{
+            'service': 'zmw_lights', 'fingerprint': "Timeout talking to <IP>", 'count': 2,
+            'first_seen': datetime.fromtimestamp(_T0).isoformat(),
+            'last_seen': datetime.fromtimestamp(_T0 + 3600).isoformat(), 'max_priority': 3,
+        }]
+        assert len(history.search(fp="Timeout talking to <IP>")) == 2
+
+    def test_trends(self, history):
+        trends = history.trends(bucket_secs=3600, service='zmw_lights')
+        assert [(t['fingerprint'], t['count']) for t in trends] == [("Timeout talking to <IP>", 1)] * 2
+        assert trends[1]['time'] > trends[0]['time']
+        with pytest.raises(ValueError):
+            history.trends(bucket_secs=0)
+
+    def test_retention(self, tmp_path):
+        hist = ErrorHistory(str(tmp_path / 'errors.sqlite'), retention_days=1, max_rows=3)
+        for i in range(5):
+            hist.add(_err('zmw_lights', f"Error {i}", i * 3600))
+        hist.add(_err('zmw_lights', "Old error", -2 * 24 * 3600))
+        assert hist.apply_retention(now=_T0 + 5 * 3600) == 3
+        assert [e['message'] for e in hist.search()] == ["Error 4", "Error 3", "Error 2"]
+        assert hist.search(query="old") == []
+        hist.close()
+
+    def test_persists(self, tmp_path, history):
+        history.close()
+        hist = ErrorHistory(str(tmp_path / 'errors.sqlite'))
+        assert hist.get_stats()['errors'] == 4
+        hist.close()
+
+    def test_www(self, history):
+        app = Flask(__name__)
+        app.add_url_rule('/error_history', view_func=history.http_search)
+        app.add_url_rule('/error_history/trends', view_func=history.http_trends)
+        client = app.test_client()
+        res = client.get('/error_history?q=timeout&since=' + datetime.fromtimestamp(_T0 + 60).isoformat())
+        assert [e['message'] for e in res.get_json()] == ["Timeout talking to 10.0.0.7"]
+        assert client.get('/error_history?severity=BAD').status_code == 400
+        assert client.get('/error_history?since=yesterday').status_code == 400
+        assert client.get('/error_history/trends?bucket_secs=0').status_code == 400
@@ -0,0 +1,226 @@
+"""Unit tests for journal_monitor.py, against a fake journal reader"""
+import threading
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+import journal_monitor
+from error_history import ErrorHistory
+from journal_monitor import STATE_NAMESPACE, JournalMonitor
+
+
+class FakeJournal:
+    """An in-memory journal. Entries get a cursor in the same format as the real journal."""
+
+    def __init__(self):
+        self.entries = []
+        self.readers = 0
+        self.cond = threading.Condition()
+        # Set once a reader is positioned and waiting for new entries
+        self.waiting = threading.Event()
+
+    def log(self, unit, message, priority=3):
+        with self.cond:
+            self.entries.append({
+                '__CURSOR': f"s=fake;i={len(self.entries)}",
+                '__REALTIME_TIMESTAMP': datetime.now(),
+                '_SYSTEMD_UNIT': unit,
+                'MESSAGE': message,
+                'PRIORITY': priority,
+            })
+            self.cond.notify_all()
+
+    def reader(self):
+        self.readers += 1
+        return FakeReader(self)
+
+
+class FakeReader:
+    """The subset of systemd.journal.Reader used by JournalMonitor"""
+
+    def __init__(self, fake_journal):
+        self._journal = fake_journal
+        # Index of the current entry: iterating starts at the entry after it
+        self._pos = -1
+
+    def log_level(self, _level):
+        pass
+
+    def seek_cursor(self, cursor):
+        # Like the real journal, seeking to a cursor that isn't there lands on the nearest entry
+        cursors = [e['__CURSOR'] for e in self._journal.entries]
+        self._pos = cursors.index(cursor) - 1 if cursor in cursors else -1
+
+    def get_next(self):
+        if self._pos + 1 >= len(self._journal.entries):
+            return {}
+        self._pos += 1
+        return self._journal.entries[self._pos]
+
+    def get_previous(self):
+        if self._pos <= 0:
+            self._pos = -1
+            return {}
+        self._pos -= 1
+        return self._journal.entries[self._pos]
+
+    def test_cursor(self, cursor):
+        return 0 <= self._pos < len(self._journal.entries) and self._journal.entries[self._pos]['__CURSOR'] == cursor
+
+    def seek_tail(self):
+        self._pos = len(self._journal.entries)
+
+    def wait(self, _timeout):
+        self._journal.waiting.set()
+        with self._journal.cond:
+            return self._journal.cond.wait_for(lambda: self._pos + 1 < len(self._journal.entries), timeout=0.05)
+
+    def __iter__(self):
+        while self._pos + 1 < len(self._journal.entries):
+            self._pos += 1
+            yield self._journal.entries[self._pos]
+
+
+@pytest.fixture
+def fake_journal():
+    fake = FakeJournal()
+    with patch.object(journal_monitor.journal, 'Reader', fake.reader, create=True), \
+         patch.object(journal_monitor.journal, 'LOG_WARNING', 4, create=True), \
+         patch('journal_monitor._systemd_svc_exists', return_value=True):
+        yield fake
+
+
+@pytest.fixture
+def state():
+    """ Runtime state cache contents, kept across monitors like across restarts """
+    values = {}
+
+    def cache_set(key, value, namespace=None):
+        values[(namespace, key)] = value
+    with patch('journal_monitor.runtime_state_cache_get', lambda key, namespace=None: values.get((namespace, key))), \
+         patch('journal_monitor.runtime_state_cache_set', cache_set), \
+         patch('journal_monitor.runtime_state_cache_flush'):
+        yield values
+
+
+def _wait_for(cond, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _make_monitor(errors=None, history=None):
+    return JournalMonitor(max_errors=50, own_service_name='zmw_servicemon', history=history,
+                          on_error_logged=(errors.append if errors is not None else lambda _err: None))
+
+
+def _start(monitor, fake_journal, service_name):
+    fake_journal.waiting.clear()
+    monitor.monitor_unit(service_name)
+    assert fake_journal.waiting.wait(timeout=2)
+
+
+def _messages(monitor):
+    return [err['message'] for err in monitor.get_recent_errors()]
+
+
+def _last_cursor(fake_journal):
+    return fake_journal.entries[-1]['__CURSOR']
+
+
+class TestJournalMonitor:
+    """Test entries are processed exactly once, across restarts and unit changes"""
+
+    def test_starts_at_tail_without_cursor(self, fake_journal, state):
+        fake_journal.log('zmw_lights.service', "Before start")
+        monitor = _make_monitor()
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_lights.service', "After start")
+        assert _wait_for(lambda: _messages(monitor) == ["After start"])
+        monitor.stop()
+
+    def test_resumes_after_persisted_cursor(self, fake_journal, state):
+        errors = []
+        monitor = _make_monitor(errors)
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_lights.service', "Processed before restart")
+        assert _wait_for(lambda: state.get((STATE_NAMESPACE, 'cursor')) == _last_cursor(fake_journal))
+        monitor.stop()
+
+        # Logged while the service was down. Units monitored before the restart are still monitored.
+        fake_journal.log('zmw_lights.service', "Logged while down")
+        restarted = _make_monitor(errors)
+        _start(restarted, fake_journal, 'zmw_heating')
+        fake_journal.log('zmw_heating.service', "After restart")
+        assert _wait_for(lambda: len(errors) == 3)
+        assert _wait_for(lambda: state.get((STATE_NAMESPACE, 'cursor')) == _last_cursor(fake_journal))
+        assert [err['message'] for err in errors] == [
+            "Processed before restart", "Logged while down", "After restart"]
+        restarted.stop()
+
+    def test_missing_cursor_falls_back_to_tail(self, fake_journal, state):
+        fake_journal.log('zmw_lights.service', "Old entry")
+        state[(STATE_NAMESPACE, 'cursor')] = "s=fake;i=rotated-away"
+        state[(STATE_NAMESPACE, 'units')] = ['zmw_lights.service']
+        monitor = _make_monitor()
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_lights.service', "New entry")
+        assert _wait_for(lambda: _messages(monitor) == ["New entry"])
+        assert state[(STATE_NAMESPACE, 'cursor')] == _last_cursor(fake_journal)
+        monitor.stop()
+
+    def test_ignores_units_not_monitored(self, fake_journal, state):
+        errors = []
+        monitor = _make_monitor(errors)
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_heating.service', "Not monitored")
+        fake_journal.log('sshd.service', "Not monitored either")
+        fake_journal.log('zmw_lights.service', "Monitored")
+        assert _wait_for(lambda: state.get((STATE_NAMESPACE, 'cursor')) == _last_cursor(fake_journal))
+        assert [err['message'] for err in errors] == ["Monitored"]
+        assert _messages(monitor) == ["Monitored"]
+        monitor.stop()
+
+    def test_unit_added_while_running(self, fake_journal, state):
+        monitor = _make_monitor()
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_heating.service', "Before monitoring")
+        assert _wait_for(lambda: state.get((STATE_NAMESPACE, 'cursor')) == _last_cursor(fake_journal))
+        monitor.monitor_unit('zmw_heating')
+        fake_journal.log('zmw_heating.service', "After monitoring")
+        assert _wait_for(lambda: _messages(monitor) == ["After monitoring"])
+        assert fake_journal.readers == 1
+        assert state[(STATE_NAMESPACE, 'units')] == ['zmw_heating.service', 'zmw_lights.service']
+        monitor.stop()
+
+    def test_recent_errors_loaded_from_history(self, fake_journal, state, tmp_path):
+        history = ErrorHistory(str(tmp_path / 'errors.sqlite'))
+        monitor = _make_monitor(history=history)
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_lights.service', "First error")
+        fake_journal.log('zmw_lights.service', "Second error")
+        assert _wait_for(lambda: len(monitor.get_recent_errors()) == 2)
+        monitor.stop()
+        assert _messages(_make_monitor(history=history)) == ["First error", "Second error"]
+        history.close()
+
+    def test_cleared_errors_stay_cleared_after_restart(self, fake_journal, state, tmp_path):
+        history = ErrorHistory(str(tmp_path / 'errors.sqlite'))
+        monitor = _make_monitor(history=history)
+        _start(monitor, fake_journal, 'zmw_lights')
+        fake_journal.log('zmw_lights.service', "Before clear")
+        assert _wait_for(lambda: len(monitor.get_recent_errors()) == 1)
+        monitor.clear_recent_errors()
+        fake_journal.log('zmw_lights.service', "After clear")
+        assert _wait_for(lambda: _messages(monitor)[-1:] == ["After clear"])
+        monitor.stop()
+
+        assert _messages(_make_monitor(history=history)) == ["After clear"]
+        # Cleared errors are only hidden from the recent errors list, the history keeps them
+        assert len(history.search()) == 2
+        history.close()
@@ -0,0 +1,134 @@
+"""Unit tests for unit_status.py"""
+import queue
+import time
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
+
+from jeepney import DBusAddress, HeaderFields, new_method_return, new_signal
+
+from unit_status import UnitStatusCache, parse_systemctl_show, unit_object_path
+
+
+SYSTEMCTL_SHOW = """Id=zmw_lights.service
+LoadState=loaded
+ActiveState=active
+SubState=running
+
+Id=zmw_heating.service
+LoadState=loaded
+ActiveState=failed
+SubState=failed
+"""
+
+
+def unit_changed_signal(unit):
+    addr = DBusAddress(unit_object_path(unit), interface='org.freedesktop.DBus.Properties')
+    return new_signal(addr, 'PropertiesChanged', 'sa{sv}as', ('org.freedesktop.systemd1.Unit', {}, []))
+
+
+class FakeSystemd:
+    """A D-Bus router replying to systemd calls with a fixed set of unit states"""
+
+    def __init__(self, states):
+        self.states = states
+        self.calls = []
+        self.signals = None
+
+    def send_and_get_reply(self, msg, timeout=None):
+        member = msg.header.fields[HeaderFields.member]
+        self.calls.append(member)
+        if member == 'ListUnitsByNames':
+            rows = [(name, '', 'loaded', *self.states.get(name.removesuffix('.service'), ('inactive', 'dead')),
+                     '', '/', 0, '', '/') for name in msg.body[0]]
+            return new_method_return(msg, 'a(ssssssouso)', (rows,))
+        return new_method_return(msg)
+
+    @contextmanager
+    def filter(self, _rule, bufsize=1):
+        self.signals = queue.Queue(maxsize=bufsize)
+        yield self.signals
+
+    def close(self):
+        pass
+
+
+def wait_for(cond, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+class TestDbusCache:
+    """Test unit states are read in one call, and refreshed on signals"""
+
+    def test_cache_follows_signals(self):
+        systemd = FakeSystemd({'zmw_lights': ('active', 'running')})
+        on_change = Mock()
+        cache = UnitStatusCache(['zmw_lights', 'zmw_heating'], on_change=on_change)
+        with patch('unit_status.open_dbus_connection'), patch('unit_status.DBusRouter', return_value=systemd):
+            cache.start()
+        try:
+            wait_for(lambda: systemd.calls.count('ListUnitsByNames') == 1)
+            assert systemd.calls[:2] == ['AddMatch', 'Subscribe']
+            assert [s['running'] for s in cache.get_all(['zmw_lights', 'zmw_heating'])] == [True, False]
+            # Reads are served from memory
+            assert systemd.calls.count('ListUnitsByNames') == 1
+
+            systemd.states['zmw_heating'] = ('active', 'running')
+            systemd.signals.put(unit_changed_signal('zmw_heating'))
+            wait_for(lambda: cache.get_all(['zmw_heating'])[0]['running'])
+            assert on_change.call_count == 2
+
+            cache.watch('zmw_doorman')
+            wait_for(lambda: cache.get_all(['zmw_doorman'])[0]['status'] == 'inactive')
+        finally:
+            cache.stop()
+
+    def test_ignores_signals_from_other_units(self):
+        systemd = FakeSystemd({'zmw_lights': ('active', 'running')})
+        cache = UnitStatusCache(['zmw_lights'])
+        with patch('unit_status.open_dbus_connection'), patch('unit_status.DBusRouter', return_value=systemd):
+            cache.start()
+        try:
+            wait_for(lambda: systemd.calls.count('ListUnitsByNames') == 1)
+            for unit in ('sshd', 'zmw_lights2', 'user@1000'):
+                systemd.signals.put(unit_changed_signal(unit))
+            wait_for(systemd.signals.empty)
+            time.sleep(0.05)
+            assert systemd.calls.count('ListUnitsByNames') == 1
+
+            systemd.signals.put(unit_changed_signal('zmw_lights'))
+            wait_for(lambda: systemd.calls.count('ListUnitsByNames') == 2)
+        finally:
+            cache.stop()
+
+    def test_unit_object_path(self):
+        assert unit_object_path('zmw_lights') == '/org/freedesktop/systemd1/unit/zmw_5flights_2eservice'
+        assert unit_object_path('user@1000') == '/org/freedesktop/systemd1/unit/user_401000_2eservice'
+
+
+class TestSystemctlFallback:
+    """Test the fallback when D-Bus isn't available"""
+
+    def test_parse(self):
+        states = parse_systemctl_show(SYSTEMCTL_SHOW)
+        assert states['zmw_lights'] == {'name': 'zmw_lights', 'running': True, 'status': 'active',
+                                        'sub_state': 'running', 'load_state': 'loaded'}
+        assert states['zmw_heating']['status'] == 'failed'
+
+    @patch('unit_status.subprocess.run')
+    def test_one_call_for_all_units(self, mock_run):
+        mock_run.return_value = Mock(stdout=SYSTEMCTL_SHOW)
+        cache = UnitStatusCache(['zmw_lights', 'zmw_heating'], fallback_ttl_secs=60)
+        with patch('unit_status.open_dbus_connection', side_effect=FileNotFoundError):
+            cache.start()
+        units = ['zmw_lights', 'zmw_heating', 'zmw_doorman']
+        assert [s['status'] for s in cache.get_all(units)] == ['active', 'failed', 'unknown']
+        cache.get_all(units)
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][0][-3:] == ['zmw_lights.service', 'zmw_heating.service', 'zmw_doorman.service']
+        cache.stop()
+
+    def test_no_units(self):
+        assert UnitStatusCache().get_all([]) == []
@@ -0,0 +1,212 @@
+"""Cached status of systemd units.
+
+The state of all watched units is read with a single ListUnitsByNames call to
+systemd over D-Bus, and kept in memory, so reading the status of units never
+blocks on systemd. systemd sends a PropertiesChanged signal when a unit
+changes; when one arrives for a watched unit, the cache is refreshed (with one
+call for a whole burst of signals). Signals from other units on the host are
+ignored. A full refresh also runs every refresh_secs, in case a
+signal is missed.
+
+If the system bus isn't reachable, unit states are read with a single
+`systemctl show` call for all units, when they are requested, and cached for
+fallback_ttl_secs.
+"""
+import queue
+import subprocess
+import threading
+import time
+
+from jeepney import DBusAddress, DBusErrorResponse, HeaderFields, MatchRule, message_bus, new_method_call
+from jeepney.io.threading import DBusRouter, open_dbus_connection
+from jeepney.wrappers import unwrap_msg
+
+from zzmw_lib.logs import build_logger
+
+log = build_logger("UnitStatusCache")
+
+_SYSTEMD_MANAGER = DBusAddress('/org/freedesktop/systemd1', bus_name='org.freedesktop.systemd1',
+                               interface='org.freedesktop.systemd1.Manager')
+_DBUS_TIMEOUT_SECS = 5
+_UNIT_PATH_PREFIX = '/org/freedesktop/systemd1/unit/'
+
+
+def _unit_changed_rule():
+    rule = MatchRule(type='signal', sender='org.freedesktop.systemd1', interface='org.freedesktop.DBus.Properties',
+                     member='PropertiesChanged', path_namespace=_UNIT_PATH_PREFIX.rstrip('/'))
+    rule.add_arg_condition(0, 'org.freedesktop.systemd1.Unit')
+    return rule
+
+
+def unit_object_path(unit):
+    """ D-Bus object path of a service, as systemd escapes it: anything but [A-Za-z0-9] becomes _xx (hex) """
+    return _UNIT_PATH_PREFIX + ''.join(c if c.isascii() and c.isalnum() else ''.join(f'_{b:02x}' for b in c.encode())
+                                       for c in f'{unit}.service')
+
+
+def _unit_status(name, load_state, active_state, sub_state):
+    return {
+        'name': name,
+        'running': active_state == 'active',
+        'status': active_state,
+        'sub_state': sub_state,
+        'load_state': load_state,
+    }
+
+
+def parse_systemctl_show(output):
+    """ Parse the output of `systemctl show -p Id,LoadState,ActiveState,SubState unit...` into {name: status} """
+    states = {}
+    for block in output.strip().split('\n\n'):
+        props = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        if 'Id' not in props:
+            continue
+        name = props['Id'].removesuffix('.service')
+        states[name] = _unit_status(name, props.get('LoadState'), props.get('ActiveState'), props.get('SubState'))
+    return states
+
+
+class UnitStatusCache:
+    """ In-memory status of a set of systemd services, kept up to date by systemd signals """
+
+    def __init__(self, units=(), on_change=None, refresh_secs=60, fallback_ttl_secs=5):
+        """
+        units: names of services to watch (without the .service suffix). More can be added with watch().
+        on_change: optional callback(), called when the state of any watched unit changes.
+        """
+        self._units = list(dict.fromkeys(units))
+        self._unit_paths = {unit_object_path(unit) for unit in self._units}
+        self._units_lock = threading.Lock()
+        self._on_change = on_change
+        self._refresh_secs = refresh_secs
+        self._fallback_ttl_secs = fallback_ttl_secs
+        self._states = {}
+        self._states_time = None
+        self._conn = None
+        self._router = None
+        self._signals = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Connect to systemd and start listening for unit changes. Falls back to systemctl if that fails. """
+        try:
+            self._conn = open_dbus_connection(bus='SYSTEM')
+            self._router = DBusRouter(self._conn)
+            unwrap_msg(self._router.send_and_get_reply(message_bus.AddMatch(_unit_changed_rule()),
+                                                       timeout=_DBUS_TIMEOUT_SECS))
+            # systemd only emits unit signals while some client is subscribed
+            unwrap_msg(self._router.send_and_get_reply(new_method_call(_SYSTEMD_MANAGER, 'Subscribe'),
+                                                       timeout=_DBUS_TIMEOUT_SECS))
+        except (OSError, TimeoutError, DBusErrorResponse):
+            log.warning("Can't listen to systemd over D-Bus, will read unit states with systemctl", exc_info=True)
+            self._close_dbus()
+            return
+        self._thread = threading.Thread(target=self._run, name='unit_status', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout=_DBUS_TIMEOUT_SECS)
+            self._thread = None
+        self._close_dbus()
+
+    def _close_dbus(self):
+        if self._router is not None:
+            self._router.close()
+            self._router = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def watch(self, unit):
+        """ Add a service to the watched set (no-op if it's already watched) """
+        with self._units_lock:
+            if unit in self._units:
+                return
+            self._units.append(unit)
+            self._unit_paths.add(unit_object_path(unit))
+        self._wake()
+
+    def _wake(self):
+        signals = self._signals
+        if signals is not None:
+            try:
+                signals.put_nowait(None)
+            except queue.Full:
+                # Already has pending signals, will refresh anyway
+                pass
+
+    def _run(self):
+        with self._router.filter(_unit_changed_rule(), bufsize=256) as signals:
+            self._signals = signals
+            while not self._stop.is_set():
+                try:
+                    self._refresh(self._read_dbus)
+                except (OSError, TimeoutError, DBusErrorResponse):
+                    log.error("Failed to read unit states from systemd", exc_info=True)
+                self._wait_for_change(signals)
+            self._signals = None
+
+    def _wait_for_change(self, signals):
+        """ Blocks until a watched unit changes, the cache is woken up, or refresh_secs pass """
+        deadline = time.monotonic() + self._refresh_secs
+        try:
+            while not self._is_watched_signal(signals.get(timeout=max(0, deadline - time.monotonic()))):
+                pass
+            # Refresh once for a burst of signals (eg a restart of all services)
+            while True:
+                signals.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _is_watched_signal(self, msg):
+        # None is a wake up from watch() or stop()
+        if msg is None:
+            return True
+        with self._units_lock:
+            return msg.header.fields.get(HeaderFields.path) in self._unit_paths
+
+    def _refresh(self, read_states):
+        with self._units_lock:
+            units = list(self._units)
+        states = read_states(units)
+        changed = states != self._states
+        self._states = states
+        self._states_time = time.monotonic()
+        if changed and self._on_change is not None:
+            try:
+                self._on_change()
+            except Exception:  # pylint: disable=broad-except
+                log.error("Error in unit state change callback", exc_info=True)
+
+    def _read_dbus(self, units):
+        msg = new_method_call(_SYSTEMD_MANAGER, 'ListUnitsByNames', 'as', ([f'{u}.service' for u in units],))
+        rows = unwrap_msg(self._router.send_and_get_reply(msg, timeout=_DBUS_TIMEOUT_SECS))[0]
+        states = {}
+        for unit_name, _description, load_state, active_state, sub_state, *_ in rows:
+            name = unit_name.removesuffix('.service')
+            states[name] = _unit_status(name, load_state, active_state, sub_state)
+        return states
+
+    @staticmethod
+    def _read_systemctl(units):
+        if not units:
+            return {}
+        result = subprocess.run(['systemctl', 'show', '--no-pager', '-p', 'Id,LoadState,ActiveState,SubState'] +
+                                [f'{u}.service' for u in units], capture_output=True, text=True, check=False)
+        return parse_systemctl_show(result.stdout)
+
+    def get_all(self, units):
+        """ Returns the status of each of units, in order. Units that aren't watched are added to the watched set,
+        and reported as unknown until the next refresh. """
+        for unit in units:
+            self.watch(unit)
+        if self._thread is None:
+            # No D-Bus: refresh on demand, at most every fallback_ttl_secs
+            if self._states_time is None or time.monotonic() - self._states_time > self._fallback_ttl_secs:
+                self._refresh(self._read_systemctl)
+        states = self._states
+        return [states.get(unit) or _unit_status(unit, None, 'unknown', None) for unit in units]
@@ -5,8 +5,8 @@ import os
 import json
 import subprocess
 import threading
-from collections import deque
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 
 from ansi2html import Ansi2HTMLConverter
 from flask import abort, request
@@ -15,32 +15,62 @@ from zzmw_lib.zmw_mqtt_mon import ZmwMqttServiceMonitor
 from zzmw_lib.service_runner import service_runner
 from zzmw_lib.logs import build_logger
 
+from error_fingerprints import ErrorAggregator
+from error_history import ErrorHistory
 from journal_monitor import JournalMonitor
+from unit_status import UnitStatusCache
 
 log = build_logger("ZmwServicemon")
 
+# Errors to notify are batched until no new one arrives for this long...
+ERROR_BATCH_DELAY_SECS = 5
+# ...but a batch is never delayed for longer than this, even if errors keep arriving
+ERROR_BATCH_MAX_DELAY_SECS = 60
+# The systemd status page is rendered again when a unit changes state, or when it's older than this
+SYSTEMD_STATUS_MAX_AGE_SECS = 60
+# Rendered service logs are reused for this long
+SYSTEMD_LOGS_CACHE_SECS = 10
+
 
 class ZmwServicemon(ZmwMqttServiceMonitor):
     """ Monitor other z2m2w services running on this host """
 
     def __init__(self, cfg, www, sched):
+        # Persistent, searchable history of all captured errors
+        self._error_history = ErrorHistory(
+            dbpath=cfg.get('error_history_db_path', 'error_history.sqlite'),
+            retention_days=cfg.get('error_history_retention_days', 90),
+            max_rows=cfg.get('error_history_max_rows', 100000),
+        )
+        sched.add_job(self._error_history.apply_retention, 'interval', hours=6, next_run_time=datetime.now())
+
         # Initialize journal monitor (exclude own service to prevent error loops)
         self._journal_monitor = JournalMonitor(
             max_errors=cfg['error_history_len'],
             rate_limit_window_mins=cfg['rate_limit_window_mins'],
             on_error_logged=self._on_service_logged_err,
-            own_service_name="zmw_servicemon"
+            own_service_name="zmw_servicemon",
+            history=self._error_history,
         )
 
         # Store list of systemd services to monitor from config
         self._systemd_services = cfg.get('systemd_services', [])
+        self._unit_status = UnitStatusCache(self._systemd_services, on_change=self._on_units_changed)
+        self._unit_status.start()
+        # Rendered pages: (monotonic time, html). The systemd status page, and logs per (service, lines)
+        self._systemd_status_html = None
+        self._systemd_logs_html = {}
+
+        # Aggregate errors by fingerprint, to decide which ones to notify
+        self._errors = ErrorAggregator(
+            backoff_base_secs=cfg.get('error_backoff_base_secs', 5 * 60),
+            backoff_max_secs=cfg.get('error_backoff_max_secs', 7 * 24 * 60 * 60),
+            storm_threshold=cfg.get('error_storm_threshold', 5),
+        )
 
-        # Track recently sent error messages for deduplication (message_key, timestamp)
-        self._recent_messages = deque(maxlen=100)
-
-        # Batch error messages with a 5-second delay
-        self._pending_errors = []
+        # Batch error notifications, see ERROR_BATCH_DELAY_SECS
         self._error_timer = None
+        self._error_batch_started = None
         self._error_lock = threading.Lock()
 
         # Add configured systemd services to journal monitor
@@ -58,6 +88,14 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
         www.serve_url('/systemd_logs', self.systemd_logs)
         www.serve_url('/recent_errors', lambda: json.dumps(self._journal_monitor.get_recent_errors(), default=str))
         www.serve_url('/recent_errors_clear', self._journal_monitor.clear_recent_errors)
+        www.serve_url('/error_history', self._error_history.http_search)
+        www.serve_url('/error_history/fingerprints', self._error_history.http_fingerprints)
+        www.serve_url('/error_history/trends', self._error_history.http_trends)
+        www.serve_url('/error_history/stats', self._error_history.get_stats)
+        www.serve_url('/error_fingerprints', lambda: json.dumps({
+            'stats': self._errors.get_stats(),
+            'fingerprints': self._errors.get_fingerprints(),
+        }, default=str))
         def _log_error():
             log.error("Hola!")
             try:
@@ -89,8 +127,16 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
     def system_uptime(self):
         return subprocess.run("uptime", stdout=subprocess.PIPE, text=True, check=True).stdout
 
+    def _on_units_changed(self):
+        # Drop the rendered status page, it will be rendered again with the new state on the next request
+        self._systemd_status_html = None
+
     def systemd_status(self):
-        """Execute services_status.sh script and return HTML-formatted systemd status."""
+        """Return HTML-formatted systemd status, from services_status.sh. The output is cached until a unit changes
+        state (or for SYSTEMD_STATUS_MAX_AGE_SECS)."""
+        cached = self._systemd_status_html
+        if cached is not None and time.monotonic() - cached[0] < SYSTEMD_STATUS_MAX_AGE_SECS:
+            return cached[1]
         status_script = os.path.join(os.getcwd(), '../services_status.sh')
         if not os.path.isfile(status_script):
             script_dir = pathlib.Path(__file__).parent.resolve()
@@ -100,23 +146,13 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
         cmd = str(status_script)
         syslogcmd = subprocess.run(cmd.split(), stdout=subprocess.PIPE, text=True, check=True)
         conv = Ansi2HTMLConverter(inline=True, scheme='ansi2html')
-        return conv.convert(syslogcmd.stdout, full=False)
+        html = conv.convert(syslogcmd.stdout, full=False)
+        self._systemd_status_html = (time.monotonic(), html)
+        return html
 
     def systemd_services_status(self):
-        """Get status of configured systemd services."""
-        services = []
-        for service_name in self._systemd_services:
-            result = subprocess.run(
-                ['systemctl', 'is-active', f'{service_name}.service'],
-                capture_output=True, text=True, check=False
-            )
-            is_running = result.stdout.strip() == 'active'
-            services.append({
-                'name': service_name,
-                'running': is_running,
-                'status': result.stdout.strip()
-            })
-        return json.dumps(services)
+        """Get status of configured systemd services, from the unit status cache."""
+        return json.dumps(self._unit_status.get_all(self._systemd_services))
 
     def systemd_logs(self):
         """Get journalctl logs for a specific service."""
@@ -129,6 +165,9 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
             return abort(403, description=f"Service '{service_name}' is not in the monitored list")
 
         num_lines = request.args.get('n', '200')
+        cached = self._systemd_logs_html.get((service_name, num_lines))
+        if cached is not None and time.monotonic() - cached[0] < SYSTEMD_LOGS_CACHE_SECS:
+            return cached[1]
 
         result = subprocess.run(
             ['journalctl', '-u', f'{service_name}.service', '-n', num_lines, '--no-pager', '-r'],
@@ -136,7 +175,7 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
         )
         conv = Ansi2HTMLConverter(inline=True, scheme='ansi2html')
         log_content = conv.convert(result.stdout, full=False)
-        return f'''<!DOCTYPE html>
+        html = f'''<!DOCTYPE html>
 <html>
 <head>
     <title>Logs: {service_name}</title>
@@ -147,46 +186,45 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
     <pre>{log_content}</pre>
 </body>
 </html>'''
+        # Only keep the latest render of each service, so the cache can't grow past the number of services
+        self._systemd_logs_html = {key: val for key, val in self._systemd_logs_html.items() if key[0] != service_name}
+        self._systemd_logs_html[(service_name, num_lines)] = (time.monotonic(), html)
+        return html
 
     def on_new_svc_discovered(self, svc_name, svc_meta):
         """ Called by ZmwMqttServiceMonitor when a new service is discovered. Not guaranteed that service is alive. """
         journal_name = svc_meta.get('systemd_name', svc_name)
         log.info("New service '%s' with journal '%s' discovered", svc_name, journal_name)
         self._journal_monitor.monitor_unit(journal_name)
+        # Its state changes invalidate the systemd status page
+        self._unit_status.watch(journal_name)
 
     def _on_service_logged_err(self, err):
-        msg_key = (err.get('service'), err.get('message'))
-        now = datetime.now()
-
-        # Check if this message was sent in the last 7 days
-        cutoff = now - timedelta(days=7)
-        for i, (sent_key, sent_time) in enumerate(self._recent_messages):
-            if sent_key == msg_key and sent_time > cutoff:
-                # Message is a duplicate within the last 7 days
-                # Refresh timestamp so it will be ignored for another 7 days
-                del self._recent_messages[i]
-                self._recent_messages.append((msg_key, now))
-                return
-
-        self._recent_messages.append((msg_key, now))
-        msg = f"{err.get('service')} {err.get('priority_name')}: {err.get('message')}"
-
-        # Batch errors with a 5-second delay, resetting timer on each new error
+        if not self._errors.record(err.get('service'), err.get('priority_name'), err.get('message')):
+            # Seen recently, this error is in backoff
+            return
+
+        # Batch errors, resetting the timer on each new error (up to ERROR_BATCH_MAX_DELAY_SECS)
         with self._error_lock:
-            self._pending_errors.append(msg)
+            now = time.monotonic()
             if self._error_timer is not None:
+                if now - self._error_batch_started >= ERROR_BATCH_MAX_DELAY_SECS:
+                    # Let the pending timer fire, this batch has waited long enough
+                    return
                 self._error_timer.cancel()
-            self._error_timer = threading.Timer(5.0, self._flush_pending_errors)
+            else:
+                self._error_batch_started = now
+            self._error_timer = threading.Timer(ERROR_BATCH_DELAY_SECS, self._flush_pending_errors)
             self._error_timer.start()
 
     def _flush_pending_errors(self):
-        """Send all pending error messages combined with newlines."""
+        """Send one alert with all errors to notify (or a summary, if there are too many)."""
         with self._error_lock:
-            if not self._pending_errors:
-                return
-            combined_msg = '\n'.join(self._pending_errors)
-            self._pending_errors = []
             self._error_timer = None
+            self._error_batch_started = None
+        combined_msg = self._errors.take_alert()
+        if combined_msg is None:
+            return
 
         # Bypass service discovery. Because we monitor other services, we don't keep a map of service=>mqtt_topics.
         # I should fix this, but for now this hack will do.
@@ -199,6 +237,8 @@ class ZmwServicemon(ZmwMqttServiceMonitor):
                 self._error_timer.cancel()
                 self._error_timer = None
         self._journal_monitor.stop()
+        self._unit_status.stop()
+        self._error_history.close()
         super().stop()
 
 service_runner(ZmwServicemon)
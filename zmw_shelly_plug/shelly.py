@@ -1,18 +1,35 @@
 """Shelly Gen2 device API client."""
 import json
+import logging
 import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor, wait
 from json.decoder import JSONDecodeError
 
-from requests import post
+from requests import Session
 from requests.exceptions import RequestException
 from requests.auth import HTTPDigestAuth
 
+log = logging.getLogger(__name__)
+
 # Docs https://shelly-api-docs.shelly.cloud/gen2/0.14/Devices/ShellyPlusPlugUK/
 # Some code stolen from https://github.com/Jan200101/ShellyPy
 
 
+class _SharedDigestAuth(HTTPDigestAuth):
+    """ Digest auth that keeps the server nonce across threads. requests keeps it per thread, so a device polled from
+    a thread pool would go through the 401 challenge again each time its poll lands on a new thread. A device only
+    has one request in flight at a time, so its auth state doesn't need to be per thread. """
+
+    def __init__(self, username, password):
+        super().__init__(username, password)
+        self._thread_local = types.SimpleNamespace()
+
+
 class ShellyGen2:
-    """Base client for Shelly Gen2 devices."""
+    """Base client for Shelly Gen2 devices. Keeps a persistent HTTP session, so the connection and the digest auth
+    nonce are reused across requests."""
 
     def __init__(self, host, port="80", login=None, timeout=5):
         self._host = host
@@ -22,6 +39,8 @@ class ShellyGen2:
             login = {}
         self._credentials = (login.get("username", ""), login.get("password", ""))
         self._payload_id = 1
+        self._session = Session()
+        self._session.auth = _SharedDigestAuth('admin', self._credentials[1])
 
         self._last_status = None
         self._last_cfg = None
@@ -41,13 +60,7 @@ class ShellyGen2:
         if values:
             payload["params"] = values
 
-        credentials = None
-        try:
-            credentials = HTTPDigestAuth('admin', self._credentials[1])
-        except IndexError:
-            pass
-
-        response = post(url, auth=credentials, json=payload, timeout=self._timeout)
+        response = self._session.post(url, json=payload, timeout=self._timeout)
         if response.status_code == 401:
             raise PermissionError()
         if response.status_code == 404:
@@ -86,39 +99,40 @@ class ShellyPlug(ShellyGen2):
         self._host = host
         self._stats = None
         self._device_cfg = {}
-        self.update_device_config()
 
     def update_device_config(self):
-        """Fetch and cache device configuration."""
-        def _f():
-            try:
-                self._device_cfg = self.post("Switch.GetConfig", {"id": 0})
-            except (RequestException, PermissionError, LookupError, ValueError, KeyError):
-                self._device_cfg = {}
-
-        thread = threading.Thread(target=_f, daemon=True)
-        thread.start()
+        """Fetch and cache device configuration. Blocks until the device replies. Returns False if the device can't
+        be reached."""
+        try:
+            self._device_cfg = self.post("Switch.GetConfig", {"id": 0})
+        except RequestException:
+            self._device_cfg = {}
+            return False
+        except (PermissionError, LookupError, ValueError, KeyError):
+            self._device_cfg = {}
+        return True
 
     def get_name(self):
-        """Return device name."""
-        if "name" not in self._device_cfg:
-            self.update_device_config()
-            self._device_cfg["name"] = self._host
-        return self._device_cfg["name"]
-
-    def get_stats_bg(self):
-        """ Same as get_stats, but will return last cached stats and then fetch new ones in the background """
-        cached_stats = self._stats
-        thread = threading.Thread(target=self.get_stats, daemon=True)
-        thread.start()
-        return cached_stats
+        """Return device name, or its host if the device config wasn't fetched yet."""
+        return self._device_cfg.get("name") or self._host
+
+    def get_cached_stats(self):
+        """ Last stats fetched by get_stats, or None if the device wasn't polled yet """
+        return self._stats
 
     def get_stats(self):
-        """Return current device statistics."""
-        try:
-            stats = self.post("Shelly.GetStatus")
-        except (RequestException, PermissionError, LookupError, ValueError, KeyError):
-            stats = {"online": False}
+        """Fetch and return current device statistics. Blocks until the device replies (or times out)."""
+        stats = None
+        if not self._device_cfg.get("name"):
+            # Not fetched yet, or the device was offline: retry with each poll until its name is known. If the device
+            # can't be reached, don't wait for a second timeout asking for its status.
+            if not self.update_device_config():
+                stats = {"online": False}
+        if stats is None:
+            try:
+                stats = self.post("Shelly.GetStatus")
+            except (RequestException, PermissionError, LookupError, ValueError, KeyError):
+                stats = {"online": False}
         switch = stats.get("switch:0", {})
         sys_stats = stats.get("sys", {})
         wifi = stats.get("wifi", {})
@@ -138,3 +152,112 @@ class ShellyPlug(ShellyGen2):
             "online": "sta_ip" in wifi,
         }
         return self._stats
+
+
+def _is_stable(prev, stats):
+    """ True if a plug reported about the same as in its previous poll: same on/off state, power within 1W or 2% """
+    if prev is None or not prev["online"] or not stats["online"]:
+        return False
+    if prev["powered_on"] != stats["powered_on"]:
+        return False
+    prev_w, w = prev["active_power_watts"], stats["active_power_watts"]
+    if prev_w is None or w is None:
+        return prev_w == w
+    return abs(w - prev_w) <= max(1.0, 0.02 * abs(prev_w))
+
+
+class ShellyPoller:
+    """ Polls a set of plugs from a single background thread. Each cycle, all plugs that are due are polled
+    concurrently (each with its own request timeout), and on_cycle is called once with {device_name: stats} for
+    the plugs that replied in that cycle.
+
+    A cycle waits at most cycle_timeout_secs for replies, so a slow or offline plug doesn't hold up the others:
+    plugs that haven't replied by then are reported with the first cycle after they do, and aren't polled again
+    until they reply.
+
+    Plugs are polled every period_secs. While a plug reports stable values, its period doubles with each poll, up
+    to max_period_secs; it goes back to period_secs as soon as its values change. Offline plugs back off the same
+    way: the first poll after a plug goes offline is after period_secs, then the period doubles while it stays
+    offline. """
+
+    def __init__(self, devices, period_secs, max_period_secs=None, on_cycle=None, max_workers=8,
+                 cycle_timeout_secs=2):
+        self._devices = list(devices)
+        self._period_secs = period_secs
+        self._max_period_secs = max(max_period_secs or period_secs, period_secs)
+        self._on_cycle = on_cycle
+        self._cycle_timeout_secs = cycle_timeout_secs
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self._devices))),
+                                        thread_name_prefix='shelly_poll')
+        self._dev_period = {id(d): period_secs for d in self._devices}
+        self._next_poll = {id(d): 0 for d in self._devices}
+        # {id(device): (device, stats before the poll, future)} for polls without a reply yet
+        self._in_flight = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='shelly_poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_period(self, device):
+        """ Current polling period of a device, in seconds """
+        return self._dev_period[id(device)]
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll_cycle(time.monotonic())
+            now = time.monotonic()
+            idle = [t for dev_id, t in self._next_poll.items() if dev_id not in self._in_flight]
+            next_poll = min(idle, default=now + self._period_secs)
+            if self._in_flight:
+                # Pick up late replies with the next cycle
+                next_poll = min(next_poll, now + self._period_secs)
+            self._stop.wait(max(0, next_poll - now))
+
+    def _next_period(self, dev, prev, stats):
+        period = self._dev_period[id(dev)]
+        if _is_stable(prev, stats):
+            return min(period * 2, self._max_period_secs)
+        if not stats["online"] and prev is not None and not prev["online"]:
+            return min(period * 2, self._max_period_secs)
+        return self._period_secs
+
+    def poll_cycle(self, now):
+        """ Poll all devices due at time now (a monotonic clock), and report the stats of all devices that replied
+        since the last cycle. Returns the stats. """
+        due = [d for d in self._devices if id(d) not in self._in_flight and self._next_poll[id(d)] <= now]
+        for dev in due:
+            self._in_flight[id(dev)] = (dev, dev.get_cached_stats(), self._pool.submit(dev.get_stats))
+        if due:
+            wait([future for _, _, future in self._in_flight.values()], timeout=self._cycle_timeout_secs)
+
+        batch = {}
+        for dev_id, (dev, prev_stats, future) in list(self._in_flight.items()):
+            if not future.done():
+                continue
+            del self._in_flight[dev_id]
+            try:
+                stats = future.result()
+            except Exception:  # pylint: disable=broad-except
+                log.error("Error polling Shelly device %s", dev.get_name(), exc_info=True)
+                self._next_poll[dev_id] = now + self._period_secs
+                continue
+            period = self._next_period(dev, prev_stats, stats)
+            self._dev_period[dev_id] = period
+            self._next_poll[dev_id] = now + period
+            batch[stats["device_name"]] = stats
+
+        if batch and self._on_cycle is not None:
+            try:
+                self._on_cycle(batch)
+            except Exception:  # pylint: disable=broad-except
+                log.error("Error reporting Shelly stats", exc_info=True)
+        return batch
@@ -0,0 +1,156 @@
+"""Unit tests for shelly.py"""
+import threading
+import time
+
+from requests.exceptions import ConnectTimeout
+
+from shelly import ShellyPlug, ShellyPoller, _SharedDigestAuth
+
+
+class FakePlug:
+    """A plug that reports a scripted list of power readings"""
+
+    def __init__(self, name, watts):
+        self._name = name
+        self._watts = list(watts)
+        self._stats = None
+        self.polls = 0
+
+    def get_name(self):
+        return self._name
+
+    def get_cached_stats(self):
+        return self._stats
+
+    def get_stats(self):
+        self.polls += 1
+        watts = self._watts.pop(0) if self._watts else None
+        online = watts is not None
+        self._stats = {"device_name": self._name, "online": online, "powered_on": online,
+                       "active_power_watts": watts}
+        return self._stats
+
+
+class SlowPlug(FakePlug):
+    """A plug that doesn't reply until released"""
+
+    def __init__(self, name, watts):
+        super().__init__(name, watts)
+        self.release = threading.Event()
+
+    def get_stats(self):
+        self.release.wait(timeout=5)
+        return super().get_stats()
+
+
+class TestShellyPoller:
+    """Test concurrent polling, adaptive periods and batched reports"""
+
+    def test_cycle_reports_one_batch(self):
+        batches = []
+        plugs = [FakePlug('Plug1', [10]), FakePlug('Plug2', [20])]
+        poller = ShellyPoller(plugs, period_secs=10, on_cycle=batches.append)
+        poller.poll_cycle(0)
+        assert len(batches) == 1
+        assert {name: stats["active_power_watts"] for name, stats in batches[0].items()} == \
+               {'Plug1': 10, 'Plug2': 20}
+        poller.stop()
+
+    def test_period_grows_while_stable(self):
+        plug = FakePlug('Plug1', [10, 10, 10.1, 10, 10, 50])
+        poller = ShellyPoller([plug], period_secs=10, max_period_secs=30)
+        now = 0
+        periods = []
+        for _ in range(6):
+            poller.poll_cycle(now)
+            periods.append(poller.get_period(plug))
+            now += periods[-1]
+        assert periods == [10, 20, 30, 30, 30, 10]
+        poller.stop()
+
+    def test_offline_resets_period(self):
+        plug = FakePlug('Plug1', [10, 10])
+        poller = ShellyPoller([plug], period_secs=10, max_period_secs=40)
+        poller.poll_cycle(0)
+        poller.poll_cycle(10)
+        assert poller.get_period(plug) == 20
+        poller.poll_cycle(30)
+        assert poller.get_period(plug) == 10
+        poller.stop()
+
+    def test_offline_backs_off(self):
+        plug = FakePlug('Plug1', [])
+        poller = ShellyPoller([plug], period_secs=10, max_period_secs=40)
+        now = 0
+        periods = []
+        for _ in range(5):
+            poller.poll_cycle(now)
+            periods.append(poller.get_period(plug))
+            now += periods[-1]
+        assert periods == [10, 20, 40, 40, 40]
+        poller.stop()
+
+    def test_slow_device_doesnt_delay_others(self):
+        slow = SlowPlug('Slow', [10, 10])
+        fast = FakePlug('Fast', [20] * 10)
+        batches = []
+        poller = ShellyPoller([slow, fast], period_secs=10, on_cycle=batches.append, cycle_timeout_secs=0.1)
+        start = time.monotonic()
+        assert list(poller.poll_cycle(0)) == ['Fast']
+        assert time.monotonic() - start < 2
+        # Still waiting for a reply: not polled again, and reported once it replies
+        assert list(poller.poll_cycle(10)) == ['Fast']
+        slow.release.set()
+        poller._in_flight[id(slow)][2].result(timeout=5)
+        assert list(poller.poll_cycle(15)) == ['Slow']
+        assert slow.polls == 1
+        assert len(batches) == 3
+        poller.stop()
+
+    def test_only_due_devices_are_polled(self):
+        stable = FakePlug('Plug1', [10] * 10)
+        changing = FakePlug('Plug2', range(0, 100, 10))
+        batches = []
+        poller = ShellyPoller([stable, changing], period_secs=10, max_period_secs=40, on_cycle=batches.append)
+        for now in (0, 10, 20):
+            poller.poll_cycle(now)
+        assert (stable.polls, changing.polls) == (2, 3)
+        assert list(batches[-1]) == ['Plug2']
+        assert poller.poll_cycle(25) == {}
+        poller.stop()
+
+    def test_report_errors_dont_stop_polling(self):
+        def fail(_batch):
+            raise RuntimeError("broken")
+        poller = ShellyPoller([FakePlug('Plug1', [10])], period_secs=10, on_cycle=fail)
+        assert list(poller.poll_cycle(0)) == ['Plug1']
+        poller.stop()
+
+
+class TestShellyPlug:
+    """Test fetching stats from a plug"""
+
+    def test_unreachable_device_costs_one_request(self):
+        plug = ShellyPlug('192.168.1.2', timeout=1)
+        calls = []
+
+        def post(method, *_args):
+            calls.append(method)
+            raise ConnectTimeout()
+        plug.post = post
+        assert plug.get_stats()["online"] is False
+        assert calls == ['Switch.GetConfig']
+
+
+class TestSharedDigestAuth:
+    """Test digest auth state is shared by all threads polling a device"""
+
+    def test_nonce_is_shared_across_threads(self):
+        auth = _SharedDigestAuth('admin', 'secret')
+        auth.init_per_thread_state()
+        auth._thread_local.chal = {'nonce': 'abc'}
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(auth._thread_local.chal.get('nonce')))
+        thread.start()
+        thread.join()
+        assert seen == ['abc']
@@ -1,13 +1,12 @@
 """MQTT service for monitoring Shelly smart plugs."""
 import os
 import pathlib
-import threading
 
 from zzmw_lib.service_runner import service_runner
 from zzmw_lib.zmw_mqtt_service import ZmwMqttService
 from zzmw_lib.logs import build_logger
 
-from shelly import ShellyPlug
+from shelly import ShellyPlug, ShellyPoller
 
 log = build_logger("ZmwShellyPlug")
 
@@ -20,13 +19,16 @@ class ZmwShellyPlug(ZmwMqttService):
         www_path = os.path.join(pathlib.Path(__file__).parent.resolve(), 'www')
         self._public_url_base = www.register_www_dir(www_path)
 
-        self._devices = [ShellyPlug(host) for host in cfg["devices_to_monitor"]]
-        self._bcast_period_secs = cfg["bcast_period_secs"]
-        self._timer = None
+        timeout = cfg.get("poll_timeout_secs", 5)
+        self._devices = [ShellyPlug(host, timeout=timeout) for host in cfg["devices_to_monitor"]]
+        bcast_period_secs = cfg["bcast_period_secs"]
+        self._poller = ShellyPoller(self._devices, bcast_period_secs,
+                                    max_period_secs=cfg.get("max_poll_period_secs", 4 * bcast_period_secs),
+                                    on_cycle=self._bcast)
 
         www.serve_url('/ls_devs', lambda: [d.get_name() for d in self._devices])
-        www.serve_url('/all_stats', lambda: {d.get_name(): d.get_stats_bg() for d in self._devices})
-        self._bcast()
+        www.serve_url('/all_stats', self._all_stats)
+        self._poller.start()
 
     def get_mqtt_description(self):
         return {
@@ -47,9 +49,10 @@ class ZmwShellyPlug(ZmwMqttService):
                 },
             },
             "announcements": {
-                "<device_name>/stats": {
-                    "description": "Periodically published stats for each online Shelly plug",
-                    "payload": {
+                "stats": {
+                    "description": "Periodically published stats of the online Shelly plugs polled in each cycle, as a map "\
+                                   "of device name to stats. Plugs with stable readings are polled less often",
+                    "payload": {"<device_name>": {
                         "device_name": "Name",
                         "powered_on": "Switch is on",
                         "active_power_watts": "Power draw in watts",
@@ -62,7 +65,7 @@ class ZmwShellyPlug(ZmwMqttService):
                         "device_uptime": "Device uptime in seconds",
                         "device_ip": "Device WiFi IP address",
                         "online": "Whether the device is reachable"
-                    }
+                    }}
                 },
                 "ls_devs_reply": {
                     "description": "List of devices",
@@ -70,7 +73,7 @@ class ZmwShellyPlug(ZmwMqttService):
                 },
                 "all_stats_reply": {
                     "description": "Map of device name to stats object",
-                    "payload": "See `<device_name>/stats`",
+                    "payload": "See `stats`",
                 },
                 "get_mqtt_description_reply": {
                     "description": "Service description",
@@ -79,19 +82,17 @@ class ZmwShellyPlug(ZmwMqttService):
             }
         }
 
-    def _bcast(self):
-        self._timer = threading.Timer(self._bcast_period_secs, self._bcast)
-        self._timer.start()
-        for dev in self._devices:
-            stats = dev.get_stats_bg()
-            if stats and stats["online"]:
-                self.publish_own_svc_message(f'{stats["device_name"]}/stats', stats)
+    def _all_stats(self):
+        return {d.get_name(): d.get_cached_stats() for d in self._devices}
+
+    def _bcast(self, batch):
+        online = {name: stats for name, stats in batch.items() if stats["online"]}
+        if online:
+            self.publish_own_svc_message('stats', online)
 
     def stop(self):
-        """Stop the broadcast timer and clean up."""
-        if self._timer:
-            self._timer.cancel()
-            self._timer = None
+        """Stop polling and clean up."""
+        self._poller.stop()
         super().stop()
 
     def on_service_received_message(self, subtopic, _payload):
@@ -104,8 +105,7 @@ class ZmwShellyPlug(ZmwMqttService):
                 self.publish_own_svc_message("ls_devs_reply",
                     [d.get_name() for d in self._devices])
             case "all_stats":
-                self.publish_own_svc_message("all_stats_reply",
-                    {d.get_name(): d.get_stats_bg() for d in self._devices})
+                self.publish_own_svc_message("all_stats_reply", self._all_stats())
             case "get_mqtt_description":
                 self.publish_own_svc_message("get_mqtt_description_reply",
                     self.get_mqtt_description())
@@ -0,0 +1,31 @@
+"""Adaptive polling interval.
+
+Polls quickly while presence is changing, and backs off while the network is
+stable: the interval grows by `backoff` with each poll that finds no change,
+up to max_secs, and goes back to min_secs as soon as a change is seen (or
+while a change is pending, eg a user leaving during the away cooldown).
+"""
+
+
+class AdaptivePollInterval:
+    def __init__(self, min_secs, max_secs=None, backoff=2):
+        if min_secs <= 0:
+            raise ValueError(f"Invalid poll interval {min_secs}, must be a positive number of seconds")
+        if backoff < 1:
+            raise ValueError(f"Invalid poll backoff {backoff}, must be >= 1")
+        self._min_secs = min_secs
+        self._max_secs = max(max_secs or min_secs, min_secs)
+        self._backoff = backoff
+        self._current = min_secs
+
+    def on_poll(self, changed):
+        """Record the result of a poll, return the interval until the next one."""
+        if changed:
+            self._current = self._min_secs
+        else:
+            self._current = min(self._current * self._backoff, self._max_secs)
+        return self._current
+
+    @property
+    def current_secs(self):
+        return self._current
@@ -0,0 +1,123 @@
+"""A local fake UniFi controller, serving the subset of the API used by UnifiClient."""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeUnifiController:
+    """Serves login, client list, single client and event log endpoints on localhost. Clients connect and
+    disconnect with connect()/disconnect(), which also log events unless the controller has no event log."""
+
+    def __init__(self, has_events=True, udm=False):
+        self.has_events = has_events
+        self._prefix = "/proxy/network" if udm else ""
+        self._login_path = "/api/auth/login" if udm else "/api/login"
+        self._clients = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        # Rows returned by the event log, over all requests
+        self.events_served = 0
+        self.expire_session = False
+
+        controller = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                controller._handle(self, "GET")
+
+            def do_POST(self):
+                controller._handle(self, "POST")
+
+            def log_message(self, *_):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def connect(self, mac, hostname, ip, event_time=None, log_event=True):
+        now = event_time or time.time()
+        with self._lock:
+            self._clients[mac] = {"mac": mac, "hostname": hostname, "ip": ip,
+                                  "assoc_time": int(now), "last_seen": int(now)}
+            if log_event:
+                self._log_event("EVT_WU_Connected", mac, hostname, now)
+
+    def disconnect(self, mac, event_time=None, log_event=True):
+        now = event_time or time.time()
+        with self._lock:
+            client = self._clients.pop(mac)
+            if log_event:
+                self._log_event("EVT_WU_Disconnected", mac, client["hostname"], now)
+
+    def roam(self, mac, event_time=None):
+        """Log a roaming event, which doesn't change presence"""
+        with self._lock:
+            self._log_event("EVT_WU_Roam", mac, self._clients[mac]["hostname"], event_time or time.time())
+
+    def _log_event(self, key, mac, hostname, event_time):
+        self._events.append({"_id": f"ev{len(self._events)}", "key": key, "user": mac, "hostname": hostname,
+                             "time": int(event_time * 1000)})
+
+    def _reply(self, handler, status, payload=None):
+        body = json.dumps(payload if payload is not None else {}).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _query_events(self, query):
+        """Events newest first, honouring the within (hours), _start and _limit of the query"""
+        events = sorted(self._events, key=lambda ev: -ev["time"])
+        if "within" in query:
+            oldest_ms = (time.time() - query["within"] * 60 * 60) * 1000
+            events = [ev for ev in events if ev["time"] >= oldest_ms]
+        start = query.get("_start", 0)
+        events = events[start:start + query.get("_limit", 3000)]
+        self.events_served += len(events)
+        return events
+
+    def _handle(self, handler, method):
+        path = handler.path
+        length = int(handler.headers.get("Content-Length", 0))
+        body = json.loads(handler.rfile.read(length)) if length else {}
+        self.requests[path] += 1
+
+        if method == "POST" and path == self._login_path:
+            handler.send_response(200)
+            handler.send_header("Set-Cookie", "unifises=fake; Path=/")
+            handler.send_header("Content-Length", "2")
+            handler.end_headers()
+            handler.wfile.write(b"{}")
+            return
+        if not path.startswith(self._prefix + "/api/s/default/"):
+            self._reply(handler, 404)
+            return
+        if self.expire_session or "unifises=fake" not in handler.headers.get("Cookie", ""):
+            self.expire_session = False
+            self._reply(handler, 401)
+            return
+
+        path = path[len(self._prefix):]
+        with self._lock:
+            if method == "GET" and path == "/api/s/default/stat/sta":
+                self._reply(handler, 200, {"data": list(self._clients.values())})
+            elif method == "GET" and path.startswith("/api/s/default/stat/sta/"):
+                mac = path.rsplit("/", 1)[1]
+                if mac in self._clients:
+                    self._reply(handler, 200, {"data": [self._clients[mac]]})
+                else:
+                    self._reply(handler, 400, {"meta": {"rc": "error", "msg": "api.err.UnknownStation"}})
+            elif method == "POST" and path == "/api/s/default/stat/event" and self.has_events:
+                self._reply(handler, 200, {"data": self._query_events(body)})
+            else:
+                self._reply(handler, 404)
@@ -0,0 +1,24 @@
+"""Unit tests for adaptive_poll.py"""
+import pytest
+
+from adaptive_poll import AdaptivePollInterval
+
+
+class TestAdaptivePollInterval:
+    """Test the poll interval backs off while stable and resets on changes"""
+
+    def test_backoff_and_reset(self):
+        interval = AdaptivePollInterval(3, 20)
+        assert [interval.on_poll(False) for _ in range(4)] == [6, 12, 20, 20]
+        assert interval.on_poll(True) == 3
+        assert interval.current_secs == 3
+
+    def test_no_max_means_fixed_interval(self):
+        interval = AdaptivePollInterval(5)
+        assert interval.on_poll(False) == 5
+
+    def test_validation(self):
+        with pytest.raises(ValueError):
+            AdaptivePollInterval(0)
+        with pytest.raises(ValueError):
+            AdaptivePollInterval(1, 10, backoff=0.5)
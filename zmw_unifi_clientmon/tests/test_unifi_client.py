@@ -0,0 +1,173 @@
+"""Unit tests for unifi_client.py, against a local fake controller"""
+import time
+
+import pytest
+
+from fake_unifi_controller import FakeUnifiController
+from unifi_client import UnifiClient
+
+
+STA = "/api/s/default/stat/sta"
+EVENTS = "/api/s/default/stat/event"
+
+
+@pytest.fixture
+def controller():
+    ctrl = FakeUnifiController()
+    ctrl.connect("aa:00:00:00:00:01", "Phone1", "10.0.0.1", event_time=time.time() - 60)
+    ctrl.connect("aa:00:00:00:00:02", "Laptop", "10.0.0.2", event_time=time.time() - 60)
+    yield ctrl
+    ctrl.stop()
+
+
+def make_client(ctrl, **kw):
+    return UnifiClient(ctrl.url, "user", "pass", **kw)
+
+
+class TestEventMode:
+    """Test incremental change detection through the controller event log"""
+
+    def test_first_poll_seeds_state(self, controller):
+        client = make_client(controller)
+        assert client.poll_changes(set()) == (None, None, None)
+        assert set(client.current_clients) == {"aa:00:00:00:00:01", "aa:00:00:00:00:02"}
+        assert client.get_stats()["mode"] == "events"
+
+    def test_changes_come_from_events(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.requests.clear()
+
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3")
+        controller.disconnect("aa:00:00:00:00:01")
+        joined, left, current = client.poll_changes(set())
+
+        assert joined == {"aa:00:00:00:00:03": {"hostname": "Phone2", "mac": "aa:00:00:00:00:03", "ip": "10.0.0.3"}}
+        assert list(left) == ["aa:00:00:00:00:01"]
+        assert set(current) == {"aa:00:00:00:00:02", "aa:00:00:00:00:03"}
+        assert set(client.all_clients) == {"aa:00:00:00:00:02", "aa:00:00:00:00:03"}
+        # Only the event log and the joined client were fetched, not the full client list
+        assert controller.requests[STA] == 0
+        assert controller.requests[EVENTS] == 1
+        assert controller.requests[f"{STA}/aa:00:00:00:00:03"] == 1
+
+    def test_stable_poll_is_one_request(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.requests.clear()
+        assert client.poll_changes(set()) == ({}, {}, client.current_clients)
+        assert sum(controller.requests.values()) == 1
+        assert client.get_stats()["incremental_polls"] == 1
+
+    def test_quiet_poll_reads_one_page(self, controller):
+        now = time.time()
+        for i in range(200):
+            controller.roam("aa:00:00:00:00:01", event_time=now - 30 + i / 100)
+        client = make_client(controller, event_page_size=10)
+        client.poll_changes(set())
+        controller.requests.clear()
+        controller.events_served = 0
+        assert client.poll_changes(set())[:2] == ({}, {})
+        assert controller.requests[EVENTS] == 1
+        assert controller.events_served <= 10
+
+    def test_events_are_paged_up_to_the_cursor(self, controller):
+        client = make_client(controller, event_page_size=10)
+        client.poll_changes(set())
+        macs = [f"aa:00:00:00:01:{i:02x}" for i in range(25)]
+        for mac in macs:
+            controller.connect(mac, f"Host{mac[-2:]}", "10.0.1.1")
+            controller.roam(mac)
+        controller.requests.clear()
+        controller.events_served = 0
+        assert set(client.poll_changes(set())[0]) == set(macs)
+        # 50 new events, plus the page that reaches the cursor
+        assert controller.requests[EVENTS] == 6
+        assert controller.events_served <= 60
+
+    def test_old_events_are_ignored(self, controller):
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3", event_time=time.time() - 2 * 60 * 60)
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.events_served = 0
+        client.poll_changes(set())
+        assert controller.events_served == 2
+
+    def test_events_are_read_once(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3")
+        assert list(client.poll_changes(set())[0]) == ["aa:00:00:00:00:03"]
+        assert client.poll_changes(set())[:2] == ({}, {})
+
+    def test_join_and_leave_between_polls(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3")
+        controller.disconnect("aa:00:00:00:00:03")
+        assert client.poll_changes(set())[:2] == ({}, {})
+
+    def test_interesting_filter(self, controller):
+        client = make_client(controller)
+        client.poll_changes({"Phone2", "aa:00:00:00:00:01"})
+        assert list(client.current_clients) == ["aa:00:00:00:00:01"]
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3")
+        controller.connect("aa:00:00:00:00:04", "TV", "10.0.0.4")
+        controller.disconnect("aa:00:00:00:00:02")
+        joined, left, _ = client.poll_changes({"Phone2", "aa:00:00:00:00:01"})
+        assert list(joined) == ["aa:00:00:00:00:03"]
+        assert left == {}
+        assert "aa:00:00:00:00:04" in client.all_clients
+
+    def test_detection_latency(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3", event_time=time.time() - 5)
+        client.poll_changes(set())
+        assert client.get_detection_latency("aa:00:00:00:00:03") == pytest.approx(5, abs=1)
+        stats = client.get_stats()["detection_latency_secs"]
+        assert stats["count"] == 1
+        assert stats["max"] == pytest.approx(5, abs=1)
+
+    def test_resync_finds_missed_changes(self, controller):
+        client = make_client(controller, full_resync_secs=0)
+        client.poll_changes(set())
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3", log_event=False)
+        joined, _, _ = client.poll_changes(set())
+        assert list(joined) == ["aa:00:00:00:00:03"]
+        assert client.get_stats()["changes_missed_by_events"] == 1
+
+    def test_expired_session_logs_in_again(self, controller):
+        client = make_client(controller)
+        client.poll_changes(set())
+        controller.expire_session = True
+        controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3")
+        assert list(client.poll_changes(set())[0]) == ["aa:00:00:00:00:03"]
+
+
+class TestFullListMode:
+    """Test change detection on controllers without an event log"""
+
+    def test_falls_back_to_full_list(self):
+        controller = FakeUnifiController(has_events=False, udm=True)
+        try:
+            controller.connect("aa:00:00:00:00:01", "Phone1", "10.0.0.1")
+            client = make_client(controller)
+            client.poll_changes(set())
+            assert client.get_stats()["mode"] == "full_list"
+
+            controller.connect("aa:00:00:00:00:03", "Phone2", "10.0.0.3", event_time=time.time() - 3)
+            controller.disconnect("aa:00:00:00:00:01")
+            joined, left, current = client.poll_changes(set())
+            assert list(joined) == ["aa:00:00:00:00:03"]
+            assert list(left) == ["aa:00:00:00:00:01"]
+            assert list(current) == ["aa:00:00:00:00:03"]
+            # Joins are timed by the association time
+            assert client.get_detection_latency("aa:00:00:00:00:03") == pytest.approx(3, abs=1)
+            # No more event log probes once the controller is known not to have one
+            controller.requests.clear()
+            client.poll_changes(set())
+            assert controller.requests["/proxy/network" + EVENTS] == 0
+            assert client.get_stats()["full_polls"] == 3
+        finally:
+            controller.stop()
@@ -1,8 +1,30 @@
-""" UniFi controller API client. """
+""" UniFi controller API client.
+
+Change detection works in one of two modes:
+
+- events: the controller's event log (stat/event) is read newest first, one
+  small page at a time, until reaching the newest event seen by the previous
+  poll. Only clients with connect or disconnect events are then fetched
+  (stat/sta/<mac>), so a poll with no changes is a single request for one page
+  of events instead of the full client list. The full client list is still
+  fetched every full_resync_secs, to catch anything the event log missed.
+- full_list: controllers without an event log are polled for the full client
+  list, which is diffed against the previous one.
+
+For each change, the detection latency is estimated: the time between the
+controller seeing the change (event time, association time or last seen
+time) and this client reporting it.
+"""
+
+import logging
+import time
+from collections import deque
 
 import requests
 import urllib3
 
+log = logging.getLogger(__name__)
+
 
 class UnsupportedUnifi(Exception):
     pass
@@ -14,22 +36,60 @@ class AuthError(Exception):
 urllib3.disable_warnings()
 
 ENDPOINTS = [
-    {"login": "/api/login",      "clients": "/api/s/default/stat/sta"},
-    {"login": "/api/auth/login", "clients": "/proxy/network/api/s/default/stat/sta"},
+    {"login": "/api/login",      "clients": "/api/s/default/stat/sta",
+     "events": "/api/s/default/stat/event"},
+    {"login": "/api/auth/login", "clients": "/proxy/network/api/s/default/stat/sta",
+     "events": "/proxy/network/api/s/default/stat/event"},
 ]
 
+# Wireless and wired connect/disconnect events. Other events (eg roaming between APs) don't change presence.
+JOIN_EVENTS = {"EVT_WU_Connected", "EVT_LU_Connected"}
+LEAVE_EVENTS = {"EVT_WU_Disconnected", "EVT_LU_Disconnected"}
+
+# Status codes of controllers that don't have an event log
+_NO_EVENTS_STATUS = (400, 404, 405)
+
+
+def _parse_client(c):
+    hostname = c.get("hostname") or c.get("name") or "(unknown)"
+    return {"hostname": hostname, "mac": c.get("mac", ""), "ip": c.get("ip", "(unknown)")}
+
+
+def _is_interesting(entry, interesting):
+    return not interesting or entry["hostname"] in interesting or entry["mac"] in interesting
+
 
 class UnifiClient:
-    def __init__(self, controller, username, password):
+    def __init__(self, controller, username, password, full_resync_secs=300, event_window_hours=1,
+                 event_page_size=50, latency_history_len=100):
         self._controller = controller.rstrip('/')
         self._username = username
         self._password = password
+        self._full_resync_secs = full_resync_secs
+        self._event_window_hours = event_window_hours
+        self._event_page_size = event_page_size
         self._session = None
         self._endpoint = None
         # {mac: {hostname, mac, ip}} — current and previous snapshots for change detection
         self._previous = None
         self._current = {}
         self._all_clients = {}
+        # {mac: (assoc_time, last_seen)} as reported by the controller in the last full list, to estimate latency
+        self._client_times = {}
+        # None until probed, then True/False
+        self._events_supported = None
+        # Event log cursor: time (ms) of the newest event seen, and the ids of events at that time
+        self._last_event_ms = None
+        self._last_event_ids = set()
+        self._last_full_sync = None
+        self._last_latency = {}
+        self._latencies = deque(maxlen=latency_history_len)
+        self._stats = {
+            "full_polls": 0,
+            "incremental_polls": 0,
+            "events_seen": 0,
+            "changes_missed_by_events": 0,
+        }
         # If login fails, make sure we fail early, during service startup
         self._login()
 
@@ -59,15 +119,66 @@ class UnifiClient:
             raise AuthError(f"Invalid credentials for UniFi controller at {self._controller}.")
         raise UnsupportedUnifi(f"Failed to login to UniFi controller at {self._controller} (tried standard + UDM endpoints).")
 
-    def get_all_clients(self):
-        """Return the raw list of all connected clients from the controller."""
-        resp = self._session.get(f"{self._controller}{self._endpoint['clients']}")
+    def _request(self, method, url, **kwargs):
+        """Send a request to the controller, logging in again if the session expired."""
+        resp = self._session.request(method, f"{self._controller}{url}", **kwargs)
         if resp.status_code == 401:
             self._login()
-            resp = self._session.get(f"{self._controller}{self._endpoint['clients']}")
+            resp = self._session.request(method, f"{self._controller}{url}", **kwargs)
+        return resp
+
+    def get_all_clients(self):
+        """Return the raw list of all connected clients from the controller."""
+        resp = self._request("GET", self._endpoint['clients'])
         resp.raise_for_status()
         return resp.json().get("data", [])
 
+    def get_client(self, mac):
+        """Return {hostname, mac, ip} for a single connected client, or None if it isn't connected."""
+        resp = self._request("GET", f"{self._endpoint['clients']}/{mac}")
+        if resp.status_code == 400:
+            # Unknown station: not connected
+            return None
+        resp.raise_for_status()
+        data = resp.json().get("data", [])
+        if not data:
+            return None
+        self._client_times[mac] = (data[0].get("assoc_time"), data[0].get("last_seen"))
+        return _parse_client(data[0])
+
+    def get_events_since(self, since_ms, since_ids=()):
+        """Return all events newer than since_ms (and not in since_ids), oldest first, or None if the controller has
+        no event log. Events are read newest first, one page at a time, until reaching since_ms. With no since_ms,
+        only the newest page is read."""
+        events = []
+        start = 0
+        while True:
+            resp = self._request("POST", self._endpoint['events'], json={
+                "_sort": "-time",
+                "within": self._event_window_hours,
+                "_start": start,
+                "_limit": self._event_page_size,
+            })
+            if resp.status_code in _NO_EVENTS_STATUS:
+                return None
+            resp.raise_for_status()
+            page = resp.json().get("data", [])
+            events.extend(ev for ev in page
+                          if ev.get("time", 0) >= (since_ms or 0) and ev.get("_id") not in since_ids)
+            if since_ms is None or len(page) < self._event_page_size or page[-1].get("time", 0) < since_ms:
+                break
+            start += len(page)
+        return sorted(events, key=lambda ev: ev["time"])
+
+    def _advance_event_cursor(self, events):
+        if not events:
+            return
+        newest = events[-1]["time"]
+        if newest != self._last_event_ms:
+            self._last_event_ms = newest
+            self._last_event_ids = set()
+        self._last_event_ids.update(ev.get("_id") for ev in events if ev["time"] == newest)
+
     def get_interesting_clients(self, interesting):
         """Return a dict of {mac: {hostname, mac, ip}} for connected interesting devices.
 
@@ -77,15 +188,16 @@ class UnifiClient:
         clients = self.get_all_clients()
         all_parsed = {}
         result = {}
+        client_times = {}
         for c in clients:
-            hostname = c.get("hostname") or c.get("name") or "(unknown)"
-            mac = c.get("mac", "")
-            ip = c.get("ip", "(unknown)")
-            entry = {"hostname": hostname, "mac": mac, "ip": ip}
+            entry = _parse_client(c)
+            mac = entry["mac"]
             all_parsed[mac] = entry
-            if not interesting or hostname in interesting or mac in interesting:
+            client_times[mac] = (c.get("assoc_time"), c.get("last_seen"))
+            if _is_interesting(entry, interesting):
                 result[mac] = entry
         self._all_clients = all_parsed
+        self._client_times = client_times
         return result
 
     def poll_changes(self, interesting):
@@ -94,9 +206,37 @@ class UnifiClient:
         joined: {mac: {hostname, mac, ip}} for newly connected devices
         left: {mac: {hostname, mac, ip}} for disconnected devices (using last known info)
         current: {mac: {hostname, mac, ip}} for all currently connected interesting devices
-        Returns (None, None, current) on the first poll (no previous state).
+        Returns (None, None, None) on the first poll (no previous state).
         """
+        resync_due = (self._last_full_sync is None or
+                      time.monotonic() - self._last_full_sync >= self._full_resync_secs)
+        if self._previous is None or self._events_supported is False or resync_due:
+            return self._poll_full_list(interesting)
+
+        events = self.get_events_since(self._last_event_ms, self._last_event_ids)
+        if events is None:
+            # Event log went away (eg controller upgrade)
+            log.warning("UniFi controller event log is not available, falling back to polling the client list")
+            self._events_supported = False
+            return self._poll_full_list(interesting)
+        return self._poll_events(events, interesting)
+
+    def _poll_full_list(self, interesting):
+        if self._events_supported is not False:
+            # Read the event cursor before the client list: events between both are applied twice, which is a no-op
+            events = self.get_events_since(self._last_event_ms, self._last_event_ids)
+            if self._events_supported is None:
+                self._events_supported = events is not None
+                log.info("UniFi controller %s an event log, using %s change detection",
+                         "has" if self._events_supported else "doesn't have",
+                         "incremental" if self._events_supported else "full client list")
+            if events is not None:
+                self._advance_event_cursor(events)
+
+        prev_times = self._client_times
         current = self.get_interesting_clients(interesting)
+        self._last_full_sync = time.monotonic()
+        self._stats["full_polls"] += 1
         current_macs = set(current.keys())
 
         if self._previous is None:
@@ -108,11 +248,98 @@ class UnifiClient:
         prev_macs = set(self._previous.keys())
         joined = {mac: current[mac] for mac in current_macs - prev_macs}
         left = {mac: self._previous[mac] for mac in prev_macs - current_macs}
+        if self._events_supported and (joined or left):
+            self._stats["changes_missed_by_events"] += len(joined) + len(left)
+            log.warning("Full resync found %d changes missed by the controller event log", len(joined) + len(left))
+
+        now = time.time()
+        self._last_latency = {}
+        for mac in joined:
+            self._record_latency(mac, now, self._client_times.get(mac, (None, None))[0])
+        for mac in left:
+            self._record_latency(mac, now, prev_times.get(mac, (None, None))[1])
 
         self._previous = current
         self._current = current
         return joined, left, current
 
+    def _poll_events(self, events, interesting):
+        self._stats["incremental_polls"] += 1
+        self._advance_event_cursor(events)
+        # Other events (eg roaming) only move the cursor
+        events = [ev for ev in events if ev.get("key") in JOIN_EVENTS | LEAVE_EVENTS]
+        self._stats["events_seen"] += len(events)
+
+        # A client may connect and disconnect between polls: only its last event matters
+        last_event = {}
+        for ev in events:
+            mac = ev.get("user") or ev.get("client")
+            if mac:
+                last_event[mac] = ev
+
+        # Update copies: the web server may be reading the current ones
+        current = dict(self._current)
+        all_clients = dict(self._all_clients)
+        joined = {}
+        left = {}
+        now = time.time()
+        self._last_latency = {}
+        for mac, ev in last_event.items():
+            if ev["key"] in JOIN_EVENTS:
+                if mac in all_clients:
+                    continue
+                entry = self.get_client(mac)
+                if entry is None:
+                    # Already gone again
+                    continue
+                all_clients[mac] = entry
+                if _is_interesting(entry, interesting):
+                    current[mac] = entry
+                    joined[mac] = entry
+                    self._record_latency(mac, now, ev["time"] / 1000)
+            else:
+                entry = all_clients.pop(mac, None)
+                if entry is None:
+                    continue
+                self._client_times.pop(mac, None)
+                if mac in current:
+                    left[mac] = current.pop(mac)
+                    self._record_latency(mac, now, ev["time"] / 1000)
+
+        self._all_clients = all_clients
+        self._previous = current
+        self._current = current
+        return joined, left, current
+
+    def _record_latency(self, mac, now, changed_at):
+        if changed_at is None:
+            self._last_latency[mac] = None
+            return
+        # Controller and local clocks may disagree slightly
+        latency = max(0.0, now - changed_at)
+        self._last_latency[mac] = latency
+        self._latencies.append(latency)
+
+    def get_detection_latency(self, mac):
+        """Estimated detection latency, in seconds, of a change reported by the last poll. None if unknown."""
+        return self._last_latency.get(mac)
+
+    def get_stats(self):
+        if self._events_supported is None:
+            mode = None
+        else:
+            mode = "events" if self._events_supported else "full_list"
+        latencies = list(self._latencies)
+        return {
+            **self._stats,
+            "mode": mode,
+            "detection_latency_secs": {
+                "count": len(latencies),
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "max": max(latencies) if latencies else None,
+            },
+        }
+
     @property
     def current_clients(self):
         return self._current
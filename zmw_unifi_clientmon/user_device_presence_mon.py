@@ -123,6 +123,11 @@ class UserDevicePresenceMon:
         log.info("%s is leaving (%s)", user, device_id)
         self._on_state_change(user, "away", device_id)
 
+    @property
+    def has_pending_away(self):
+        """True while any user is in the leave cooldown (presence is still settling)."""
+        return bool(self._pending_away_timers)
+
     @property
     def user_states(self):
         """Return a copy of {user: True/False/None} state map."""
@@ -5,7 +5,7 @@ import os
 import pathlib
 import signal
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import deque
 
 from zzmw_lib.logs import build_logger
@@ -14,6 +14,7 @@ from zzmw_lib.zmw_mqtt_service import ZmwMqttService
 
 import requests.exceptions
 
+from adaptive_poll import AdaptivePollInterval
 from unifi_client import UnifiClient, UnsupportedUnifi, AuthError
 from user_device_presence_mon import UserDevicePresenceMon
 from unknown_device_mon import UnknownDeviceMon
@@ -30,9 +31,14 @@ class ZmwUnifiClientmon(ZmwMqttService):
             controller=cfg['unifi_controller'],
             username=cfg['unifi_username'],
             password=cfg['unifi_password'],
+            full_resync_secs=cfg.get('full_resync_secs', 300),
         )
         self._interesting = set(cfg['interesting_devices'])
-        self._poll_interval = cfg['poll_interval_secs']
+        self._sched = _sched
+        self._poll_interval = AdaptivePollInterval(
+            cfg['poll_interval_secs'],
+            cfg.get('max_poll_interval_secs', 4 * cfg['poll_interval_secs']),
+        )
         self._event_history = deque(maxlen=cfg.get('event_history_len', 100))
         self._presence_mon = UserDevicePresenceMon(
             cfg.get('device_owners', {}),
@@ -49,11 +55,11 @@ class ZmwUnifiClientmon(ZmwMqttService):
         www.serve_url('/events', lambda: json.dumps(list(self._event_history), default=str))
         www.serve_url('/presence', lambda: json.dumps(self._presence_mon.user_states, default=str))
         www.serve_url('/all_devices', lambda: json.dumps(self._get_all_devices(), default=str))
+        www.serve_url('/stats', self._get_stats)
         www.serve_url('/device_trust', self._unknown_device_mon.http_set_trusted, methods=['POST'])
         www.serve_url('/device_alias', self._unknown_device_mon.http_set_alias, methods=['POST'])
 
-        _sched.add_job(self._poll_clients, 'interval', seconds=self._poll_interval,
-                       next_run_time=datetime.now())
+        self._schedule_poll(0)
 
     def get_mqtt_description(self):
         return {
@@ -68,6 +74,10 @@ class ZmwUnifiClientmon(ZmwMqttService):
                     "description": "Event history (joins/leaves)",
                     "params": {}
                 },
+                "get_stats": {
+                    "description": "Change detection mode, current poll interval and detection latency",
+                    "params": {}
+                },
             },
             "announcements": {
                 "client_joined": {
@@ -78,6 +88,8 @@ class ZmwUnifiClientmon(ZmwMqttService):
                         "hostname": "Device hostname",
                         "mac": "MAC address",
                         "ip": "IP address",
+                        "detection_latency_secs": "Estimated time between the controller seeing the device and "
+                                                  "this announcement, or null if unknown",
                     }
                 },
                 "client_left": {
@@ -88,6 +100,8 @@ class ZmwUnifiClientmon(ZmwMqttService):
                         "hostname": "Device hostname",
                         "mac": "MAC address",
                         "ip": "Last known IP address",
+                        "detection_latency_secs": "Estimated time between the controller losing the device and "
+                                                  "this announcement, or null if unknown",
                     }
                 },
                 "ls_reply": {
@@ -98,6 +112,18 @@ class ZmwUnifiClientmon(ZmwMqttService):
                     "description": "Event history",
                     "payload": [{"time": "ISO timestamp", "event": "joined|left", "hostname": "str", "mac": "str", "ip": "str"}]
                 },
+                "get_stats_reply": {
+                    "description": "Change detection stats",
+                    "payload": {
+                        "mode": "events (incremental queries of the controller event log) or full_list",
+                        "poll_interval_secs": "Current poll interval",
+                        "full_polls": "Polls that fetched the full client list",
+                        "incremental_polls": "Polls that only fetched new events",
+                        "events_seen": "Connect/disconnect events read from the controller",
+                        "changes_missed_by_events": "Changes only found by a full resync",
+                        "detection_latency_secs": {"count": "Recent changes", "mean": "secs", "max": "secs"},
+                    }
+                },
                 "user_home": {
                     "description": "A known user arrived home (at least one device connected)",
                     "payload": {"time": "ISO timestamp", "user": "User name", "device_hostname": "Device hostname or MAC"}
@@ -112,7 +138,20 @@ class ZmwUnifiClientmon(ZmwMqttService):
             }
         }
 
+    def _schedule_poll(self, delay_secs):
+        self._sched.add_job(self._poll_clients, 'date', id='unifi_poll_clients', replace_existing=True,
+                            run_date=datetime.now() + timedelta(seconds=delay_secs))
+
     def _poll_clients(self):
+        changed = False
+        try:
+            changed = self._poll_and_announce()
+        finally:
+            # Always schedule the next poll, even if this one failed
+            self._schedule_poll(self._poll_interval.on_poll(changed or self._presence_mon.has_pending_away))
+
+    def _poll_and_announce(self):
+        """Poll the controller and announce changes. Returns True if any interesting client joined or left."""
         try:
             joined, left, _current = self._unifi.poll_changes(self._interesting)
         except (UnsupportedUnifi, AuthError, ConnectionError,
@@ -124,7 +163,8 @@ class ZmwUnifiClientmon(ZmwMqttService):
                 log.error("Too many consecutive failures, terminating service.")
                 os.kill(os.getpid(), signal.SIGTERM)
                 time.sleep(3)
-            return
+            # Retry at the fastest rate
+            return True
 
         self._consecutive_failures = 0
         self._unknown_device_mon.on_poll(self._unifi.all_clients)
@@ -134,7 +174,7 @@ class ZmwUnifiClientmon(ZmwMqttService):
             for mac, info in self._unifi.current_clients.items():
                 self._presence_mon.seed_connected_device(info["hostname"], mac)
             self._presence_mon.seed_done()
-            return
+            return False
 
         for event_type, clients in (("joined", joined), ("left", left)):
             for mac, info in clients.items():
@@ -144,11 +184,16 @@ class ZmwUnifiClientmon(ZmwMqttService):
                     "hostname": info["hostname"],
                     "mac": mac,
                     "ip": info["ip"],
+                    "detection_latency_secs": self._unifi.get_detection_latency(mac),
                 }
                 self._event_history.append(event)
                 log.info("%s: %s (%s) %s", event_type.upper(), info["hostname"], mac, info["ip"])
                 self.publish_own_svc_message(f"client_{event_type}", event)
                 self._presence_mon.on_device_event(event_type, info["hostname"], mac)
+        return bool(joined or left)
+
+    def _get_stats(self):
+        return {**self._unifi.get_stats(), "poll_interval_secs": self._poll_interval.current_secs}
 
     def _get_all_devices(self):
         online_macs = set(self._unifi.all_clients.keys())
@@ -188,6 +233,8 @@ class ZmwUnifiClientmon(ZmwMqttService):
             case "get_history":
                 self.publish_own_svc_message("get_history_reply",
                     list(self._event_history))
+            case "get_stats":
+                self.publish_own_svc_message("get_stats_reply", self._get_stats())
             case "get_mqtt_description":
                 self.publish_own_svc_message("get_mqtt_description_reply",
                     self.get_mqtt_description())
@@ -215,6 +215,11 @@ class VisitorDetector:
             if migrated:
                 log.info("Migrated %d entries: discarded old nn4 embeddings", migrated)
 
+    def set_sighting_params(self, sighting_dedup_gap_secs, max_crops):
+        """Update tunables that don't require reloading models or state."""
+        self._sighting_dedup_gap_secs = sighting_dedup_gap_secs
+        self._max_crops = max_crops
+
     def _load_yunet(self, model_name):
         model_path = self._models_dir / model_name
         if not model_path.exists():
@@ -9,7 +9,8 @@ from flask import jsonify
 from zzmw_lib.service_runner import service_runner
 from zzmw_lib.zmw_mqtt_service import ZmwMqttService
 from zzmw_lib.logs import build_logger
-from zzmw_lib.runtime_state_cache import runtime_state_cache_get, runtime_state_cache_set
+from zzmw_lib.event_journal import EventJournal
+from zzmw_lib.runtime_state_cache import runtime_state_cache_get
 
 from visitor_detector import VisitorDetector
 
@@ -35,8 +36,13 @@ class ZmwVisitorDetect(ZmwMqttService):
 
         # Per-person cooldown: {name: last_announced_epoch}
         self._announce_cooldowns = {}
-        # Last N detections for web endpoint
-        self._recent_detections = deque(runtime_state_cache_get("recent_detections") or [], maxlen=20)
+        # Last N detections for web endpoint, persisted in an append-only journal
+        self._detections_journal = EventJournal("recent_detections.jsonl", max_records=20)
+        if len(self._detections_journal) == 0:
+            # Migrate detections persisted by older versions in the runtime state cache
+            for detection in runtime_state_cache_get("recent_detections") or []:
+                self._detections_journal.append(detection)
+        self._recent_detections = deque(self._detections_journal.tail(), maxlen=20)
         # Single-threaded executor so detection doesn't block MQTT loop
         self._detect_executor = ThreadPoolExecutor(max_workers=1)
 
@@ -44,6 +50,16 @@ class ZmwVisitorDetect(ZmwMqttService):
         www.register_www_dir(cfg.get("detection_crops_dir", "./detection_crops"), '/crops/')
         www.serve_url('/detections', lambda: jsonify(list(self._recent_detections)))
 
+    def get_hot_reloadable_cfg_keys(self):
+        return ["doorbell_cam_host", "detection_cooldown_secs", "sighting_dedup_gap_secs", "max_crops"]
+
+    def on_cfg_hot_reload(self, new_cfg, changed_keys):
+        self._doorbell_cam_host = new_cfg["doorbell_cam_host"]
+        self._cooldown_secs = new_cfg.get("detection_cooldown_secs", 300)
+        self._detector.set_sighting_params(
+            sighting_dedup_gap_secs=new_cfg.get("sighting_dedup_gap_secs", 1800),
+            max_crops=new_cfg.get("max_crops", 50))
+
     def get_mqtt_description(self):
         return {
             "description": "Visitor detection service",
@@ -124,7 +140,7 @@ class ZmwVisitorDetect(ZmwMqttService):
                 'input_image_path': input_image_path,
                 'timestamp': result['timestamp'],
             })
-            runtime_state_cache_set("recent_detections", list(self._recent_detections))
+            self._detections_journal.append(self._recent_detections[-1])
             return
 
         announce_names = []
@@ -139,7 +155,7 @@ class ZmwVisitorDetect(ZmwMqttService):
                      visitor['face_confidence'], visitor['face_detector'],
                      visitor['sightings'])
             self._recent_detections.append(visitor)
-            runtime_state_cache_set("recent_detections", list(self._recent_detections))
+            self._detections_journal.append(visitor)
             self.publish_own_svc_message("on_detection", visitor)
             last_crop = visitor['crop_path']
 
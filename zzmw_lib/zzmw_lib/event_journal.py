@@ -0,0 +1,143 @@
+"""Append-only event journal, for services that persist a history of events.
+
+Each record is a line of JSON appended to the end of the journal file, so
+persisting an event costs O(1) I/O instead of rewriting the whole history.
+The journal is compacted (rewritten with only the newest records) once it
+grows past its retention limit plus some slack, and recent records can be
+read back from the end of the file without parsing all of it.
+"""
+import json
+import os
+import threading
+
+from .logs import build_logger
+
+log = build_logger("EventJournal")
+
+
+class EventJournal:
+    """
+    Line-delimited JSON journal with bounded retention.
+
+    Usage::
+
+        journal = EventJournal("door_events.jsonl", max_records=100)
+        journal.append({"event": "door_open", "ts": time.time()})
+        recent = journal.tail(10)
+    """
+
+    _READ_BLOCK_SZ = 4096
+
+    def __init__(self, path, max_records, compact_slack=None, fsync=False):
+        """
+        Args:
+            path: File backing this journal. Will be created if it doesn't exist.
+            max_records: Number of records to keep after compaction.
+            compact_slack: Number of extra records allowed before a compaction is triggered. Defaults to
+                           max_records, so the file never holds more than twice the retention limit.
+            fsync: If set, fsync after every append. Safer, but much slower on SD cards.
+        """
+        if max_records <= 0:
+            raise ValueError(f"EventJournal needs a positive retention limit, got {max_records}")
+        self._path = path
+        self._max_records = max_records
+        self._compact_slack = compact_slack if compact_slack is not None else max_records
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._record_count = self._recover()
+        self._fp = open(self._path, "a", encoding="utf-8")
+
+    def _recover(self):
+        """ Count records in the journal, dropping any partial record left behind by an interrupted write """
+        try:
+            with open(self._path, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    good_len = data.rfind(b"\n") + 1
+                    log.warning("Journal %s has a partial record, will drop %d bytes",
+                                self._path, len(data) - good_len)
+                    f.truncate(good_len)
+                    data = data[:good_len]
+                return data.count(b"\n")
+        except FileNotFoundError:
+            return 0
+
+    def __len__(self):
+        with self._lock:
+            return min(self._record_count, self._max_records)
+
+    def append(self, record):
+        """ Append a (JSON serializable) record to the journal. Compacts the journal if it grew too large. """
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._fp.write(line)
+            self._fp.flush()
+            if self._fsync:
+                os.fsync(self._fp.fileno())
+            self._record_count += 1
+            if self._record_count > self._max_records + self._compact_slack:
+                self._compact_locked()
+
+    def tail(self, n=None):
+        """ Returns the newest n records (or all retained records, if n is None), oldest first """
+        if n is None or n > self._max_records:
+            n = self._max_records
+        if n <= 0:
+            return []
+        with self._lock:
+            self._fp.flush()
+            return self._tail_locked(n)
+
+    def replay(self):
+        """ Returns all retained records, oldest first. Useful to rebuild in-memory views on startup. """
+        return self.tail()
+
+    def compact(self):
+        """ Rewrite the journal keeping only the newest max_records records """
+        with self._lock:
+            self._compact_locked()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+    def _tail_locked(self, n):
+        with open(self._path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            buf = b""
+            # Need n+1 newlines to be sure the first of n lines is complete
+            while pos > 0 and buf.count(b"\n") <= n:
+                step = min(self._READ_BLOCK_SZ, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+
+        lines = buf.split(b"\n")
+        if pos > 0:
+            # First line may be cut in half
+            lines = lines[1:]
+        records = []
+        for line in lines[-(n + 1):]:
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                log.warning("Skipping corrupt record in journal %s", self._path)
+        return records[-n:]
+
+    def _compact_locked(self):
+        self._fp.flush()
+        keep = self._tail_locked(self._max_records)
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in keep:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._fp.close()
+        os.replace(tmp_path, self._path)
+        self._fp = open(self._path, "a", encoding="utf-8")
+        self._record_count = len(keep)
+        log.debug("Compacted journal %s to %d records", self._path, self._record_count)
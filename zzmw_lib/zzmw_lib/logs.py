@@ -1,8 +1,137 @@
+import atexit
 import os
 import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 
 from systemd.journal import JournalHandler
 
+# Max number of records waiting to be written. If the writer can't keep up, new records are dropped (and counted)
+# instead of blocking the thread that is logging.
+LOG_QUEUE_MAX_SIZE = 10000
+# Records below WARNING are rate-limited per call site: after LOG_RATE_LIMIT_BURST records in a window of
+# LOG_RATE_LIMIT_WINDOW_SECS, further records from the same call site are suppressed until the window ends.
+LOG_RATE_LIMIT_WINDOW_SECS = 10
+LOG_RATE_LIMIT_BURST = 100
+
+# Arguments of these types can't change after a log call; records using only these can be formatted in the writer
+_IMMUTABLE_ARG_TYPES = (str, bytes, int, float, bool, type(None))
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+_log_listener = None
+_log_listener_lock = threading.Lock()
+_log_stats_lock = threading.Lock()
+_log_stats = {
+    "dropped_queue_full": 0,
+    "suppressed_rate_limit": 0,
+}
+
+
+def _count_stat(stat, n=1):
+    with _log_stats_lock:
+        _log_stats[stat] += n
+
+
+def get_log_stats():
+    """ Counters for the logging pipeline of this process: how many records were dropped, and why """
+    with _log_stats_lock:
+        stats = dict(_log_stats)
+    stats["queue_depth"] = _log_queue.qsize()
+    stats["queue_max_size"] = LOG_QUEUE_MAX_SIZE
+    return stats
+
+
+class _RateLimitFilter(logging.Filter):
+    """ Suppress records from call sites that log too often. WARNING and above are never suppressed. When a call site
+    starts a new window, its first record notes how many records were suppressed in the previous one. """
+
+    def __init__(self, window_secs=LOG_RATE_LIMIT_WINDOW_SECS, burst=LOG_RATE_LIMIT_BURST):
+        super().__init__()
+        self._window_secs = window_secs
+        self._burst = burst
+        self._lock = threading.Lock()
+        # {(pathname, lineno): [window_start, count_in_window, suppressed_in_window]}
+        self._call_sites = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._call_sites.get(key)
+            if site is None:
+                self._call_sites[key] = [now, 1, 0]
+                return True
+            if now - site[0] > self._window_secs:
+                suppressed = site[2]
+                site[0], site[1], site[2] = now, 1, 0
+                if suppressed > 0:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+                return True
+            site[1] += 1
+            if site[1] <= self._burst:
+                return True
+            site[2] += 1
+
+        _count_stat("suppressed_rate_limit")
+        return False
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """ Push records to the shared log queue, to be written by a single writer thread. Never blocks the caller. """
+
+    def prepare(self, record):
+        # Formatting is deferred to the writer thread, unless the arguments may be mutated by the caller after this
+        # call returns, in which case the message needs to be rendered now. Exception info is always rendered by the
+        # writer: tracebacks are immutable.
+        args = record.args
+        # A single dict argument ends up as record.args itself, and is mutable
+        if args and (isinstance(args, dict) or not all(isinstance(a, _IMMUTABLE_ARG_TYPES) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count_stat("dropped_queue_full")
+
+
+def _build_writer_handler():
+    """ Handler for the writer thread. Logs go to the journal when running under systemd, to stdout otherwise """
+    if os.getenv("INVOCATION_ID"):
+        handler = JournalHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+    handler.setLevel(logging.DEBUG)
+    return handler
+
+
+def _ensure_log_writer_running():
+    global _log_listener
+    with _log_listener_lock:
+        if _log_listener is not None:
+            return
+        _log_listener = QueueListener(_log_queue, _build_writer_handler())
+        _log_listener.start()
+        # Stopping the listener will write any records still in the queue
+        atexit.register(_log_listener.stop)
+
+
+def _build_queue_handler(lvl):
+    handler = _AsyncQueueHandler(_log_queue)
+    handler.setLevel(lvl)
+    handler.addFilter(_RateLimitFilter())
+    return handler
+
+
 def build_logger(name, lvl=logging.DEBUG):
     """
     Create a logger configured for systemd journal or console output.
@@ -11,6 +140,10 @@ def build_logger(name, lvl=logging.DEBUG):
     configures appropriate handlers. Ensures third-party library logs are filtered
     at INFO level while allowing app logs at DEBUG level.
 
+    Records are not written by the thread that logs: they are pushed to a queue and
+    written by a single background thread. Frequent records (below WARNING) from the
+    same call site are rate-limited; see get_log_stats for drop counters.
+
     Args:
         name: Logger name (typically the service/module name)
         lvl: Log level for this logger (default: logging.DEBUG)
@@ -18,20 +151,12 @@ def build_logger(name, lvl=logging.DEBUG):
     Returns:
         Configured logging.Logger instance
     """
+    _ensure_log_writer_running()
+
     # Configure root logger ONCE with proper handler/formatter for third-party libs
     root = logging.getLogger()
     if not root.handlers:  # Only configure if not already done
-        if os.getenv("INVOCATION_ID"):
-            # Running under systemd
-            root_handler = JournalHandler()
-            root_handler.setFormatter(logging.Formatter('%(message)s'))
-        else:
-            # Running standalone
-            root_handler = logging.StreamHandler()
-            root_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
-
-        root_handler.setLevel(logging.DEBUG)
-        root.addHandler(root_handler)
+        root.addHandler(_build_queue_handler(logging.DEBUG))
         root.setLevel(logging.INFO)  # Root stays at INFO to filter third-party noise
 
     # Create isolated logger for your app code
@@ -41,18 +166,6 @@ def build_logger(name, lvl=logging.DEBUG):
     log.handlers.clear()
 
     # Same handler setup as root, but isolated
-    if os.getenv("INVOCATION_ID"):
-        # We're running under systemd, don't bother with stdout
-        handler = JournalHandler()
-        handler.setLevel(lvl)
-        handler.setFormatter(logging.Formatter('%(message)s'))
-        log.addHandler(handler)
-    else:
-        handler = logging.StreamHandler()
-        handler.setLevel(lvl)
-        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
-        log.addHandler(handler)
+    log.addHandler(_build_queue_handler(lvl))
 
     return log
-
-
@@ -1,44 +1,153 @@
-"""Runtime state cache for persisting service state between restarts."""
+"""Runtime state cache for persisting service state between restarts.
+
+The cache is held in memory and written back to disk asynchronously: a burst of
+updates results in a single write, once the debounce delay expires. Writes are
+atomic (write to a temp file, fsync, rename) so a power loss will leave either
+the old or the new cache, never a torn file.
+"""
+import atexit
+import copy
 import json
+import os
+import threading
+
+from .logs import build_logger
+
+log = build_logger("RuntimeStateCache")
 
 CACHE_FILE = "run_state_cache.json"
 CACHE_COMMENT = "This file is a cache to persist service run state between restarts, it can be safely deleted"
+# Values stored with a namespace are kept under this top-level key, as {namespace: {key: value}}
+NAMESPACES_KEY = "namespaces"
+
+
+class RuntimeStateCache:
+    """
+    Thread-safe, in-memory state cache with debounced, atomic write-back.
+
+    The backing file is loaded on first access; after that all reads are served from memory. Values are deep-copied
+    on the way in and out, so callers can keep mutating their own objects while a write is pending.
+    """
+
+    def __init__(self, path=CACHE_FILE, flush_delay_secs=2.0):
+        self._path = path
+        self._flush_delay_secs = flush_delay_secs
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._cache = None
+        self._dirty = False
+        self._flush_timer = None
+
+    def _load_locked(self):
+        if self._cache is not None:
+            return
+        try:
+            with open(self._path) as f:
+                self._cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._cache = {"COMMENT": CACHE_COMMENT}
+        if not isinstance(self._cache, dict):
+            log.warning("Runtime state cache %s has an unexpected format, ignoring it", self._path)
+            self._cache = {"COMMENT": CACHE_COMMENT}
 
+    def _get_ns_locked(self, namespace, create=False):
+        self._load_locked()
+        if namespace is None:
+            return self._cache
+        namespaces = self._cache.get(NAMESPACES_KEY)
+        if namespaces is None:
+            if not create:
+                return {}
+            namespaces = self._cache[NAMESPACES_KEY] = {}
+        if namespace not in namespaces and create:
+            namespaces[namespace] = {}
+        return namespaces.get(namespace, {})
 
-def runtime_state_cache_get(key):
+    def get(self, key, namespace=None):
+        """ Returns the value for key (in namespace, if set), or None if it doesn't exist """
+        with self._lock:
+            return copy.deepcopy(self._get_ns_locked(namespace).get(key))
+
+    def set(self, key, value, namespace=None):
+        """ Sets key to value (in namespace, if set). The write to disk will happen in the background. Raises
+        TypeError if value isn't JSON serializable: a bad value must be rejected here, not when it's persisted. """
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError) as e:
+            raise TypeError(f"Runtime state cache value for '{key}' is not JSON serializable: {e}") from e
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._get_ns_locked(namespace, create=True)[key] = value
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_delay_secs, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        """ Write pending changes to disk now, if there are any """
+        # Serialize disk writes so an older snapshot can't overwrite a newer one, but don't hold the cache lock while
+        # doing I/O: readers and writers of the cache shouldn't wait for the disk
+        with self._write_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not self._dirty:
+                    return
+                # Values are validated by set(), so this can't fail
+                data = json.dumps(self._cache)
+                self._dirty = False
+
+            tmp_path = f"{self._path}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self._path)
+            except OSError:
+                log.error("Failed to persist runtime state cache to %s", self._path, exc_info=True)
+                with self._lock:
+                    self._dirty = True
+
+
+_default_cache = RuntimeStateCache()
+atexit.register(_default_cache.flush)
+
+
+def runtime_state_cache_get(key, namespace=None):
     """
     Get a value from the runtime state cache.
 
     Args:
         key: The key to retrieve from the cache
+        namespace: Optional namespace, to keep keys of different components apart
 
     Returns:
         The cached value, or None if the key doesn't exist or the file is missing/corrupt
     """
-    try:
-        with open(CACHE_FILE) as f:
-            return json.load(f).get(key)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
+    return _default_cache.get(key, namespace)
 
 
-def runtime_state_cache_set(key, value):
+def runtime_state_cache_set(key, value, namespace=None):
     """
     Set a value in the runtime state cache.
 
-    Reads the existing cache file (or creates an empty one with a comment),
-    then saves the new key-value pair.
+    The value is updated in memory immediately; persisting to disk is debounced and happens in the background,
+    using an atomic write. Pending writes are also flushed when the process exits.
 
     Args:
         key: The key to set
-        value: The value to store
+        value: The value to store (must be JSON serializable)
+        namespace: Optional namespace, to keep keys of different components apart
+
+    Raises:
+        TypeError: if value is not JSON serializable
     """
-    try:
-        with open(CACHE_FILE) as f:
-            cache = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        cache = {"COMMENT": CACHE_COMMENT}
-
-    cache[key] = value
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+    _default_cache.set(key, value, namespace)
+
+
+def runtime_state_cache_flush():
+    """ Persist pending runtime state cache changes now, instead of waiting for the debounce delay. """
+    _default_cache.flush()
@@ -0,0 +1,179 @@
+"""Instrumentation for the APScheduler instance shared by all jobs of a service.
+
+Tracks, per job: planned vs actual start time, run duration, errors, misfires
+and overlaps (a run skipped because the previous one was still running). Also
+tracks how busy the scheduler's thread pool is, so it's possible to tell which
+periodic work is starving which.
+"""
+import re
+import threading
+from datetime import datetime, timezone
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.executors.base import run_job
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from .logs import build_logger
+
+log = build_logger("SchedStats")
+
+# APScheduler gives jobs scheduled without an id a random uuid4 hex
+_GENERATED_JOB_ID = re.compile(r'[0-9a-f]{32}')
+
+
+def _job_key(job):
+    """ Stats key of a job: the id it was scheduled with, or its name if APScheduler generated its id. A generated id
+    is different for each one-off job, so those are aggregated by the function they run instead. """
+    if job.id is None or _GENERATED_JOB_ID.fullmatch(job.id):
+        return job.name
+    return job.id
+
+
+class SchedulerStats:
+    """ Per-job timing stats, plus thread pool usage. Stats are keyed by job id, or by job name for jobs scheduled
+    without an id, so one-off jobs scheduled from the same function are aggregated together. """
+
+    def __init__(self, max_workers):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pool = {
+            "max_workers": max_workers,
+            "active": 0,
+            "max_active": 0,
+            "saturated_submits": 0,
+        }
+
+    def _job_locked(self, name):
+        if name not in self._jobs:
+            self._jobs[name] = {
+                "runs": 0,
+                "running": 0,
+                "errors": 0,
+                "misfires": 0,
+                "overlaps": 0,
+                "last_planned": None,
+                "last_start": None,
+                "start_delay_last_secs": None,
+                "start_delay_max_secs": 0.0,
+                "start_delay_total_secs": 0.0,
+                "duration_last_secs": None,
+                "duration_max_secs": 0.0,
+                "duration_total_secs": 0.0,
+            }
+        return self._jobs[name]
+
+    def on_job_submitted(self):
+        with self._lock:
+            if self._pool["active"] >= self._pool["max_workers"]:
+                # This job will need to wait for a free thread before it can start
+                self._pool["saturated_submits"] += 1
+            self._pool["active"] += 1
+            self._pool["max_active"] = max(self._pool["max_active"], self._pool["active"])
+
+    def on_job_start(self, name):
+        with self._lock:
+            self._job_locked(name)["running"] += 1
+
+    def on_job_end(self, name, planned, start, duration):
+        """ planned is the run time the job actually ran for, or None if all of its run times were missed and it
+        didn't run at all """
+        with self._lock:
+            job = self._job_locked(name)
+            job["running"] -= 1
+            if planned is None:
+                return
+            delay = max(0.0, (start - planned).total_seconds())
+            job["runs"] += 1
+            job["last_planned"] = planned
+            job["last_start"] = start
+            job["start_delay_last_secs"] = delay
+            job["start_delay_max_secs"] = max(job["start_delay_max_secs"], delay)
+            job["start_delay_total_secs"] += delay
+            job["duration_last_secs"] = duration
+            job["duration_max_secs"] = max(job["duration_max_secs"], duration)
+            job["duration_total_secs"] += duration
+
+    def on_job_done(self):
+        with self._lock:
+            self._pool["active"] -= 1
+
+    def on_sched_event(self, name, event_code):
+        with self._lock:
+            job = self._job_locked(name)
+            if event_code == EVENT_JOB_ERROR:
+                job["errors"] += 1
+            elif event_code == EVENT_JOB_MISSED:
+                job["misfires"] += 1
+            elif event_code == EVENT_JOB_MAX_INSTANCES:
+                job["overlaps"] += 1
+
+    def get_stats(self):
+        """ Returns a json-serializable snapshot of all stats """
+        with self._lock:
+            jobs = {}
+            for name, job in self._jobs.items():
+                stats = dict(job)
+                for k in ("last_planned", "last_start"):
+                    stats[k] = stats[k].isoformat() if stats[k] is not None else None
+                stats["start_delay_avg_secs"] = job["start_delay_total_secs"] / job["runs"] if job["runs"] else None
+                stats["duration_avg_secs"] = job["duration_total_secs"] / job["runs"] if job["runs"] else None
+                jobs[name] = stats
+            return {"pool": dict(self._pool), "jobs": jobs}
+
+
+class _InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """ Thread pool executor that reports job start time and duration to a SchedulerStats """
+
+    def __init__(self, stats, max_workers):
+        super().__init__(max_workers=max_workers)
+        self._stats = stats
+
+    def _do_submit_job(self, job, run_times):
+        def _timed_run_job(job, jobstore_alias, run_times, logger_name):
+            key = _job_key(job)
+            start = datetime.now(timezone.utc)
+            self._stats.on_job_start(key)
+            events = []
+            try:
+                events = run_job(job, jobstore_alias, run_times, logger_name)
+            finally:
+                # Missed run times are skipped without running the job, so they don't count as runs
+                ran = [ev for ev in events if ev.code != EVENT_JOB_MISSED]
+                planned = ran[0].scheduled_run_time if ran else None
+                self._stats.on_job_end(key, planned, start, (datetime.now(timezone.utc) - start).total_seconds())
+            # Count errors and misfires here, instead of in a scheduler listener: one-off jobs are gone from the
+            # scheduler by the time their events are dispatched, so their name wouldn't be known there
+            for ev in events:
+                self._stats.on_sched_event(key, ev.code)
+                if ev.code == EVENT_JOB_MISSED:
+                    log.warning("Job '%s' missed its run time %s", key, ev.scheduled_run_time)
+            return events
+
+        def callback(f):
+            self._stats.on_job_done()
+            exc, tb = (f.exception(), getattr(f.exception(), "__traceback__", None))
+            if exc:
+                self._run_job_error(job.id, exc, tb)
+            else:
+                self._run_job_success(job.id, f.result())
+
+        self._stats.on_job_submitted()
+        f = self._pool.submit(_timed_run_job, job, job._jobstore_alias, run_times, self._logger.name)
+        f.add_done_callback(callback)
+
+
+def build_instrumented_scheduler(max_workers=10):
+    """ Create a BackgroundScheduler that records timing stats for all of its jobs. Returns (scheduler, stats) """
+    stats = SchedulerStats(max_workers)
+    sched = BackgroundScheduler(executors={'default': _InstrumentedThreadPoolExecutor(stats, max_workers)})
+
+    def _on_overlap(ev):
+        # Only recurring jobs can overlap, so the job will still be known by the scheduler
+        job = sched.get_job(ev.job_id)
+        name = _job_key(job) if job is not None else ev.job_id
+        stats.on_sched_event(name, ev.code)
+        log.warning("Job '%s' is still running, skipped run planned for %s", name, ev.scheduled_run_times)
+
+    sched.add_listener(_on_overlap, EVENT_JOB_MAX_INSTANCES)
+    return sched, stats
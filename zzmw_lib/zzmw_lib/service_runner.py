@@ -9,8 +9,6 @@ import sys
 import threading
 import time
 
-from apscheduler.schedulers.background import BackgroundScheduler
-
 from flask import Flask
 from flask import send_from_directory, abort, redirect, url_for
 from werkzeug.serving import make_server, WSGIRequestHandler
@@ -19,7 +17,8 @@ from inotify_simple import INotify, flags
 from systemd.journal import JournalHandler
 
 from .zmw_mqtt_base import ZmwMqttBase
-from .logs import build_logger
+from .logs import build_logger, get_log_stats
+from .sched_stats import build_instrumented_scheduler
 from .network_helpers import get_lan_ip, get_cached_port, is_safe_path
 
 log = build_logger("ServiceRunner")
@@ -137,35 +136,101 @@ def _create_www_server(AppClass, cfg):
 
 
 def _get_config():
-    """ Will open config.json for this service. If the config file doesn't exist, returns an empty map. Will kill the
-    running service if the config changes, or if a new config file is created after the service has been started with
-    no config file, so the service will have a chance to reload. """
-    config_exists = os.path.exists('config.json')
-
-    if config_exists:
+    """ Will open config.json for this service. If the config file doesn't exist, returns an empty map. """
+    if os.path.exists('config.json'):
         with open('config.json', 'r') as fp:
-            cfg = json.loads(fp.read())
-    else:
-        log.info("Config file config.json not found, using empty config")
-        cfg = {}
-
-    def _reload_on_cfg_change():
-        inotify = INotify()
-        if config_exists:
-            inotify.add_watch("config.json", flags.MODIFY)
+            return json.loads(fp.read())
+    log.info("Config file config.json not found, using empty config")
+    return {}
+
+
+def _get_changed_cfg_keys(old_cfg, new_cfg):
+    """ Returns the set of top-level keys that were added, removed or modified between two configs """
+    missing = object()
+    return {k for k in set(old_cfg) | set(new_cfg) if old_cfg.get(k, missing) != new_cfg.get(k, missing)}
+
+
+def _restart_service(reason):
+    log.info("Config file config.json has changed (%s), will reload service (by shutting it down!)", reason)
+    os.kill(os.getpid(), signal.SIGTERM)
+    time.sleep(1)
+    log.critical("Sent SIGTERM, if you're seeing this something is broken...")
+
+
+def _apply_cfg_change(cfg, new_cfg, app, restart=_restart_service):
+    """ Apply new_cfg to a running app. If only keys declared by the app as hot-reloadable changed, the app is
+    notified and cfg is updated in place. If any other key changed, or the app fails to apply the change, the service
+    is restarted instead. """
+    changed = _get_changed_cfg_keys(cfg, new_cfg)
+    if len(changed) == 0:
+        log.debug("Config file config.json was touched, but nothing changed")
+        return
+
+    not_reloadable = changed - set(app.get_hot_reloadable_cfg_keys())
+    if len(not_reloadable) != 0:
+        restart(f"keys {sorted(not_reloadable)} can't be hot-reloaded")
+        return
+
+    log.info("Config keys %s changed, applying without restart", sorted(changed))
+    try:
+        app.on_cfg_hot_reload(new_cfg, changed)
+    except Exception:  # pylint: disable=broad-except
+        log.error("Service failed to hot-reload config", exc_info=True)
+        restart("hot-reload failed")
+        return
+
+    # Update in place, so services holding a reference to cfg see the new values. Other threads may be reading cfg,
+    # so keys are set and removed one at a time instead of clearing it: a key that didn't change is never missing.
+    for k in changed:
+        if k in new_cfg:
+            cfg[k] = new_cfg[k]
         else:
-            inotify.add_watch(".", flags.CREATE)
-        for ev in inotify.read():
-            if not config_exists and ev.name != "config.json":
-                continue
-            log.info("Config file config.json has changed, will reload service (by shutting it down!)")
-            os.kill(os.getpid(), signal.SIGTERM)
-            time.sleep(1)
-            log.critical("Sent SIGTERM, if you're seeing this something is broken...")
+            cfg.pop(k, None)
+
 
-    cfg_checker = threading.Thread(target=_reload_on_cfg_change, daemon=True)
+def _watch_config(cfg):
+    """ Watch config.json for changes (or for its creation, if the service was started without one). Watching starts
+    before the service is built, so that edits made during a slow startup aren't lost: they are held until the app is
+    known, and applied then (see _apply_cfg_change). Returns a function to call with the app once it's built. """
+    lock = threading.Lock()
+    state = {"app": None, "pending": False}
+
+    def _on_cfg_file_changed():
+        with lock:
+            if state["app"] is None:
+                log.info("Config file config.json changed during startup, will apply it once the service is up")
+                state["pending"] = True
+                return
+            state["pending"] = False
+            try:
+                with open('config.json', 'r') as fp:
+                    new_cfg = json.loads(fp.read())
+            except (OSError, json.JSONDecodeError) as ex:
+                # Likely a partial write, there should be another event once the writer is done
+                log.warning("Config file config.json changed but can't be loaded, ignoring: %s", ex)
+                return
+            _apply_cfg_change(cfg, new_cfg, state["app"])
+
+    def _set_app(app):
+        with lock:
+            state["app"] = app
+            pending = state["pending"]
+        if pending:
+            _on_cfg_file_changed()
+
+    def _watch_cfg(inotify):
+        while True:
+            for ev in inotify.read():
+                if ev.name == "config.json":
+                    _on_cfg_file_changed()
+
+    # Watch the service's run dir instead of the file itself: this catches a config file being created, and it
+    # keeps working when editors save by renaming a temp file over config.json
+    inotify = INotify()
+    inotify.add_watch(".", flags.CLOSE_WRITE | flags.MOVED_TO)
+    cfg_checker = threading.Thread(target=_watch_cfg, args=(inotify,), daemon=True)
     cfg_checker.start()
-    return cfg
+    return _set_app
 
 
 def get_this_service_logs():
@@ -212,7 +277,9 @@ def service_runner(AppClass):
 
     Loads config.json, sets up Flask server with www directory serving,
     instantiates the service class with Flask app, and runs both with
-    proper signal handling for graceful shutdown.
+    proper signal handling for graceful shutdown. Config changes are applied
+    live if the service declares them hot-reloadable (see
+    ZmwMqttBase.get_hot_reloadable_cfg_keys), otherwise the service restarts.
 
     Args:
         AppClass: Service class to instantiate. Must have __init__(cfg, www)
@@ -225,6 +292,7 @@ def service_runner(AppClass):
     runs the service's loop_forever().
     """
     cfg = _get_config()
+    set_cfg_watcher_app = _watch_config(cfg)
     flaskapp, wwwserver = _create_www_server(AppClass, cfg)
 
     def serve_url(url_path, view_func, methods=['GET']):
@@ -280,6 +348,8 @@ def service_runner(AppClass):
     # Add an endpoint to retrieve logs for this service
     flaskapp.serve_url('/svc_logs', get_this_service_logs)
     flaskapp.serve_url('/svc_logs.html', lambda: send_from_directory(_lib_www_path, 'svc_logs.html'))
+    # Counters for the async logging pipeline (dropped or rate-limited records)
+    flaskapp.serve_url('/svc_log_stats', get_log_stats)
     # Add endpoints for common www things
     flaskapp.serve_url('/zmw.css', lambda: send_from_directory(_lib_www_path, 'build/zmw.css'))
     flaskapp.serve_url('/zmw.js', lambda: send_from_directory(_lib_www_path, 'build/zmw.js'))
@@ -292,8 +362,10 @@ def service_runner(AppClass):
     # Create a global scheduler: I've found problems with using too many schedulers, and because this needs to be a
     # reliable mechanism to schedule things (otherwise the service is broken) we'll try to minimize issues that may
     # happen due to concurrency bugs between BG schedulers.
-    global_bg_svc_sheduler = BackgroundScheduler()
+    # The scheduler is instrumented, to find jobs that overrun, misfire or starve other jobs.
+    global_bg_svc_sheduler, sched_stats = build_instrumented_scheduler()
     global_bg_svc_sheduler.start()
+    flaskapp.serve_url('/svc_sched_stats', sched_stats.get_stats)
 
     app = AppClass(cfg, flaskapp, global_bg_svc_sheduler)
 
@@ -311,6 +383,8 @@ def service_runner(AppClass):
 
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    # Config changes made while the app was starting are applied now, a restart will go through signal_handler
+    set_cfg_watcher_app(app)
     if flaskapp.startup_automatically:
         # User may override this when the app is instanciated
         flaskapp.setup_complete()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# Add the zzmw_lib package root to sys.path so tests can import modules
+# tests/ is at zzmw_lib/zzmw_lib/tests/
+zmw_lib_root = Path(__file__).parent.parent.parent  # zzmw_lib/
+sys.path.insert(0, str(zmw_lib_root))
@@ -0,0 +1,62 @@
+"""Unit tests for event_journal.py"""
+import pytest
+
+from zzmw_lib.event_journal import EventJournal
+
+
+class TestEventJournal:
+    """Test EventJournal class"""
+
+    def test_empty_journal(self, tmp_path):
+        journal = EventJournal(str(tmp_path / "j.jsonl"), max_records=5)
+        assert len(journal) == 0
+        assert journal.tail() == []
+        assert journal.tail(3) == []
+
+    def test_rejects_bad_retention(self, tmp_path):
+        with pytest.raises(ValueError):
+            EventJournal(str(tmp_path / "j.jsonl"), max_records=0)
+
+    def test_append_and_tail(self, tmp_path):
+        journal = EventJournal(str(tmp_path / "j.jsonl"), max_records=5)
+        for i in range(3):
+            journal.append({"i": i})
+        assert len(journal) == 3
+        assert journal.tail() == [{"i": 0}, {"i": 1}, {"i": 2}]
+        assert journal.tail(2) == [{"i": 1}, {"i": 2}]
+        assert journal.replay() == journal.tail()
+
+    def test_reopen_restores_records(self, tmp_path):
+        path = str(tmp_path / "j.jsonl")
+        journal = EventJournal(path, max_records=5)
+        journal.append({"i": 1})
+        journal.append({"i": 2})
+        journal.close()
+        assert EventJournal(path, max_records=5).tail() == [{"i": 1}, {"i": 2}]
+
+    def test_retention_and_compaction(self, tmp_path):
+        path = tmp_path / "j.jsonl"
+        journal = EventJournal(str(path), max_records=3, compact_slack=2)
+        for i in range(6):
+            journal.append({"i": i})
+        # 6 > 3 + 2, so the journal was compacted down to the newest 3
+        assert len(path.read_text().splitlines()) == 3
+        assert journal.tail() == [{"i": 3}, {"i": 4}, {"i": 5}]
+        journal.append({"i": 6})
+        assert len(journal) == 3
+        assert journal.tail() == [{"i": 4}, {"i": 5}, {"i": 6}]
+
+    def test_tail_across_read_blocks(self, tmp_path):
+        journal = EventJournal(str(tmp_path / "j.jsonl"), max_records=500)
+        for i in range(500):
+            journal.append({"i": i, "pad": "x" * 50})
+        tail = journal.tail(200)
+        assert [r["i"] for r in tail] == list(range(300, 500))
+
+    def test_partial_record_is_dropped(self, tmp_path):
+        path = tmp_path / "j.jsonl"
+        path.write_text('{"i": 1}\n{"i": 2}\n{"i": 3')
+        journal = EventJournal(str(path), max_records=5)
+        assert journal.tail() == [{"i": 1}, {"i": 2}]
+        journal.append({"i": 4})
+        assert journal.tail() == [{"i": 1}, {"i": 2}, {"i": 4}]
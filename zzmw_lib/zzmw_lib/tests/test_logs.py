@@ -0,0 +1,73 @@
+"""Unit tests for logs.py"""
+import logging
+import queue
+from unittest.mock import patch
+
+from zzmw_lib import logs
+from zzmw_lib.logs import _AsyncQueueHandler, _RateLimitFilter, get_log_stats
+
+
+def _mk_record(msg="hello %s", args=("world",), lvl=logging.INFO, lineno=1):
+    return logging.LogRecord("test", lvl, "/some/file.py", lineno, msg, args, None)
+
+
+class TestRateLimitFilter:
+    """Test _RateLimitFilter class"""
+
+    def test_allows_burst_then_suppresses(self):
+        flt = _RateLimitFilter(window_secs=10, burst=3)
+        before = get_log_stats()["suppressed_rate_limit"]
+        results = [flt.filter(_mk_record()) for _ in range(5)]
+        assert results == [True, True, True, False, False]
+        assert get_log_stats()["suppressed_rate_limit"] == before + 2
+
+    def test_call_sites_are_independent(self):
+        flt = _RateLimitFilter(window_secs=10, burst=1)
+        assert flt.filter(_mk_record(lineno=1))
+        assert not flt.filter(_mk_record(lineno=1))
+        assert flt.filter(_mk_record(lineno=2))
+
+    def test_warnings_are_never_suppressed(self):
+        flt = _RateLimitFilter(window_secs=10, burst=1)
+        assert all(flt.filter(_mk_record(lvl=logging.ERROR)) for _ in range(10))
+
+    def test_new_window_reports_suppressed_count(self):
+        flt = _RateLimitFilter(window_secs=10, burst=1)
+        with patch('zzmw_lib.logs.time') as mock_time:
+            mock_time.monotonic.return_value = 100
+            flt.filter(_mk_record())
+            flt.filter(_mk_record())
+            flt.filter(_mk_record())
+            mock_time.monotonic.return_value = 111
+            rec = _mk_record()
+            assert flt.filter(rec)
+        assert rec.getMessage() == "hello world [2 similar messages suppressed]"
+
+
+class TestAsyncQueueHandler:
+    """Test _AsyncQueueHandler class"""
+
+    def test_immutable_args_are_formatted_later(self):
+        handler = _AsyncQueueHandler(queue.Queue())
+        rec = handler.prepare(_mk_record("%s %d", ("a", 1)))
+        assert rec.args == ("a", 1)
+        assert rec.getMessage() == "a 1"
+
+    def test_mutable_args_are_formatted_now(self):
+        handler = _AsyncQueueHandler(queue.Queue())
+        state = {"a": 1}
+        rec = handler.prepare(_mk_record("state %s", (state,)))
+        state["a"] = 2
+        assert rec.getMessage() == "state {'a': 1}"
+
+    def test_full_queue_drops_and_counts(self):
+        handler = _AsyncQueueHandler(queue.Queue(maxsize=1))
+        before = get_log_stats()["dropped_queue_full"]
+        handler.emit(_mk_record())
+        handler.emit(_mk_record())
+        assert get_log_stats()["dropped_queue_full"] == before + 1
+
+    def test_build_logger_writes_through_queue(self):
+        log = logs.build_logger("TestAsyncLogger")
+        assert len(log.handlers) == 1
+        assert isinstance(log.handlers[0], _AsyncQueueHandler)
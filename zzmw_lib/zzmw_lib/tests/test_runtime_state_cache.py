@@ -0,0 +1,95 @@
+"""Unit tests for runtime_state_cache.py"""
+import json
+import os
+import time
+
+import pytest
+
+from zzmw_lib.runtime_state_cache import RuntimeStateCache
+
+
+class TestRuntimeStateCache:
+    """Test RuntimeStateCache class"""
+
+    def _mk_cache(self, tmp_path, delay=60):
+        return RuntimeStateCache(path=str(tmp_path / "cache.json"), flush_delay_secs=delay)
+
+    def test_missing_file_returns_none(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        assert cache.get("foo") is None
+
+    def test_loads_existing_file(self, tmp_path):
+        (tmp_path / "cache.json").write_text(json.dumps({"foo": [1, 2]}))
+        cache = self._mk_cache(tmp_path)
+        assert cache.get("foo") == [1, 2]
+
+    def test_corrupt_file_is_ignored(self, tmp_path):
+        (tmp_path / "cache.json").write_text("{not json")
+        cache = self._mk_cache(tmp_path)
+        assert cache.get("foo") is None
+        cache.set("foo", 1)
+        cache.flush()
+        assert json.loads((tmp_path / "cache.json").read_text())["foo"] == 1
+
+    def test_reads_are_served_from_memory(self, tmp_path):
+        (tmp_path / "cache.json").write_text(json.dumps({"foo": 1}))
+        cache = self._mk_cache(tmp_path)
+        assert cache.get("foo") == 1
+        os.remove(tmp_path / "cache.json")
+        assert cache.get("foo") == 1
+
+    def test_set_is_not_written_until_flush(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        cache.set("foo", {"a": 1})
+        assert cache.get("foo") == {"a": 1}
+        assert not (tmp_path / "cache.json").exists()
+        cache.flush()
+        assert json.loads((tmp_path / "cache.json").read_text())["foo"] == {"a": 1}
+        assert not (tmp_path / "cache.json.tmp").exists()
+
+    def test_values_are_copied(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        val = {"a": [1]}
+        cache.set("foo", val)
+        val["a"].append(2)
+        assert cache.get("foo") == {"a": [1]}
+        cache.get("foo")["a"].append(3)
+        assert cache.get("foo") == {"a": [1]}
+
+    def test_namespaces_are_isolated(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        cache.set("foo", 1)
+        cache.set("foo", 2, namespace="svc_a")
+        cache.set("foo", 3, namespace="svc_b")
+        assert cache.get("foo") == 1
+        assert cache.get("foo", namespace="svc_a") == 2
+        assert cache.get("foo", namespace="svc_b") == 3
+        assert cache.get("foo", namespace="svc_c") is None
+
+        cache.flush()
+        reloaded = self._mk_cache(tmp_path)
+        assert reloaded.get("foo", namespace="svc_a") == 2
+
+    def test_debounced_write_happens_in_background(self, tmp_path):
+        cache = self._mk_cache(tmp_path, delay=0.05)
+        cache.set("foo", 1)
+        cache.set("foo", 2)
+        for _ in range(200):
+            if (tmp_path / "cache.json").exists():
+                break
+            time.sleep(0.01)
+        assert json.loads((tmp_path / "cache.json").read_text())["foo"] == 2
+
+    def test_flush_without_changes_doesnt_write(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        cache.flush()
+        assert not (tmp_path / "cache.json").exists()
+
+    def test_non_serializable_value_is_rejected(self, tmp_path):
+        cache = self._mk_cache(tmp_path)
+        cache.set("good", 1)
+        with pytest.raises(TypeError):
+            cache.set("bad", {"a": object()})
+        assert cache.get("bad") is None
+        cache.flush()
+        assert json.loads((tmp_path / "cache.json").read_text())["good"] == 1
@@ -0,0 +1,84 @@
+"""Unit tests for sched_stats.py"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from zzmw_lib.sched_stats import build_instrumented_scheduler
+
+
+def _wait_for(cond, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestSchedStats:
+    """Test the instrumented scheduler"""
+
+    def setup_method(self):
+        self.sched, self.stats = build_instrumented_scheduler(max_workers=2)
+        self.sched.start()
+
+    def teardown_method(self):
+        self.sched.shutdown(wait=False)
+
+    def _job_stats(self, name):
+        return self.stats.get_stats()["jobs"].get(name)
+
+    def test_records_run_duration_and_delay(self):
+        def slow_job():
+            time.sleep(0.05)
+        self.sched.add_job(slow_job, trigger='date', run_date=datetime.now() + timedelta(milliseconds=10))
+        name = slow_job.__qualname__
+        assert _wait_for(lambda: (self._job_stats(name) or {}).get("runs") == 1)
+        stats = self._job_stats(name)
+        assert stats["duration_last_secs"] >= 0.05
+        assert stats["start_delay_last_secs"] >= 0
+        assert stats["last_planned"] is not None
+        assert stats["errors"] == 0
+        assert _wait_for(lambda: self.stats.get_stats()["pool"]["active"] == 0)
+
+    def test_counts_errors(self):
+        def failing_job():
+            raise RuntimeError("boom")
+        self.sched.add_job(failing_job, trigger='date', run_date=datetime.now())
+        name = failing_job.__qualname__
+        assert _wait_for(lambda: (self._job_stats(name) or {}).get("errors") == 1)
+
+    def test_counts_overlaps_and_saturation(self):
+        release = threading.Event()
+        def blocking_job():
+            release.wait(5)
+        self.sched.add_job(blocking_job, trigger='interval', seconds=0.05, id='blocker')
+        self.sched.add_job(blocking_job, trigger='interval', seconds=0.05, id='blocker2')
+        self.sched.add_job(blocking_job, trigger='interval', seconds=0.05, id='blocker3')
+        try:
+            assert _wait_for(lambda: (self._job_stats('blocker') or {}).get("overlaps", 0) > 0)
+            assert _wait_for(lambda: self.stats.get_stats()["pool"]["saturated_submits"] > 0)
+        finally:
+            release.set()
+
+    def test_keyed_by_job_id_when_given(self):
+        self.sched.add_job(lambda: None, trigger='date', run_date=datetime.now(), id='named_lambda')
+        def unnamed_job():
+            pass
+        self.sched.add_job(unnamed_job, trigger='date', run_date=datetime.now())
+        self.sched.add_job(unnamed_job, trigger='date', run_date=datetime.now())
+        assert _wait_for(lambda: (self._job_stats('named_lambda') or {}).get("runs") == 1)
+        # Jobs without an id are aggregated by name, not by their generated id
+        assert _wait_for(lambda: (self._job_stats(unnamed_job.__qualname__) or {}).get("runs") == 2)
+        assert set(self.stats.get_stats()["jobs"]) == {'named_lambda', unnamed_job.__qualname__}
+
+    def test_missed_run_is_not_a_run(self):
+        def late_job():
+            pass
+        self.sched.add_job(late_job, trigger='date', run_date=datetime.now(timezone.utc) - timedelta(minutes=1),
+                           id='late_job', misfire_grace_time=1)
+        assert _wait_for(lambda: (self._job_stats('late_job') or {}).get("misfires") == 1)
+        stats = self._job_stats('late_job')
+        assert stats["runs"] == 0
+        assert stats["running"] == 0
+        assert stats["duration_avg_secs"] is None
@@ -0,0 +1,122 @@
+"""Unit tests for the config hot-reload logic of service_runner.py"""
+import json
+import time
+from unittest.mock import MagicMock
+
+from zzmw_lib.service_runner import _apply_cfg_change, _get_changed_cfg_keys, _watch_config
+
+
+def _wait_for(cond, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeApp:
+    """The subset of ZmwMqttBase used to hot-reload config"""
+
+    def __init__(self, reloadable, fail=False):
+        self._reloadable = reloadable
+        self._fail = fail
+        self.reloads = []
+
+    def get_hot_reloadable_cfg_keys(self):
+        return self._reloadable
+
+    def on_cfg_hot_reload(self, new_cfg, changed_keys):
+        if self._fail:
+            raise RuntimeError("Can't apply")
+        self.reloads.append((new_cfg, changed_keys))
+
+
+class TestGetChangedCfgKeys:
+    """Test the config diff"""
+
+    def test_no_changes(self):
+        assert _get_changed_cfg_keys({'a': 1, 'b': {'c': 2}}, {'a': 1, 'b': {'c': 2}}) == set()
+
+    def test_added_removed_and_modified(self):
+        old = {'same': 1, 'removed': 2, 'modified': {'x': 1}}
+        new = {'same': 1, 'added': 3, 'modified': {'x': 2}}
+        assert _get_changed_cfg_keys(old, new) == {'removed', 'added', 'modified'}
+
+    def test_key_set_to_none_is_a_change(self):
+        assert _get_changed_cfg_keys({}, {'a': None}) == {'a'}
+        assert _get_changed_cfg_keys({'a': None}, {}) == {'a'}
+
+
+class TestApplyCfgChange:
+    """Test the choice between hot-reloading and restarting"""
+
+    def test_only_reloadable_keys_changed(self):
+        cfg = {'fixed': 1, 'level': 'info', 'gone': True}
+        app = FakeApp(reloadable=['level', 'gone'])
+        restart = MagicMock()
+        _apply_cfg_change(cfg, {'fixed': 1, 'level': 'debug'}, app, restart)
+        restart.assert_not_called()
+        assert app.reloads == [({'fixed': 1, 'level': 'debug'}, {'level', 'gone'})]
+        assert cfg == {'fixed': 1, 'level': 'debug'}
+
+    def test_cfg_is_updated_in_place(self):
+        cfg = {'level': 'info'}
+        held = cfg
+        _apply_cfg_change(cfg, {'level': 'debug'}, FakeApp(reloadable=['level']), MagicMock())
+        assert held['level'] == 'debug'
+
+    def test_non_reloadable_key_restarts(self):
+        cfg = {'fixed': 1, 'level': 'info'}
+        app = FakeApp(reloadable=['level'])
+        restart = MagicMock()
+        _apply_cfg_change(cfg, {'fixed': 2, 'level': 'debug'}, app, restart)
+        restart.assert_called_once()
+        assert app.reloads == []
+        assert cfg == {'fixed': 1, 'level': 'info'}
+
+    def test_failed_hot_reload_restarts(self):
+        cfg = {'level': 'info'}
+        restart = MagicMock()
+        _apply_cfg_change(cfg, {'level': 'debug'}, FakeApp(reloadable=['level'], fail=True), restart)
+        restart.assert_called_once()
+        assert cfg == {'level': 'info'}
+
+    def test_nothing_changed(self):
+        app = FakeApp(reloadable=[])
+        restart = MagicMock()
+        _apply_cfg_change({'a': 1}, {'a': 1}, app, restart)
+        restart.assert_not_called()
+        assert app.reloads == []
+
+
+class TestWatchConfig:
+    """Test config changes are picked up, including those made before the app exists"""
+
+    def _write_cfg(self, tmp_path, cfg):
+        (tmp_path / 'config.json').write_text(json.dumps(cfg))
+
+    def test_change_during_startup_is_applied_once_app_is_set(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self._write_cfg(tmp_path, {'level': 'info'})
+        cfg = {'level': 'info'}
+        set_app = _watch_config(cfg)
+
+        # The app is still starting: nothing to apply the change to yet
+        self._write_cfg(tmp_path, {'level': 'debug'})
+        time.sleep(0.1)
+        assert cfg == {'level': 'info'}
+
+        app = FakeApp(reloadable=['level'])
+        set_app(app)
+        assert _wait_for(lambda: cfg == {'level': 'debug'})
+        assert app.reloads == [({'level': 'debug'}, {'level'})]
+
+    def test_change_after_startup(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        cfg = {}
+        set_app = _watch_config(cfg)
+        app = FakeApp(reloadable=['level'])
+        set_app(app)
+        self._write_cfg(tmp_path, {'level': 'debug'})
+        assert _wait_for(lambda: cfg == {'level': 'debug'})
@@ -68,6 +68,16 @@ class ZmwMqttBase(ABC):
         if self.bg_thread:
             self.bg_thread.join()
 
+    def get_hot_reloadable_cfg_keys(self):
+        """ Top-level config keys this service can apply without a restart. When config.json changes and only these
+        keys are affected, the service_runner will call on_cfg_hot_reload instead of restarting the service. """
+        return []
+
+    def on_cfg_hot_reload(self, new_cfg, changed_keys):
+        """ Called from the config watcher thread when only hot-reloadable keys changed. Raising an exception will
+        make the service_runner fall back to restarting the service. """
+        pass
+
     def broadcast(self, topic, msg):
         """ JSONises and broadcasts a message to MQTT """
         def _serialize(obj):